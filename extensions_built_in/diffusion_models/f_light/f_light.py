@@ -12,6 +12,7 @@ from toolkit.prompt_utils import PromptEmbeds
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
 from toolkit.dequantize import patch_dequantization_on_save
 from toolkit.accelerator import unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from optimum.quanto import freeze, QTensor
 from toolkit.util.quantize import quantize, get_qtype
 from transformers import T5TokenizerFast, T5EncoderModel
@@ -255,9 +256,10 @@ class FLiteModel(BaseModel):
         # diffusers
         # only save the unet
         transformer: DiT = unwrap_model(self.transformer)
-        transformer.save_pretrained(
+        save_pretrained_streaming(
+            transformer,
             save_directory=os.path.join(output_path, 'dit_model'),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
         # save out meta config
         meta_path = os.path.join(output_path, 'aitk_meta.yaml')
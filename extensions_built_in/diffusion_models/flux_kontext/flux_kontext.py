@@ -15,6 +15,7 @@ from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscre
 from toolkit.models.flux import add_model_gpu_splitter_to_flux, bypass_flux_guidance, restore_flux_guidance
 from toolkit.dequantize import patch_dequantization_on_save
 from toolkit.accelerator import get_accelerator, unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from optimum.quanto import freeze, QTensor
 from toolkit.util.mask import generate_random_mask, random_dialate_mask
 from toolkit.util.quantize import quantize, get_qtype
@@ -377,9 +378,10 @@ class FluxKontextModel(BaseModel):
     def save_model(self, output_path, meta, save_dtype):
         # only save the unet
         transformer: FluxTransformer2DModel = unwrap_model(self.model)
-        transformer.save_pretrained(
+        save_pretrained_streaming(
+            transformer,
             save_directory=os.path.join(output_path, 'transformer'),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
 
         meta_path = os.path.join(output_path, 'aitk_meta.yaml')
@@ -12,6 +12,7 @@ from toolkit.samplers.custom_flowmatch_sampler import (
     CustomFlowMatchEulerDiscreteScheduler,
 )
 from toolkit.accelerator import unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from optimum.quanto import freeze
 from toolkit.util.quantize import quantize, get_qtype
 from .src.pipelines.omnigen2.pipeline_omnigen2 import OmniGen2Pipeline
@@ -321,9 +322,10 @@ class OmniGen2Model(BaseModel):
     def save_model(self, output_path, meta, save_dtype):
         # only save the transformer
         transformer: OmniGen2Transformer2DModel = unwrap_model(self.model)
-        transformer.save_pretrained(
+        save_pretrained_streaming(
+            transformer,
             save_directory=os.path.join(output_path, "transformer"),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
 
         meta_path = os.path.join(output_path, "aitk_meta.yaml")
@@ -1,4 +1,5 @@
 import os
+from functools import partial
 from typing import TYPE_CHECKING, List, Optional
 
 import torch
@@ -13,8 +14,11 @@ from toolkit.samplers.custom_flowmatch_sampler import (
     CustomFlowMatchEulerDiscreteScheduler,
 )
 from toolkit.accelerator import get_accelerator, unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from optimum.quanto import freeze, QTensor
-from toolkit.util.quantize import quantize, get_qtype, quantize_model
+from toolkit.util.quantize import quantize, get_qtype, quantize_model, quantize_block, load_quantized_model
+from toolkit.util.lazy_load import load_pretrained_lazily
+from toolkit.util.quantize_cache import get_quantize_cache
 import torch.nn.functional as F
 from toolkit.memory_management import MemoryManager
 from safetensors.torch import load_file
@@ -92,41 +96,75 @@ class QwenImageModel(BaseModel):
             # use the repo for extras
             base_model_path = "Qwen/Qwen-Image"
 
-        self.print_and_status_update("Loading transformer")
+        # check if the path is a full checkpoint.
+        te_folder_path = os.path.join(model_path, "text_encoder")
+        # if we have the te, this folder is a full checkpoint, use it as the base
+        if not model_path.endswith(".safetensors") and os.path.exists(te_folder_path):
+            base_model_path = model_path
 
-        if model_path.endswith(".safetensors"):
-            # load the safetensors file
-            transformer = QwenImageTransformer2DModel.from_single_file(
-                model_path,
-                config="Qwen/Qwen-Image",
-                subfolder="transformer",
-                torch_dtype=model_dtype,
-            )
-            transformer.to(model_dtype)
-
-        else:
-            transformer_path = model_path
-            transformer_subfolder = "transformer"
-            if os.path.exists(transformer_path):
-                transformer_subfolder = None
-                transformer_path = os.path.join(transformer_path, "transformer")
-                # check if the path is a full checkpoint.
-                te_folder_path = os.path.join(model_path, "text_encoder")
-                # if we have the te, this folder is a full checkpoint, use it as the base
-                if os.path.exists(te_folder_path):
-                    base_model_path = model_path
-
-            transformer = QwenImageTransformer2DModel.from_pretrained(
-                transformer_path, subfolder=transformer_subfolder, torch_dtype=dtype
-            )
+        self.print_and_status_update("Loading transformer")
 
+        transformer = None
+        quantize_cache = None
         if self.model_config.quantize:
-            self.print_and_status_update("Quantizing Transformer")
-            quantize_model(self, transformer)
-            flush()
+            quantize_cache = get_quantize_cache(self, model_path, QwenImageTransformer2DModel)
+            transformer = load_quantized_model(self, quantize_cache)
+
+        if transformer is None:
+            blocks_quantized = False
+            if model_path.endswith(".safetensors"):
+                # load the safetensors file
+                transformer = QwenImageTransformer2DModel.from_single_file(
+                    model_path,
+                    config="Qwen/Qwen-Image",
+                    subfolder="transformer",
+                    torch_dtype=model_dtype,
+                )
+                transformer.to(model_dtype)
+
+            else:
+                transformer_path = model_path
+                transformer_subfolder = "transformer"
+                if os.path.exists(transformer_path):
+                    transformer_subfolder = None
+                    transformer_path = os.path.join(transformer_path, "transformer")
+
+                if self.model_config.lazy_load:
+                    # quantize the blocks as they are loaded, the adapter needs the whole model first
+                    blocks_quantized = self.model_config.quantize and self.model_config.accuracy_recovery_adapter is None
+                    process_block = None
+                    if blocks_quantized:
+                        process_block = partial(
+                            quantize_block,
+                            weights=get_qtype(self.model_config.qtype),
+                            device=self.device_torch,
+                            dtype=dtype,
+                        )
+                    transformer = load_pretrained_lazily(
+                        QwenImageTransformer2DModel,
+                        transformer_path,
+                        transformer_subfolder,
+                        dtype,
+                        block_names=self.get_transformer_block_names(),
+                        process_block=process_block,
+                    )
+
+                if transformer is None:
+                    blocks_quantized = False
+                    transformer = QwenImageTransformer2DModel.from_pretrained(
+                        transformer_path, subfolder=transformer_subfolder, torch_dtype=dtype
+                    )
+
+            if self.model_config.quantize:
+                self.print_and_status_update("Quantizing Transformer")
+                quantize_model(self, transformer, cache=quantize_cache, blocks_quantized=blocks_quantized)
+                flush()
 
         if self.model_config.auto_memory:
-            MemoryManager.attach(transformer, self.device_torch)
+            MemoryManager.attach(
+                transformer, self.device_torch, budget_gb=self.model_config.auto_memory_budget,
+                prefetch_depth=self.model_config.auto_memory_prefetch,
+            )
 
         if self.model_config.low_vram:
             self.print_and_status_update("Moving transformer to CPU")
@@ -148,7 +186,10 @@ class QwenImageModel(BaseModel):
             text_encoder.model.visual = None
 
         if self.model_config.auto_memory:
-            MemoryManager.attach(text_encoder, self.device_torch)
+            MemoryManager.attach(
+                text_encoder, self.device_torch, budget_gb=self.model_config.auto_memory_budget_te,
+                prefetch_depth=self.model_config.auto_memory_prefetch,
+            )
 
         text_encoder.to(self.device_torch, dtype=dtype)
         flush()
@@ -365,9 +406,10 @@ class QwenImageModel(BaseModel):
     def save_model(self, output_path, meta, save_dtype):
         # only save the unet
         transformer: QwenImageTransformer2DModel = unwrap_model(self.model)
-        transformer.save_pretrained(
+        save_pretrained_streaming(
+            transformer,
             save_directory=os.path.join(output_path, "transformer"),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
 
         meta_path = os.path.join(output_path, "aitk_meta.yaml")
@@ -5,6 +5,7 @@ from typing_extensions import Self
 import torch
 import yaml
 from toolkit.accelerator import unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from toolkit.basic import flush
 from toolkit.models.wan21.wan_utils import add_first_frame_conditioning
 from toolkit.prompt_utils import PromptEmbeds
@@ -419,13 +420,15 @@ class Wan2214bModel(Wan21):
 
     def save_model(self, output_path, meta, save_dtype):
         transformer_combo: DualWanTransformer3DModel = unwrap_model(self.model)
-        transformer_combo.transformer_1.save_pretrained(
+        save_pretrained_streaming(
+            transformer_combo.transformer_1,
             save_directory=os.path.join(output_path, "transformer"),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
-        transformer_combo.transformer_2.save_pretrained(
+        save_pretrained_streaming(
+            transformer_combo.transformer_2,
             save_directory=os.path.join(output_path, "transformer_2"),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
 
         meta_path = os.path.join(output_path, "aitk_meta.yaml")
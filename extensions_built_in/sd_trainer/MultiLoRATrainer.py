@@ -0,0 +1,280 @@
+import copy
+import inspect
+import os
+from collections import OrderedDict
+from typing import List, Union
+
+import torch
+
+from extensions_built_in.sd_trainer.SDTrainer import SDTrainer
+from toolkit.config_modules import DatasetConfig, LoRASlotConfig, NetworkConfig, preprocess_dataset_raw_config
+from toolkit.data_loader import get_dataloader_from_datasets
+from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+from toolkit.metadata import get_meta_for_safetensors
+from toolkit.multi_lora import LoRASlot, clear_batch_routing, combine_batches, get_routing_masks, \
+    route_to_network, set_batch_routing
+from toolkit.optimizer import get_optimizer
+from toolkit.print import print_acc
+from toolkit.scheduler import get_lr_scheduler
+from toolkit.train_tools import get_torch_dtype
+
+
+class MultiLoRATrainer(SDTrainer):
+    """
+    Trains the LoRA of the process plus every LoRA listed under loras on one shared frozen base model.
+    Each step takes a batch from every LoRA's datasets and runs them through the model together, with
+    each network routed to its own samples. Every LoRA keeps its own optimizer, save schedule and folder.
+    """
+
+    def __init__(self, process_id: int, job, config: OrderedDict, **kwargs):
+        super(MultiLoRATrainer, self).__init__(process_id, job, config, **kwargs)
+        if self.network_config is None:
+            raise ValueError("The multi lora trainer needs a network config")
+        self.slot_configs: List[LoRASlotConfig] = [LoRASlotConfig(**x) for x in self.get_conf('loras', [])]
+        names = [self.job.name] + [x.name for x in self.slot_configs]
+        if len(set(names)) != len(names):
+            raise ValueError("Every LoRA needs a unique name")
+        # concatenate the batches of all the LoRAs into one forward when their sizes match
+        self.combine_batches = self.get_conf('combine_batches', True)
+
+        self.slot_datasets: List[List[DatasetConfig]] = []
+        for slot_config in self.slot_configs:
+            raw_datasets = preprocess_dataset_raw_config(copy.deepcopy(slot_config.datasets))
+            datasets = []
+            for raw_dataset in raw_datasets:
+                if self.train_config.cache_text_embeddings:
+                    raw_dataset['cache_text_embeddings'] = True
+                dataset = DatasetConfig(**raw_dataset)
+                if dataset.trigger_word is None:
+                    dataset.trigger_word = slot_config.trigger_word
+                if dataset.is_reg:
+                    raise ValueError(f"Reg datasets are only supported on the main datasets, not on {slot_config.name}")
+                # the model is loaded and the text encoder unloaded based on the main datasets
+                is_caching = dataset.cache_latents or dataset.cache_latents_to_disk
+                if self.is_latents_cached and not is_caching:
+                    raise ValueError(
+                        f"The main datasets cache latents so the datasets of {slot_config.name} have to as well"
+                    )
+                if self.is_caching_text_embeddings and not dataset.cache_text_embeddings:
+                    raise ValueError(
+                        f"The main datasets cache text embeddings so the datasets of {slot_config.name} have to as well"
+                    )
+                datasets.append(dataset)
+            self.slot_datasets.append(datasets)
+
+        self.slots: List[LoRASlot] = []
+
+    @property
+    def all_networks(self):
+        return [self.network] + [slot.network for slot in self.slots]
+
+    def setup_slot(self, slot_config: LoRASlotConfig, datasets: List[DatasetConfig]) -> LoRASlot:
+        network_config_dict = copy.deepcopy(self.get_conf('network', {}))
+        network_config_dict.update(slot_config.network)
+        network_config = NetworkConfig(**network_config_dict)
+        if network_config.type.lower() == 'lorm':
+            raise ValueError("LoRM is not supported by the multi lora trainer")
+        text_encoder = self.sd.text_encoder
+        unet = self.sd.unet
+
+        network = self.create_network(network_config, text_encoder)
+        network.force_to(self.device_torch, dtype=torch.float32)
+        network._update_torch_multiplier()
+        # applied on top of the main network, each layer calls the next network down the chain
+        network.apply_to(
+            text_encoder,
+            unet,
+            self.train_config.train_text_encoder,
+            self.train_config.train_unet
+        )
+        network.prepare_grad_etc(text_encoder, unet)
+        # merging in for sampling does not know about routing
+        network.can_merge_in = False
+
+        slot = LoRASlot(slot_config, network_config, network, os.path.join(self.training_folder, slot_config.name))
+
+        lr = slot_config.lr if slot_config.lr is not None else self.train_config.lr
+        config = {
+            'text_encoder_lr': lr,
+            'unet_lr': lr,
+        }
+        sig = inspect.signature(network.prepare_optimizer_params)
+        if 'default_lr' in sig.parameters:
+            config['default_lr'] = lr
+        if 'learning_rate' in sig.parameters:
+            config['learning_rate'] = lr
+        slot.params = network.prepare_optimizer_params(**config)
+        if self.train_config.gradient_checkpointing:
+            network.enable_gradient_checkpointing()
+
+        latest_save_path = self.get_slot_latest_save_path(slot)
+        if latest_save_path is not None:
+            print_acc(f"Loading {slot.name} from {latest_save_path}")
+            network.load_weights(latest_save_path)
+            network.multiplier = 1.0
+
+        for param in slot.get_trainable_params():
+            param.requires_grad_(True)
+        slot.optimizer = get_optimizer(
+            slot.params,
+            self.train_config.optimizer.lower(),
+            learning_rate=lr,
+            optimizer_params=self.train_config.optimizer_params
+        )
+        self.load_optimizer(slot.optimizer, slot.save_root, network)
+
+        lr_scheduler_params = copy.deepcopy(self.train_config.lr_scheduler_params)
+        if 'total_iters' not in lr_scheduler_params:
+            lr_scheduler_params['total_iters'] = self.train_config.steps
+        slot.lr_scheduler = get_lr_scheduler(
+            self.train_config.lr_scheduler,
+            slot.optimizer,
+            **lr_scheduler_params
+        )
+        slot.data_loader = get_dataloader_from_datasets(datasets, self.train_config.batch_size, self.sd)
+        slot.last_save_step = self.step_num
+        return slot
+
+    def get_slot_latest_save_path(self, slot: LoRASlot):
+        slot.manifest.load([(f"{slot.name}_*.safetensors", 'lora')])
+        latest = slot.manifest.get_latest('lora')
+        if latest is not None and os.path.exists(slot.manifest.get_abs_path(latest)):
+            return slot.manifest.get_abs_path(latest)
+        # a final save has no step
+        final_path = os.path.join(slot.save_root, f"{slot.name}.safetensors")
+        if os.path.exists(final_path):
+            return final_path
+        return None
+
+    def hook_before_train_loop(self):
+        # the slot datasets cache their text embeddings here, before the trainer unloads the text encoder
+        for slot_config, datasets in zip(self.slot_configs, self.slot_datasets):
+            print_acc(f"Setting up LoRA {slot_config.name}")
+            self.slots.append(self.setup_slot(slot_config, datasets))
+        # the main network passes its multiplier and active state on to the others
+        self.network.routed_networks = [slot.network for slot in self.slots]
+        self.network.can_merge_in = False
+        super().hook_before_train_loop()
+        for slot in self.slots:
+            # the networks are not wrapped, routing needs the network itself
+            slot.optimizer = self.accelerator.prepare(slot.optimizer)
+            slot.lr_scheduler = self.accelerator.prepare(slot.lr_scheduler)
+            self.modules_being_trained.append(slot.network)
+
+    def train_single_accumulation(self, batch: DataLoaderBatchDTO):
+        if len(self.slots) == 0:
+            return super().train_single_accumulation(batch)
+        networks = self.all_networks
+        with torch.no_grad():
+            slot_batches = [slot.next_batch() for slot in self.slots]
+            combined = None
+            if self.combine_batches and not any(batch.get_is_reg_list()):
+                combined = combine_batches([batch] + slot_batches)
+
+        try:
+            if combined is not None:
+                batch_sizes = [len(b.file_items) for b in [batch] + slot_batches]
+                set_batch_routing(networks, get_routing_masks(batch_sizes))
+                loss = super().train_single_accumulation(combined)
+            else:
+                # sizes differ, fall back to one forward per LoRA
+                route_to_network(networks, 0)
+                loss = super().train_single_accumulation(batch)
+                if not any(batch.get_is_reg_list()):
+                    for i, slot_batch in enumerate(slot_batches):
+                        route_to_network(networks, i + 1)
+                        loss = loss + super().train_single_accumulation(slot_batch)
+                    loss = loss / len(networks)
+        finally:
+            clear_batch_routing(networks)
+            for slot_batch in slot_batches:
+                slot_batch.cleanup()
+        return loss
+
+    def hook_train_loop(self, batch: Union[DataLoaderBatchDTO, List[DataLoaderBatchDTO]]):
+        for slot in self.slots:
+            slot.optimizer.zero_grad()
+        # trains every network and steps the main one
+        loss_dict = super().hook_train_loop(batch)
+
+        for slot in self.slots:
+            if not self.is_grad_accumulation_step:
+                if self.train_config.optimizer != 'adafactor':
+                    self.accelerator.clip_grad_norm_(slot.get_trainable_params(), self.train_config.max_grad_norm)
+                with self.timer('optimizer_step'):
+                    slot.optimizer.step()
+                    slot.optimizer.zero_grad(set_to_none=True)
+            slot.lr_scheduler.step()
+
+            save_every = slot.config.save_every
+            if save_every is not None and self.step_num != self.start_step and self.step_num % save_every == 0:
+                print_acc(f"\nSaving {slot.name} at step {self.step_num}")
+                self.save_slot(slot, self.step_num)
+        return loss_dict
+
+    def save_slot(self, slot: LoRASlot, step=None):
+        if not self.accelerator.is_main_process:
+            return
+        os.makedirs(slot.save_root, exist_ok=True)
+        if not slot.manifest.loaded:
+            slot.manifest.load([(f"{slot.name}_*.safetensors", 'lora')])
+        step_num = ''
+        if step is not None:
+            slot.last_save_step = step
+            step_num = f"_{str(step).zfill(9)}"
+        file_path = os.path.join(slot.save_root, f"{slot.name}{step_num}.safetensors")
+
+        self.update_training_metadata()
+        save_meta = copy.deepcopy(self.meta)
+        save_meta = get_meta_for_safetensors(save_meta, slot.name)
+        prev_multiplier = slot.network.multiplier
+        slot.network.multiplier = 1.0
+        slot.network.save_weights(
+            file_path,
+            dtype=get_torch_dtype(self.save_config.dtype),
+            metadata=save_meta,
+        )
+        slot.network.multiplier = prev_multiplier
+        slot.manifest.add(file_path, step, 'lora', files=[
+            file_path,
+            file_path.replace('.safetensors', '_high_noise.safetensors'),
+            file_path.replace('.safetensors', '_low_noise.safetensors'),
+        ])
+        print_acc(f"Saved {slot.name} to {file_path}")
+        self.save_optimizer(slot.optimizer, slot.save_root, slot.manifest, step)
+
+        num_saves_to_keep = slot.config.max_step_saves_to_keep
+        if num_saves_to_keep is None:
+            num_saves_to_keep = self.save_config.max_step_saves_to_keep
+        slot.manifest.remove(slot.manifest.get_artifacts_to_remove(num_saves_to_keep))
+        slot.manifest.write()
+
+    def save(self, step=None):
+        super().save(step)
+        for slot in self.slots:
+            # slots without their own schedule save with the main LoRA, the final save always happens
+            if step is None or slot.config.save_every is None:
+                self.save_slot(slot, step)
+        if step is None:
+            for slot in self.slots:
+                slot.manifest.wait_for_deletes()
+
+    def sample(self, step=None, is_first=False):
+        if len(self.slots) == 0:
+            return super().sample(step, is_first)
+        networks = self.all_networks
+        save_root = self.save_root
+        try:
+            route_to_network(networks, 0)
+            super().sample(step, is_first)
+            for i, slot in enumerate(self.slots):
+                if not slot.config.sample:
+                    continue
+                route_to_network(networks, i + 1)
+                # samples go to the samples folder of the LoRA
+                self.save_root = slot.save_root
+                super().sample(step, is_first)
+                self.save_root = save_root
+        finally:
+            self.save_root = save_root
+            clear_batch_routing(networks)
@@ -33,6 +33,8 @@ from torchvision import transforms
 from diffusers import EMAModel
 import math
 from toolkit.train_tools import precondition_model_outputs_flow_match
+from toolkit.samplers.timestep_index import get_timestep_indices
+from toolkit.prior_prediction import PriorPredictionEngine, PriorPredictionRequest
 from toolkit.models.diffusion_feature_extraction import DiffusionFeatureExtractor, load_dfe
 from toolkit.util.losses import wavelet_loss, stepped_loss
 import torch.nn.functional as F
@@ -59,6 +61,8 @@ class SDTrainer(BaseSDTrainProcess):
         self.do_prior_prediction = False
         self.do_long_prompts = False
         self.do_guided_loss = False
+        # batches and keeps the prior predictions of a step
+        self.prior_engine = PriorPredictionEngine()
         self.taesd: Optional[AutoencoderTiny] = None
 
         self._clip_image_embeds_unconditional: Union[List[str], None] = None
@@ -386,6 +390,9 @@ class SDTrainer(BaseSDTrainProcess):
 
             train_sigmas = self.sd.noise_scheduler.sigmas.clone().detach()
 
+            # the step index of every item, with one sync for the batch
+            timestep_indices = get_timestep_indices(train_timesteps, timesteps).tolist()
+
             # set the scheduler to one timestep, we build the step and sigmas for each item in batch for the partial step
             self.sd.noise_scheduler.set_timesteps(
                 1,
@@ -402,7 +409,7 @@ class SDTrainer(BaseSDTrainProcess):
             latents_item = latent_chunks[i]
             noise_item = noise_chunks[i]
             with torch.no_grad():
-                timestep_idx = [(train_timesteps == t).nonzero().item() for t in timesteps_item][0]
+                timestep_idx = timestep_indices[i]
                 single_step_timestep_schedule = [timesteps_item.squeeze().item()]
                 # extract the sigma idx for our midpoint timestep
                 sigmas = train_sigmas[timestep_idx:timestep_idx + 1].to(self.device_torch)
@@ -468,7 +475,10 @@ class SDTrainer(BaseSDTrainProcess):
             **kwargs
     ):
         loss_target = self.train_config.loss_target
-        is_reg = any(batch.get_is_reg_list())
+        is_reg_list = batch.get_is_reg_list()
+        is_reg = any(is_reg_list)
+        # reg samples packed in with train samples, see pack_reg_batches
+        is_packed_reg = is_reg and not all(is_reg_list)
         additional_loss = 0.0
 
         prior_mask_multiplier = None
@@ -553,7 +563,7 @@ class SDTrainer(BaseSDTrainProcess):
                     target = (noise - batch.latents).detach()
                 else:
                     target = noise
-        elif prior_pred is not None and not self.train_config.do_prior_divergence:
+        elif prior_pred is not None and not self.train_config.do_prior_divergence and not is_packed_reg:
             assert not self.train_config.train_turbo
             # matching adapter prediction
             target = prior_pred
@@ -575,6 +585,12 @@ class SDTrainer(BaseSDTrainProcess):
             # target = (batch.latents - noise).detach()
         else:
             target = noise
+
+        if is_packed_reg and prior_pred is not None and not self.train_config.do_prior_divergence:
+            # the reg samples match the prior like they do in a batch of their own, the train samples keep their target
+            with torch.no_grad():
+                reg_mask = torch.tensor(is_reg_list, device=target.device).view(-1, *([1] * (len(target.shape) - 1)))
+                target = torch.where(reg_mask, prior_pred.to(target.device, dtype=target.dtype), target)
             
         if self.dfe is not None:
             if self.dfe.version == 1:
@@ -830,6 +846,9 @@ class SDTrainer(BaseSDTrainProcess):
         except:
             # todo handle mask with video models
             pass
+        if batch.timestep_weights is not None:
+            # importance weights from the timestep sampler
+            loss = loss * batch.timestep_weights.to(loss.device, dtype=loss.dtype).detach()
         if prior_loss is not None:
             loss = loss + prior_loss
 
@@ -1188,6 +1207,118 @@ class SDTrainer(BaseSDTrainProcess):
     
 
     def train_single_accumulation(self, batch: DataLoaderBatchDTO):
+        steps = self.iter_single_accumulation(batch)
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+        raise RuntimeError("Prior predictions are only deferred when training with batched prior predictions")
+
+    def can_batch_prior_predictions(self, batch_list: List[DataLoaderBatchDTO]) -> bool:
+        # every microbatch is set up before their priors run, nothing can depend on the order they run in
+        if not self.train_config.batch_prior_predictions or len(batch_list) < 2:
+            return False
+        if type(self).train_single_accumulation is not SDTrainer.train_single_accumulation:
+            return False
+        if self.adapter is not None or self.assistant_adapter is not None or self.embedding is not None or self.decorator is not None:
+            return False
+        if self.sd.is_multistage or self.train_config.single_item_batching or self.train_config.train_turbo:
+            return False
+        if self.train_config.do_cfg or self.train_config.do_random_cfg or self.train_config.do_guidance_loss or self.do_guided_loss:
+            return False
+        if self.train_config.timestep_type == 'next_sample' or self.train_config.loss_type == 'mean_flow':
+            return False
+        for batch in batch_list:
+            if batch is None or batch.unconditional_latents is not None:
+                return False
+            # the batched forward sees the first batch, so none of them can carry images the model reads
+            if batch.tensor is not None or batch.control_tensor is not None or batch.control_tensor_list is not None:
+                return False
+            if batch.clip_image_tensor is not None:
+                return False
+        return True
+
+    def can_pack_reg_batches(self) -> bool:
+        # the loss handles packed reg samples per sample when the prior is only predicted for them
+        if not super().can_pack_reg_batches():
+            return False
+        if self.adapter is not None or self.assistant_adapter is not None:
+            return False
+        if self.train_config.unload_text_encoder or self.is_caching_text_embeddings:
+            # the cached trigger or blank prompt is picked per batch, the train rows would get the blank one
+            return False
+        if self.do_prior_prediction or self.train_config.diff_output_preservation or self.train_config.do_prior_divergence:
+            return False
+        if self.train_config.inverted_mask_prior or self.train_config.correct_pred_norm:
+            return False
+        if self.train_config.do_guidance_loss or self.do_guided_loss or self.train_config.train_turbo:
+            return False
+        if self.train_config.timestep_type == 'next_sample' or self.train_config.loss_type == 'mean_flow':
+            return False
+        return True
+
+    def get_accumulation_state(self):
+        # what setting up a microbatch changes on the trainer and is read again after its prior prediction
+        scheduler = self.sd.noise_scheduler
+        return (
+            self.diff_output_preservation_embeds,
+            self.batch_negative_prompt,
+            getattr(scheduler, 'timesteps', None),
+            getattr(scheduler, 'sigmas', None),
+        )
+
+    def set_accumulation_state(self, state):
+        scheduler = self.sd.noise_scheduler
+        self.diff_output_preservation_embeds, self.batch_negative_prompt, timesteps, sigmas = state
+        if timesteps is not None:
+            scheduler.timesteps = timesteps
+        if sigmas is not None:
+            scheduler.sigmas = sigmas
+
+    def train_with_batched_prior_predictions(self, batch_list: List[DataLoaderBatchDTO]):
+        # set every microbatch up to its prior prediction, the ones that do not need one just train
+        losses = []
+        pending = []
+        requests = []
+        for batch in batch_list:
+            steps = self.iter_single_accumulation(batch, defer_prior=True)
+            try:
+                requests.append(next(steps))
+                pending.append(steps)
+            except StopIteration as e:
+                losses.append(e.value)
+
+        with self.timer('prior predict'):
+            prior_preds = self.prior_engine.predict(
+                requests,
+                lambda noisy_latents, timesteps, conditional_embeds, batch: self.get_prior_prediction(
+                    noisy_latents=noisy_latents,
+                    conditional_embeds=conditional_embeds,
+                    match_adapter_assist=False,
+                    network_weight_list=None,
+                    timesteps=timesteps,
+                    pred_kwargs={},
+                    batch=batch,
+                    noise=None,
+                )
+            )
+
+        for steps, prior_pred in zip(pending, prior_preds):
+            try:
+                steps.send(prior_pred)
+            except StopIteration as e:
+                losses.append(e.value)
+                continue
+            raise RuntimeError("A microbatch asked for more than one prior prediction")
+
+        total_loss = None
+        for loss in losses:
+            total_loss = loss if total_loss is None else total_loss + loss
+        return total_loss
+
+    def iter_single_accumulation(self, batch: DataLoaderBatchDTO, defer_prior: bool = False):
+        # a generator so the prior prediction can be deferred. With defer_prior it yields a
+        # PriorPredictionRequest and expects the prior prediction to be sent back, the loss is its return value
         with torch.no_grad():
             self.timer.start('preprocess_batch')
             if isinstance(self.adapter, CustomAdapter):
@@ -1268,6 +1399,14 @@ class SDTrainer(BaseSDTrainProcess):
                 if file_item.is_reg:
                     loss_multiplier[idx] = loss_multiplier[idx] * self.train_config.reg_weight
                     is_reg = True
+            if is_reg and not all(batch.get_is_reg_list()):
+                # reg samples packed in with train samples. The batch mean below would spread reg_weight over
+                # the train samples, weigh every sample in the loss instead
+                batch.loss_multiplier_list = [
+                    multiplier * (self.train_config.reg_weight if file_item.is_reg else 1.0)
+                    for multiplier, file_item in zip(batch.loss_multiplier_list, batch.file_items)
+                ]
+                loss_multiplier = torch.ones_like(loss_multiplier)
 
             adapter_images = None
             sigmas = None
@@ -1762,26 +1901,35 @@ class SDTrainer(BaseSDTrainProcess):
 
                 if ((
                         has_adapter_img and self.assistant_adapter and match_adapter_assist) or self.do_prior_prediction or do_guidance_prior or do_reg_prior or do_inverted_masked_prior or self.train_config.correct_pred_norm):
-                    with self.timer('prior predict'):
-                        prior_embeds_to_use = conditional_embeds
-                        # use diff_output_preservation embeds if doing dfe
-                        if self.train_config.diff_output_preservation:
-                            prior_embeds_to_use = self.diff_output_preservation_embeds.expand_to_batch(noisy_latents.shape[0])
-                        
-                        prior_pred = self.get_prior_prediction(
-                            noisy_latents=noisy_latents,
-                            conditional_embeds=prior_embeds_to_use,
-                            match_adapter_assist=match_adapter_assist,
-                            network_weight_list=network_weight_list,
-                            timesteps=timesteps,
-                            pred_kwargs=pred_kwargs,
-                            noise=noise,
-                            batch=batch,
-                            unconditional_embeds=unconditional_embeds,
-                            conditioned_prompts=conditioned_prompts
-                        )
-                        if prior_pred is not None:
-                            prior_pred = prior_pred.detach()
+                    prior_embeds_to_use = conditional_embeds
+                    # use diff_output_preservation embeds if doing dfe
+                    if self.train_config.diff_output_preservation:
+                        prior_embeds_to_use = self.diff_output_preservation_embeds.expand_to_batch(noisy_latents.shape[0])
+
+                    if defer_prior and len(pred_kwargs) == 0 and unconditional_embeds is None:
+                        # run with the priors of the other microbatches in one forward
+                        accumulation_state = self.get_accumulation_state()
+                        prior_pred = yield PriorPredictionRequest(noisy_latents, timesteps, prior_embeds_to_use, batch)
+                        # the other microbatches were set up in the meantime
+                        self.set_accumulation_state(accumulation_state)
+                        network.multiplier = network_weight_list
+                        network.is_active = True
+                    else:
+                        with self.timer('prior predict'):
+                            prior_pred = self.get_prior_prediction(
+                                noisy_latents=noisy_latents,
+                                conditional_embeds=prior_embeds_to_use,
+                                match_adapter_assist=match_adapter_assist,
+                                network_weight_list=network_weight_list,
+                                timesteps=timesteps,
+                                pred_kwargs=pred_kwargs,
+                                noise=noise,
+                                batch=batch,
+                                unconditional_embeds=unconditional_embeds,
+                                conditioned_prompts=conditioned_prompts
+                            )
+                    if prior_pred is not None:
+                        prior_pred = prior_pred.detach()
 
                 # do the custom adapter after the prior prediction
                 if self.adapter and isinstance(self.adapter, CustomAdapter) and (has_clip_image or self.adapter_config.type in ['llm_adapter', 'text_encoder']):
@@ -2007,7 +2155,13 @@ class SDTrainer(BaseSDTrainProcess):
             batch_list = [batch]
         total_loss = None
         self.optimizer.zero_grad()
-        for batch in batch_list:
+        self.prior_engine.start_step()
+        if self.can_batch_prior_predictions(batch_list):
+            total_loss = self.train_with_batched_prior_predictions(batch_list)
+            batch_list_to_train = []
+        else:
+            batch_list_to_train = batch_list
+        for batch in batch_list_to_train:
             if self.sd.is_multistage:
                 # handle multistage switching
                 if self.steps_this_boundary >= self.train_config.switch_boundary_every or self.current_boundary_index not in self.sd.trainable_multistage_boundaries:
@@ -2069,6 +2223,12 @@ class SDTrainer(BaseSDTrainProcess):
             {'loss': (total_loss / len(batch_list)).item()}
         )
 
+        if self.prior_engine.num_requests > 0 and self.accelerator.is_main_process:
+            self.logger.log({
+                'prior/forwards': self.prior_engine.num_forwards,
+                'prior/forwards_saved': self.prior_engine.num_forwards_saved,
+            })
+
         self.end_of_training_loop()
 
         return loss_dict
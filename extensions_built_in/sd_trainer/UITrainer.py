@@ -212,6 +212,10 @@ class UITrainer(SDTrainer):
             print("train_loop not found in timing_dict", timing_dict)
             return
         seconds_per_iter = timing_dict["train_loop"]
+        stats = self.timer.timers.get("train_loop")
+        if stats is not None and stats.count > 0:
+            # every step since the last print, not just the last few
+            seconds_per_iter = stats.total / stats.count
         # determine iter/sec or sec/iter
         if seconds_per_iter < 1:
             iters_per_sec = 1 / seconds_per_iter
@@ -56,6 +56,24 @@ class DiffusionTrainerExtension(Extension):
         return DiffusionTrainer
 
 
+# Trains several LoRAs at once on a shared base model
+class MultiLoRATrainerExtension(Extension):
+    # uid must be unique, it is how the extension is identified
+    uid = "multi_lora_trainer"
+
+    # name is the name of the extension for printing
+    name = "Multi LoRA Trainer"
+
+    # This is where your process class is loaded
+    # keep your imports in here so they don't slow down the rest of the program
+    @classmethod
+    def get_process(cls):
+        # import your process class here so it is only loaded when needed and return it
+        from .MultiLoRATrainer import MultiLoRATrainer
+
+        return MultiLoRATrainer
+
+
 # for backwards compatability
 class TextualInversionTrainer(SDTrainerExtension):
     uid = "textual_inversion_trainer"
@@ -67,4 +85,5 @@ AI_TOOLKIT_EXTENSIONS = [
     TextualInversionTrainer,
     UITrainerExtension,
     DiffusionTrainerExtension,
+    MultiLoRATrainerExtension,
 ]
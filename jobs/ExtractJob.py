@@ -1,4 +1,6 @@
-from toolkit.kohya_model_util import load_models_from_stable_diffusion_checkpoint
+import os
+
+from toolkit.kohya_model_util import load_models_from_stable_diffusion_checkpoint, is_safetensors
 from collections import OrderedDict
 from jobs import BaseJob
 from toolkit.train_tools import get_torch_dtype
@@ -30,12 +32,28 @@ class ExtractJob(BaseJob):
         self.output_folder = self.get_conf('output_folder', required=True)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # read safetensors checkpoints tensor by tensor instead of loading both models
+        self.stream = self.get_conf('stream', True)
+        self.num_workers = self.get_conf('num_workers', os.cpu_count() if self.device == 'cpu' else 1)
 
         # loads the processes from the config
         self.load_processes(process_dict)
 
+    def can_stream(self):
+        return self.stream and is_safetensors(self.base_model_path) and is_safetensors(self.extract_model_path)
+
     def run(self):
         super().run()
+        if self.can_stream():
+            print(f"Streaming weights for extraction")
+            print(f" - Base model: {self.base_model_path}")
+            print(f" - Extract model: {self.extract_model_path}")
+            print("")
+            print(f"Running  {len(self.process)} process{'' if len(self.process) == 1 else 'es'}")
+            for process in self.process:
+                process.run()
+            return
+
         # load models
         print(f"Loading models for extraction")
         print(f" - Loading base model: {self.base_model_path}")
@@ -4,6 +4,8 @@ from jobs import BaseJob
 from toolkit.train_tools import get_torch_dtype
 
 process_dict = {
+    'locon': 'MergeLoconProcess',
+    'lora': 'MergeLoconProcess',
 }
 
 
@@ -15,6 +17,8 @@ class MergeJob(BaseJob):
         self.torch_dtype = get_torch_dtype(self.dtype)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # default base model for the processes
+        self.base_model_path = self.get_conf('base_model', None)
 
         # loads the processes from the config
         self.load_processes(process_dict)
@@ -20,8 +20,24 @@ class BaseProcess(object):
         self.raw_process_config = config
         self.name = self.get_conf('name', self.job.name)
         self.meta = copy.deepcopy(self.job.meta)
-        self.timer: Timer = Timer(f'{self.name} Timer')
         self.performance_log_every = self.get_conf('performance_log_every', 0)
+        # writes every timed span to this file, a chrome trace or jsonl if it ends in .jsonl
+        self.performance_trace_path = self.get_conf('performance_trace_path', None)
+        # also record the device time of every span with cuda events
+        self.performance_device_timing = self.get_conf('performance_device_timing', False)
+        # synchronize the device when spans start and stop so their wall time covers the work they queued. slow
+        self.performance_sync = self.get_conf('performance_sync', False)
+        # track the peak allocated device memory of every span
+        self.performance_memory = self.get_conf('performance_memory', False)
+        # nothing reads the timings unless they are logged or traced
+        self.timer: Timer = Timer(
+            f'{self.name} Timer',
+            enabled=self.performance_log_every > 0 or self.performance_trace_path is not None,
+            device_timing=self.performance_device_timing,
+            sync=self.performance_sync,
+            track_memory=self.performance_memory,
+            trace_path=self.performance_trace_path,
+        )
 
         print(json.dumps(self.config, indent=4))
         
@@ -8,7 +8,8 @@ from collections import OrderedDict
 import os
 import re
 import traceback
-from typing import Union, List, Optional
+from contextlib import nullcontext
+from typing import Dict, Union, List, Optional
 
 import numpy as np
 import yaml
@@ -23,8 +24,11 @@ from huggingface_hub import HfApi, Repository, interpreter_login
 from huggingface_hub.utils import HfFolder
 
 from toolkit.basic import value_map
+from toolkit.checkpoint_manifest import CheckpointManifest
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
+from toolkit.delta_checkpoint import DeltaSave, cleanup_delta_restore, get_delta_base_path, get_delta_index, \
+    resolve_delta_checkpoint
 from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
 from toolkit.ema import ExponentialMovingAverage
@@ -35,19 +39,24 @@ from toolkit.lora_special import LoRASpecialNetwork
 from toolkit.lorm import convert_diffusers_unet_to_lorm, count_parameters, print_lorm_extract_details, \
     lorm_ignore_if_contains, lorm_parameter_threshold, LORM_TARGET_REPLACE_MODULE
 from toolkit.lycoris_special import LycorisSpecialNetwork
+from toolkit.multi_lora import combine_batches
 from toolkit.models.decorator import Decorator
 from toolkit.network_mixins import Network
 from toolkit.optimizer import get_optimizer
+from toolkit.optimizers.optimizer_checkpoint import OPTIMIZER_STATE_FOLDER, has_sharded_optimizer_state, \
+    keep_optimizer_state_as_delta_base, load_optimizer_state_sharded, save_optimizer_state_sharded
 from toolkit.paths import CONFIG_ROOT
 from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
+from toolkit.samplers.timestep_index import get_timestep_indices
 from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adapter_from_diffusers, \
     load_ip_adapter_model, load_custom_adapter_model
 
 from toolkit.scheduler import get_lr_scheduler
 from toolkit.sd_device_states_presets import get_train_sd_device_state_preset
 from toolkit.stable_diffusion_model import StableDiffusion
+from toolkit.timestep_sampler import TimestepSampler, get_timestep_sampler
 
 from jobs.process import BaseTrainProcess
 from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_base_model_info_to_meta, \
@@ -97,6 +106,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.start_step = 0
         self.epoch_num = 0
         self.last_save_step = 0
+        # full snapshot the next delta checkpoint is written against
+        self.delta_base_path: Optional[str] = None
+        self.saves_since_full_checkpoint = 0
+        # records every saved artifact, retention is decided from it instead of scanning the save folder
+        self.checkpoint_manifest = CheckpointManifest(self.save_root)
         # start at 1 so we can do a sample at the start
         self.grad_accumulation_step = 1
         # if true, then we do not do an optimizer step. We are accumulating gradients
@@ -249,6 +263,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.named_lora = True
         self.snr_gos: Union[LearnableSNRGamma, None] = None
         self.ema: ExponentialMovingAverage = None
+        # (content_or_style, num timesteps, min, max) -> sampler
+        self.timestep_samplers: Dict[tuple, TimestepSampler] = {}
         
         validate_configs(self.train_config, self.model_config, self.save_config, self.dataset_configs)
         
@@ -403,82 +419,77 @@ class BaseSDTrainProcess(BaseTrainProcess):
         })
         return info
 
+    def get_step_artifact_type(self):
+        # type of the {job_name}_{step} saves of this job
+        if self.is_fine_tuning:
+            return 'model'
+        if self.network is not None:
+            return 'lora'
+        if self.decorator is not None:
+            return 'decorator'
+        return 'adapter'
+
+    def load_checkpoint_manifest(self):
+        if self.checkpoint_manifest.loaded:
+            return self.checkpoint_manifest
+        # folders from before the manifest existed are scanned once to build it, most specific patterns first
+        legacy_scan_patterns = [
+            (f"CRITIC_{self.job.name}_*", 'critic'),
+            (f"{self.job.name}_refiner_*", 'refiner'),
+            (f"{self.job.name}_LoRA_*", 'lora'),
+        ]
+        for suffix in ['_t2i', '_cn', '_clip', '_ip', '_adapter']:
+            legacy_scan_patterns.append((f"{self.job.name}{suffix}_*", 'adapter'))
+        legacy_scan_patterns.append((f"{self.job.name}_*", self.get_step_artifact_type()))
+        if self.embed_config is not None:
+            legacy_scan_patterns.append((f"{self.embed_config.trigger}_*", 'embedding'))
+        self.checkpoint_manifest.load(legacy_scan_patterns)
+        return self.checkpoint_manifest
+
     def clean_up_saves(self):
         if not self.accelerator.is_main_process:
             return
         # remove old saves
-        # get latest saved step
-        latest_item = None
-        if os.path.exists(self.save_root):
-            # pattern is {job_name}_{zero_filled_step} for both files and directories
-            pattern = f"{self.job.name}_*"
-            items = glob.glob(os.path.join(self.save_root, pattern))
-            # Separate files and directories
-            safetensors_files = [f for f in items if f.endswith('.safetensors')]
-            pt_files = [f for f in items if f.endswith('.pt')]
-            directories = [d for d in items if os.path.isdir(d) and not d.endswith('.safetensors')]
-            embed_files = []
-            # do embedding files
-            if self.embed_config is not None:
-                embed_pattern = f"{self.embed_config.trigger}_*"
-                embed_items = glob.glob(os.path.join(self.save_root, embed_pattern))
-                # will end in safetensors or pt
-                embed_files = [f for f in embed_items if f.endswith('.safetensors') or f.endswith('.pt')]
-
-            # check for critic files
-            critic_pattern = f"CRITIC_{self.job.name}_*"
-            critic_items = glob.glob(os.path.join(self.save_root, critic_pattern))
-
-            # Sort the lists by creation time if they are not empty
-            if safetensors_files:
-                safetensors_files.sort(key=os.path.getctime)
-            if pt_files:
-                pt_files.sort(key=os.path.getctime)
-            if directories:
-                directories.sort(key=os.path.getctime)
-            if embed_files:
-                embed_files.sort(key=os.path.getctime)
-            if critic_items:
-                critic_items.sort(key=os.path.getctime)
-
-            # Combine and sort the lists
-            combined_items = safetensors_files + directories + pt_files
-            combined_items.sort(key=os.path.getctime)
-            
-            num_saves_to_keep = self.save_config.max_step_saves_to_keep
-            
-            if hasattr(self.sd, 'max_step_saves_to_keep_multiplier'):
-                num_saves_to_keep *= self.sd.max_step_saves_to_keep_multiplier
-
-            # Use slicing with a check to avoid 'NoneType' error
-            safetensors_to_remove = safetensors_files[
-                                    :-num_saves_to_keep] if safetensors_files else []
-            pt_files_to_remove = pt_files[:-num_saves_to_keep] if pt_files else []
-            directories_to_remove = directories[:-num_saves_to_keep] if directories else []
-            embeddings_to_remove = embed_files[:-num_saves_to_keep] if embed_files else []
-            critic_to_remove = critic_items[:-num_saves_to_keep] if critic_items else []
-
-            items_to_remove = safetensors_to_remove + pt_files_to_remove + directories_to_remove + embeddings_to_remove + critic_to_remove
+        manifest = self.load_checkpoint_manifest()
+
+        # split multistage LoRAs are recorded as a single artifact per step, so max_step_saves_to_keep_multiplier
+        # is not needed here
+        num_saves_to_keep = self.save_config.max_step_saves_to_keep
+        items_to_remove = manifest.get_artifacts_to_remove(num_saves_to_keep)
+
+        if self.save_config.delta_checkpoints:
+            # never remove a full snapshot that a kept delta checkpoint is built on
+            remove_paths = [a['path'] for a in items_to_remove]
+            kept_items = [
+                manifest.get_abs_path(a) for a in manifest.get_artifacts('model') if a['path'] not in remove_paths
+            ]
+            delta_bases = [get_delta_base_path(item) for item in kept_items]
+            delta_bases = set([path for path in delta_bases if path is not None])
+            items_to_remove = [
+                item for item in items_to_remove
+                if os.path.normpath(os.path.abspath(manifest.get_abs_path(item))) not in delta_bases
+            ]
 
-            # remove all but the latest max_step_saves_to_keep
-            # items_to_remove = combined_items[:-num_saves_to_keep]
+        # files are removed on a background thread so slow storage does not hold up training
+        manifest.remove(items_to_remove)
+        manifest.write()
 
-            # remove duplicates
-            items_to_remove = list(dict.fromkeys(items_to_remove))
+        latest_item = manifest.get_latest(self.get_step_artifact_type())
+        if latest_item is not None:
+            return manifest.get_abs_path(latest_item)
+        return None
 
-            for item in items_to_remove:
-                print_acc(f"Removing old save: {item}")
-                if os.path.isdir(item):
-                    shutil.rmtree(item)
-                else:
-                    os.remove(item)
-                # see if a yaml file with same name exists
-                yaml_file = os.path.splitext(item)[0] + ".yaml"
-                if os.path.exists(yaml_file):
-                    os.remove(yaml_file)
-            if combined_items:
-                latest_item = combined_items[-1]
-        return latest_item
+    def get_delta_save(self, save_path) -> Optional[DeltaSave]:
+        # the first save and every full_checkpoint_every saves stay full snapshots, the rest are written as deltas
+        is_full_save = self.delta_base_path is None or not os.path.exists(self.delta_base_path)
+        if self.saves_since_full_checkpoint + 1 >= self.save_config.full_checkpoint_every:
+            is_full_save = True
+        if is_full_save:
+            self.delta_base_path = save_path
+            self.saves_since_full_checkpoint = 0
+            return None
+        self.saves_since_full_checkpoint += 1
+        return DeltaSave(save_path, self.delta_base_path, self.saves_since_full_checkpoint)
 
     def post_save_hook(self, save_path):
         # override in subclass
@@ -500,6 +511,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         if not os.path.exists(self.save_root):
             os.makedirs(self.save_root, exist_ok=True)
+        manifest = self.load_checkpoint_manifest()
 
         step_num = ''
         if step is not None:
@@ -512,6 +524,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         file_path = os.path.join(self.save_root, filename)
 
         save_meta = copy.deepcopy(self.meta)
+        # None unless this save is part of a delta checkpoint series
+        optimizer_as_delta = None
         # get extra meta
         if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
             additional_save_meta = self.adapter.get_additional_save_metadata()
@@ -542,6 +556,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     extra_state_dict=embedding_dict
                 )
                 self.network.multiplier = prev_multiplier
+                # split multistage models write a high and low noise file instead
+                manifest.add(file_path, step, 'lora', files=[
+                    file_path,
+                    file_path.replace('.safetensors', '_high_noise.safetensors'),
+                    file_path.replace('.safetensors', '_low_noise.safetensors'),
+                ])
                 # if we have an embedding as well, pair it with the network
 
             # even if added to lora, still save the trigger version
@@ -556,6 +576,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     # replace extension
                     emb_file_path = os.path.splitext(emb_file_path)[0] + ".pt"
                 self.embedding.save(emb_file_path)
+                manifest.add(emb_file_path, step, 'embedding')
             
             if self.decorator is not None:
                 dec_filename = f'{self.job.name}{step_num}.safetensors'
@@ -569,6 +590,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     dec_file_path,
                     metadata=save_meta,
                 )
+                manifest.add(dec_file_path, step, 'decorator')
 
             if self.adapter is not None and self.adapter_config.train:
                 adapter_name = self.job.name
@@ -613,6 +635,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         yaml.dump(self.meta, f)
                     # move it back
                     self.adapter = self.adapter.to(orig_device, dtype=orig_dtype)
+                    manifest.add(name_or_path, step, 'adapter')
                 else:
                     direct_save = False
                     if self.adapter_config.train_only_image_encoder:
@@ -626,6 +649,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         dtype=get_torch_dtype(self.save_config.dtype),
                         direct_save=direct_save
                     )
+                if self.adapter_config.type != 'control_net':
+                    manifest.add(file_path, step, 'adapter')
         else:
             if self.save_config.save_format == "diffusers":
                 # saving as a folder path
@@ -643,12 +668,21 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     save_meta,
                     get_torch_dtype(self.save_config.dtype)
                 )
+                manifest.add(file_path, step, 'refiner')
             if self.train_config.train_unet or self.train_config.train_text_encoder:
-                self.sd.save(
-                    file_path,
-                    save_meta,
-                    get_torch_dtype(self.save_config.dtype)
-                )
+                delta_save = None
+                if self.save_config.delta_checkpoints and step is not None:
+                    delta_save = self.get_delta_save(file_path)
+                    optimizer_as_delta = delta_save is not None
+                    if delta_save is not None:
+                        print_acc(f"Saving {file_path} as a delta checkpoint")
+                with delta_save if delta_save is not None else nullcontext():
+                    self.sd.save(
+                        file_path,
+                        save_meta,
+                        get_torch_dtype(self.save_config.dtype)
+                    )
+                manifest.add(file_path, step, 'model')
 
         # save learnable params as json if we have thim
         if self.snr_gos:
@@ -666,18 +700,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         # save optimizer
         if self.optimizer is not None:
-            try:
-                filename = f'optimizer.pt'
-                file_path = os.path.join(self.save_root, filename)
-                try:
-                    state_dict = unwrap_model(self.optimizer).state_dict()
-                except Exception as e:
-                    state_dict = self.optimizer.state_dict()
-                torch.save(state_dict, file_path)
-                print_acc(f"Saved optimizer to {file_path}")
-            except Exception as e:
-                print_acc(e)
-                print_acc("Could not save optimizer")
+            optimizer_path = self.save_optimizer(
+                self.optimizer, self.save_root, manifest, step, as_delta=optimizer_as_delta
+            )
+            if optimizer_path is not None:
+                file_path = optimizer_path
 
         self.clean_up_saves()
         self.post_save_hook(file_path)
@@ -686,6 +713,104 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.ema.train()
         flush()
 
+    def save_optimizer(
+            self,
+            optimizer,
+            save_root: str,
+            manifest: CheckpointManifest,
+            step=None,
+            as_delta: Optional[bool] = None
+    ) -> Optional[str]:
+        """
+        Saves the optimizer state to save_root in the configured format and returns the path.
+        as_delta is None unless delta checkpoints are on. True writes the safetensors state as a delta,
+        False marks a full snapshot whose state later deltas are written against
+        """
+        try:
+            filename = f'optimizer.pt'
+            file_path = os.path.join(save_root, filename)
+            try:
+                state_dict = unwrap_model(optimizer).state_dict()
+            except Exception as e:
+                state_dict = optimizer.state_dict()
+            saved_sharded = False
+            if self.save_config.optimizer_format == 'safetensors':
+                try:
+                    file_path = save_optimizer_state_sharded(
+                        state_dict,
+                        save_root,
+                        max_shard_size=self.save_config.max_shard_size,
+                        as_delta=as_delta is True
+                    )
+                    saved_sharded = True
+                    if as_delta is False:
+                        keep_optimizer_state_as_delta_base(save_root)
+                    # do not leave a stale optimizer.pt around to be picked up on resume
+                    if os.path.exists(os.path.join(save_root, filename)):
+                        os.remove(os.path.join(save_root, filename))
+                except (TypeError, ValueError) as e:
+                    print_acc(f"Could not save optimizer as safetensors, falling back to torch.save: {e}")
+            if not saved_sharded:
+                torch.save(state_dict, file_path)
+            manifest.add(file_path, step, 'optimizer')
+            print_acc(f"Saved optimizer to {file_path}")
+            return file_path
+        except Exception as e:
+            print_acc(e)
+            print_acc("Could not save optimizer")
+            return None
+
+    def load_optimizer(self, optimizer, save_root: str, network=None):
+        """Loads the newest optimizer state saved in save_root into optimizer if there is one"""
+        optimizer_state_filename = f'optimizer.pt'
+        optimizer_state_file_path = os.path.join(save_root, optimizer_state_filename)
+        use_sharded_optimizer_state = has_sharded_optimizer_state(save_root)
+        if use_sharded_optimizer_state and os.path.exists(optimizer_state_file_path):
+            # both formats exist if optimizer_format was changed, use the newest
+            sharded_folder = os.path.join(save_root, OPTIMIZER_STATE_FOLDER)
+            use_sharded_optimizer_state = os.path.getmtime(sharded_folder) >= os.path.getmtime(optimizer_state_file_path)
+        if use_sharded_optimizer_state:
+            optimizer_state_file_path = os.path.join(save_root, OPTIMIZER_STATE_FOLDER)
+        if os.path.exists(optimizer_state_file_path):
+            # try to load
+            # previous param groups
+            # previous_params = copy.deepcopy(optimizer.param_groups)
+            previous_lrs = []
+            for group in optimizer.param_groups:
+                previous_lrs.append(group['lr'])
+
+            load_optimizer = True
+            if network is not None:
+                if network.did_change_weights:
+                    # do not load optimizer if the network changed, it will result in
+                    # a double state that will oom.
+                    load_optimizer = False
+
+            if load_optimizer:
+                try:
+                    print_acc(f"Loading optimizer state from {optimizer_state_file_path}")
+                    if use_sharded_optimizer_state:
+                        # state tensors are memory mapped and moved to the device the first time each param steps
+                        load_optimizer_state_sharded(optimizer, save_root)
+                    else:
+                        optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
+                        optimizer.load_state_dict(optimizer_state_dict)
+                        del optimizer_state_dict
+                    flush()
+                except Exception as e:
+                    print_acc(f"Failed to load optimizer state from {optimizer_state_file_path}")
+                    print_acc(e)
+
+            # update the optimizer LR from the params
+            print_acc(f"Updating optimizer LR from params")
+            if len(previous_lrs) > 0:
+                for i, group in enumerate(optimizer.param_groups):
+                    group['lr'] = previous_lrs[i]
+                    group['initial_lr'] = previous_lrs[i]
+
+            # Update the learning rates if they changed
+            # optimizer.param_groups = previous_params
+
     # Called before the model is loaded
     def hook_before_model_load(self):
         # override in subclass
@@ -766,6 +891,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 decay=self.train_config.ema_config.ema_decay,
                 use_feedback=self.train_config.ema_config.use_feedback,
                 param_multiplier=self.train_config.ema_config.param_multiplier,
+                update_every=self.train_config.ema_config.update_every,
+                offload=self.train_config.ema_config.offload,
             )
 
     def before_dataset_load(self):
@@ -839,6 +966,62 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.start_step = self.step_num
             print_acc(f"Found step {self.step_num} in metadata, starting from there")
 
+    def create_network(self, network_config: NetworkConfig, text_encoder):
+        # builds a network for the model being trained from a network config, it is not applied yet
+        # TODO should we completely switch to LycorisSpecialNetwork?
+        network_kwargs = network_config.network_kwargs
+        is_lycoris = False
+        is_lorm = network_config.type.lower() == 'lorm'
+        # default to LoCON if there are any conv layers or if it is named
+        NetworkClass = LoRASpecialNetwork
+        if network_config.type.lower() == 'locon' or network_config.type.lower() == 'lycoris':
+            NetworkClass = LycorisSpecialNetwork
+            is_lycoris = True
+
+        if is_lorm:
+            network_kwargs['ignore_if_contains'] = lorm_ignore_if_contains
+            network_kwargs['parameter_threshold'] = lorm_parameter_threshold
+            network_kwargs['target_lin_modules'] = LORM_TARGET_REPLACE_MODULE
+
+        # if is_lycoris:
+        #     preset = PRESET['full']
+        # NetworkClass.apply_preset(preset)
+        
+        if hasattr(self.sd, 'target_lora_modules'):
+            network_kwargs['target_lin_modules'] = self.sd.target_lora_modules
+
+        return NetworkClass(
+            text_encoder=text_encoder,
+            unet=self.sd.get_model_to_train(),
+            lora_dim=network_config.linear,
+            multiplier=1.0,
+            alpha=network_config.linear_alpha,
+            train_unet=self.train_config.train_unet,
+            train_text_encoder=self.train_config.train_text_encoder,
+            conv_lora_dim=network_config.conv,
+            conv_alpha=network_config.conv_alpha,
+            is_sdxl=self.model_config.is_xl or self.model_config.is_ssd,
+            is_v2=self.model_config.is_v2,
+            is_v3=self.model_config.is_v3,
+            is_pixart=self.model_config.is_pixart,
+            is_auraflow=self.model_config.is_auraflow,
+            is_flux=self.model_config.is_flux,
+            is_lumina2=self.model_config.is_lumina2,
+            is_ssd=self.model_config.is_ssd,
+            is_vega=self.model_config.is_vega,
+            dropout=network_config.dropout,
+            use_text_encoder_1=self.model_config.use_text_encoder_1,
+            use_text_encoder_2=self.model_config.use_text_encoder_2,
+            use_bias=is_lorm,
+            is_lorm=is_lorm,
+            network_config=network_config,
+            network_type=network_config.type,
+            transformer_only=network_config.transformer_only,
+            is_transformer=self.sd.is_transformer,
+            base_model=self.sd,
+            **network_kwargs
+        )
+
     def load_weights(self, path):
         if self.network is not None:
             extra_weights = self.network.load_weights(path)
@@ -896,12 +1079,46 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # override in subclass
         return params
 
+    def get_timestep_sampler(self, content_or_style, num_train_timesteps, min_noise_steps, max_noise_steps):
+        # samplers precompute their distribution, keep one for every range we sample from
+        key = (content_or_style, num_train_timesteps, min_noise_steps, max_noise_steps)
+        if key not in self.timestep_samplers:
+            self.timestep_samplers[key] = get_timestep_sampler(
+                self.train_config,
+                content_or_style,
+                num_train_timesteps,
+                min_noise_steps,
+                max_noise_steps,
+                self.device_torch
+            )
+        return self.timestep_samplers[key]
+
+    def can_pack_reg_batches(self) -> bool:
+        # batch preparation only handles reg samples per sample for prompts, everything below is per batch
+        if not self.train_config.pack_reg_batches:
+            return False
+        if self.train_config.short_and_long_captions or self.train_config.dynamic_noise_offset:
+            return False
+        if self.train_config.img_multiplier is not None:
+            return False
+        if self.train_config.content_or_style != self.train_config.content_or_style_reg:
+            return False
+        return True
+
+    def pack_reg_batch(self, batch: 'DataLoaderBatchDTO', batch_reg: 'DataLoaderBatchDTO') -> Optional['DataLoaderBatchDTO']:
+        """
+        One batch with the reg samples after the train samples, or None if they cannot share a forward.
+        Loss multipliers are scaled so the packed batch gets the gradient of both batches run one after the other,
+        the sum of the train and reg gradients where alternating steps would take one of them per microbatch
+        """
+        return combine_batches([batch, batch_reg], allow_reg=True)
+
     def get_sigmas(self, timesteps, n_dim=4, dtype=torch.float32):
         sigmas = self.sd.noise_scheduler.sigmas.to(device=self.device, dtype=dtype)
         schedule_timesteps = self.sd.noise_scheduler.timesteps.to(self.device)
         timesteps = timesteps.to(self.device)
 
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(schedule_timesteps, timesteps)
 
         sigma = sigmas[step_indices].flatten()
         while len(sigma.shape) < n_dim:
@@ -1202,65 +1419,16 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 if is_reg:
                     content_or_style = self.train_config.content_or_style_reg
 
-                # if self.train_config.timestep_sampling == 'style' or self.train_config.timestep_sampling == 'content':
-                if self.train_config.timestep_type == 'next_sample':
-                    timestep_indices = torch.randint(
-                            0,
-                            num_train_timesteps - 2, # -1 for 0 idx, -1 so we can step
-                            (batch_size,),
-                            device=self.device_torch
-                        )
-                    timestep_indices = timestep_indices.long()
-                elif self.train_config.timestep_type == 'one_step':
-                    timestep_indices = torch.zeros((batch_size,), device=self.device_torch, dtype=torch.long)
-                elif content_or_style in ['style', 'content']:
-                    # this is from diffusers training code
-                    # Cubic sampling for favoring later or earlier timesteps
-                    # For more details about why cubic sampling is used for content / structure,
-                    # refer to section 3.4 of https://arxiv.org/abs/2302.08453
-
-                    # for content / structure, it is best to favor earlier timesteps
-                    # for style, it is best to favor later timesteps
-
-                    orig_timesteps = torch.rand((batch_size,), device=latents.device)
-
-                    if content_or_style == 'content':
-                        timestep_indices = orig_timesteps ** 3 * self.train_config.num_train_timesteps
-                    elif content_or_style == 'style':
-                        timestep_indices = (1 - orig_timesteps ** 3) * self.train_config.num_train_timesteps
-
-                    timestep_indices = value_map(
-                        timestep_indices,
-                        0,
-                        self.train_config.num_train_timesteps - 1,
-                        min_noise_steps,
-                        max_noise_steps
-                    )
-                    timestep_indices = timestep_indices.long().clamp(
-                        min_noise_steps,
-                        max_noise_steps
-                    )
-                    
-                elif content_or_style == 'balanced':
-                    if min_noise_steps == max_noise_steps:
-                        timestep_indices = torch.ones((batch_size,), device=self.device_torch) * min_noise_steps
-                    else:
-                        # todo, some schedulers use indices, otheres use timesteps. Not sure what to do here
-                        min_idx = min_noise_steps + 1
-                        max_idx = max_noise_steps - 1
-                        if self.train_config.noise_scheduler == 'flowmatch':
-                            # flowmatch uses indices, so we need to use indices
-                            min_idx = min_noise_steps
-                            max_idx = max_noise_steps
-                        timestep_indices = torch.randint(
-                            min_idx,
-                            max_idx,
-                            (batch_size,),
-                            device=self.device_torch
-                        )
-                    timestep_indices = timestep_indices.long()
-                else:
-                    raise ValueError(f"Unknown content_or_style {content_or_style}")
+                timestep_sampler = self.get_timestep_sampler(
+                    content_or_style,
+                    num_train_timesteps,
+                    min_noise_steps,
+                    max_noise_steps
+                )
+                timestep_indices = timestep_sampler.sample(batch_size)
+                if self.train_config.timestep_importance_weighting:
+                    # loss weight that makes the draw count as uniform over the sampled range
+                    batch.timestep_weights = timestep_sampler.importance_weights(timestep_indices)
             with self.timer('convert_timestep_indices_to_timesteps'):
                 # convert the timestep_indices to a timestep
                 timesteps = self.sd.noise_scheduler.timesteps[timestep_indices.long()]
@@ -1364,6 +1532,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     refiner_timesteps = refiner_timesteps.long()
                     # add our new timesteps on to end
                     timesteps = torch.cat([timesteps, refiner_timesteps], dim=0)
+                    if batch.timestep_weights is not None:
+                        # refiner timesteps are drawn uniformly
+                        batch.timestep_weights = torch.cat(
+                            [batch.timestep_weights, torch.ones_like(batch.timestep_weights)], dim=0
+                        )
 
                     refiner_noisy_latents = self.sd.noise_scheduler.add_noise(latents, noise, refiner_timesteps)
                     noisy_latents = torch.cat([noisy_latents, refiner_noisy_latents], dim=0)
@@ -1372,6 +1545,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     # just double it
                     noisy_latents = double_up_tensor(noisy_latents)
                     timesteps = double_up_tensor(timesteps)
+                    batch.timestep_weights = double_up_tensor(batch.timestep_weights)
 
                 noise = double_up_tensor(noise)
                 # prompts are already updated above
@@ -1519,7 +1693,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             if latest_save_path is not None:
                 print_acc(f"#### IMPORTANT RESUMING FROM {latest_save_path} ####")
-                model_config_to_load.name_or_path = latest_save_path
+                # keep writing deltas against the same full snapshot
+                self.delta_base_path = get_delta_base_path(latest_save_path) or latest_save_path
+                self.saves_since_full_checkpoint = get_delta_index(latest_save_path)
+                # delta checkpoints are restored to a full checkpoint before loading
+                model_config_to_load.name_or_path = resolve_delta_checkpoint(latest_save_path)
                 self.load_training_state_from_metadata(latest_save_path)
 
         ModelClass = get_model_class(self.model_config)
@@ -1558,10 +1736,20 @@ class BaseSDTrainProcess(BaseTrainProcess):
             custom_pipeline=self.custom_pipeline,
             noise_scheduler=sampler,
         )
+        self.sd.max_shard_size = self.save_config.max_shard_size
         
         self.hook_after_sd_init_before_load()
         # run base sd process run
         self.sd.load_model()
+        # the full checkpoint a delta resume was restored to is loaded now
+        cleanup_delta_restore(self.save_root)
+
+        if self.model_config.auto_memory and self.timer.enabled:
+            # report prefetch stalls with the other timings
+            text_encoders = self.sd.text_encoder if isinstance(self.sd.text_encoder, list) else [self.sd.text_encoder]
+            for model in [self.sd.unet] + text_encoders:
+                if hasattr(model, '_memory_manager'):
+                    model._memory_manager.set_timer(self.timer)
         
         # compile the model if needed
         if self.model_config.compile:
@@ -1690,59 +1878,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         flush()
         if not self.is_fine_tuning:
             if self.network_config is not None:
-                # TODO should we completely switch to LycorisSpecialNetwork?
-                network_kwargs = self.network_config.network_kwargs
-                is_lycoris = False
                 is_lorm = self.network_config.type.lower() == 'lorm'
-                # default to LoCON if there are any conv layers or if it is named
-                NetworkClass = LoRASpecialNetwork
-                if self.network_config.type.lower() == 'locon' or self.network_config.type.lower() == 'lycoris':
-                    NetworkClass = LycorisSpecialNetwork
-                    is_lycoris = True
-
-                if is_lorm:
-                    network_kwargs['ignore_if_contains'] = lorm_ignore_if_contains
-                    network_kwargs['parameter_threshold'] = lorm_parameter_threshold
-                    network_kwargs['target_lin_modules'] = LORM_TARGET_REPLACE_MODULE
-
-                # if is_lycoris:
-                #     preset = PRESET['full']
-                # NetworkClass.apply_preset(preset)
-                
-                if hasattr(self.sd, 'target_lora_modules'):
-                    network_kwargs['target_lin_modules'] = self.sd.target_lora_modules
-
-                self.network = NetworkClass(
-                    text_encoder=text_encoder,
-                    unet=self.sd.get_model_to_train(),
-                    lora_dim=self.network_config.linear,
-                    multiplier=1.0,
-                    alpha=self.network_config.linear_alpha,
-                    train_unet=self.train_config.train_unet,
-                    train_text_encoder=self.train_config.train_text_encoder,
-                    conv_lora_dim=self.network_config.conv,
-                    conv_alpha=self.network_config.conv_alpha,
-                    is_sdxl=self.model_config.is_xl or self.model_config.is_ssd,
-                    is_v2=self.model_config.is_v2,
-                    is_v3=self.model_config.is_v3,
-                    is_pixart=self.model_config.is_pixart,
-                    is_auraflow=self.model_config.is_auraflow,
-                    is_flux=self.model_config.is_flux,
-                    is_lumina2=self.model_config.is_lumina2,
-                    is_ssd=self.model_config.is_ssd,
-                    is_vega=self.model_config.is_vega,
-                    dropout=self.network_config.dropout,
-                    use_text_encoder_1=self.model_config.use_text_encoder_1,
-                    use_text_encoder_2=self.model_config.use_text_encoder_2,
-                    use_bias=is_lorm,
-                    is_lorm=is_lorm,
-                    network_config=self.network_config,
-                    network_type=self.network_config.type,
-                    transformer_only=self.network_config.transformer_only,
-                    is_transformer=self.sd.is_transformer,
-                    base_model=self.sd,
-                    **network_kwargs
-                )
+                self.network = self.create_network(self.network_config, text_encoder)
 
 
                 # todo switch everything to proper mixed precision like this
@@ -1758,9 +1895,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     self.train_config.train_unet
                 )
 
-                # we cannot merge in if quantized
-                if self.model_config.quantize or self.model_config.auto_memory:
-                    # todo find a way around this
+                # merging into quantized weights requantizes with the original scale. float8 keeps small
+                # lora deltas, integer types would round most of them away
+                if self.model_config.auto_memory or (
+                        self.model_config.quantize and self.model_config.qtype != 'qfloat8'
+                ):
                     self.network.can_merge_in = False
 
                 if is_lorm:
@@ -1930,43 +2069,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.optimizer.enable_paramiter_swapping(self.train_config.paramiter_swapping_factor)
 
         # check if it exists
-        optimizer_state_filename = f'optimizer.pt'
-        optimizer_state_file_path = os.path.join(self.save_root, optimizer_state_filename)
-        if os.path.exists(optimizer_state_file_path):
-            # try to load
-            # previous param groups
-            # previous_params = copy.deepcopy(optimizer.param_groups)
-            previous_lrs = []
-            for group in optimizer.param_groups:
-                previous_lrs.append(group['lr'])
-
-            load_optimizer = True
-            if self.network is not None:
-                if self.network.did_change_weights:
-                    # do not load optimizer if the network changed, it will result in
-                    # a double state that will oom.
-                    load_optimizer = False
-
-            if load_optimizer:
-                try:
-                    print_acc(f"Loading optimizer state from {optimizer_state_file_path}")
-                    optimizer_state_dict = torch.load(optimizer_state_file_path, weights_only=True)
-                    optimizer.load_state_dict(optimizer_state_dict)
-                    del optimizer_state_dict
-                    flush()
-                except Exception as e:
-                    print_acc(f"Failed to load optimizer state from {optimizer_state_file_path}")
-                    print_acc(e)
-
-            # update the optimizer LR from the params
-            print_acc(f"Updating optimizer LR from params")
-            if len(previous_lrs) > 0:
-                for i, group in enumerate(optimizer.param_groups):
-                    group['lr'] = previous_lrs[i]
-                    group['initial_lr'] = previous_lrs[i]
-
-            # Update the learning rates if they changed
-            # optimizer.param_groups = previous_params
+        self.load_optimizer(optimizer, self.save_root, self.network)
 
         lr_scheduler_params = self.train_config.lr_scheduler_params
 
@@ -2036,6 +2139,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
             dataloader_reg = None
             dataloader_iterator_reg = None
 
+        # pack a reg batch into every microbatch instead of alternating steps
+        pack_reg_batches = dataloader is not None and dataloader_reg is not None and self.can_pack_reg_batches()
+
         # zero any gradients
         optimizer.zero_grad()
 
@@ -2063,6 +2169,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         for step in range(start_step_num, self.train_config.steps):
             if self.train_config.do_paramiter_swapping:
                 self.optimizer.optimizer.swap_paramiters()
+            self.timer.set_step(step)
             self.timer.start('train_loop')
             if flush_next:
                 flush()
@@ -2079,7 +2186,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 self.progress_bar.unpause()
             with torch.no_grad():
                 # if is even step and we have a reg dataset, use that
-                # todo improve this logic to send one of each through if we can buckets and batch size might be an issue
+                # pack_reg_batches sends one of each through together when they share a bucket
                 is_reg_step = False
                 is_save_step = self.save_config.save_every and self.step_num % self.save_config.save_every == 0
                 is_sample_step = self.sample_config.sample_every and self.step_num % self.sample_config.sample_every == 0
@@ -2092,7 +2199,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     # keep track to alternate on an accumulation step for reg   
                     batch_step = step
                     # don't do a reg step on sample or save steps as we dont want to normalize on those
-                    if batch_step % 2 == 0 and dataloader_reg is not None and not is_save_step and not is_sample_step:
+                    do_reg_batch = dataloader_reg is not None and not is_save_step and not is_sample_step
+                    if batch_step % 2 == 0 and do_reg_batch and not pack_reg_batches:
                         try:
                             with self.timer('get_batch:reg'):
                                 batch = next(dataloader_iterator_reg)
@@ -2131,6 +2239,31 @@ class BaseSDTrainProcess(BaseTrainProcess):
                                 self.progress_bar.unpause()
                     else:
                         batch = None
+                    if pack_reg_batches and do_reg_batch and batch is not None:
+                        try:
+                            with self.timer('get_batch:reg'):
+                                batch_reg = next(dataloader_iterator_reg)
+                        except StopIteration:
+                            with self.timer('reset_batch:reg'):
+                                # hit the end of an epoch, reset
+                                if self.progress_bar is not None:
+                                    self.progress_bar.pause()
+                                dataloader_iterator_reg = iter(dataloader_reg)
+                                trigger_dataloader_setup_epoch(dataloader_reg)
+
+                            with self.timer('get_batch:reg'):
+                                batch_reg = next(dataloader_iterator_reg)
+                            if self.progress_bar is not None:
+                                self.progress_bar.unpause()
+                        with self.timer('pack_reg_batch'):
+                            packed_batch = self.pack_reg_batch(batch, batch_reg)
+                        if packed_batch is None:
+                            # different buckets, the reg batch runs as its own microbatch in the same step
+                            batch_list.append(batch)
+                            batch = batch_reg
+                        else:
+                            batch = packed_batch
+                        is_reg_step = True
                     batch_list.append(batch)
                     batch_step += 1
 
@@ -2296,6 +2429,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                             self.progress_bar.pause()
                         # print the timers and clear them
                         self.timer.print()
+                        if self.accelerator.is_main_process:
+                            self.logger.log(self.timer.get_log_dict())
                         self.timer.reset()
                         if self.progress_bar is not None:
                             self.progress_bar.unpause()
@@ -2332,6 +2467,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         print_acc("")
         if self.accelerator.is_main_process:
             self.save()
+            # make sure old saves are gone before the folder is pushed or the job exits
+            self.checkpoint_manifest.wait_for_deletes()
             self.logger.finish()
         self.accelerator.end_training()
 
@@ -2355,6 +2492,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         )
 
         flush()
+        self.timer.close()
         self.done_hook()
 
     def push_to_hub(
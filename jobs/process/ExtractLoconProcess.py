@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
+from toolkit.lycoris_utils import extract_diff, extract_diff_from_files
 from .BaseExtractProcess import BaseExtractProcess
 
 mode_dict = {
@@ -32,6 +32,9 @@ class ExtractLoconProcess(BaseExtractProcess):
         self.mode = self.get_conf('mode', 'fixed')
         self.use_sparse_bias = self.get_conf('use_sparse_bias', False)
         self.sparsity = self.get_conf('sparsity', 0.98)
+        # opt in to a randomized svd with this many power iterations for fixed rank extraction.
+        # Faster on large layers but approximate. None uses an exact svd
+        self.lowrank_niter = self.get_conf('lowrank_niter', None)
         self.disable_cp = self.get_conf('disable_cp', False)
 
         # set modes
@@ -44,19 +47,39 @@ class ExtractLoconProcess(BaseExtractProcess):
         super().run()
         print(f"Running process: {self.mode}, lin: {self.linear_param}, conv: {self.conv_param}")
 
-        state_dict, extract_diff_meta = extract_diff(
-            self.job.model_base,
-            self.job.model_extract,
-            self.mode,
-            self.linear_param,
-            self.conv_param,
-            self.job.device,
-            self.use_sparse_bias,
-            self.sparsity,
-            not self.disable_cp,
-            extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
-        )
+        if self.job.model_base is None:
+            # weights are streamed from the checkpoint files
+            state_dict, extract_diff_meta = extract_diff_from_files(
+                self.job.base_model_path,
+                self.job.extract_model_path,
+                self.job.is_v2,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                not self.disable_cp,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                lowrank_niter=self.lowrank_niter,
+                num_workers=self.job.num_workers,
+            )
+        else:
+            state_dict, extract_diff_meta = extract_diff(
+                self.job.model_base,
+                self.job.model_extract,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                not self.disable_cp,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                lowrank_niter=self.lowrank_niter,
+            )
 
         self.add_meta(extract_diff_meta)
         self.save(state_dict)
@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
+from toolkit.lycoris_utils import extract_diff, extract_diff_from_files
 from .BaseExtractProcess import BaseExtractProcess
 
 
@@ -44,25 +44,49 @@ class ExtractLoraProcess(BaseExtractProcess):
         self.conv_param = self.get_conf('conv', mode_dict[self.mode]['conv'], as_type=mode_dict[self.mode]['type'])
         self.use_sparse_bias = self.get_conf('use_sparse_bias', False)
         self.sparsity = self.get_conf('sparsity', 0.98)
+        # opt in to a randomized svd with this many power iterations for fixed rank extraction.
+        # Faster on large layers but approximate. None uses an exact svd
+        self.lowrank_niter = self.get_conf('lowrank_niter', None)
 
     def run(self):
         super().run()
         print(f"Running process: {self.mode}, dim: {self.dim}")
 
-        state_dict, extract_diff_meta = extract_diff(
-            self.job.model_base,
-            self.job.model_extract,
-            self.mode,
-            self.linear_param,
-            self.conv_param,
-            self.job.device,
-            self.use_sparse_bias,
-            self.sparsity,
-            small_conv=False,
-            linear_only=self.conv_param > 0.0000000001,
-            extract_unet=self.extract_unet,
-            extract_text_encoder=self.extract_text_encoder
-        )
+        if self.job.model_base is None:
+            # weights are streamed from the checkpoint files
+            state_dict, extract_diff_meta = extract_diff_from_files(
+                self.job.base_model_path,
+                self.job.extract_model_path,
+                self.job.is_v2,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                small_conv=False,
+                linear_only=self.conv_param > 0.0000000001,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                lowrank_niter=self.lowrank_niter,
+                num_workers=self.job.num_workers,
+            )
+        else:
+            state_dict, extract_diff_meta = extract_diff(
+                self.job.model_base,
+                self.job.model_extract,
+                self.mode,
+                self.linear_param,
+                self.conv_param,
+                self.job.device,
+                self.use_sparse_bias,
+                self.sparsity,
+                small_conv=False,
+                linear_only=self.conv_param > 0.0000000001,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder,
+                lowrank_niter=self.lowrank_niter,
+            )
 
         self.add_meta(extract_diff_meta)
         self.save(state_dict)
@@ -1,4 +1,5 @@
 import gc
+import glob
 import os
 from collections import OrderedDict
 from typing import ForwardRef, List, Optional, Union
@@ -7,7 +8,9 @@ import torch
 from safetensors.torch import save_file, load_file
 
 from jobs.process.BaseProcess import BaseProcess
-from toolkit.config_modules import ModelConfig, GenerateImageConfig
+from toolkit.adapter_pool import LoRAAdapterPool
+from toolkit.config_modules import ModelConfig, GenerateImageConfig, NetworkConfig
+from toolkit.lora_special import LoRASpecialNetwork
 from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_model_hash_to_meta, \
     add_base_model_info_to_meta
 from toolkit.sampler import get_sampler
@@ -67,6 +70,37 @@ class GenerateConfig:
             random.shuffle(self.prompts)
 
 
+class AdapterPoolConfig:
+
+    def __init__(self, **kwargs):
+        # checkpoint files, or folders to take every .safetensors file from, eg the save_root of a training run
+        self.paths: List[str] = kwargs.get('paths', [])
+        if isinstance(self.paths, str):
+            self.paths = [self.paths]
+        # how many checkpoints are kept on the device at once
+        self.pool_size: int = kwargs.get('pool_size', 8)
+        # the rank has to be at least the largest rank of the checkpoints
+        self.network_config = NetworkConfig(**kwargs.get('network', {}))
+
+    def get_adapter_paths(self) -> 'OrderedDict[str, str]':
+        adapter_paths = OrderedDict()
+        for path in self.paths:
+            if os.path.isdir(path):
+                files = sorted(glob.glob(os.path.join(path, '*.safetensors')))
+            elif os.path.exists(path):
+                files = [path]
+            else:
+                raise ValueError(f"Adapter path does not exist: {path}")
+            for file in files:
+                name = os.path.splitext(os.path.basename(file))[0]
+                if name in adapter_paths:
+                    raise ValueError(f"Two adapters are named {name}")
+                adapter_paths[name] = file
+        if len(adapter_paths) == 0:
+            raise ValueError("No adapters found in the adapter paths")
+        return adapter_paths
+
+
 class GenerateProcess(BaseProcess):
     process_id: int
     config: OrderedDict
@@ -85,6 +119,11 @@ class GenerateProcess(BaseProcess):
         self.device = self.get_conf('device', self.job.device)
         self.generate_config = GenerateConfig(**self.get_conf('generate', required=True))
         self.torch_dtype = get_torch_dtype(self.get_conf('dtype', 'float16'))
+        # renders every prompt with every checkpoint, switching between them through an adapter pool
+        self.adapter_pool_config = None
+        if self.get_conf('adapters', None) is not None:
+            self.adapter_pool_config = AdapterPoolConfig(**self.get_conf('adapters'))
+        self.adapter_pool: Optional[LoRAAdapterPool] = None
 
         self.progress_bar = None
         
@@ -117,6 +156,52 @@ class GenerateProcess(BaseProcess):
 
         print(f"Using device {self.device}")
 
+    def setup_adapter_pool(self) -> List[str]:
+        network_config = self.adapter_pool_config.network_config
+        network_kwargs = network_config.network_kwargs
+        if hasattr(self.sd, 'target_lora_modules'):
+            network_kwargs['target_lin_modules'] = self.sd.target_lora_modules
+        unet = self.sd.get_model_to_train()
+        network = LoRASpecialNetwork(
+            text_encoder=self.sd.text_encoder,
+            unet=unet,
+            lora_dim=network_config.linear,
+            multiplier=1.0,
+            alpha=network_config.linear_alpha,
+            train_unet=True,
+            train_text_encoder=False,
+            is_sdxl=self.model_config.is_xl or self.model_config.is_ssd,
+            is_v2=self.model_config.is_v2,
+            is_v3=self.model_config.is_v3,
+            is_pixart=self.model_config.is_pixart,
+            is_auraflow=self.model_config.is_auraflow,
+            is_flux=self.model_config.is_flux,
+            is_lumina2=self.model_config.is_lumina2,
+            is_ssd=self.model_config.is_ssd,
+            is_vega=self.model_config.is_vega,
+            network_config=network_config,
+            network_type=network_config.type,
+            transformer_only=network_config.transformer_only,
+            is_transformer=self.sd.is_transformer,
+            base_model=self.sd,
+            **network_kwargs
+        )
+        network.force_to(self.device, dtype=self.torch_dtype)
+        network.apply_to(self.sd.text_encoder, unet, False, True)
+        network.is_active = True
+        self.sd.network = network
+
+        self.adapter_pool = LoRAAdapterPool(
+            network,
+            capacity=self.adapter_pool_config.pool_size,
+            device=self.device,
+            dtype=self.torch_dtype,
+        )
+        for name, path in self.adapter_pool_config.get_adapter_paths().items():
+            self.adapter_pool.register(name, path)
+        print(f"Generating with {len(self.adapter_pool.names)} adapters")
+        return self.adapter_pool.names
+
     def clean_prompt(self, prompt: str):
         # remove any non alpha numeric characters or ,'" from prompt
         return ''.join(e for e in prompt if e.isalnum() or e in ", '\"")
@@ -133,38 +218,48 @@ class GenerateProcess(BaseProcess):
             if self.generate_config.compile:
                 self.sd.unet = torch.compile(self.sd.unet, mode="reduce-overhead")
 
-            print(f"Generating {len(self.generate_config.prompts)} images")
+            adapter_names = [None]
+            if self.adapter_pool_config is not None:
+                adapter_names = self.setup_adapter_pool()
+
+            print(f"Generating {len(self.generate_config.prompts) * len(adapter_names)} images")
             # build prompt image configs
             prompt_image_configs = []
-            for _ in range(self.generate_config.num_repeats):
-                for prompt in self.generate_config.prompts:
-                    # remove --
-                    prompt = prompt.replace('--', '').strip()
-                    width = self.generate_config.width
-                    height = self.generate_config.height
-                    # prompt = self.clean_prompt(prompt)
-
-                    if self.generate_config.size_list is not None:
-                        # randomly select a size
-                        width, height = random.choice(self.generate_config.size_list)
-
-                    prompt_image_configs.append(GenerateImageConfig(
-                        prompt=prompt,
-                        prompt_2=self.generate_config.prompt_2,
-                        width=width,
-                        height=height,
-                        num_inference_steps=self.generate_config.sample_steps,
-                        guidance_scale=self.generate_config.guidance_scale,
-                        negative_prompt=self.generate_config.neg,
-                        negative_prompt_2=self.generate_config.neg_2,
-                        seed=self.generate_config.seed,
-                        guidance_rescale=self.generate_config.guidance_rescale,
-                        output_ext=self.generate_config.ext,
-                        output_folder=self.output_folder,
-                        add_prompt_file=self.generate_config.prompt_file
-                    ))
+            # grouped by adapter so each checkpoint is only loaded into the pool once
+            for adapter_name in adapter_names:
+                for _ in range(self.generate_config.num_repeats):
+                    for prompt in self.generate_config.prompts:
+                        # remove --
+                        prompt = prompt.replace('--', '').strip()
+                        width = self.generate_config.width
+                        height = self.generate_config.height
+                        # prompt = self.clean_prompt(prompt)
+
+                        if self.generate_config.size_list is not None:
+                            # randomly select a size
+                            width, height = random.choice(self.generate_config.size_list)
+
+                        prompt_image_configs.append(GenerateImageConfig(
+                            prompt=prompt,
+                            prompt_2=self.generate_config.prompt_2,
+                            width=width,
+                            height=height,
+                            num_inference_steps=self.generate_config.sample_steps,
+                            guidance_scale=self.generate_config.guidance_scale,
+                            negative_prompt=self.generate_config.neg,
+                            negative_prompt_2=self.generate_config.neg_2,
+                            seed=self.generate_config.seed,
+                            guidance_rescale=self.generate_config.guidance_rescale,
+                            output_ext=self.generate_config.ext,
+                            output_folder=self.output_folder,
+                            add_prompt_file=self.generate_config.prompt_file,
+                            adapter=adapter_name,
+                            output_tail=adapter_name if adapter_name is not None else '',
+                        ))
             # generate images
             self.sd.generate_images(prompt_image_configs, sampler=self.generate_config.sampler)
+            if self.adapter_pool is not None:
+                self.adapter_pool.print_stats()
 
             print("Done generating images")
             # cleanup
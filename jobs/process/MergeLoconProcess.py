@@ -1,20 +1,35 @@
+import os
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
-from .BaseExtractProcess import BaseExtractProcess
 
+from toolkit.lycoris_utils import merge_from_files
+from toolkit.metadata import get_meta_for_safetensors
+from .BaseMergeProcess import BaseMergeProcess
 
-class MergeLoconProcess(BaseExtractProcess):
+
+class MergeLoconProcess(BaseMergeProcess):
     def __init__(self, process_id: int, job, config: OrderedDict):
         super().__init__(process_id, job, config)
+        # ldm stable diffusion .safetensors checkpoint to merge into
+        self.base_model = self.get_conf('base_model', self.job.base_model_path, required=self.job.base_model_path is None)
+        # list of {path: str, scale: float}
+        self.loras = self.get_conf('loras', required=True)
+        self.is_v2 = self.get_conf('is_v2', self.job.is_v2)
+        self.max_shard_size = self.get_conf('max_shard_size', "5GB")
+        self.num_workers = self.get_conf('num_workers', os.cpu_count() if self.job.device == 'cpu' else 1, as_type=int)
 
     def run(self):
         super().run()
-        new_state_dict = {}
-        raise NotImplementedError("This is not implemented yet")
-
-
-    def get_output_path(self, prefix=None, suffix=None):
-        if suffix is None:
-            suffix = f"_{self.mode}_{self.linear_param}_{self.conv_param}"
-        return super().get_output_path(prefix, suffix)
-
+        loras = [(lora['path'], float(lora.get('scale', 1.0))) for lora in self.loras]
+        print(f"Merging {len(loras)} LoRA{'' if len(loras) == 1 else 's'} into {self.base_model}")
+        merge_from_files(
+            self.base_model,
+            loras,
+            self.output_path,
+            is_v2=self.is_v2,
+            dtype=self.torch_dtype,
+            device=self.job.device,
+            num_workers=self.num_workers,
+            max_shard_size=self.max_shard_size,
+            metadata=get_meta_for_safetensors(self.meta, self.job.name),
+        )
+        print(f"Saved to {self.output_path}")
@@ -7,7 +7,7 @@ import torch
 from safetensors.torch import save_file, load_file
 
 from jobs.process.BaseProcess import BaseProcess
-from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_model_hash_to_meta, \
+from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, save_file_with_model_hash, \
     add_base_model_info_to_meta
 from toolkit.train_tools import get_torch_dtype
 
@@ -90,8 +90,7 @@ class ModRescaleLoraProcess(BaseProcess):
             v = v.detach().clone().to("cpu").to(self.save_dtype)
             new_state_dict[key] = v
 
-        save_meta = add_model_hash_to_meta(new_state_dict, save_meta)
-        save_file(new_state_dict, self.output_path, save_meta)
+        save_meta = save_file_with_model_hash(new_state_dict, self.output_path, save_meta)
 
         # cleanup incase there are other jobs
         del new_state_dict
@@ -5,6 +5,7 @@ from .BaseProcess import BaseProcess
 from .BaseTrainProcess import BaseTrainProcess
 from .TrainVAEProcess import TrainVAEProcess
 from .BaseMergeProcess import BaseMergeProcess
+from .MergeLoconProcess import MergeLoconProcess
 from .TrainSliderProcess import TrainSliderProcess
 from .TrainSliderProcessOld import TrainSliderProcessOld
 from .TrainSDRescaleProcess import TrainSDRescaleProcess
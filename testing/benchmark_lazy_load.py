@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from toolkit.util.lazy_load import get_safetensors_weight_map, load_model_lazily
+
+# compares peak host memory of loading a synthetic transformer the eager way (the whole state dict, then
+# processing the blocks) against the lazy per block path. Every block is cast to float8 after loading as a
+# stand in for quantizing it, so the end state is smaller than the source. Each mode runs in its own process.
+# python testing/benchmark_lazy_load.py --num_blocks 24 --hidden_size 1024
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_blocks', type=int, default=24, help='Number of blocks')
+parser.add_argument('--hidden_size', type=int, default=1024, help='Hidden size of the fake model')
+parser.add_argument('--mode', type=str, default=None, help='eager or lazy, used internally')
+parser.add_argument('--folder', type=str, default=None, help='Saved model folder, used internally')
+args = parser.parse_args()
+
+DTYPE = torch.bfloat16
+
+
+class SyntheticBlock(torch.nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(dim)
+        self.attn = torch.nn.Linear(dim, dim * 4)
+        self.ff = torch.nn.Sequential(torch.nn.Linear(dim, dim * 4), torch.nn.GELU(), torch.nn.Linear(dim * 4, dim))
+
+
+class SyntheticModel(torch.nn.Module):
+    def __init__(self, dim, num_blocks):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(dim, dim)
+        self.transformer_blocks = torch.nn.ModuleList([SyntheticBlock(dim) for _ in range(num_blocks)])
+        self.proj_out = torch.nn.Linear(dim, dim)
+
+
+def build():
+    return SyntheticModel(args.hidden_size, args.num_blocks)
+
+
+def process_block(block):
+    for module in block.modules():
+        if isinstance(module, torch.nn.Linear):
+            module.weight.data = module.weight.data.to(torch.float8_e4m3fn)
+
+
+def get_peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode, folder):
+    rss_before = get_peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'eager':
+        from accelerate import init_empty_weights
+        with init_empty_weights():
+            model = build()
+        state_dict = {k: v.to(DTYPE) for k, v in load_file(os.path.join(folder, 'model.safetensors')).items()}
+        model.load_state_dict(state_dict, assign=True)
+        del state_dict
+        for block in model.transformer_blocks:
+            process_block(block)
+    else:
+        model = load_model_lazily(
+            build,
+            get_safetensors_weight_map(folder),
+            DTYPE,
+            block_names=['transformer_blocks'],
+            process_block=process_block,
+        )
+    load_time = time.perf_counter() - start
+    final_mb = sum(p.numel() * p.element_size() for p in model.parameters()) / 1024 ** 2
+    return {'load_s': load_time, 'peak_extra_mb': get_peak_rss_mb() - rss_before, 'final_mb': final_mb}
+
+
+if __name__ == "__main__":
+    if args.mode is not None:
+        print(json.dumps(run_mode(args.mode, args.folder)))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        model = build()
+        state_dict = {k: v.to(DTYPE).contiguous() for k, v in model.state_dict().items()}
+        source_mb = sum(v.numel() * v.element_size() for v in state_dict.values()) / 1024 ** 2
+        save_file(state_dict, os.path.join(folder, 'model.safetensors'))
+        del model, state_dict
+        block_mb = source_mb / args.num_blocks
+        print(f"{args.num_blocks} blocks, {source_mb:.0f}MB in bf16, {block_mb:.0f}MB per block\n")
+        print(f"{'mode':<8}{'load s':>8}{'peak extra MB':>16}{'final MB':>10}")
+        for mode in ['eager', 'lazy']:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--mode', mode, '--folder', folder,
+                 '--num_blocks', str(args.num_blocks), '--hidden_size', str(args.hidden_size)],
+                capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:<8}{result['load_s']:>8.2f}{result['peak_extra_mb']:>16.0f}{result['final_mb']:>10.0f}")
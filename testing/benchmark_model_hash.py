@@ -0,0 +1,102 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import safetensors.torch
+import torch
+
+from toolkit.metadata import load_metadata_from_safetensors, save_file_with_model_hash
+from toolkit.train_tools import addnet_hash_legacy, addnet_hash_safetensors
+
+# compares the old in memory hashing (serialize to bytes + BytesIO) against hashing the written file.
+# each method runs in its own process so peak RSS can be compared
+# python testing/benchmark_model_hash.py --size_gb 4
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size_gb', type=float, default=4.0, help='Size of the fake state dict in GB')
+parser.add_argument('--tensor_mb', type=float, default=64.0, help='Size of each tensor in MB')
+parser.add_argument('--output_dir', type=str, default=None, help='Where to write the test files')
+args = parser.parse_args()
+
+
+def make_state_dict(size_gb, tensor_mb):
+    torch.manual_seed(0)
+    numel = int(tensor_mb * 1024 * 1024 / 2)
+    num_tensors = max(1, int(size_gb * 1024 / tensor_mb))
+    state_dict = OrderedDict()
+    for i in range(num_tensors):
+        state_dict[f"lora_unet_block_{i}.lora_down.weight"] = torch.randn(numel, dtype=torch.float16)
+    return state_dict
+
+
+def get_meta():
+    return OrderedDict({
+        "ss_output_name": "benchmark",
+        "ss_base_model_version": "sdxl_1.0",
+        "training_info": "{}",
+    })
+
+
+def run_old(output_file, queue):
+    state_dict = make_state_dict(args.size_gb, args.tensor_mb)
+    meta = get_meta()
+    start = time.time()
+    metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
+    b = BytesIO(safetensors.torch.save(state_dict, metadata))
+    meta["sshs_model_hash"] = addnet_hash_safetensors(b)
+    meta["sshs_legacy_hash"] = addnet_hash_legacy(b)
+    del b
+    safetensors.torch.save_file(state_dict, output_file, meta)
+    elapsed = time.time() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, dict(meta)))
+
+
+def run_new(output_file, queue):
+    state_dict = make_state_dict(args.size_gb, args.tensor_mb)
+    meta = get_meta()
+    start = time.time()
+    meta = save_file_with_model_hash(state_dict, output_file, meta)
+    elapsed = time.time() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, dict(meta)))
+
+
+def run_in_process(fn, output_file):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=fn, args=(output_file, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == '__main__':
+    output_dir = args.output_dir if args.output_dir is not None else tempfile.mkdtemp()
+    os.makedirs(output_dir, exist_ok=True)
+    old_file = os.path.join(output_dir, 'hash_old.safetensors')
+    new_file = os.path.join(output_dir, 'hash_new.safetensors')
+
+    print(f"Benchmarking hashing of a {args.size_gb:.1f}GB state dict")
+    old_time, old_rss, old_meta = run_in_process(run_old, old_file)
+    new_time, new_rss, new_meta = run_in_process(run_new, new_file)
+
+    # ru_maxrss is in KB on linux
+    print(f"in memory:  {old_time:.2f}s, peak rss {old_rss / 1024 / 1024:.2f}GB")
+    print(f"from file:  {new_time:.2f}s, peak rss {new_rss / 1024 / 1024:.2f}GB")
+
+    assert old_meta["sshs_model_hash"] == new_meta["sshs_model_hash"], "model hash mismatch"
+    assert old_meta["sshs_legacy_hash"] == new_meta["sshs_legacy_hash"], "legacy hash mismatch"
+    # the rewritten header has to be readable and keep the hashes
+    file_meta = load_metadata_from_safetensors(new_file)
+    assert str(file_meta["sshs_model_hash"]) == new_meta["sshs_model_hash"], "hash missing from saved metadata"
+    print("Hashes match")
+
+    os.remove(old_file)
+    os.remove(new_file)
@@ -0,0 +1,158 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.lora_special import LoRASpecialNetwork, LINEAR_MODULES, CONV_MODULES
+from toolkit.memory_management.manager import LINEAR_MODULES as MM_LINEAR_MODULES, CONV_MODULES as MM_CONV_MODULES, \
+    UNMANAGED_MODULES, UNMANAGED_MODULES_INCLUDES
+from toolkit.module_index import ModuleIndex, NameFilter
+
+# times LoRA module discovery on a synthetic DiT against the old nested named_modules() walk and
+# checks both select the same modules. Runs on cpu.
+# python testing/benchmark_module_index.py --num_blocks 57
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_blocks', type=int, default=57, help='Number of transformer blocks')
+parser.add_argument('--hidden_size', type=int, default=64, help='Hidden size of the fake model')
+parser.add_argument('--ignore', type=str, nargs='*', default=['norm_out', 'proj_out', 'x_embedder'])
+args = parser.parse_args()
+
+
+class SyntheticAttention(torch.nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.to_q = torch.nn.Linear(dim, dim)
+        self.to_k = torch.nn.Linear(dim, dim)
+        self.to_v = torch.nn.Linear(dim, dim)
+        self.to_out = torch.nn.ModuleList([torch.nn.Linear(dim, dim), torch.nn.Dropout(0.0)])
+        self.norm_q = torch.nn.RMSNorm(dim) if hasattr(torch.nn, 'RMSNorm') else torch.nn.LayerNorm(dim)
+        self.norm_k = torch.nn.RMSNorm(dim) if hasattr(torch.nn, 'RMSNorm') else torch.nn.LayerNorm(dim)
+
+
+class SyntheticBlock(torch.nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.norm1 = torch.nn.LayerNorm(dim)
+        self.attn = SyntheticAttention(dim)
+        self.norm2 = torch.nn.LayerNorm(dim)
+        self.ff = torch.nn.Sequential(
+            torch.nn.Linear(dim, dim * 4),
+            torch.nn.GELU(),
+            torch.nn.Linear(dim * 4, dim),
+        )
+
+
+class SyntheticTransformer(torch.nn.Module):
+    def __init__(self, dim, num_blocks):
+        super().__init__()
+        self.x_embedder = torch.nn.Linear(dim, dim)
+        self.transformer_blocks = torch.nn.ModuleList([SyntheticBlock(dim) for _ in range(num_blocks)])
+        self.norm_out = torch.nn.LayerNorm(dim)
+        self.proj_out = torch.nn.Linear(dim, dim)
+
+
+def legacy_lora_names(root, target_replace_modules, ignore_if_contains, prefix='transformer'):
+    # the walk create_modules used before the index
+    names = []
+    for name, module in root.named_modules():
+        if module.__class__.__name__ in target_replace_modules:
+            for child_name, child_module in module.named_modules():
+                if child_module.__class__.__name__ not in LINEAR_MODULES + CONV_MODULES:
+                    continue
+                lora_name = ".".join([x for x in [prefix, name, child_name] if x])
+                if any([word in lora_name for word in ignore_if_contains]):
+                    continue
+                names.append(lora_name.replace(".", "_"))
+    return names
+
+
+def indexed_lora_names(root, target_replace_modules, ignore_if_contains, prefix='transformer'):
+    ignore_filter = NameFilter(ignore_if_contains)
+    names = []
+    for child_name, child_module, module in ModuleIndex(root).iter_under_targets(
+            target_replace_modules,
+            LINEAR_MODULES + CONV_MODULES
+    ):
+        lora_name = ".".join([x for x in [prefix, child_name] if x])
+        if ignore_filter.matches(lora_name):
+            continue
+        names.append(lora_name.replace(".", "_"))
+    return names
+
+
+def legacy_managed_modules(root):
+    # the nested walk MemoryManager.attach used before the index
+    found = []
+    for name, sub_module in root.named_modules():
+        for child_name, child_module in sub_module.named_modules():
+            class_name = child_module.__class__.__name__
+            if class_name in MM_LINEAR_MODULES or class_name in MM_CONV_MODULES or class_name in UNMANAGED_MODULES or any(
+                    inc in class_name for inc in UNMANAGED_MODULES_INCLUDES):
+                found.append(child_module)
+    return found
+
+
+def indexed_managed_modules(root):
+    unmanaged_includes = NameFilter(UNMANAGED_MODULES_INCLUDES)
+    found = []
+    for name, child_module in ModuleIndex(root).iter_modules():
+        class_name = child_module.__class__.__name__
+        if class_name in MM_LINEAR_MODULES or class_name in MM_CONV_MODULES or class_name in UNMANAGED_MODULES or \
+                unmanaged_includes.matches(class_name):
+            found.append(child_module)
+    return found
+
+
+def timed(fn, *fn_args, **fn_kwargs):
+    start = time.perf_counter()
+    result = fn(*fn_args, **fn_kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    model = SyntheticTransformer(args.hidden_size, args.num_blocks)
+    num_modules = len(list(model.named_modules()))
+    print(f"Synthetic model: {args.num_blocks} blocks, {num_modules} modules")
+
+    # whole model as the target, the way the transformer models set it up
+    targets = ['SyntheticTransformer']
+    legacy_names, legacy_time = timed(legacy_lora_names, model, targets, args.ignore)
+    indexed_names, indexed_time = timed(indexed_lora_names, model, targets, args.ignore)
+    assert legacy_names == indexed_names, "LoRA module selection differs"
+    print(f"LoRA selection:   legacy {legacy_time * 1000:.1f}ms, indexed {indexed_time * 1000:.1f}ms, "
+          f"{len(indexed_names)} modules")
+
+    legacy_mm, legacy_mm_time = timed(legacy_managed_modules, model)
+    indexed_mm, indexed_mm_time = timed(indexed_managed_modules, model)
+    legacy_mm_ids = set(id(m) for m in legacy_mm)
+    indexed_mm_ids = set(id(m) for m in indexed_mm)
+    assert legacy_mm_ids == indexed_mm_ids, "Memory manager module selection differs"
+    print(f"Memory manager:   legacy {legacy_mm_time * 1000:.1f}ms ({len(legacy_mm)} visits), "
+          f"indexed {indexed_mm_time * 1000:.1f}ms ({len(indexed_mm)} visits)")
+
+    network, network_time = timed(
+        LoRASpecialNetwork,
+        text_encoder=None,
+        unet=model,
+        lora_dim=4,
+        alpha=4,
+        train_text_encoder=False,
+        train_unet=True,
+        ignore_if_contains=args.ignore,
+        target_lin_modules=targets,
+        target_conv_modules=[],
+        is_transformer=True,
+    )
+    # transformers use peft names, $$ in place of the dots
+    network_names = sorted(lora.lora_name.replace('$$', '_') for lora in network.unet_loras)
+    assert network_names == sorted(indexed_names), "LoRASpecialNetwork created a different set of modules"
+    print(f"Network creation: {network_time * 1000:.1f}ms, {len(network.unet_loras)} loras")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.automagic import Automagic
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor, BlockwiseInt8Tensor
+
+# times the 8bit optimizers with block wise states and grouped updates against the per param loops with
+# per tensor Auto8bitTensor states they replaced, and checks that old state dicts still load. Runs on cpu.
+# Every implementation runs in its own process so the peak memory of the steps can be measured.
+# python testing/benchmark_optimizer_8bit.py --num_blocks 24 --hidden_size 256
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_blocks', type=int, default=24, help='Number of fake transformer blocks')
+parser.add_argument('--hidden_size', type=int, default=256, help='Hidden size of the fake model')
+parser.add_argument('--steps', type=int, default=10, help='Timed steps')
+parser.add_argument('--impl', type=str, default=None, help='Run a single implementation, used internally')
+args = parser.parse_args()
+
+
+def make_params(seed=0):
+    # the shapes of the linear layers and biases of a transformer, lots of repeated shapes
+    generator = torch.Generator().manual_seed(seed)
+    dim = args.hidden_size
+    shapes = []
+    for _ in range(args.num_blocks):
+        shapes += [(dim, dim)] * 4 + [(dim * 4, dim), (dim, dim * 4)]
+        shapes += [(dim,)] * 5 + [(dim * 4,)]
+    params = [torch.nn.Parameter(torch.randn(shape, generator=generator) * 0.02) for shape in shapes]
+    grads = [torch.randn(shape, generator=generator) * 0.01 for shape in shapes]
+    return params, grads
+
+
+class LegacyAdam8bit(Adam8bit):
+    # the per param step from before the grouped update
+    @torch.no_grad()
+    def step(self, closure=None):
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            eps = group['eps']
+            lr = group['lr']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data.to(torch.float32)
+                p_fp32 = p.clone().to(torch.float32)
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = Auto8bitTensor(torch.zeros_like(p_fp32.data).detach())
+                    state['exp_avg_sq'] = Auto8bitTensor(torch.zeros_like(p_fp32.data).detach())
+                exp_avg = state['exp_avg'].to(torch.float32)
+                exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
+                state['step'] += 1
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                step_size = lr / bias_correction1
+                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+                p_fp32.data.addcdiv_(exp_avg, denom, value=-step_size)
+                state['exp_avg'] = Auto8bitTensor(exp_avg)
+                state['exp_avg_sq'] = Auto8bitTensor(exp_avg_sq)
+                # copy_stochastic refuses cpu tensors, these params are fp32 so it would only copy
+                p.data.copy_(p_fp32)
+
+
+class LegacyAutomagic(Automagic):
+    # the per param step from before the grouped update, without weight decay
+    @torch.no_grad()
+    def step(self, closure=None):
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.to(torch.float32)
+                state = self.state[p]
+                if len(state) == 0:
+                    self.initialize_state(p)
+                    state['lr_mask'] = Auto8bitTensor(torch.ones(p.shape) * self.lr)
+                factored = len(grad.shape) >= 2
+                state['step'] += 1
+                state['RMS'] = self._rms(p)
+                beta2 = group['beta2']
+                update = (grad ** 2) + group['eps'][0]
+                if factored:
+                    state['exp_avg_sq_row'].mul_(beta2).add_(update.mean(dim=-1), alpha=(1.0 - beta2))
+                    state['exp_avg_sq_col'].mul_(beta2).add_(update.mean(dim=-2), alpha=(1.0 - beta2))
+                    update = self._approx_sq_grad(state['exp_avg_sq_row'], state['exp_avg_sq_col'])
+                    update.mul_(grad)
+                else:
+                    state['exp_avg_sq'].mul_(beta2).add_(update, alpha=(1.0 - beta2))
+                    update = state['exp_avg_sq'].rsqrt().mul_(grad)
+                update.div_((self._rms(update) / group['clip_threshold']).clamp_(min=1.0))
+                current_polarity = (update > 0).to(torch.bool)
+                sign_agreement = torch.where(state['last_polarity'] == current_polarity, 1, -1)
+                state['last_polarity'] = current_polarity
+                lr_mask = state['lr_mask'].to(torch.float32)
+                new_lr = torch.where(sign_agreement > 0, lr_mask + self.lr_bump, lr_mask - self.lr_bump)
+                new_lr = torch.clamp(new_lr, min=self.min_lr, max=self.max_lr)
+                update.mul_(new_lr)
+                state['lr_mask'] = Auto8bitTensor(new_lr)
+                state['avg_lr'] = torch.mean(new_lr)
+                p.add_(-update)
+
+
+IMPLEMENTATIONS = {
+    'adam8bit_legacy': lambda params: LegacyAdam8bit(params, lr=1e-4, eps=1e-6),
+    'adam8bit_blockwise': lambda params: Adam8bit(params, lr=1e-4, eps=1e-6),
+    'automagic_legacy': lambda params: LegacyAutomagic(params, lr=1e-6),
+    'automagic_blockwise': lambda params: Automagic(params, lr=1e-6),
+}
+
+
+def get_state_nbytes(optimizer):
+    total = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if isinstance(value, Auto8bitTensor):
+                value = value.state_dict()
+                total += value['quantized'].numel()
+                if isinstance(value['scale'], torch.Tensor):
+                    total += value['scale'].numel() * value['scale'].element_size()
+            elif isinstance(value, torch.Tensor):
+                total += value.numel() * value.element_size()
+    return total
+
+
+def get_peak_rss_bytes():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_impl(name):
+    params, grads = make_params()
+    optimizer = IMPLEMENTATIONS[name](params)
+    for p, g in zip(params, grads):
+        p.grad = g
+    # the first step allocates the states
+    optimizer.step()
+    rss_before = get_peak_rss_bytes()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        optimizer.step()
+    step_time = (time.perf_counter() - start) / args.steps
+    return {
+        'step_ms': step_time * 1000,
+        'peak_extra_mb': (get_peak_rss_bytes() - rss_before) / 1024 ** 2,
+        'state_mb': get_state_nbytes(optimizer) / 1024 ** 2,
+    }
+
+
+def check_results_match():
+    # both implementations make nearly the same updates, the block wise states are just more precise
+    for legacy_name, new_name in [('adam8bit_legacy', 'adam8bit_blockwise'), ('automagic_legacy', 'automagic_blockwise')]:
+        legacy_params, grads = make_params()
+        new_params, _ = make_params()
+        legacy = IMPLEMENTATIONS[legacy_name](legacy_params)
+        new = IMPLEMENTATIONS[new_name](new_params)
+        for lp, np_, g in zip(legacy_params, new_params, grads):
+            lp.grad = g
+            np_.grad = g.clone()
+        for _ in range(3):
+            legacy.step()
+            new.step()
+        start_params, _ = make_params()
+        max_diff = 0.0
+        max_update = 0.0
+        for lp, np_, sp in zip(legacy_params, new_params, start_params):
+            max_diff = max(max_diff, (lp - np_).abs().max().item())
+            max_update = max(max_update, (lp - sp).abs().max().item())
+        print(f"{new_name}: max param difference to legacy {max_diff:.3e}, max update {max_update:.3e}")
+        assert max_diff <= max_update * 0.1
+
+
+def check_legacy_state_dict_loads():
+    params, grads = make_params()
+    legacy = LegacyAdam8bit(params, lr=1e-4, eps=1e-6)
+    for p, g in zip(params, grads):
+        p.grad = g
+    legacy.step()
+    state_dict = legacy.state_dict()
+    new = Adam8bit(params, lr=1e-4, eps=1e-6)
+    new.load_state_dict(state_dict)
+    for p in params:
+        state = new.state[p]
+        assert isinstance(state['exp_avg'], BlockwiseInt8Tensor)
+        legacy_exp_avg = legacy.state[p]['exp_avg'].dequantize()
+        assert torch.allclose(state['exp_avg'].dequantize(), legacy_exp_avg, atol=legacy.state[p]['exp_avg'].scale)
+    new.step()
+
+    legacy = LegacyAutomagic(params, lr=1e-6)
+    legacy.step()
+    new = Automagic(params, lr=1e-6)
+    new.load_state_dict(legacy.state_dict())
+    for p in params:
+        assert isinstance(new.state[p]['lr_mask'], BlockwiseInt8Tensor)
+    new.step()
+    print("legacy state dicts load: OK")
+
+
+if __name__ == "__main__":
+    if args.impl is not None:
+        print(json.dumps(run_impl(args.impl)))
+        sys.exit(0)
+
+    check_results_match()
+    check_legacy_state_dict_loads()
+
+    num_params = sum(p.numel() for p in make_params()[0])
+    print(f"\n{num_params:,} params, {args.steps} steps\n")
+    print(f"{'implementation':<22}{'step ms':>10}{'peak extra MB':>16}{'state MB':>10}")
+    for name in IMPLEMENTATIONS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--impl', name,
+             '--num_blocks', str(args.num_blocks), '--hidden_size', str(args.hidden_size), '--steps', str(args.steps)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{name:<22}{result['step_ms']:>10.1f}{result['peak_extra_mb']:>16.1f}{result['state_mb']:>10.1f}")
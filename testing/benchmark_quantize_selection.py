@@ -0,0 +1,95 @@
+import argparse
+import os
+import sys
+import time
+from fnmatch import fnmatch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.util.quantize import get_qtype, quantize_blocks, select_modules
+
+# times quantize module selection on a synthetic 1000 block model against the old fnmatch loop and
+# checks both select the same modules, then times quantizing the blocks on the cpu serially and on
+# the thread pool.
+# python testing/benchmark_quantize_selection.py --num_blocks 1000 --qtype qfloat8
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_blocks', type=int, default=1000, help='Number of blocks')
+parser.add_argument('--hidden_size', type=int, default=64, help='Hidden size of the fake model')
+parser.add_argument('--quantize_blocks', type=int, default=64, help='Blocks to quantize for the timing, 0 to skip')
+parser.add_argument('--qtype', type=str, default='qfloat8')
+parser.add_argument('--num_workers', type=int, default=8)
+args = parser.parse_args()
+
+
+class SyntheticBlock(torch.nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(dim)
+        self.to_q = torch.nn.Linear(dim, dim)
+        self.to_k = torch.nn.Linear(dim, dim)
+        self.to_v = torch.nn.Linear(dim, dim)
+        self.to_out = torch.nn.Linear(dim, dim)
+        self.ff = torch.nn.Sequential(torch.nn.Linear(dim, dim * 4), torch.nn.GELU(), torch.nn.Linear(dim * 4, dim))
+
+
+class SyntheticModel(torch.nn.Module):
+    def __init__(self, dim, num_blocks):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(dim, dim)
+        self.transformer_blocks = torch.nn.ModuleList([SyntheticBlock(dim) for _ in range(num_blocks)])
+        self.proj_out = torch.nn.Linear(dim, dim)
+
+
+def legacy_select(model, include, exclude):
+    # the selection quantize used before the compiled patterns
+    selected = []
+    for name, m in model.named_modules():
+        if include is not None and not any(fnmatch(name, pattern) for pattern in include):
+            continue
+        if exclude is not None and any(fnmatch(name, pattern) for pattern in exclude):
+            continue
+        selected.append(name)
+    return selected
+
+
+def time_selection(model, include, exclude, label):
+    start = time.perf_counter()
+    legacy = legacy_select(model, include, exclude)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    compiled = [name for name, _ in select_modules(model, include, exclude)]
+    compiled_time = time.perf_counter() - start
+    assert legacy == compiled, f"{label}: selections differ"
+    print(
+        f"{label:<32} {len(compiled):>7} selected  legacy {legacy_time * 1000:>9.1f}ms  "
+        f"compiled {compiled_time * 1000:>7.1f}ms  ({legacy_time / max(compiled_time, 1e-9):.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    model = SyntheticModel(args.hidden_size, args.num_blocks)
+    num_modules = len(list(model.named_modules()))
+    print(f"{args.num_blocks} blocks, {num_modules} modules\n")
+
+    # one exclude entry per lora module, like the accuracy recovery adapter path
+    ara_exclude = [
+        f"transformer_blocks.{i}.{name}"
+        for i in range(args.num_blocks)
+        for name in ['to_q', 'to_k', 'to_v', 'to_out', 'ff.0', 'ff.2']
+    ]
+    time_selection(model, None, ara_exclude, "exclude every lora module")
+    time_selection(model, None, ['*norm*', 'proj_*'], "wildcard exclude")
+    time_selection(model, ['transformer_blocks.*'], ['*.ff.*'], "wildcard include and exclude")
+
+    if args.quantize_blocks > 0:
+        weights = get_qtype(args.qtype)
+        num = min(args.quantize_blocks, args.num_blocks)
+        print()
+        for num_workers in [1, args.num_workers]:
+            blocks = [SyntheticBlock(args.hidden_size * 16) for _ in range(num)]
+            start = time.perf_counter()
+            quantize_blocks(blocks, weights, 'cpu', torch.float32, num_workers=num_workers)
+            print(f"{num_workers} workers: {time.perf_counter() - start:.2f}s for {num} blocks")
@@ -0,0 +1,126 @@
+import copy
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import torch
+
+from toolkit.adapter_pool import LoRAAdapterPool
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRASpecialNetwork
+
+
+class ToyTransformer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(8, 16)
+        self.proj_out = torch.nn.Linear(16, 8)
+
+    def forward(self, x):
+        return self.proj_out(torch.nn.functional.gelu(self.proj_in(x)))
+
+
+def make_network(model, rank, alpha):
+    network = LoRASpecialNetwork(
+        text_encoder=[],
+        unet=model,
+        lora_dim=rank,
+        alpha=alpha,
+        train_text_encoder=False,
+        target_lin_modules=['ToyTransformer'],
+        network_config=NetworkConfig(type='lora', linear=rank, linear_alpha=alpha),
+    )
+    network.apply_to([], model, False, True)
+    return network
+
+
+class Adapter:
+    """A checkpoint for the pool and a copy of the model with it applied the normal way to compare to"""
+
+    def __init__(self, base_model, rank, alpha):
+        self.model = copy.deepcopy(base_model)
+        self.network = make_network(self.model, rank, alpha)
+        for lora in self.network.unet_loras:
+            torch.nn.init.normal_(lora.lora_up.weight)
+        self.network.is_active = True
+        self.state_dict = {key: value.detach().clone() for key, value in self.network.state_dict().items()}
+
+    @torch.no_grad()
+    def __call__(self, x, multiplier=1.0):
+        self.network.multiplier = multiplier
+        return self.model(x)
+
+
+@pytest.fixture
+def setup():
+    torch.manual_seed(0)
+    model = ToyTransformer()
+    # alpha != rank and a smaller rank than the pool check the scale and the padding
+    adapters = {
+        'a': Adapter(model, rank=4, alpha=2),
+        'b': Adapter(model, rank=2, alpha=2),
+        'c': Adapter(model, rank=4, alpha=4),
+    }
+    network = make_network(model, rank=4, alpha=4)
+    pool = LoRAAdapterPool(network, capacity=2)
+    for name, adapter in adapters.items():
+        pool.register(name, adapter.state_dict)
+    return model, pool, adapters
+
+
+def test_lru_eviction_order(setup):
+    _, pool, _ = setup
+    pool.set_batch_adapters(['a', 'b'])
+    assert list(pool.resident.keys()) == ['a', 'b']
+    # a is the least recently used
+    pool.set_batch_adapters(['c'])
+    assert list(pool.resident.keys()) == ['b', 'c']
+    # using b makes c the oldest
+    pool.set_batch_adapters(['b'])
+    pool.set_batch_adapters(['a'])
+    assert list(pool.resident.keys()) == ['b', 'a']
+    assert pool.num_loads == 4
+    assert pool.num_evictions == 2
+
+
+def test_adapters_of_the_batch_are_not_evicted(setup):
+    _, pool, _ = setup
+    pool.set_batch_adapters(['a'])
+    pool.set_batch_adapters(['b'])
+    # a is the oldest but the batch needs it, b goes instead
+    pool.set_batch_adapters(['c', 'a'])
+    assert sorted(pool.resident.keys()) == ['a', 'c']
+    with pytest.raises(ValueError):
+        pool.set_batch_adapters(['a', 'b', 'c'])
+    with pytest.raises(ValueError):
+        pool.load('b', keep=['a', 'c'])
+    assert sorted(pool.resident.keys()) == ['a', 'c']
+
+
+@torch.no_grad()
+def test_rows_match_the_adapter_applied_on_its_own(setup):
+    model, pool, adapters = setup
+    x = torch.randn(4, 8)
+    base = model(x)
+
+    # switching adapters between batches, including one that was evicted and loaded again
+    for names in [['a', 'b', None, 'a'], ['c', 'c', 'c', 'c'], ['b', 'a', None, 'b']]:
+        pool.set_batch_adapters(names, [1.0, 0.5, 1.0, 0.75])
+        output = model(x)
+        for i, name in enumerate(names):
+            multiplier = [1.0, 0.5, 1.0, 0.75][i]
+            expected = base[i] if name is None else adapters[name](x[i:i + 1], multiplier)[0]
+            assert torch.allclose(output[i], expected, atol=1e-5), (names, i)
+    assert pool.num_evictions > 0
+
+    # cfg doubles the batch, the rows repeat
+    pool.set_batch_adapters(['a', 'b'])
+    output = model(torch.cat([x[:2], x[:2]]))
+    assert torch.allclose(output[:2], output[2:], atol=1e-6)
+    assert torch.allclose(output[1], adapters['b'](x[1:2])[0], atol=1e-5)
+
+    pool.clear()
+    pool.network.is_active = False
+    assert torch.allclose(model(x), base)
@@ -0,0 +1,130 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from toolkit.delta_checkpoint import DELTA_META_KEY, DeltaSave, decode_tensor_delta, encode_tensor_delta, \
+    get_delta_base_path, get_delta_index, load_delta_file, resolve_delta_checkpoint, cleanup_delta_restore
+from toolkit.optimizers.optimizer_checkpoint import OPTIMIZER_STATE_FOLDER, keep_optimizer_state_as_delta_base, \
+    load_optimizer_state_sharded, save_optimizer_state_sharded
+from toolkit.saving import save_sharded_safetensors
+
+
+def make_state_dict(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return {
+        'a.weight': torch.randn(64, 64, generator=generator).to(torch.bfloat16),
+        'b.weight': torch.randn(128, generator=generator),
+        'c.weight': torch.randn(32, generator=generator),
+    }
+
+
+def train_step(state_dict):
+    # a small update, c is frozen and a new key shows up
+    stepped = {key: value.clone() for key, value in state_dict.items()}
+    stepped['a.weight'] += 1e-3
+    stepped['b.weight'] += 1e-4 * torch.randn_like(stepped['b.weight'])
+    stepped['d.weight'] = torch.ones(4, dtype=torch.float16)
+    return stepped
+
+
+def assert_bit_identical(loaded, expected):
+    assert sorted(loaded.keys()) == sorted(expected.keys())
+    for key, value in expected.items():
+        assert loaded[key].dtype == value.dtype
+        assert torch.equal(loaded[key].view(torch.uint8), value.contiguous().view(torch.uint8)), key
+
+
+def test_encode_decode_round_trip():
+    base = make_state_dict()
+    stepped = train_step(base)
+    modes = {}
+    for key, tensor in stepped.items():
+        mode, stored = encode_tensor_delta(tensor, base.get(key, None))
+        modes[key] = mode
+        assert_bit_identical({key: decode_tensor_delta(mode, stored, base.get(key, None))}, {key: tensor})
+    assert modes == {'a.weight': 'xor', 'b.weight': 'xor', 'c.weight': 'same', 'd.weight': 'full'}
+
+
+def test_delta_save_single_file(tmp_path):
+    base = make_state_dict()
+    base_path = str(tmp_path / 'model_000000100.safetensors')
+    save_file(base, base_path, metadata={'step': '100'})
+
+    stepped = train_step(base)
+    save_path = str(tmp_path / 'model_000000200.safetensors')
+    with DeltaSave(save_path, base_path, delta_index=1):
+        save_file(stepped, save_path, metadata={'step': '200'})
+
+    assert get_delta_base_path(save_path) == base_path
+    assert get_delta_index(save_path) == 1
+    with safe_open(save_path, framework="pt") as f:
+        assert f.metadata()['step'] == '200'
+    assert_bit_identical(load_delta_file(save_path), stepped)
+
+
+def test_delta_save_sharded_folder_is_encoded_while_writing(tmp_path):
+    base = make_state_dict()
+    base_path = str(tmp_path / 'model_000000100')
+    save_sharded_safetensors(base.items(), os.path.join(base_path, 'transformer'), max_shard_size=8500)
+
+    stepped = train_step(base)
+    save_path = str(tmp_path / 'model_000000200')
+    with DeltaSave(save_path, base_path, delta_index=2):
+        save_sharded_safetensors(stepped.items(), os.path.join(save_path, 'transformer'), max_shard_size=8500)
+
+    transformer_folder = os.path.join(save_path, 'transformer')
+    shards = sorted([f for f in os.listdir(transformer_folder) if f.endswith('.safetensors')])
+    assert len(shards) > 1
+    for shard in shards:
+        with safe_open(os.path.join(transformer_folder, shard), framework="pt") as f:
+            assert DELTA_META_KEY in f.metadata()
+            # frozen tensors are not stored at all
+            assert 'c.weight' not in f.keys()
+    assert get_delta_base_path(save_path) == base_path
+    assert get_delta_index(save_path) == 2
+
+    # resuming restores a normal checkpoint and removes it again once loaded
+    restored_path = resolve_delta_checkpoint(save_path)
+    restored_folder = os.path.join(restored_path, 'transformer')
+    with open(os.path.join(restored_folder, 'diffusion_pytorch_model.safetensors.index.json')) as f:
+        weight_map = json.load(f)['weight_map']
+    restored = {}
+    for shard in set(weight_map.values()):
+        restored.update(load_file(os.path.join(restored_folder, shard)))
+    assert_bit_identical(restored, stepped)
+    cleanup_delta_restore(str(tmp_path))
+    assert not os.path.exists(restored_path)
+
+
+def test_optimizer_state_delta(tmp_path):
+    params = [torch.nn.Parameter(torch.randn(16, 16)), torch.nn.Parameter(torch.randn(16))]
+    optimizer = torch.optim.AdamW(params, lr=1e-3)
+
+    def step():
+        optimizer.zero_grad()
+        sum((param ** 2).sum() for param in params).backward()
+        optimizer.step()
+
+    step()
+    save_optimizer_state_sharded(optimizer.state_dict(), str(tmp_path))
+    keep_optimizer_state_as_delta_base(str(tmp_path))
+    step()
+    expected = optimizer.state_dict()
+    save_optimizer_state_sharded(expected, str(tmp_path), as_delta=True)
+    folder = os.path.join(str(tmp_path), OPTIMIZER_STATE_FOLDER)
+    with safe_open(os.path.join(folder, 'optimizer.safetensors'), framework="pt") as f:
+        assert DELTA_META_KEY in f.metadata()
+
+    new_params = [torch.nn.Parameter(param.detach().clone()) for param in params]
+    new_optimizer = torch.optim.AdamW(new_params, lr=1e-3)
+    load_optimizer_state_sharded(new_optimizer, str(tmp_path))
+    loaded = new_optimizer.state_dict()
+    for param_id, param_state in expected['state'].items():
+        for key in ['exp_avg', 'exp_avg_sq', 'step']:
+            assert torch.equal(loaded['state'][param_id][key], param_state[key])
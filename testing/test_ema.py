@@ -0,0 +1,101 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.ema import ExponentialMovingAverage
+
+
+def make_params(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    shapes = [(16, 8), (8,), (16, 8), (4, 4, 3, 3), (8,)]
+    return [torch.nn.Parameter(torch.randn(shape, generator=generator)) for shape in shapes]
+
+
+def perturb(params, step):
+    generator = torch.Generator().manual_seed(100 + step)
+    with torch.no_grad():
+        for p in params:
+            p.add_(torch.randn(p.shape, generator=generator) * 0.1)
+
+
+def reference_update(shadows, params, decay, use_feedback=False, param_multiplier=1.0):
+    # the per param loop the grouped update replaced
+    for s_param, param in zip(shadows, params):
+        tmp = (s_param - param) * (1.0 - decay)
+        s_param.sub_(tmp)
+        if use_feedback:
+            param.data.add_(tmp * 10)
+        if param_multiplier != 1.0:
+            param.data.mul_(param_multiplier)
+
+
+def assert_all_close(a, b):
+    for x, y in zip(a, b):
+        assert torch.allclose(x, y, atol=1e-6), (x - y).abs().max()
+
+
+def test_matches_reference():
+    for use_feedback, param_multiplier in [(False, 1.0), (True, 1.0), (False, 0.99)]:
+        params = make_params()
+        ref_params = make_params()
+        ema = ExponentialMovingAverage(params, decay=0.9, use_feedback=use_feedback, param_multiplier=param_multiplier)
+        ref_shadows = [p.detach().clone() for p in ref_params]
+        for step in range(5):
+            perturb(params, step)
+            perturb(ref_params, step)
+            ema.update()
+            with torch.no_grad():
+                reference_update(ref_shadows, ref_params, 0.9, use_feedback, param_multiplier)
+        assert_all_close(ema.shadow_params, ref_shadows)
+        assert_all_close(params, ref_params)
+
+
+def test_update_every_corrects_decay():
+    params = make_params()
+    ema = ExponentialMovingAverage(params, decay=0.9, update_every=3)
+    ref_shadows = [p.detach().clone() for p in params]
+    for step in range(6):
+        perturb(params, step)
+        ema.update()
+        if step % 3 == 2:
+            reference_update(ref_shadows, params, 0.9 ** 3)
+        assert_all_close(ema.shadow_params, ref_shadows)
+
+
+def test_offload_matches_device():
+    params = make_params()
+    offload_params = make_params()
+    ema = ExponentialMovingAverage(params, decay=0.9)
+    offload_ema = ExponentialMovingAverage(offload_params, decay=0.9, offload=True)
+    for step in range(4):
+        perturb(params, step)
+        perturb(offload_params, step)
+        ema.update()
+        offload_ema.update()
+    # reading the state waits for the worker
+    state = offload_ema.state_dict()
+    assert all(s.dtype == torch.float32 for s in state['shadow_params'])
+    assert_all_close(state['shadow_params'], ema.shadow_params)
+
+
+def test_store_copy_restore():
+    params = make_params()
+    ema = ExponentialMovingAverage(params, decay=0.5, offload=True)
+    perturb(params, 0)
+    ema.update()
+    trained = [p.detach().clone() for p in params]
+    ema.eval()
+    assert_all_close(params, ema.shadow_params)
+    ema.train()
+    assert_all_close(params, trained)
+
+
+def test_offload_rejects_feedback():
+    try:
+        ExponentialMovingAverage(make_params(), use_feedback=True, offload=True)
+    except ValueError:
+        return
+    assert False, "offload with feedback should raise"
@@ -0,0 +1,109 @@
+import copy
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import torch
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRASpecialNetwork
+
+
+class ToyAttention(torch.nn.Module):
+    def __init__(self, dim=16):
+        super().__init__()
+        self.to_q = torch.nn.Linear(dim, dim)
+        self.to_k = torch.nn.Linear(dim, dim)
+        self.to_v = torch.nn.Linear(dim, dim)
+        self.to_out = torch.nn.Linear(dim, dim)
+
+    def forward(self, x, context=None):
+        context = x if context is None else context
+        q = self.to_q(x)
+        k = self.to_k(context)
+        v = self.to_v(context)
+        attn = torch.softmax(q @ k.transpose(-1, -2) / q.shape[-1] ** 0.5, dim=-1)
+        return self.to_out(attn @ v)
+
+
+def make_network(model, fuse_projections):
+    network = LoRASpecialNetwork(
+        text_encoder=[],
+        unet=model,
+        lora_dim=4,
+        alpha=4,
+        train_text_encoder=False,
+        target_lin_modules=['ToyAttention'],
+        network_config=NetworkConfig(type='lora', linear=4, linear_alpha=4, fuse_projections=fuse_projections),
+    )
+    network.apply_to([], model, False, True)
+    network.is_active = True
+    network.multiplier = 1.0
+    network.requires_grad_(True)
+    return network
+
+
+def make_pair():
+    torch.manual_seed(0)
+    model = ToyAttention()
+    model.requires_grad_(False)
+    fused_model = copy.deepcopy(model)
+    separate = make_network(model, fuse_projections=False)
+    for lora in separate.unet_loras:
+        torch.nn.init.normal_(lora.lora_up.weight)
+    fused = make_network(fused_model, fuse_projections=True)
+    fused.load_state_dict(separate.state_dict())
+    return (model, separate), (fused_model, fused)
+
+
+def get_fused_group(network, name):
+    return next(lora for lora in network.unet_loras if lora.lora_name.endswith(name)).fused_group
+
+
+def run(model, network, x, context):
+    for param in network.parameters():
+        param.grad = None
+    output = model(x, context)
+    output.pow(2).sum().backward()
+    grads = {name: param.grad.detach().clone() for name, param in network.named_parameters()}
+    return output.detach(), grads
+
+
+def test_siblings_are_grouped():
+    (_, separate), (_, fused) = make_pair()
+    assert all(lora.fused_group is None for lora in separate.unet_loras)
+    group = get_fused_group(fused, '_to_q')
+    assert group is not None
+    assert [lora.lora_name for lora in group.modules] == [
+        'lora_unet_to_q', 'lora_unet_to_k', 'lora_unet_to_v'
+    ]
+    assert get_fused_group(fused, '_to_out') is None
+
+
+@pytest.mark.parametrize('cross_attention', [False, True])
+def test_fused_matches_separate_modules(cross_attention):
+    (model, separate), (fused_model, fused) = make_pair()
+    x = torch.randn(2, 6, 16)
+    context = torch.randn(2, 3, 16) if cross_attention else None
+
+    # the first pass calibrates the groups, the later ones run fused
+    for _ in range(3):
+        expected_output, expected_grads = run(model, separate, x, context)
+        output, grads = run(fused_model, fused, x, context)
+        assert torch.allclose(output, expected_output, atol=1e-5)
+        assert grads.keys() == expected_grads.keys()
+        for name in grads:
+            assert torch.allclose(grads[name], expected_grads[name], atol=1e-5), name
+
+    q_group = get_fused_group(fused, '_to_q')
+    k_group = get_fused_group(fused, '_to_k')
+    if cross_attention:
+        # q reads the hidden states and k and v the context, only k and v share an input
+        assert q_group is None
+        assert [lora.lora_name for lora in k_group.modules] == ['lora_unet_to_k', 'lora_unet_to_v']
+    else:
+        assert q_group is k_group
+        assert len(q_group.modules) == 3
+    assert k_group.is_calibrated
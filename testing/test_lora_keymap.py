@@ -0,0 +1,65 @@
+import os
+import sys
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.lora_keymap import BinaryKeymap, KeyTranslator, read_keymap_bin, write_keymap_bin
+
+
+def make_keymap():
+    keymap = OrderedDict()
+    for i in range(50):
+        keymap[f"lora_unet_input_blocks_{i}.lora_down.weight"] = f"lora_unet_down_blocks_{i % 20}.lora_down.weight"
+    keymap['lora_te_ü.alpha'] = 'lora_te_text_model.alpha'
+    return keymap
+
+
+def write_and_read(tmp_path, keymap):
+    json_path = tmp_path / 'keymap.json'
+    json_path.write_text('{}')
+    bin_path = str(tmp_path / 'cache' / 'keymap.keymap.bin')
+    write_keymap_bin(keymap, bin_path, os.stat(json_path))
+    return read_keymap_bin(bin_path, os.stat(json_path)), json_path, bin_path
+
+
+def test_binary_keymap_matches_dict(tmp_path):
+    keymap = make_keymap()
+    loaded, _, _ = write_and_read(tmp_path, keymap)
+    assert isinstance(loaded, BinaryKeymap)
+    assert len(loaded) == len(keymap)
+    assert list(loaded.items()) == list(keymap.items())
+    for key, value in keymap.items():
+        assert loaded[key] == value
+    assert 'lora_unet_missing.alpha' not in loaded
+    assert loaded.get('lora_unet_missing.alpha', 'x') == 'x'
+
+    # values repeat, the last key wins like inverting into a dict
+    inverted = {value: key for key, value in keymap.items()}
+    for value, key in inverted.items():
+        assert loaded.inverse()[value] == key
+    # and each value is one key of the inverse view
+    assert len(loaded.inverse()) == len(inverted)
+    assert sorted(loaded.inverse()) == sorted(inverted)
+    assert dict(loaded.inverse().items()) == inverted
+    assert dict(loaded.inverse()) == inverted
+
+
+def test_translator_uses_binary_keymap(tmp_path):
+    keymap = make_keymap()
+    loaded, _, _ = write_and_read(tmp_path, keymap)
+    expected = KeyTranslator(keymap)
+    translator = KeyTranslator(loaded)
+    for ldm_key, diffusers_key in keymap.items():
+        assert translator.to_load_key(ldm_key) == expected.to_load_key(ldm_key)
+        assert translator.to_save_key(diffusers_key) == expected.to_save_key(diffusers_key)
+    assert translator.to_save_key('lora_unet_other.alpha') == 'lora_unet_other.alpha'
+
+
+def test_stale_or_corrupt_file_is_ignored(tmp_path):
+    _, json_path, bin_path = write_and_read(tmp_path, make_keymap())
+    json_path.write_text('{"changed": true}')
+    assert read_keymap_bin(bin_path, os.stat(json_path)) is None
+    with open(bin_path, 'r+b') as f:
+        f.truncate(os.path.getsize(bin_path) - 1)
+    assert read_keymap_bin(bin_path, None) is None
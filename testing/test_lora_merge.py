@@ -0,0 +1,97 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from toolkit.lycoris_utils import merge_into_safetensors
+
+
+def make_base(tmp_path):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Linear(16, 4))
+    state_dict = {key: value.detach().clone().contiguous() for key, value in model.state_dict().items()}
+    path = str(tmp_path / 'base.safetensors')
+    save_file(state_dict, path)
+    return path, state_dict
+
+
+def make_lora(path, shapes, rank=2):
+    lora = {}
+    for lora_name, (out_features, in_features) in shapes.items():
+        lora[f'{lora_name}.lora_down.weight'] = torch.randn(rank, in_features)
+        lora[f'{lora_name}.lora_up.weight'] = torch.randn(out_features, rank)
+        lora[f'{lora_name}.alpha'] = torch.tensor([1.0])
+    save_file(lora, path)
+    return lora
+
+
+def lora_delta(lora, lora_name):
+    up = lora[f'{lora_name}.lora_up.weight']
+    down = lora[f'{lora_name}.lora_down.weight']
+    alpha = lora[f'{lora_name}.alpha']
+    return (up @ down) * (alpha / up.shape[1])
+
+
+# the toy model stores each layer as its own tensor, so every view is the whole tensor
+TARGETS = {
+    'lora_0': ('0.weight', (16, 8), (8, 1), 0),
+    'lora_1': ('1.weight', (4, 16), (16, 1), 0),
+}
+
+
+def test_merge_two_layer_model(tmp_path):
+    base_path, base = make_base(tmp_path)
+    lora_a = make_lora(str(tmp_path / 'a.safetensors'), {'lora_0': (16, 8), 'lora_1': (4, 16)})
+    lora_b = make_lora(str(tmp_path / 'b.safetensors'), {'lora_0': (16, 8)})
+    output_path = str(tmp_path / 'out' / 'merged.safetensors')
+
+    merged_count = merge_into_safetensors(
+        base_path,
+        [(str(tmp_path / 'a.safetensors'), 1.0), (str(tmp_path / 'b.safetensors'), 0.5)],
+        output_path,
+        TARGETS,
+        num_workers=2,
+    )
+    assert merged_count == 2
+    merged = load_file(output_path)
+    assert sorted(merged.keys()) == sorted(base.keys())
+    expected_0 = base['0.weight'] + lora_delta(lora_a, 'lora_0') + 0.5 * lora_delta(lora_b, 'lora_0')
+    expected_1 = base['1.weight'] + lora_delta(lora_a, 'lora_1')
+    assert torch.allclose(merged['0.weight'], expected_0, atol=1e-5)
+    assert torch.allclose(merged['1.weight'], expected_1, atol=1e-5)
+    # tensors no lora touches pass through untouched
+    assert torch.equal(merged['0.bias'], base['0.bias'])
+    assert torch.equal(merged['1.bias'], base['1.bias'])
+
+
+def test_merge_leaves_other_files_alone(tmp_path):
+    base_path, base = make_base(tmp_path)
+    make_lora(str(tmp_path / 'a.safetensors'), {'lora_1': (4, 16)})
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    # files sharing the output's base name are not part of it
+    for sibling in ['merged-v2.safetensors', 'merged-00001-of-00002.safetensors.bak']:
+        save_file({'x': torch.zeros(1)}, str(output_dir / sibling))
+
+    merge_into_safetensors(
+        base_path,
+        [(str(tmp_path / 'a.safetensors'), 1.0)],
+        str(output_dir / 'merged.safetensors'),
+        TARGETS,
+        dtype=torch.float16,
+        max_shard_size=300,
+    )
+    files = sorted(os.listdir(output_dir))
+    assert 'merged-v2.safetensors' in files
+    assert 'merged-00001-of-00002.safetensors.bak' in files
+    assert 'merged.safetensors.index.json' in files
+    shards = [f for f in files if f.startswith('merged-0') and f.endswith('.safetensors')]
+    merged = {}
+    for shard in shards:
+        merged.update(load_file(str(output_dir / shard)))
+    assert sorted(merged.keys()) == sorted(base.keys())
+    assert all(value.dtype == torch.float16 for value in merged.values())
+    assert torch.equal(merged['0.weight'], base['0.weight'].half())
@@ -0,0 +1,122 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRASpecialNetwork
+
+
+class ToyTransformer(torch.nn.Module):
+    def __init__(self, dtype):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(8, 16).to(dtype)
+        self.proj_out = torch.nn.Linear(16, 8).to(dtype)
+
+
+def make_network(model, merge_backup):
+    network = LoRASpecialNetwork(
+        text_encoder=[],
+        unet=model,
+        lora_dim=4,
+        alpha=4,
+        train_text_encoder=False,
+        target_lin_modules=['ToyTransformer'],
+        network_config=NetworkConfig(type='lora', linear=4, linear_alpha=4, merge_backup=merge_backup),
+    )
+    assert network.merge_backup == merge_backup
+    assert len(network.unet_loras) == 2
+    return network
+
+
+def get_weights(model):
+    return {name: param.detach().clone() for name, param in model.named_parameters()}
+
+
+def assert_bit_identical(model, expected):
+    for name, param in model.named_parameters():
+        assert torch.equal(param.detach().view(torch.uint8), expected[name].view(torch.uint8)), name
+
+
+def test_merge_backup_is_off_by_default():
+    assert NetworkConfig(type='lora').merge_backup is False
+
+
+def test_merge_out_restores_from_backup():
+    torch.manual_seed(0)
+    model = ToyTransformer(torch.bfloat16)
+    network = make_network(model, merge_backup=True)
+    for lora in network.unet_loras:
+        torch.nn.init.normal_(lora.lora_up.weight)
+    before = get_weights(model)
+
+    # several rounds, like sampling during training
+    for _ in range(3):
+        network.merge_in(merge_weight=1.0)
+        assert not torch.equal(model.proj_in.weight, before['proj_in.weight'])
+        network.merge_out(merge_weight=1.0)
+        assert_bit_identical(model, before)
+    assert all(getattr(lora, 'merge_backup_weight', None) is None for lora in network.unet_loras)
+
+
+def test_merge_out_subtracts_without_backup():
+    # small integers keep every add exact, so subtracting the delta restores the weights exactly
+    model = ToyTransformer(torch.float32)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.copy_(torch.randint(-8, 8, param.shape).float())
+    network = make_network(model, merge_backup=False)
+    for lora in network.unet_loras:
+        with torch.no_grad():
+            lora.lora_down.weight.copy_(torch.randint(-2, 3, lora.lora_down.weight.shape).float())
+            lora.lora_up.weight.copy_(torch.randint(-2, 3, lora.lora_up.weight.shape).float())
+    before = get_weights(model)
+
+    network.merge_in(merge_weight=1.0)
+    lora = network.unet_loras[0]
+    expected = before['proj_in.weight'] + lora.lora_up.weight @ lora.lora_down.weight
+    assert torch.equal(model.proj_in.weight, expected)
+    assert getattr(lora, 'merge_backup_weight', None) is None
+    network.merge_out(merge_weight=1.0)
+    assert_bit_identical(model, before)
+
+
+def test_bf16_is_backed_up_without_merge_backup():
+    torch.manual_seed(0)
+    model = ToyTransformer(torch.bfloat16)
+    network = make_network(model, merge_backup=False)
+    for lora in network.unet_loras:
+        torch.nn.init.normal_(lora.lora_up.weight)
+    before = get_weights(model)
+
+    # subtracting the delta from rounded bf16 weights would drift a little more every round
+    for _ in range(5):
+        network.merge_in(merge_weight=1.0)
+        assert all(lora.merge_backup_weight is not None for lora in network.unet_loras)
+        network.merge_out(merge_weight=1.0)
+        assert_bit_identical(model, before)
+
+
+def test_qfloat8_merge_round_trip():
+    from optimum.quanto import freeze, qfloat8, quantize
+
+    torch.manual_seed(0)
+    model = ToyTransformer(torch.bfloat16)
+    quantize(model, weights=qfloat8)
+    freeze(model)
+    network = make_network(model, merge_backup=False)
+    for lora in network.unet_loras:
+        torch.nn.init.normal_(lora.lora_up.weight)
+    layers = [model.proj_in, model.proj_out]
+    before = [(layer.weight._data.clone(), layer.weight._scale.clone()) for layer in layers]
+
+    for _ in range(3):
+        network.merge_in(merge_weight=1.0)
+        # requantized with the old scale
+        assert not torch.equal(layers[0].weight._data.view(torch.uint8), before[0][0].view(torch.uint8))
+        network.merge_out(merge_weight=1.0)
+        for layer, (data, scale) in zip(layers, before):
+            assert torch.equal(layer.weight._data.view(torch.uint8), data.view(torch.uint8))
+            assert torch.equal(layer.weight._scale, scale)
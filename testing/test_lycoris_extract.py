@@ -0,0 +1,175 @@
+import copy
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from toolkit import kohya_model_util
+from toolkit.lycoris_utils import extract_diff, extract_diff_from_files, extract_module_lora, get_lora_rank
+from toolkit.util.threads import split_cores_thread_pool
+
+
+def reference_extract_linear(weight, mode, mode_param):
+    # the per layer extraction from before it was streamed, a full svd of every layer
+    out_ch, in_ch = weight.shape
+    U, S, Vh = torch.linalg.svd(weight)
+    lora_rank = get_lora_rank(S, mode, mode_param)
+    lora_rank = max(1, lora_rank)
+    lora_rank = min(out_ch, in_ch, lora_rank)
+    if lora_rank >= out_ch / 2:
+        return None
+    U = U[:, :lora_rank] @ torch.diag(S[:lora_rank])
+    Vh = Vh[:lora_rank, :]
+    return Vh.half(), U.half()
+
+
+def make_weights(out_ch=64, in_ch=48):
+    generator = torch.Generator().manual_seed(0)
+    base = torch.randn(out_ch, in_ch, generator=generator)
+    # a low rank update plus a little noise, like a fine tune
+    update = torch.randn(out_ch, 4, generator=generator) @ torch.randn(4, in_ch, generator=generator)
+    tuned = base + 0.1 * update + 1e-3 * torch.randn(out_ch, in_ch, generator=generator)
+    return tuned, base
+
+
+@pytest.mark.parametrize('mode, mode_param', [
+    ('fixed', 4),
+    ('threshold', 0.05),
+    ('ratio', 0.1),
+    ('quantile', 0.9),
+])
+def test_matches_full_svd_extraction(mode, mode_param):
+    tuned, base = make_weights()
+    loras = extract_module_lora('lora_unet_layer', 'Linear', tuned, base, mode=mode, linear_mode_param=mode_param)
+    reference = reference_extract_linear(tuned - base, mode, mode_param)
+    assert reference is not None
+    down, up = reference
+    assert loras['lora_unet_layer.lora_down.weight'].shape == down.shape
+    assert loras['lora_unet_layer.alpha'].item() == down.shape[0]
+    # the singular vectors can differ in sign, the product can not
+    extracted = loras['lora_unet_layer.lora_up.weight'].float() @ loras['lora_unet_layer.lora_down.weight'].float()
+    assert torch.allclose(extracted, up.float() @ down.float(), atol=1e-2)
+
+
+def test_full_rank_and_unchanged_layers():
+    tuned, base = make_weights()
+    loras = extract_module_lora('lora_unet_layer', 'Linear', tuned, base, mode='fixed', linear_mode_param=32)
+    assert list(loras.keys()) == ['lora_unet_layer.diff']
+    assert torch.equal(loras['lora_unet_layer.diff'], (tuned - base).half())
+    assert len(extract_module_lora('lora_unet_layer', 'Linear', base, base.clone())) == 0
+
+
+def test_lowrank_is_opt_in_and_close():
+    tuned, base = make_weights()
+    exact = extract_module_lora('lora_unet_layer', 'Linear', tuned, base, mode='fixed', linear_mode_param=4)
+    approx = extract_module_lora(
+        'lora_unet_layer', 'Linear', tuned, base, mode='fixed', linear_mode_param=4, lowrank_niter=2
+    )
+    exact_product = exact['lora_unet_layer.lora_up.weight'].float() @ exact['lora_unet_layer.lora_down.weight'].float()
+    approx_product = approx['lora_unet_layer.lora_up.weight'].float() @ approx['lora_unet_layer.lora_down.weight'].float()
+    assert torch.allclose(exact_product, approx_product, atol=5e-2)
+
+
+def test_thread_pool_restores_thread_count():
+    num_threads = torch.get_num_threads()
+    with split_cores_thread_pool(4) as executor:
+        worker_threads = list(executor.map(lambda _: torch.get_num_threads(), range(4)))
+    assert all(count == max(1, num_threads // 4) for count in worker_threads)
+    assert torch.get_num_threads() == num_threads
+
+
+def make_tiny_sd(monkeypatch):
+    from diffusers import UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    # the sd1 layout with small layers, the key conversions only depend on the layout
+    monkeypatch.setattr(kohya_model_util, 'UNET_PARAMS_MODEL_CHANNELS', 32)
+    monkeypatch.setattr(kohya_model_util, 'UNET_PARAMS_CONTEXT_DIM', 32)
+    text_encoder_config = CLIPTextConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=77,
+        hidden_act="quick_gelu",
+    )
+    monkeypatch.setattr(kohya_model_util, 'create_text_encoder_config_v1', lambda: text_encoder_config)
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(text_encoder_config)
+    unet = UNet2DConditionModel(**kohya_model_util.create_unet_diffusers_config(False))
+    return text_encoder, unet
+
+
+def make_tuned(model):
+    tuned = copy.deepcopy(model)
+    with torch.no_grad():
+        for param in tuned.parameters():
+            if param.dim() >= 2:
+                param.add_(torch.randn_like(param) * 0.01)
+    return tuned
+
+
+def save_ldm_checkpoint(path, text_encoder, unet, drop_keys=()):
+    state_dict = {}
+    for key, value in kohya_model_util.convert_unet_state_dict_to_sd(False, unet.state_dict()).items():
+        state_dict[f"model.diffusion_model.{key}"] = value
+    for key, value in text_encoder.state_dict().items():
+        state_dict[f"cond_stage_model.transformer.{key}"] = value
+    save_file(
+        {key: value.detach().clone().contiguous() for key, value in state_dict.items() if key not in drop_keys},
+        path
+    )
+
+
+def get_lora_products(loras):
+    # singular vectors can differ in sign between runs, compare what the lora applies
+    products = {}
+    for key, value in loras.items():
+        if key.endswith('.lora_down.weight'):
+            lora_name = key[:-len('.lora_down.weight')]
+            up = loras[f'{lora_name}.lora_up.weight'].float()
+            products[lora_name] = up.flatten(1) @ value.float().flatten(1)
+        elif not key.endswith('.lora_up.weight'):
+            products[key] = value.float()
+    return products
+
+
+def test_streaming_matches_in_memory_extraction(tmp_path, monkeypatch):
+    text_encoder, unet = make_tiny_sd(monkeypatch)
+    tuned_text_encoder, tuned_unet = make_tuned(text_encoder), make_tuned(unet)
+    base_path = str(tmp_path / 'base.safetensors')
+    tuned_path = str(tmp_path / 'tuned.safetensors')
+    save_ldm_checkpoint(base_path, text_encoder, unet)
+    save_ldm_checkpoint(tuned_path, tuned_text_encoder, tuned_unet)
+
+    kwargs = dict(mode='fixed', linear_mode_param=4, conv_mode_param=4, small_conv=False)
+    expected, _ = extract_diff((text_encoder, None, unet), (tuned_text_encoder, None, tuned_unet), **kwargs)
+    streamed, meta = extract_diff_from_files(base_path, tuned_path, num_workers=2, **kwargs)
+    assert len(expected) > 0
+    assert list(streamed.keys()) == list(expected.keys())
+    assert 'skipped_layers' not in meta
+    expected_products = get_lora_products(expected)
+    streamed_products = get_lora_products(streamed)
+    for key, value in expected_products.items():
+        assert torch.allclose(streamed_products[key], value, atol=1e-3), key
+
+
+def test_streaming_reports_skipped_layers(tmp_path, monkeypatch):
+    text_encoder, unet = make_tiny_sd(monkeypatch)
+    base_path = str(tmp_path / 'base.safetensors')
+    tuned_path = str(tmp_path / 'tuned.safetensors')
+    save_ldm_checkpoint(base_path, text_encoder, unet)
+    save_ldm_checkpoint(
+        tuned_path,
+        make_tuned(text_encoder),
+        unet,
+        drop_keys=['cond_stage_model.transformer.text_model.encoder.layers.0.mlp.fc1.weight'],
+    )
+    loras, meta = extract_diff_from_files(base_path, tuned_path, mode='fixed', linear_mode_param=4, extract_unet=False)
+    assert meta['skipped_layers'] == ['lora_te_text_model_encoder_layers_0_mlp_fc1']
+    assert 'lora_te_text_model_encoder_layers_0_mlp_fc2.lora_down.weight' in loras
@@ -0,0 +1,110 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.memory_management import MemoryManager
+from toolkit.memory_management.planner import GB, LayerResidency, get_module_nbytes, measure_call_counts, \
+    plan_residency
+
+
+MB = 1024 ** 2
+
+
+def make_layers():
+    return [
+        LayerResidency('small', 10 * MB),
+        LayerResidency('medium', 40 * MB),
+        LayerResidency('large', 100 * MB),
+        LayerResidency('shared', 30 * MB, calls_per_step=4),
+    ]
+
+
+def get_resident_names(plan):
+    return sorted(layer.name for layer in plan.resident_layers)
+
+
+def test_no_budget_bounces_everything():
+    plan = plan_residency(make_layers(), None)
+    assert len(plan.resident_layers) == 0
+    assert plan.bounced_bytes == 180 * MB
+    # shared runs 4 times
+    assert plan.get_transfer_bytes_per_step(1) == (10 + 40 + 100 + 30 * 4) * MB
+
+
+def test_frequent_layers_first():
+    plan = plan_residency(make_layers(), 35 * MB)
+    assert get_resident_names(plan) == ['shared']
+    assert plan.get_transfer_bytes_per_step(1) == 150 * MB
+
+
+def test_larger_layers_first_then_fill():
+    # shared (30) + large (100) fit, medium does not, small fills the rest
+    plan = plan_residency(make_layers(), 145 * MB)
+    assert get_resident_names(plan) == ['large', 'shared', 'small']
+    assert plan.resident_bytes == 140 * MB
+    assert plan.resident_bytes <= plan.budget_bytes
+
+
+def test_budget_fits_everything():
+    plan = plan_residency(make_layers(), GB)
+    assert len(plan.bounced_layers) == 0
+    assert plan.get_transfer_bytes_per_step(2) == 0
+
+
+def test_training_transfers_scale_with_passes():
+    plan = plan_residency(make_layers(), 35 * MB)
+    assert plan.get_transfer_bytes_per_step(2) == 2 * plan.get_transfer_bytes_per_step(1)
+    assert plan.get_transfer_bytes_per_step(3) == 3 * plan.get_transfer_bytes_per_step(1)
+
+
+def test_replanning_resets():
+    layers = make_layers()
+    plan_residency(layers, GB)
+    plan = plan_residency(layers, 0)
+    assert len(plan.resident_layers) == 0
+
+
+class SharedBlockModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(8, 16)
+        self.block = torch.nn.Linear(16, 16)
+        self.norm = torch.nn.LayerNorm(16)
+        self.proj_out = torch.nn.Linear(16, 4)
+
+    def forward(self, x):
+        x = self.proj_in(x)
+        for _ in range(3):
+            x = self.block(x)
+        return self.proj_out(self.norm(x))
+
+
+def test_measure_call_counts():
+    model = SharedBlockModel()
+    modules = {'proj_in': model.proj_in, 'block': model.block, 'proj_out': model.proj_out}
+    counts = measure_call_counts(modules, lambda: model(torch.randn(2, 8)))
+    assert counts == {'proj_in': 1, 'block': 3, 'proj_out': 1}
+
+
+def test_attach_with_budget():
+    torch.manual_seed(0)
+    model = SharedBlockModel()
+    x = torch.randn(2, 8)
+    with torch.no_grad():
+        expected = model(x)
+    # block is the largest layer and uses up the budget
+    block_bytes = get_module_nbytes(model.block)
+    MemoryManager.attach(model, torch.device('cpu'), budget_gb=block_bytes / GB)
+    plan = model._memory_manager.plan
+    assert get_resident_names(plan) == ['block']
+    # resident layers move with the model, bounced ones are managed
+    assert model.block in model._memory_manager.unmanaged_modules
+    assert not hasattr(model.block, '_layer_memory_manager')
+    assert hasattr(model.proj_in, '_layer_memory_manager')
+    assert hasattr(model.proj_out, '_layer_memory_manager')
+    assert plan.get_transfer_bytes_per_step(1) == get_module_nbytes(model.proj_in) + get_module_nbytes(model.proj_out)
+    with torch.no_grad():
+        assert torch.allclose(model(x), expected)
@@ -0,0 +1,121 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRASpecialNetwork
+from toolkit.multi_lora import clear_batch_routing, get_routing_masks, route_to_network, set_batch_routing
+
+
+class ToyTransformer(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.proj_in = torch.nn.Linear(8, 16)
+        self.proj_out = torch.nn.Linear(16, 8)
+
+    def forward(self, x):
+        return self.proj_out(torch.nn.functional.gelu(self.proj_in(x)))
+
+
+def make_networks(num_networks=2):
+    torch.manual_seed(0)
+    model = ToyTransformer()
+    model.requires_grad_(False)
+    networks = []
+    for _ in range(num_networks):
+        network = LoRASpecialNetwork(
+            text_encoder=[],
+            unet=model,
+            lora_dim=4,
+            alpha=4,
+            train_text_encoder=False,
+            target_lin_modules=['ToyTransformer'],
+            network_config=NetworkConfig(type='lora', linear=4, linear_alpha=4),
+        )
+        # applied on top of each other like the trainer does
+        network.apply_to([], model, False, True)
+        for lora in network.unet_loras:
+            torch.nn.init.normal_(lora.lora_up.weight)
+        network.requires_grad_(True)
+        networks.append(network)
+    # the main network passes its multiplier and active state on to the others
+    networks[0].routed_networks = networks[1:]
+    networks[0].is_active = True
+    networks[0].multiplier = 1.0
+    return model, networks
+
+
+def get_grads(network):
+    return {name: param.grad.detach().clone() for name, param in network.named_parameters()}
+
+
+def zero_grads(networks):
+    for network in networks:
+        for param in network.parameters():
+            param.grad = None
+
+
+def test_main_network_passes_state_on():
+    _, networks = make_networks()
+    assert networks[1].is_active
+    networks[0].multiplier = 0.5
+    assert networks[1].multiplier == 0.5
+    route_to_network(networks, 0)
+    assert not networks[0].is_routed_out
+    assert networks[1].is_routed_out
+    clear_batch_routing(networks)
+    assert not networks[1].is_routed_out
+
+
+def test_routed_batch_matches_separate_forwards():
+    model, networks = make_networks()
+    x = torch.randn(4, 8)
+    set_batch_routing(networks, get_routing_masks([2, 2]))
+    combined = model(x)
+
+    # each network's samples come out as if only that network was applied
+    route_to_network(networks, 0)
+    only_first = model(x[:2])
+    route_to_network(networks, 1)
+    only_second = model(x[2:])
+    clear_batch_routing(networks)
+    assert torch.allclose(combined[:2], only_first, atol=1e-6)
+    assert torch.allclose(combined[2:], only_second, atol=1e-6)
+    # and the networks do change the output
+    networks[0].is_active = False
+    base = model(x)
+    assert not torch.allclose(combined[:2], base[:2], atol=1e-3)
+    assert not torch.allclose(combined[2:], base[2:], atol=1e-3)
+
+
+def test_gradients_only_come_from_own_samples():
+    model, networks = make_networks()
+    x = torch.randn(4, 8)
+    set_batch_routing(networks, get_routing_masks([2, 2]))
+
+    # a loss on the first network's samples does not reach the second network
+    model(x)[:2].pow(2).sum().backward()
+    for param in networks[1].parameters():
+        assert param.grad is None or torch.count_nonzero(param.grad) == 0
+    assert any(torch.count_nonzero(param.grad) > 0 for param in networks[0].parameters())
+
+    # the combined loss gives each network the gradient of its own batch
+    zero_grads(networks)
+    model(x).pow(2).sum().backward()
+    combined_grads = [get_grads(network) for network in networks]
+
+    separate_grads = []
+    for i, samples in enumerate([x[:2], x[2:]]):
+        zero_grads(networks)
+        route_to_network(networks, i)
+        model(samples).pow(2).sum().backward()
+        separate_grads.append(get_grads(networks[i]))
+    clear_batch_routing(networks)
+
+    for combined, separate in zip(combined_grads, separate_grads):
+        assert combined.keys() == separate.keys()
+        for name in combined:
+            assert torch.allclose(combined[name], separate[name], atol=1e-5), name
@@ -0,0 +1,108 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.automagic import Automagic
+from toolkit.optimizers.optimizer_checkpoint import LazyOptimizerState, load_optimizer_state_sharded, \
+    save_optimizer_state_sharded
+from toolkit.optimizers.optimizer_utils import BlockwiseInt8Tensor
+
+
+def make_params(dtype=torch.float32, first_shape=(16, 16)):
+    generator = torch.Generator().manual_seed(0)
+    return [
+        torch.nn.Parameter(torch.randn(*first_shape, generator=generator).to(dtype)),
+        torch.nn.Parameter(torch.randn(16, generator=generator).to(dtype)),
+    ]
+
+
+def take_steps(optimizer, num_steps=2):
+    params = [p for group in optimizer.param_groups for p in group['params']]
+    for _ in range(num_steps):
+        optimizer.zero_grad()
+        sum((p.float() ** 2).sum() for p in params).backward()
+        optimizer.step()
+
+
+def test_lazy_round_trip(tmp_path):
+    optimizer = torch.optim.AdamW(make_params(), lr=1e-3)
+    take_steps(optimizer)
+    expected = optimizer.state_dict()
+    save_optimizer_state_sharded(expected, str(tmp_path))
+
+    new_params = make_params()
+    new_optimizer = torch.optim.AdamW(new_params, lr=1e-2)
+    load_optimizer_state_sharded(new_optimizer, str(tmp_path))
+    assert isinstance(new_optimizer.state, LazyOptimizerState)
+    assert new_optimizer.param_groups[0]['lr'] == 1e-3
+    # nothing is read until a param is looked up
+    assert len(new_optimizer.state.pending) == 2
+    assert torch.equal(new_optimizer.state[new_params[0]]['exp_avg'], expected['state'][0]['exp_avg'])
+    assert len(new_optimizer.state.pending) == 1
+
+    loaded = new_optimizer.state_dict()
+    for param_id, param_state in expected['state'].items():
+        for key, value in param_state.items():
+            assert torch.equal(loaded['state'][param_id][key], value)
+    # training carries on from the loaded state
+    take_steps(new_optimizer, 1)
+    assert new_optimizer.state[new_params[0]]['step'].item() == 3
+
+
+def test_lazy_load_casts_like_torch(tmp_path):
+    optimizer = torch.optim.AdamW(make_params(), lr=1e-3)
+    take_steps(optimizer)
+    save_optimizer_state_sharded(optimizer.state_dict(), str(tmp_path))
+
+    # fp32 state loaded for bf16 params ends up the same as torch's own load_state_dict
+    torch_optimizer = torch.optim.AdamW(make_params(torch.bfloat16), lr=1e-3)
+    torch_optimizer.load_state_dict(optimizer.state_dict())
+    lazy_optimizer = torch.optim.AdamW(make_params(torch.bfloat16), lr=1e-3)
+    load_optimizer_state_sharded(lazy_optimizer, str(tmp_path))
+    expected = torch_optimizer.state_dict()['state']
+    loaded = lazy_optimizer.state_dict()['state']
+    for param_id, param_state in expected.items():
+        for key, value in param_state.items():
+            assert loaded[param_id][key].dtype == value.dtype
+            assert torch.equal(loaded[param_id][key], value)
+
+
+def test_adam8bit_loads_through_its_load_state_dict(tmp_path):
+    optimizer = Adam8bit(make_params(), lr=1e-3)
+    take_steps(optimizer)
+    save_optimizer_state_sharded(optimizer.state_dict(), str(tmp_path))
+
+    new_params = make_params()
+    new_optimizer = Adam8bit(new_params, lr=1e-3)
+    load_optimizer_state_sharded(new_optimizer, str(tmp_path))
+    assert not isinstance(new_optimizer.state, LazyOptimizerState)
+    for param, new_param in zip(optimizer.param_groups[0]['params'], new_params):
+        state = optimizer.state[param]
+        new_state = new_optimizer.state[new_param]
+        assert new_state['step'] == state['step']
+        for key in ['exp_avg', 'exp_avg_sq']:
+            assert isinstance(new_state[key], BlockwiseInt8Tensor)
+            assert torch.equal(new_state[key].quantized, state[key].quantized)
+            assert torch.equal(new_state[key].scale, state[key].scale)
+    take_steps(new_optimizer, 1)
+
+
+def test_automagic_keeps_its_mismatch_handling(tmp_path):
+    optimizer = Automagic(make_params(), lr=1e-6)
+    for param in optimizer.param_groups[0]['params']:
+        optimizer.initialize_state(param)
+    saved_mask = optimizer.state[optimizer.param_groups[0]['params'][1]]['lr_mask']
+    save_optimizer_state_sharded(optimizer.state_dict(), str(tmp_path))
+
+    # the first param changed shape, its lr mask is reinitialized instead of loaded
+    new_params = make_params(first_shape=(16, 8))
+    new_optimizer = Automagic(new_params, lr=1e-6)
+    load_optimizer_state_sharded(new_optimizer, str(tmp_path))
+    assert new_optimizer.state[new_params[0]]['lr_mask'].shape == new_params[0].shape
+    loaded_mask = new_optimizer.state[new_params[1]]['lr_mask']
+    assert torch.equal(loaded_mask.quantized, saved_mask.quantized)
+    assert torch.equal(loaded_mask.scale, saved_mask.scale)
@@ -0,0 +1,161 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.memory_management.prefetch import PrefetchScheduler, TransferBackend
+from toolkit.timer import Timer
+
+
+class MockLayer:
+    def __init__(self, name):
+        self.name = name
+        self.weight = torch.zeros(1)
+        self.target_dtype = None
+
+    def materialize(self, device):
+        return self.weight, None
+
+
+class MockTransferBackend(TransferBackend):
+    def __init__(self, instant=True):
+        # copies are done as soon as they start, otherwise only after synchronize
+        self.instant = instant
+        self.started = []
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    def start(self, layer):
+        self.started.append(layer.name)
+        self.outstanding += 1
+        self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        # the weights at the time of the copy
+        return {'weight': layer.weight, 'ready': self.instant}
+
+    def is_ready(self, handle):
+        return handle['ready']
+
+    def synchronize(self, handle):
+        handle['ready'] = True
+
+    def wait(self, handle):
+        self.outstanding -= 1
+        return handle['weight'], None
+
+
+def make_layers(names):
+    return {name: MockLayer(name) for name in names}
+
+
+def run_step(scheduler, layers, order, num_forward=None):
+    # calls after the first num_forward are backward calls
+    num_forward = len(order) if num_forward is None else num_forward
+    for i, name in enumerate(order):
+        weight, _ = scheduler.get_weights(layers[name], is_backward=i >= num_forward)
+        # always the weights of the layer that asked for them
+        assert weight is layers[name].weight
+
+
+TRAIN_ORDER = ['a', 'b', 'c', 'd', 'd', 'c', 'b', 'a']
+
+
+def test_records_then_prefetches():
+    layers = make_layers('abcd')
+    scheduler = PrefetchScheduler(MockTransferBackend(), depth=2)
+    run_step(scheduler, layers, TRAIN_ORDER, 4)
+    assert scheduler.is_recording
+    assert scheduler.num_hits == 0 and scheduler.num_misses == 0
+    # the first call of the second step ends recording and has nothing prefetched yet
+    run_step(scheduler, layers, TRAIN_ORDER, 4)
+    assert not scheduler.is_recording
+    assert scheduler.num_misses == 1
+    assert scheduler.num_hits == 7
+    # nothing is prefetched past the end of a step, the first call of every step misses
+    run_step(scheduler, layers, TRAIN_ORDER, 4)
+    assert scheduler.num_misses == 2
+    assert scheduler.num_hits == 14
+
+
+def test_weights_updated_between_steps():
+    layers = make_layers('abcd')
+    backend = MockTransferBackend()
+    scheduler = PrefetchScheduler(backend, depth=2)
+    for step in range(4):
+        # run_step checks every call gets the current weights
+        run_step(scheduler, layers, TRAIN_ORDER, 4)
+        assert len(scheduler.in_flight) == 0
+        # the optimizer step
+        for layer in layers.values():
+            layer.weight = torch.full((1,), float(step + 1))
+
+
+def test_prefetches_backward_in_reverse():
+    layers = make_layers('abcd')
+    backend = MockTransferBackend()
+    scheduler = PrefetchScheduler(backend, depth=2)
+    run_step(scheduler, layers, TRAIN_ORDER, 4)
+    run_step(scheduler, layers, ['a', 'b', 'c', 'd'])
+    # d forward queued d and c for the backward pass
+    assert backend.started[-2:] == ['d', 'c']
+
+
+def test_depth_bounds_buffers():
+    for depth in [1, 2, 4]:
+        layers = make_layers('abcdefgh')
+        order = list('abcdefgh') + list('hgfedcba')
+        backend = MockTransferBackend()
+        scheduler = PrefetchScheduler(backend, depth=depth)
+        for _ in range(3):
+            run_step(scheduler, layers, order, 8)
+        assert len(scheduler.in_flight) <= depth
+        # the prefetched ones plus the one being used
+        assert backend.max_outstanding <= depth + 1
+
+
+def test_shared_layers():
+    layers = make_layers(['in', 'block', 'out'])
+    order = ['in', 'block', 'block', 'block', 'out']
+    scheduler = PrefetchScheduler(MockTransferBackend(), depth=2)
+    for _ in range(4):
+        run_step(scheduler, layers, order)
+    assert len(scheduler.sequence) == 5
+    # only the first call of each step after recording
+    assert scheduler.num_misses == 3
+
+
+def test_rerecords_when_order_changes():
+    layers = make_layers('abcdef')
+    scheduler = PrefetchScheduler(MockTransferBackend(), depth=1)
+    for _ in range(2):
+        run_step(scheduler, layers, list('abcdef'))
+    # a very different order, most calls miss and the order is recorded again
+    new_order = list('afbecd')
+    for _ in range(3):
+        run_step(scheduler, layers, new_order)
+    misses = scheduler.num_misses
+    for _ in range(2):
+        run_step(scheduler, layers, new_order)
+    # only the first call of each step
+    assert scheduler.num_misses == misses + 2
+    assert [layer.name for layer in scheduler.sequence] == new_order
+
+
+def test_stalls_reported_to_timer():
+    layers = make_layers('abc')
+    timer = Timer('test')
+    scheduler = PrefetchScheduler(MockTransferBackend(instant=False), depth=1, timer=timer)
+    run_step(scheduler, layers, 'abc')
+    # the total of every wait, with the layers under it
+    stats = timer.get_stats()
+    assert list(stats.keys())[0] == 'prefetch_stall'
+    assert stats['prefetch_stall']['count'] == 3
+    for name in 'abc':
+        assert stats[f'prefetch_stall/{name}']['parent'] == 'prefetch_stall'
+        assert stats[f'prefetch_stall/{name}']['count'] == 1
+
+    timer = Timer('test')
+    scheduler = PrefetchScheduler(MockTransferBackend(instant=True), depth=1, timer=timer)
+    run_step(scheduler, layers, 'abc')
+    assert len(timer.timers) == 0
@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.prior_prediction import PriorPredictionEngine, PriorPredictionRequest
+from toolkit.prompt_utils import PromptEmbeds
+
+
+def make_request(batch_size=2, height=8, seq_len=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    noisy_latents = torch.randn((batch_size, 4, height, 8), generator=generator)
+    timesteps = torch.rand((batch_size,), generator=generator) * 1000
+    embeds = PromptEmbeds(torch.randn((batch_size, seq_len, 16), generator=generator))
+    return PriorPredictionRequest(noisy_latents, timesteps, embeds, batch=None)
+
+
+class FakeModel:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, noisy_latents, timesteps, conditional_embeds, batch):
+        self.calls.append(noisy_latents.shape[0])
+        # depends on every input per sample, so a mixed up split would show
+        text = conditional_embeds.text_embeds.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+        return noisy_latents * 2 + timesteps.view(-1, 1, 1, 1) / 1000 + text
+
+
+def test_batched_matches_separate():
+    requests = [make_request(seed=i) for i in range(3)]
+    model = FakeModel()
+    engine = PriorPredictionEngine()
+    batched = engine.predict(requests, model)
+    assert model.calls == [6]
+    for request, pred in zip(requests, batched):
+        expected = model(request.noisy_latents, request.timesteps, request.conditional_embeds, None)
+        assert torch.allclose(pred, expected)
+
+
+def test_groups_by_shape():
+    requests = [make_request(seed=0), make_request(height=16, seed=1), make_request(seed=2), make_request(seq_len=6, seed=3)]
+    model = FakeModel()
+    engine = PriorPredictionEngine()
+    engine.predict(requests, model)
+    assert sorted(model.calls) == [2, 2, 4]
+    assert engine.num_forwards == 3
+    assert engine.num_forwards_saved == 1
+
+
+def test_repeated_requests_are_kept_for_the_step():
+    request = make_request()
+    model = FakeModel()
+    engine = PriorPredictionEngine()
+    first = engine.predict([request, request], model)
+    second = engine.predict([request], model)
+    assert model.calls == [2]
+    assert first[0] is first[1] and first[0] is second[0]
+    assert engine.num_requests == 3 and engine.num_forwards_saved == 2
+    # modified in place, the key changes
+    request.noisy_latents.add_(1.0)
+    engine.predict([PriorPredictionRequest(request.noisy_latents, request.timesteps, request.conditional_embeds, None)], model)
+    assert model.calls == [2, 2]
+    engine.start_step()
+    assert engine.num_requests == 0 and len(engine.results) == 0
@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from safetensors.torch import load_file, save_file
+
+from toolkit.saving import save_sharded_safetensors
+
+# every tensor is 4KB, a 10KB shard limit puts two in each shard
+
+
+def make_state_dict(num_tensors, value=1.0):
+    return {f"layer{i}.weight": torch.full((1024,), value) for i in range(num_tensors)}
+
+
+def list_files(folder):
+    return sorted(os.listdir(folder))
+
+
+def test_resave_removes_only_its_own_shards(tmp_path):
+    save_sharded_safetensors(make_state_dict(6).items(), str(tmp_path), 'model.safetensors', max_shard_size=10_000)
+    assert len([f for f in list_files(tmp_path) if f.endswith('-of-00003.safetensors')]) == 3
+    # files that share the base name but are not shards of it
+    for sibling in ['model-v2.safetensors', 'model-00001-of-00001-old.safetensors', 'model-final.safetensors']:
+        save_file({'x': torch.zeros(1)}, str(tmp_path / sibling))
+
+    save_sharded_safetensors(make_state_dict(4, 2.0).items(), str(tmp_path), 'model.safetensors', max_shard_size=10_000)
+    assert list_files(tmp_path) == [
+        'model-00001-of-00001-old.safetensors',
+        'model-00001-of-00002.safetensors',
+        'model-00002-of-00002.safetensors',
+        'model-final.safetensors',
+        'model-v2.safetensors',
+        'model.safetensors.index.json',
+    ]
+    with open(tmp_path / 'model.safetensors.index.json') as f:
+        weight_map = json.load(f)['weight_map']
+    assert sorted(weight_map.keys()) == sorted(make_state_dict(4).keys())
+    loaded = load_file(str(tmp_path / weight_map['layer3.weight']))
+    assert torch.equal(loaded['layer3.weight'], torch.full((1024,), 2.0))
+
+
+def test_single_file_replaces_shards(tmp_path):
+    save_sharded_safetensors(make_state_dict(4).items(), str(tmp_path), 'model.safetensors', max_shard_size=10_000)
+    save_file({'x': torch.zeros(1)}, str(tmp_path / 'model-v2.safetensors'))
+    save_sharded_safetensors(make_state_dict(2).items(), str(tmp_path), 'model.safetensors')
+    assert list_files(tmp_path) == ['model-v2.safetensors', 'model.safetensors']
+
+
+def test_shards_replace_single_file_and_failed_save(tmp_path):
+    save_sharded_safetensors(make_state_dict(2).items(), str(tmp_path), 'model.safetensors')
+    # left behind by a save that did not finish
+    save_file({'x': torch.zeros(1)}, str(tmp_path / 'model-00007.safetensors.tmp'))
+    save_sharded_safetensors(make_state_dict(4).items(), str(tmp_path), 'model.safetensors', max_shard_size=10_000)
+    assert list_files(tmp_path) == [
+        'model-00001-of-00002.safetensors',
+        'model-00002-of-00002.safetensors',
+        'model.safetensors.index.json',
+    ]
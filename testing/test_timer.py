@@ -0,0 +1,158 @@
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.timer import Timer
+
+
+def test_nested_spans():
+    timer = Timer('test')
+    with timer('outer'):
+        with timer('inner'):
+            time.sleep(0.01)
+        with timer('inner'):
+            pass
+    stats = timer.get_stats()
+    assert list(stats.keys()) == ['outer', 'inner']
+    assert stats['inner']['parent'] == 'outer'
+    assert stats['inner']['count'] == 2
+    assert stats['outer']['avg'] >= stats['inner']['total'] - 1e-6
+    assert stats['inner']['device_avg'] is None and stats['inner']['peak_memory'] is None
+
+
+def test_start_stop_around_context():
+    timer = Timer('test')
+    timer.start('train_loop')
+    with timer('get_batch'):
+        pass
+    timer.stop('train_loop')
+    assert timer.get_stats()['get_batch']['parent'] == 'train_loop'
+    try:
+        timer.stop('train_loop')
+        assert False, "stopping a stopped timer should raise"
+    except ValueError:
+        pass
+
+
+def test_exception_cancels_span():
+    timer = Timer('test')
+    try:
+        with timer('outer'):
+            with timer('failing'):
+                raise RuntimeError('boom')
+    except RuntimeError:
+        pass
+    assert 'failing' not in timer.get_stats()
+    assert len(timer.active_timers) == 0
+    with timer('after'):
+        pass
+    assert timer.get_stats()['after']['parent'] is None
+
+
+def test_print_hooks():
+    timer = Timer('test')
+    received = []
+    timer.add_after_print_hook(received.append)
+    with timer('train_loop'):
+        pass
+    timer.print()
+    assert list(received[0].keys()) == ['train_loop']
+    assert 'timing/train_loop' in timer.get_log_dict()
+    timer.reset()
+    assert len(timer.get_stats()) == 0
+
+
+def test_disabled_does_nothing():
+    timer = Timer('test', enabled=False)
+    received = []
+    timer.add_after_print_hook(received.append)
+    with timer('outer'):
+        timer.start('inner')
+        timer.stop('inner')
+    timer.stop('never_started')
+    timer.print()
+    assert len(timer.timers) == 0 and len(received) == 0
+
+
+def test_chrome_trace(tmp_path):
+    path = str(tmp_path / 'trace.json')
+    timer = Timer('test', trace_path=path)
+    for step in range(3):
+        timer.set_step(step)
+        with timer('train_loop'):
+            with timer('predict'):
+                pass
+    timer.close()
+    with open(path) as f:
+        # the array is left open, close it to parse
+        events = json.loads(f.read().rstrip().rstrip(',') + ']')
+    assert len(events) == 6
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    predict = [event for event in events if event['name'] == 'predict']
+    assert [event['args']['step'] for event in predict] == [0, 1, 2]
+    assert predict[0]['args']['path'] == 'train_loop/predict'
+
+
+def test_jsonl_trace(tmp_path):
+    path = str(tmp_path / 'trace.jsonl')
+    timer = Timer('test', trace_path=path, trace_buffer=2)
+    for _ in range(5):
+        with timer('span'):
+            pass
+    # written as the buffer fills
+    with open(path) as f:
+        assert len(f.readlines()) == 4
+    timer.close()
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 5 and all(line['name'] == 'span' for line in lines)
+
+
+class FakeCudaMemory:
+    def __init__(self):
+        self.allocated = 0
+        self.peak = 0
+        self.num_resets = 0
+
+    def alloc(self, num_bytes):
+        self.allocated += num_bytes
+        self.peak = max(self.peak, self.allocated)
+
+    def free(self, num_bytes):
+        self.allocated -= num_bytes
+
+    def reset_peak_memory_stats(self):
+        self.peak = self.allocated
+        self.num_resets += 1
+
+
+def test_peak_memory(monkeypatch):
+    import torch
+    memory = FakeCudaMemory()
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: True)
+    monkeypatch.setattr(torch.cuda, 'memory_allocated', lambda: memory.allocated)
+    monkeypatch.setattr(torch.cuda, 'max_memory_allocated', lambda: memory.peak)
+    monkeypatch.setattr(torch.cuda, 'reset_peak_memory_stats', memory.reset_peak_memory_stats)
+    timer = Timer('test', track_memory=True)
+    for _ in range(2):
+        with timer('step'):
+            with timer('forward'):
+                memory.alloc(100)
+                memory.free(60)
+            with timer('backward'):
+                memory.alloc(120)
+                memory.free(160)
+            with timer('optimizer'):
+                memory.alloc(30)
+                memory.free(30)
+    stats = timer.get_stats()
+    assert stats['forward']['peak_memory'] == 100
+    assert stats['backward']['peak_memory'] == 160
+    assert stats['step']['peak_memory'] == 160
+    # below the peak of the step so far, only its ends are known
+    assert stats['optimizer']['peak_memory'] == 0
+    # once per step, not for every span
+    assert memory.num_resets == 2
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.samplers.timestep_index import TimestepIndex, get_timestep_indices
+
+
+def reference_indices(schedule, timesteps):
+    # the per timestep loop the lookup replaced
+    return torch.tensor([(schedule == t).nonzero().item() for t in timesteps])
+
+
+def test_matches_reference_linear():
+    schedule = torch.linspace(1000, 1, 1000)
+    timesteps = schedule[torch.randint(0, 1000, (64,), generator=torch.Generator().manual_seed(0))]
+    assert torch.equal(get_timestep_indices(schedule, timesteps), reference_indices(schedule, timesteps))
+
+
+def test_matches_reference_unsorted_schedule():
+    generator = torch.Generator().manual_seed(1)
+    schedule = torch.rand(500, generator=generator) * 1000
+    timesteps = schedule[torch.randint(0, 500, (32,), generator=generator)]
+    assert torch.equal(get_timestep_indices(schedule, timesteps), reference_indices(schedule, timesteps))
+
+
+def test_nearest_after_dtype_round_trip():
+    schedule = torch.linspace(1000, 1, 1000)
+    indices = torch.arange(0, 1000, 7)
+    # bf16 cannot hold every timestep exactly, the nearest step is still found
+    timesteps = schedule[indices].to(torch.bfloat16)
+    found = get_timestep_indices(schedule, timesteps)
+    assert ((found - indices).abs() <= 4).all()
+    assert torch.equal(get_timestep_indices(schedule, schedule[indices] + 0.3), indices)
+
+
+def test_cache_follows_schedule():
+    index = TimestepIndex()
+    schedule = torch.linspace(1000, 1, 1000)
+    timesteps = torch.tensor([1000.0, 500.0, 1.0])
+    assert index.get_indices(schedule, timesteps).tolist() == [0, 500, 999]
+    # in place changes and new tensors both rebuild the table
+    schedule.copy_(schedule.flip(0))
+    assert index.get_indices(schedule, timesteps).tolist() == [999, 499, 0]
+    schedule = torch.tensor([1.0, 1000.0])
+    assert index.get_indices(schedule, timesteps).tolist() == [1, 0, 0]
+
+
+def test_table_per_dtype():
+    index = TimestepIndex()
+    sigmas = torch.linspace(1, 0, 1001)
+    table_32 = index.get_table('sigmas', sigmas, 'cpu', torch.float32)
+    table_16 = index.get_table('sigmas', sigmas, 'cpu', torch.float16)
+    assert table_16.dtype == torch.float16
+    assert index.get_table('sigmas', sigmas, 'cpu', torch.float32) is table_32
+    sigmas.mul_(0.5)
+    assert torch.allclose(index.get_table('sigmas', sigmas, 'cpu', torch.float32), sigmas)
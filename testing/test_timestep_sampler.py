@@ -0,0 +1,133 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from toolkit.basic import value_map
+from toolkit.timestep_sampler import CubicTimestepSampler, TimestepSampler, get_timestep_sampler
+
+# checks the timestep samplers against the sampling the train loop did before them. Histograms are
+# compared on coarse bins so the sampling noise stays well below the tolerance. They run on cpu.
+
+NUM_SAMPLES = 400_000
+NUM_BINS = 50
+TOLERANCE = 0.02
+
+
+class FakeTrainConfig:
+    def __init__(self, **kwargs):
+        self.timestep_type = kwargs.get('timestep_type', 'sigmoid')
+        self.noise_scheduler = kwargs.get('noise_scheduler', 'flowmatch')
+        self.num_train_timesteps = kwargs.get('num_train_timesteps', 1000)
+        self.gradient_accumulation = kwargs.get('gradient_accumulation', 1)
+
+
+def reference_indices(train_config, content_or_style, num_train_timesteps, min_noise_steps, max_noise_steps, batch_size):
+    # the branches of process_general_training_batch the samplers replaced
+    if train_config.timestep_type == 'next_sample':
+        return torch.randint(0, num_train_timesteps - 2, (batch_size,)).long()
+    elif train_config.timestep_type == 'one_step':
+        return torch.zeros((batch_size,), dtype=torch.long)
+    elif content_or_style in ['style', 'content']:
+        orig_timesteps = torch.rand((batch_size,))
+        if content_or_style == 'content':
+            timestep_indices = orig_timesteps ** 3 * train_config.num_train_timesteps
+        else:
+            timestep_indices = (1 - orig_timesteps ** 3) * train_config.num_train_timesteps
+        timestep_indices = value_map(
+            timestep_indices, 0, train_config.num_train_timesteps - 1, min_noise_steps, max_noise_steps
+        )
+        return timestep_indices.long().clamp(min_noise_steps, max_noise_steps)
+    if min_noise_steps == max_noise_steps:
+        return (torch.ones((batch_size,)) * min_noise_steps).long()
+    min_idx = min_noise_steps + 1
+    max_idx = max_noise_steps - 1
+    if train_config.noise_scheduler == 'flowmatch':
+        min_idx = min_noise_steps
+        max_idx = max_noise_steps
+    return torch.randint(min_idx, max_idx, (batch_size,)).long()
+
+
+def histogram(indices, num_timesteps):
+    counts = torch.bincount(indices, minlength=num_timesteps).double()
+    return counts / counts.sum()
+
+
+def coarse(probabilities):
+    return torch.stack([chunk.sum() for chunk in torch.tensor_split(probabilities.double(), NUM_BINS)])
+
+
+def total_variation(a, b):
+    return 0.5 * (coarse(a) - coarse(b)).abs().sum().item()
+
+
+CASES = [
+    (FakeTrainConfig(), 'balanced', 1000, 0, 999),
+    (FakeTrainConfig(noise_scheduler='ddpm'), 'balanced', 1000, 0, 999),
+    (FakeTrainConfig(), 'content', 1000, 0, 999),
+    (FakeTrainConfig(), 'style', 1000, 0, 999),
+    # narrowed like the multistage boundaries and min / max denoising steps
+    (FakeTrainConfig(), 'content', 1000, 200, 600),
+    (FakeTrainConfig(), 'style', 1000, 200, 600),
+    (FakeTrainConfig(), 'balanced', 1000, 200, 600),
+    (FakeTrainConfig(timestep_type='next_sample'), 'balanced', 8, 0, 7),
+    (FakeTrainConfig(timestep_type='one_step'), 'balanced', 1000, 0, 999),
+    (FakeTrainConfig(), 'balanced', 1000, 300, 300),
+]
+
+
+def test_histograms_match_reference():
+    for train_config, content_or_style, num_timesteps, min_steps, max_steps in CASES:
+        torch.manual_seed(0)
+        label = f"{train_config.timestep_type} {train_config.noise_scheduler} {content_or_style} {min_steps}-{max_steps}"
+        sampler = get_timestep_sampler(train_config, content_or_style, num_timesteps, min_steps, max_steps, 'cpu')
+        sampled = histogram(sampler.sample(NUM_SAMPLES), num_timesteps)
+        reference = histogram(
+            reference_indices(train_config, content_or_style, num_timesteps, min_steps, max_steps, NUM_SAMPLES),
+            num_timesteps
+        )
+        pmf = sampler.probabilities.double()
+        assert total_variation(sampled, reference) < TOLERANCE, f"{label}: sampled histogram differs"
+        assert total_variation(pmf, reference) < TOLERANCE, f"{label}: pmf differs"
+        # never samples where the old code could not
+        assert pmf[reference == 0].sum() < 1e-3, f"{label}: mass outside the old support"
+
+
+def test_cubic_pmf_is_exact():
+    # dense histogram against the analytic mass where it is concentrated
+    torch.manual_seed(1)
+    train_config = FakeTrainConfig()
+    sampler = CubicTimestepSampler('content', 0, 999, 1000, 1000, 'cpu')
+    reference = histogram(reference_indices(train_config, 'content', 1000, 0, 999, NUM_SAMPLES), 1000)
+    assert abs(sampler.probabilities[0].item() - reference[0].item()) < 0.005
+    assert abs(sampler.probabilities[:10].sum().item() - reference[:10].sum().item()) < 0.005
+
+
+def test_window_is_drawn_once():
+    draws = []
+
+    class CountingSampler(TimestepSampler):
+        def get_probabilities(self):
+            return torch.ones(self.num_timesteps)
+
+        def draw(self, num):
+            draws.append(num)
+            return super().draw(num)
+
+    sampler = CountingSampler(1000, 'cpu', window_size=4)
+    batches = [sampler.sample(2) for _ in range(8)]
+    assert draws == [8, 8]
+    assert all(batch.shape == (2,) for batch in batches)
+
+
+def test_importance_weights_average_to_one():
+    torch.manual_seed(2)
+    for content_or_style in ['content', 'style', 'balanced']:
+        sampler = get_timestep_sampler(FakeTrainConfig(), content_or_style, 1000, 100, 900, 'cpu')
+        weights = sampler.importance_weights(sampler.sample(NUM_SAMPLES))
+        assert abs(weights.mean().item() - 1.0) < 0.02, f"{content_or_style}: {weights.mean().item()}"
+        # exact expectation
+        expected = (sampler.probabilities * sampler.weights).sum().item()
+        assert abs(expected - 1.0) < 1e-4
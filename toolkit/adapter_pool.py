@@ -0,0 +1,233 @@
+import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+import torch
+
+from toolkit.network_mixins import broadcast_and_multiply
+from toolkit.print import print_acc
+
+if TYPE_CHECKING:
+    from toolkit.lora_special import LoRASpecialNetwork, LoRAModule
+
+
+class LoRAAdapterPool:
+    """
+    Holds up to capacity LoRA checkpoints for one network in stacked device tensors, so a different
+    checkpoint can be applied to every row of a batch in one forward pass and switching between them
+    does not load or merge anything. The network's own modules are used for the layer layout only.
+    When more checkpoints are registered than fit, the least recently used one is evicted and loaded
+    again from its source when it is needed.
+    """
+
+    def __init__(
+            self,
+            network: 'LoRASpecialNetwork',
+            capacity: int = 8,
+            device: Union[str, torch.device] = None,
+            dtype: torch.dtype = None,
+    ):
+        if capacity < 1:
+            raise ValueError("The adapter pool needs a capacity of at least 1")
+        self.network = network
+        self.capacity = capacity
+        modules: List['LoRAModule'] = network.get_all_modules()
+        if len(modules) == 0:
+            raise ValueError("There are not any lora modules in this network. Check your config and try again")
+        first_weight = modules[0].lora_down.weight
+        self.device = torch.device(device) if device is not None else first_weight.device
+        self.dtype = dtype if dtype is not None else first_weight.dtype
+
+        # lora name -> (down [capacity, rank, in], up [capacity, out, rank]), the scale is folded into up
+        self.stacks: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        for module in modules:
+            is_linear_lora = isinstance(getattr(module, 'lora_down', None), torch.nn.Linear)
+            if not is_linear_lora or getattr(module, 'full_rank', False) or module.__class__.__name__ == "DoRAModule":
+                raise ValueError(
+                    f"The adapter pool only supports linear LoRA layers, {module.lora_name} is not one"
+                )
+            rank, in_features = module.lora_down.weight.shape
+            out_features = module.lora_up.weight.shape[0]
+            self.stacks[module.lora_name] = (
+                torch.zeros((capacity, rank, in_features), device=self.device, dtype=self.dtype),
+                torch.zeros((capacity, out_features, rank), device=self.device, dtype=self.dtype),
+            )
+
+        # name -> path or state dict to load it from
+        self.sources: Dict[str, Union[str, Dict[str, torch.Tensor]]] = OrderedDict()
+        # resident adapters in least to most recently used order, name -> slot
+        self.resident: OrderedDict[str, int] = OrderedDict()
+        self.free_slots = list(range(capacity))
+        self.num_loads = 0
+        self.num_evictions = 0
+
+        # set by set_batch_adapters
+        self.is_active = False
+        self.num_rows = 0
+        # (slot, row indices) for every adapter in the batch
+        self.row_groups: List[Tuple[int, torch.Tensor]] = []
+        self.row_multipliers: Optional[torch.Tensor] = None
+        self._expanded_rows: Dict[int, List[Tuple[int, torch.Tensor]]] = {}
+
+        network.adapter_pool = self
+        # merging in would bake the network's own weights into the model
+        network.can_merge_in = False
+
+    def register(self, name: str, source: Union[str, Dict[str, torch.Tensor]]):
+        """Adds a checkpoint path or state dict under name. It is loaded the first time it is used"""
+        if name in self.resident:
+            # replaced, drop the old weights
+            self.free_slots.append(self.resident.pop(name))
+        self.sources[name] = source
+
+    @property
+    def names(self) -> List[str]:
+        return list(self.sources.keys())
+
+    def _get_state_dict(self, name: str) -> Dict[str, torch.Tensor]:
+        source = self.sources[name]
+        if isinstance(source, str):
+            if os.path.splitext(source)[1] == ".safetensors":
+                from safetensors.torch import load_file
+                state_dict = load_file(source)
+            else:
+                state_dict = torch.load(source, map_location="cpu")
+        else:
+            state_dict = source
+        if self.network.base_model_ref is not None:
+            state_dict = self.network.base_model_ref().convert_lora_weights_before_load(state_dict)
+        translator = self.network.get_key_translator()
+        load_sd = {}
+        for key, value in state_dict.items():
+            load_key = translator.to_load_key(key)
+            if load_key is not None:
+                load_sd[load_key] = value
+        return load_sd
+
+    @torch.no_grad()
+    def _load_into_slot(self, name: str, slot: int):
+        state_dict = self._get_state_dict(name)
+        num_loaded = 0
+        for lora_name, (down_stack, up_stack) in self.stacks.items():
+            down_stack[slot].zero_()
+            up_stack[slot].zero_()
+            down = state_dict.get(f"{lora_name}.lora_down.weight", None)
+            up = state_dict.get(f"{lora_name}.lora_up.weight", None)
+            if down is None or up is None:
+                # layer is not in this checkpoint, it stays zero
+                continue
+            down = down.flatten(1)
+            up = up.flatten(1)
+            rank = down.shape[0]
+            if rank > down_stack.shape[1]:
+                raise ValueError(
+                    f"{name} has rank {rank} for {lora_name} but the pool only holds rank {down_stack.shape[1]}. "
+                    f"Create the network with a rank at least as large as every checkpoint."
+                )
+            alpha = state_dict.get(f"{lora_name}.alpha", None)
+            # peft checkpoints do not have an alpha, they are saved with alpha == rank
+            scale = 1.0 if alpha is None else float(alpha) / rank
+            down_stack[slot, :rank].copy_(down.to(self.device, dtype=self.dtype), non_blocking=True)
+            up_stack[slot, :, :rank].copy_((up.float() * scale).to(self.device, dtype=self.dtype), non_blocking=True)
+            num_loaded += 1
+        if num_loaded == 0:
+            raise ValueError(f"None of the layers of {name} match the network")
+        self.num_loads += 1
+
+    def load(self, name: str, keep: Optional[List[str]] = None) -> int:
+        """Makes name resident and returns its slot. Adapters in keep are not evicted"""
+        if name not in self.sources:
+            raise ValueError(f"Unknown adapter {name}, register it first")
+        if name in self.resident:
+            self.resident.move_to_end(name)
+            return self.resident[name]
+        if len(self.free_slots) == 0:
+            keep = keep if keep is not None else []
+            evict_name = next((n for n in self.resident if n not in keep), None)
+            if evict_name is None:
+                raise ValueError(f"All {self.capacity} slots of the adapter pool are in use by this batch")
+            self.free_slots.append(self.resident.pop(evict_name))
+            self.num_evictions += 1
+        slot = self.free_slots.pop(0)
+        self._load_into_slot(name, slot)
+        self.resident[name] = slot
+        return slot
+
+    def set_batch_adapters(self, names: List[Optional[str]], multipliers: Union[float, List[float]] = 1.0):
+        """
+        Sets the adapter for every row of the batch. None rows get no adapter. The network skips its
+        forward when no row has one.
+        """
+        if not isinstance(multipliers, list):
+            multipliers = [multipliers] * len(names)
+        if len(multipliers) != len(names):
+            raise ValueError(f"Got {len(multipliers)} multipliers for {len(names)} rows")
+        unique_names = list(OrderedDict.fromkeys(n for n in names if n is not None))
+        if len(unique_names) > self.capacity:
+            raise ValueError(
+                f"The batch uses {len(unique_names)} adapters but the pool only holds {self.capacity}"
+            )
+        groups = []
+        for name in unique_names:
+            slot = self.load(name, keep=unique_names)
+            rows = [i for i, n in enumerate(names) if n == name]
+            groups.append((slot, torch.tensor(rows, device=self.device, dtype=torch.long)))
+        self.row_groups = groups
+        self.num_rows = len(names)
+        self._expanded_rows = {}
+        row_multipliers = [m if n is not None else 0.0 for n, m in zip(names, multipliers)]
+        self.row_multipliers = torch.tensor(row_multipliers, device=self.device, dtype=self.dtype)
+        self.is_active = True
+        # the pool applies the per row multipliers itself, the network only switches on and off
+        self.network.multiplier = 1.0 if len(groups) > 0 else 0.0
+        self.network.is_active = True
+
+    def clear(self):
+        self.is_active = False
+        self.row_groups = []
+        self.row_multipliers = None
+        self._expanded_rows = {}
+        self.num_rows = 0
+
+    def _get_row_groups(self, batch_size: int) -> List[Tuple[int, torch.Tensor]]:
+        if batch_size == self.num_rows:
+            return self.row_groups
+        if batch_size not in self._expanded_rows:
+            if batch_size % self.num_rows != 0:
+                raise ValueError(f"Batch size {batch_size} does not match the {self.num_rows} adapter rows")
+            # pipelines concatenate the unconditional and conditional batches for cfg
+            num_repeats = batch_size // self.num_rows
+            self._expanded_rows[batch_size] = [
+                (slot, torch.cat([rows + i * self.num_rows for i in range(num_repeats)]))
+                for slot, rows in self.row_groups
+            ]
+        return self._expanded_rows[batch_size]
+
+    def forward_module(self, module: 'LoRAModule', x: torch.Tensor) -> torch.Tensor:
+        """LoRA output of module for the adapter of every row of x, before the network multiplier"""
+        down_stack, up_stack = self.stacks[module.lora_name]
+        x = x.to(self.dtype)
+        batch_size = x.size(0)
+        row_groups = self._get_row_groups(batch_size)
+        row_multipliers = self.row_multipliers
+        if batch_size != self.num_rows:
+            row_multipliers = row_multipliers.repeat(batch_size // self.num_rows)
+
+        if len(row_groups) == 1 and row_groups[0][1].numel() == batch_size:
+            # every row uses the same adapter
+            slot = row_groups[0][0]
+            lx = torch.nn.functional.linear(x, down_stack[slot])
+            lx = torch.nn.functional.linear(lx, up_stack[slot])
+            return broadcast_and_multiply(lx, row_multipliers)
+
+        lora_output = x.new_zeros((*x.shape[:-1], up_stack.shape[1]))
+        for slot, rows in row_groups:
+            lx = torch.nn.functional.linear(x[rows], down_stack[slot])
+            lora_output[rows] = torch.nn.functional.linear(lx, up_stack[slot])
+        return broadcast_and_multiply(lora_output, row_multipliers)
+
+    def print_stats(self):
+        print_acc(
+            f"Adapter pool: {len(self.resident)}/{self.capacity} resident, {len(self.sources)} registered, "
+            f"{self.num_loads} loads, {self.num_evictions} evictions"
+        )
@@ -0,0 +1,202 @@
+import concurrent.futures
+import glob
+import json
+import os
+import re
+import shutil
+import time
+from typing import List, Optional
+
+from toolkit.print import print_acc
+
+# checkpoints.json in the save root records every artifact a training job writes.
+# {
+#     "version": 1,
+#     "artifacts": [
+#         {"type": "lora", "step": 500, "path": "my_lora_000000500.safetensors",
+#          "files": [{"path": "my_lora_000000500.safetensors", "size": 123}], "time": 1700000000.0},
+#         ...
+#     ]
+# }
+# Paths are relative to the save root. An artifact can have several files, such as the high and low
+# noise LoRAs of a split multistage model, and they are always kept or removed together.
+
+CHECKPOINT_MANIFEST_FILE = 'checkpoints.json'
+CHECKPOINT_MANIFEST_VERSION = 1
+
+# artifact types that are overwritten in place and never removed by retention
+UNMANAGED_ARTIFACT_TYPES = ['optimizer']
+
+_step_regex = re.compile(r'_(\d{9})(?=[._]|$)')
+
+
+def get_step_from_name(name: str) -> Optional[int]:
+    match = _step_regex.search(os.path.basename(name))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def _get_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(root, filename))
+    return total
+
+
+def _remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    # see if a yaml file with same name exists
+    yaml_file = os.path.splitext(path)[0] + ".yaml"
+    if os.path.exists(yaml_file):
+        os.remove(yaml_file)
+
+
+class CheckpointManifest:
+    def __init__(self, save_root: str):
+        self.save_root = save_root
+        self.manifest_path = os.path.join(save_root, CHECKPOINT_MANIFEST_FILE)
+        self.artifacts = []
+        self.loaded = False
+        # deletions run one at a time off the training thread
+        self.delete_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending_deletes = []
+
+    def load(self, legacy_scan_patterns: Optional[List[tuple]] = None):
+        """
+        Loads the manifest. If there is none yet, it is built once from a directory scan using
+        legacy_scan_patterns, a list of (glob pattern, artifact type) tuples.
+        """
+        self.loaded = True
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r') as f:
+                    data = json.load(f)
+                self.artifacts = data.get('artifacts', [])
+                return
+            except Exception as e:
+                print_acc(f"Could not read {self.manifest_path}, rebuilding it: {e}")
+        self.artifacts = []
+        if legacy_scan_patterns is not None and os.path.exists(self.save_root):
+            self._build_from_scan(legacy_scan_patterns)
+            self.write()
+
+    def _build_from_scan(self, legacy_scan_patterns: List[tuple]):
+        seen = set()
+        # files of the same type and step are one artifact, eg split high and low noise LoRAs
+        grouped = {}
+        for pattern, artifact_type in legacy_scan_patterns:
+            for item in sorted(glob.glob(os.path.join(self.save_root, pattern))):
+                if item in seen or item.endswith('.yaml'):
+                    continue
+                seen.add(item)
+                step = get_step_from_name(item)
+                if step is None:
+                    continue
+                grouped.setdefault((artifact_type, step), []).append(item)
+        for (artifact_type, step), items in grouped.items():
+            self.artifacts.append(self._make_artifact(items[0], step, artifact_type, items))
+
+    def _make_artifact(self, path: str, step: Optional[int], artifact_type: str, files: List[str]) -> dict:
+        return {
+            'type': artifact_type,
+            'step': step,
+            'path': os.path.relpath(path, self.save_root),
+            'files': [
+                {'path': os.path.relpath(f, self.save_root), 'size': _get_size(f)} for f in files if os.path.exists(f)
+            ],
+            'time': time.time(),
+        }
+
+    def write(self):
+        os.makedirs(self.save_root, exist_ok=True)
+        data = {
+            'version': CHECKPOINT_MANIFEST_VERSION,
+            'artifacts': self.artifacts,
+        }
+        # written to a temp file and swapped in so readers never see a partial manifest
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def add(self, path: str, step: Optional[int], artifact_type: str, files: Optional[List[str]] = None):
+        """Records an artifact written by save. files defaults to just path."""
+        if files is None:
+            files = [path]
+        rel_path = os.path.relpath(path, self.save_root)
+        # a save to the same path replaces the old entry, unmanaged types only keep their latest entry
+        self.artifacts = [
+            a for a in self.artifacts
+            if a['path'] != rel_path and not (artifact_type in UNMANAGED_ARTIFACT_TYPES and a['type'] == artifact_type)
+        ]
+        self.artifacts.append(self._make_artifact(path, step, artifact_type, files))
+
+    def get_artifacts(self, artifact_type: Optional[str] = None) -> List[dict]:
+        if artifact_type is None:
+            return list(self.artifacts)
+        return [a for a in self.artifacts if a['type'] == artifact_type]
+
+    def get_abs_path(self, artifact: dict) -> str:
+        return os.path.join(self.save_root, artifact['path'])
+
+    def get_latest(self, artifact_type: str) -> Optional[dict]:
+        artifacts = [a for a in self.get_artifacts(artifact_type) if a['step'] is not None]
+        if len(artifacts) == 0:
+            return None
+        return max(artifacts, key=lambda a: (a['step'], a['time']))
+
+    def get_artifacts_to_remove(self, num_to_keep: int) -> List[dict]:
+        """Returns every step artifact except the latest num_to_keep of each type"""
+        to_remove = []
+        if num_to_keep <= 0:
+            return to_remove
+        types = list(dict.fromkeys([a['type'] for a in self.artifacts]))
+        for artifact_type in types:
+            if artifact_type in UNMANAGED_ARTIFACT_TYPES:
+                continue
+            # final saves without a step are never removed
+            artifacts = [a for a in self.get_artifacts(artifact_type) if a['step'] is not None]
+            artifacts.sort(key=lambda a: (a['step'], a['time']))
+            to_remove.extend(artifacts[:-num_to_keep])
+        return to_remove
+
+    def remove(self, artifacts: List[dict], background: bool = True):
+        """Drops the artifacts from the manifest, writes it, then deletes their files"""
+        if len(artifacts) == 0:
+            return
+        remove_paths = set([a['path'] for a in artifacts])
+        self.artifacts = [a for a in self.artifacts if a['path'] not in remove_paths]
+        # the manifest is updated first so a crash mid delete never lists missing files
+        self.write()
+        for artifact in artifacts:
+            files = [os.path.join(self.save_root, f['path']) for f in artifact['files']]
+            if len(files) == 0:
+                files = [self.get_abs_path(artifact)]
+            for file_path in files:
+                print_acc(f"Removing old save: {file_path}")
+                if background:
+                    self.pending_deletes.append(self.delete_pool.submit(_remove_path, file_path))
+                else:
+                    _remove_path(file_path)
+        still_pending = []
+        for future in self.pending_deletes:
+            if not future.done():
+                still_pending.append(future)
+            elif future.exception() is not None:
+                print_acc(f"Failed to remove old save: {future.exception()}")
+        self.pending_deletes = still_pending
+
+    def wait_for_deletes(self):
+        for future in self.pending_deletes:
+            try:
+                future.result()
+            except Exception as e:
+                print_acc(f"Failed to remove old save: {e}")
+        self.pending_deletes = []
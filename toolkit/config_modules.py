@@ -7,6 +7,7 @@ import torch
 import torchaudio
 
 from toolkit.prompt_utils import PromptEmbeds
+from toolkit.saving import DEFAULT_MAX_SHARD_SIZE
 
 ImgExt = Literal['jpg', 'png', 'webp']
 
@@ -29,6 +30,17 @@ class SaveConfig:
         self.push_to_hub: bool = kwargs.get("push_to_hub", False)
         self.hf_repo_id: Optional[str] = kwargs.get("hf_repo_id", None)
         self.hf_private: Optional[str] = kwargs.get("hf_private", False)
+        # full model saves are streamed into shards of at most this size (eg "5GB")
+        self.max_shard_size: str = kwargs.get('max_shard_size', DEFAULT_MAX_SHARD_SIZE)
+        # fine tuning only. Saves between full snapshots are stored as compressed deltas from the last snapshot
+        self.delta_checkpoints: bool = kwargs.get('delta_checkpoints', False)
+        # with delta_checkpoints, every nth save is written as a full snapshot
+        self.full_checkpoint_every: int = kwargs.get('full_checkpoint_every', 5)
+        # pt: single optimizer.pt. safetensors: sharded optimizer_state folder that is loaded lazily on resume.
+        # Defaults to safetensors with delta_checkpoints since only that format is stored as a delta
+        self.optimizer_format: str = kwargs.get('optimizer_format', 'safetensors' if self.delta_checkpoints else 'pt')
+        if self.optimizer_format not in ['pt', 'safetensors']:
+            raise ValueError(f"optimizer_format must be pt or safetensors, got {self.optimizer_format}")
 
 class LoggingConfig:
     def __init__(self, **kwargs):
@@ -209,6 +221,35 @@ class NetworkConfig:
         # for multi stage models
         self.split_multistage_loras = kwargs.get('split_multistage_loras', True)
 
+        # keep a cpu copy of the float32 base weights touched when merging in for sampling so merging out
+        # restores them exactly instead of subtracting the delta again. Costs a cpu copy of every
+        # weight with a lora while sampling. Quantized and half precision weights are always backed up,
+        # subtracting the delta from them would leave rounding error in the base weights every merge
+        self.merge_backup = kwargs.get('merge_backup', False)
+
+        # run the down projections of sibling modules that read the same input, like q, k and v, as one matmul
+        self.fuse_projections = kwargs.get('fuse_projections', False)
+
+
+class LoRASlotConfig:
+    # an extra LoRA trained on the same base model by the multi lora trainer
+    def __init__(self, **kwargs):
+        self.name: str = kwargs.get('name', None)
+        if self.name is None:
+            raise ValueError("Every entry in loras needs a name")
+        # overrides for the network config of the process, eg a different rank
+        self.network: dict = kwargs.get('network', {})
+        self.datasets: List[dict] = kwargs.get('datasets', [])
+        if len(self.datasets) == 0:
+            raise ValueError(f"LoRA {self.name} has no datasets")
+        self.trigger_word: Optional[str] = kwargs.get('trigger_word', None)
+        # default to the train and save config of the process
+        self.lr: Optional[float] = kwargs.get('lr', None)
+        self.save_every: Optional[int] = kwargs.get('save_every', None)
+        self.max_step_saves_to_keep: Optional[int] = kwargs.get('max_step_saves_to_keep', None)
+        # also generate the samples with this LoRA into its own folder
+        self.sample: bool = kwargs.get('sample', True)
+
 
 AdapterTypes = Literal['t2i', 'ip', 'ip+', 'clip', 'ilora', 'photo_maker', 'control_net', 'control_lora', 'i2v']
 
@@ -431,6 +472,17 @@ class TrainConfig:
         # and accumulate gradients. This can be used as basic gradient accumulation but is very helpful
         # for training tricks that increase batch size but need a single gradient step
         self.single_item_batching = kwargs.get('single_item_batching', False)
+        # with gradient_accumulation, sets up every microbatch of a step first and runs their prior predictions
+        # (prior preservation, diff output preservation, ...) as one batched forward. Needs cached latents and
+        # no adapters, control or clip images
+        self.batch_prior_predictions = kwargs.get('batch_prior_predictions', False)
+        # instead of alternating steps between the train and reg datasets, every microbatch gets a reg batch
+        # packed in with it when they share a bucket. The reg samples are weighted by reg_weight and matched
+        # to the prior per sample in the same forward. Batches from different buckets run one after the other.
+        # Alternating makes every other microbatch a reg batch, packing gives every microbatch both, so a step
+        # sums the gradients of twice as many batches. Halve gradient_accumulation or the learning rate to
+        # match the step size of an alternating run
+        self.pack_reg_batches = kwargs.get('pack_reg_batches', False)
 
         match_adapter_assist = kwargs.get('match_adapter_assist', False)
         self.match_adapter_chance = kwargs.get('match_adapter_chance', 0.0)
@@ -500,6 +552,8 @@ class TrainConfig:
         self.target_norm_std_value = kwargs.get('target_norm_std_value', 1.0)
         self.timestep_type = kwargs.get('timestep_type', 'sigmoid')  # sigmoid, linear, lognorm_blend, next_sample, weighted, one_step
         self.next_sample_timesteps = kwargs.get('next_sample_timesteps', 8)
+        # weights the loss by 1 / (range * p(timestep)) so non uniform timestep sampling trains like a uniform draw
+        self.timestep_importance_weighting = kwargs.get('timestep_importance_weighting', False)
         self.linear_timesteps = kwargs.get('linear_timesteps', False)
         self.linear_timesteps2 = kwargs.get('linear_timesteps2', False)
         self.disable_sampling = kwargs.get('disable_sampling', False)
@@ -613,6 +667,16 @@ class ModelConfig:
         self.ignore_if_contains: Optional[List[str]] = kwargs.get("ignore_if_contains", None)
         self.only_if_contains: Optional[List[str]] = kwargs.get("only_if_contains", None)
         self.quantize_kwargs = kwargs.get("quantize_kwargs", {})
+        # threads used to quantize transformer blocks when quantizing on the cpu, defaults to up to 8
+        self.quantize_num_workers: Optional[int] = kwargs.get("quantize_num_workers", None)
+        # save the quantized weights after the first quantization and load them from there next time.
+        # Only some models. The cache is keyed on the model files, qtype and accuracy recovery adapter
+        self.quantize_cache = kwargs.get("quantize_cache", False)
+        # defaults to cache/quantized in the toolkit root
+        self.quantize_cache_dir = kwargs.get("quantize_cache_dir", None)
+        # build the transformer on the meta device and load it from safetensors one block at a time,
+        # quantizing each block as it is loaded. Only some models, with diffusers format weights
+        self.lazy_load = kwargs.get("lazy_load", False)
         
         # splits the model over the available gpus WIP
         self.split_model_over_gpus = kwargs.get("split_model_over_gpus", False)
@@ -626,6 +690,12 @@ class ModelConfig:
         
         # auto memory management, only for some models
         self.auto_memory = kwargs.get("auto_memory", False)
+        # GB of device memory auto memory may keep layers resident in, the rest are bounced from cpu.
+        # None bounces every layer
+        self.auto_memory_budget = kwargs.get("auto_memory_budget", None)
+        self.auto_memory_budget_te = kwargs.get("auto_memory_budget_te", None)
+        # how many layers ahead auto memory copies bounced weights to the device. 0 copies each on call
+        self.auto_memory_prefetch = kwargs.get("auto_memory_prefetch", 0)
         if self.auto_memory and self.qtype == "qfloat8":
             print(f"Auto memory is not compatible with qfloat8, switching to float8 for model")
             self.qtype = "float8"
@@ -724,6 +794,11 @@ class EMAConfig:
         # similar to a decay in an optimizer but the opposite
         self.param_multiplier: float = kwargs.get('param_multiplier', 1.0)
 
+        # only average every n optimizer steps, the decay is corrected to cover the skipped steps
+        self.update_every: int = int(kwargs.get('update_every', 1))
+        # keep the ema weights in cpu memory and average them on a worker thread. Not with use_feedback
+        self.offload: bool = kwargs.get('offload', False)
+
 
 class ReferenceDatasetConfig:
     def __init__(self, **kwargs):
@@ -1009,6 +1084,7 @@ class GenerateImageConfig:
             fps: int = 15,
             ctrl_idx: int = 0,
             do_cfg_norm: bool = False,
+            adapter: Optional[str] = None,  # name of the adapter pool checkpoint to generate with
     ):
         self.width: int = width
         self.height: int = height
@@ -1027,6 +1103,7 @@ class GenerateImageConfig:
             # generate random one
             self.seed = random.randint(0, 2 ** 32 - 1)
         self.network_multiplier: float = network_multiplier
+        self.adapter: Optional[str] = adapter
         self.output_folder: str = output_folder
         self.output_ext: str = output_ext
         self.add_prompt_file: bool = add_prompt_file
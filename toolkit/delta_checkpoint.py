@@ -0,0 +1,346 @@
+import json
+import os
+import shutil
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+# Delta checkpoints store a save as the difference from the last full snapshot.
+# Every safetensors file in the save keeps its name and holds, for each tensor, either
+#   same - bit identical to the base, nothing stored
+#   xor  - the xor of the raw bits against the base, zlib compressed, stored as a uint8 tensor
+#   full - stored as is (new key, shape or dtype changed, or xor did not compress)
+# The file metadata is kept so training info can still be read from a delta save.
+# Saves made inside a DeltaSave context are encoded from memory as each file is written.
+
+DELTA_META_KEY = 'aitk_delta'
+DELTA_BASE_META_KEY = 'aitk_delta_base'
+# how many saves since the full snapshot, so the snapshot cadence survives a resume
+DELTA_INDEX_META_KEY = 'aitk_delta_index'
+# written in the root of a delta save that is a diffusers folder
+DELTA_FOLDER_INFO_FILE = 'aitk_delta.json'
+DELTA_RESTORE_FOLDER = '_delta_restore'
+
+_int_view_dtypes = {
+    1: torch.uint8,
+    2: torch.int16,
+    4: torch.int32,
+    8: torch.int64,
+}
+
+
+def _list_safetensors_files(path: str) -> List[str]:
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith('.safetensors'):
+                files.append(os.path.join(root, filename))
+    files.sort()
+    return files
+
+
+def _get_raw_metadata(file_path: str) -> Dict[str, str]:
+    with safe_open(file_path, framework="pt") as f:
+        metadata = f.metadata()
+    return dict(metadata) if metadata is not None else {}
+
+
+def is_delta_checkpoint(path: str) -> bool:
+    if path is None or not os.path.exists(path):
+        return False
+    if os.path.isdir(path):
+        return os.path.exists(os.path.join(path, DELTA_FOLDER_INFO_FILE))
+    if not path.endswith('.safetensors'):
+        return False
+    return DELTA_META_KEY in _get_raw_metadata(path)
+
+
+def get_delta_base_path(path: str) -> Optional[str]:
+    """Returns the full snapshot a delta save depends on, or None if it is not a delta save"""
+    if not is_delta_checkpoint(path):
+        return None
+    parent = os.path.dirname(os.path.abspath(path))
+    if os.path.isdir(path):
+        with open(os.path.join(path, DELTA_FOLDER_INFO_FILE), 'r') as f:
+            base_name = json.load(f)['base']
+    else:
+        base_name = _get_raw_metadata(path)[DELTA_BASE_META_KEY]
+    return os.path.normpath(os.path.join(parent, base_name))
+
+
+def get_delta_index(path: str) -> int:
+    """Returns how many saves a checkpoint is past its full snapshot, 0 for a full snapshot"""
+    if not is_delta_checkpoint(path):
+        return 0
+    if os.path.isdir(path):
+        with open(os.path.join(path, DELTA_FOLDER_INFO_FILE), 'r') as f:
+            return int(json.load(f).get('index', 1))
+    return int(_get_raw_metadata(path).get(DELTA_INDEX_META_KEY, 1))
+
+
+class _BaseTensorLookup:
+    # lazily reads base tensors by key from the memory mapped files of the matching base file or folder
+    def __init__(self, base_path: str):
+        self.key_to_file = {}
+        if os.path.exists(base_path):
+            files = [base_path] if os.path.isfile(base_path) else [
+                os.path.join(base_path, f) for f in sorted(os.listdir(base_path)) if f.endswith('.safetensors')
+            ]
+            for file_path in files:
+                with safe_open(file_path, framework="pt") as f:
+                    for key in f.keys():
+                        self.key_to_file[key] = file_path
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        file_path = self.key_to_file.get(key, None)
+        if file_path is None:
+            return None
+        with safe_open(file_path, framework="pt") as f:
+            return f.get_tensor(key)
+
+
+def encode_tensor_delta(tensor: torch.Tensor, base: Optional[torch.Tensor]):
+    """Returns (mode, tensor to store or None)"""
+    if base is None or base.shape != tensor.shape or base.dtype != tensor.dtype or tensor.numel() == 0:
+        return 'full', tensor
+    int_dtype = _int_view_dtypes.get(tensor.element_size(), None)
+    if int_dtype is None:
+        return 'full', tensor
+    tensor_bits = tensor.contiguous().view(int_dtype)
+    base_bits = base.contiguous().view(int_dtype)
+    if torch.equal(tensor_bits, base_bits):
+        return 'same', None
+    # small updates leave sign, exponent and high mantissa bits untouched, so the xor is mostly zeros
+    xor_bytes = torch.bitwise_xor(tensor_bits, base_bits).view(torch.uint8).numpy().tobytes()
+    compressed = zlib.compress(xor_bytes, 1)
+    if len(compressed) >= len(xor_bytes):
+        return 'full', tensor
+    return 'xor', torch.frombuffer(bytearray(compressed), dtype=torch.uint8)
+
+
+def decode_tensor_delta(mode: str, stored: Optional[torch.Tensor], base: Optional[torch.Tensor]) -> torch.Tensor:
+    if mode == 'full':
+        return stored
+    if base is None:
+        raise ValueError("Base tensor for delta checkpoint is missing")
+    if mode == 'same':
+        return base
+    if mode == 'xor':
+        int_dtype = _int_view_dtypes[base.element_size()]
+        xor_bytes = zlib.decompress(stored.numpy().tobytes())
+        xor_bits = torch.frombuffer(bytearray(xor_bytes), dtype=torch.uint8).view(int_dtype)
+        base_bits = base.contiguous().view(int_dtype).reshape(-1)
+        return torch.bitwise_xor(base_bits, xor_bits).view(base.dtype).reshape(base.shape)
+    raise ValueError(f"Unknown delta mode {mode}")
+
+
+def encode_state_dict_delta(
+        state_dict: Dict[str, torch.Tensor],
+        lookup: _BaseTensorLookup,
+        base_name: str,
+        metadata: Optional[Dict[str, str]] = None,
+        delta_index: int = 1
+):
+    """Returns the (tensors, metadata) to write for state_dict as a delta against the tensors in lookup"""
+    modes = OrderedDict()
+    stored = OrderedDict()
+    for key, tensor in state_dict.items():
+        mode, value = encode_tensor_delta(tensor.detach().to('cpu'), lookup.get(key))
+        modes[key] = mode
+        if value is not None:
+            stored[key] = value
+    metadata = dict(metadata) if metadata is not None else {}
+    metadata[DELTA_META_KEY] = json.dumps(modes)
+    metadata[DELTA_BASE_META_KEY] = base_name
+    metadata[DELTA_INDEX_META_KEY] = str(delta_index)
+    return stored, metadata
+
+
+def convert_file_to_delta(file_path: str, base_path: str, base_name: str, delta_index: int = 1):
+    """
+    Rewrites a safetensors file in place as a delta against base_path, which is either a
+    safetensors file or a folder of them. base_name is stored relative to the file's folder.
+    """
+    with safe_open(file_path, framework="pt") as f:
+        metadata = f.metadata()
+        state_dict = OrderedDict((key, f.get_tensor(key)) for key in f.keys())
+    stored, metadata = encode_state_dict_delta(
+        state_dict, _BaseTensorLookup(base_path), base_name, metadata, delta_index
+    )
+    tmp_path = file_path + '.tmp'
+    save_file(stored, tmp_path, metadata=metadata)
+    os.replace(tmp_path, file_path)
+
+
+def convert_checkpoint_to_delta(path: str, base_path: str, delta_index: int = 1):
+    """
+    Converts a saved checkpoint (single safetensors file or diffusers folder) into a delta
+    checkpoint against the full snapshot at base_path. Files that are already deltas are left alone.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if os.path.isfile(path):
+        if DELTA_META_KEY not in _get_raw_metadata(path):
+            convert_file_to_delta(path, base_path, os.path.relpath(base_path, parent), delta_index)
+        return
+    for file_path in _list_safetensors_files(path):
+        if DELTA_META_KEY in _get_raw_metadata(file_path):
+            continue
+        rel_dir = os.path.relpath(os.path.dirname(file_path), path)
+        base_dir = os.path.normpath(os.path.join(base_path, rel_dir))
+        convert_file_to_delta(
+            file_path,
+            base_dir,
+            os.path.relpath(base_dir, os.path.dirname(file_path)),
+            delta_index
+        )
+    with open(os.path.join(path, DELTA_FOLDER_INFO_FILE), 'w') as f:
+        json.dump({'base': os.path.relpath(base_path, parent), 'index': delta_index}, f)
+
+
+_active_delta_save: Optional['DeltaSave'] = None
+
+
+def get_active_delta_save() -> Optional['DeltaSave']:
+    return _active_delta_save
+
+
+class DeltaSave:
+    """
+    Context for writing a checkpoint at save_path as a delta against the full snapshot at base_path.
+    While it is active, the safetensors writers in toolkit.saving hand every file under save_path to
+    encode before writing, so the full tensors never touch the disk. Anything saved another way, such
+    as a diffusers save_pretrained, is converted after the fact when the context exits.
+    """
+
+    def __init__(self, save_path: str, base_path: str, delta_index: int = 1):
+        self.save_path = os.path.abspath(save_path)
+        self.base_path = os.path.abspath(base_path)
+        self.delta_index = delta_index
+        self.lookups: Dict[str, _BaseTensorLookup] = {}
+
+    def _get_file_base_path(self, file_path: str) -> Optional[str]:
+        file_path = os.path.abspath(file_path)
+        if file_path == self.save_path:
+            return self.base_path
+        rel_dir = os.path.relpath(os.path.dirname(file_path), self.save_path)
+        if rel_dir == '..' or rel_dir.startswith('..' + os.sep):
+            # not part of this save
+            return None
+        return os.path.normpath(os.path.join(self.base_path, rel_dir))
+
+    def encode(self, state_dict: Dict[str, torch.Tensor], file_path: str, metadata: Optional[Dict[str, str]] = None):
+        """Returns the (tensors, metadata) to write to file_path"""
+        base_path = self._get_file_base_path(file_path)
+        if base_path is None:
+            return state_dict, metadata
+        if base_path not in self.lookups:
+            self.lookups[base_path] = _BaseTensorLookup(base_path)
+        base_name = os.path.relpath(base_path, os.path.dirname(os.path.abspath(file_path)))
+        return encode_state_dict_delta(state_dict, self.lookups[base_path], base_name, metadata, self.delta_index)
+
+    def __enter__(self):
+        global _active_delta_save
+        if _active_delta_save is not None:
+            raise RuntimeError("A delta save is already in progress")
+        _active_delta_save = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_delta_save
+        _active_delta_save = None
+        self.lookups = {}
+        if exc_type is None and os.path.exists(self.save_path):
+            convert_checkpoint_to_delta(self.save_path, self.base_path, self.delta_index)
+
+
+class DeltaFileReader:
+    """Reads single tensors from a memory mapped safetensors file, decoding them if it is a delta"""
+
+    def __init__(self, file_path: str, device: Union[str, torch.device] = 'cpu'):
+        self.handle = safe_open(file_path, framework="pt", device="cpu")
+        self.device = device
+        metadata = self.handle.metadata() or {}
+        self.modes = None
+        self.lookup = None
+        self.stored_keys = set(self.handle.keys())
+        if DELTA_META_KEY in metadata:
+            self.modes = json.loads(metadata[DELTA_META_KEY], object_pairs_hook=OrderedDict)
+            base_path = os.path.normpath(os.path.join(os.path.dirname(file_path), metadata[DELTA_BASE_META_KEY]))
+            self.lookup = _BaseTensorLookup(base_path)
+
+    def keys(self) -> List[str]:
+        if self.modes is None:
+            return list(self.handle.keys())
+        return list(self.modes.keys())
+
+    def get_tensor(self, key: str) -> torch.Tensor:
+        if self.modes is None:
+            return self.handle.get_tensor(key).to(self.device)
+        mode = self.modes[key]
+        stored = self.handle.get_tensor(key) if key in self.stored_keys else None
+        base = None if mode == 'full' else self.lookup.get(key)
+        return decode_tensor_delta(mode, stored, base).to(self.device)
+
+
+def load_delta_file(file_path: str, device: Union[str, torch.device] = 'cpu') -> 'OrderedDict':
+    """Reconstructs the full state dict of a single safetensors file, delta or not"""
+    reader = DeltaFileReader(file_path, device)
+    state_dict = OrderedDict()
+    for key in reader.keys():
+        state_dict[key] = reader.get_tensor(key)
+    return state_dict
+
+
+def restore_delta_checkpoint(path: str, output_path: str):
+    """Writes the full checkpoint a delta checkpoint represents to output_path"""
+    if os.path.isfile(path):
+        metadata = _get_raw_metadata(path)
+        metadata.pop(DELTA_META_KEY, None)
+        metadata.pop(DELTA_BASE_META_KEY, None)
+        metadata.pop(DELTA_INDEX_META_KEY, None)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        save_file(load_delta_file(path), output_path, metadata=metadata)
+        return
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    # copy configs and everything else, then rebuild the weights one file at a time
+    shutil.copytree(
+        path,
+        output_path,
+        ignore=shutil.ignore_patterns('*.safetensors', DELTA_FOLDER_INFO_FILE)
+    )
+    for file_path in _list_safetensors_files(path):
+        out_file = os.path.join(output_path, os.path.relpath(file_path, path))
+        metadata = _get_raw_metadata(file_path)
+        metadata.pop(DELTA_META_KEY, None)
+        metadata.pop(DELTA_BASE_META_KEY, None)
+        metadata.pop(DELTA_INDEX_META_KEY, None)
+        save_file(load_delta_file(file_path), out_file, metadata=metadata)
+
+
+def resolve_delta_checkpoint(path: str) -> str:
+    """
+    Returns a path that can be loaded as a normal checkpoint. Delta checkpoints are restored
+    into a _delta_restore folder next to them, remove it with cleanup_delta_restore once loaded.
+    """
+    if not is_delta_checkpoint(path):
+        return path
+    restore_root = os.path.join(os.path.dirname(os.path.abspath(path)), DELTA_RESTORE_FOLDER)
+    if os.path.exists(restore_root):
+        shutil.rmtree(restore_root)
+    output_path = os.path.join(restore_root, os.path.basename(os.path.normpath(path)))
+    restore_delta_checkpoint(path, output_path)
+    return output_path
+
+
+def cleanup_delta_restore(save_root: str):
+    restore_root = os.path.join(save_root, DELTA_RESTORE_FOLDER)
+    if os.path.exists(restore_root):
+        # memory mapped weights stay readable after the files are unlinked
+        shutil.rmtree(restore_root, ignore_errors=True)
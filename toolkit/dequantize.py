@@ -5,9 +5,8 @@ from optimum.quanto.tensor import QTensor
 import torch
 
 
-def hacked_state_dict(self, *args, **kwargs):
-    orig_state_dict = self.orig_state_dict(*args, **kwargs)
-    new_state_dict = {}
+def iter_dequantized_state_dict(orig_state_dict):
+    # yields one dequantized tensor at a time so a full float copy is never held in memory
     for key, value in orig_state_dict.items():
         if key.endswith("._scale"):
             continue
@@ -23,25 +22,32 @@ def hacked_state_dict(self, *args, **kwargs):
             scale = scale.float()
             value = value.float()
             dequantized = value * scale
-            
+
             # handle input and output scaling if they exist
             input_scale = orig_state_dict.get(key + ".input_scale")
-            
+
             if input_scale is not None:
                 # make sure the tensor is 1.0
                 if input_scale.item() != 1.0:
                     raise ValueError("Input scale is not 1.0, cannot dequantize")
-                
+
             output_scale = orig_state_dict.get(key + ".output_scale")
-            
+
             if output_scale is not None:
                 # make sure the tensor is 1.0
                 if output_scale.item() != 1.0:
                     raise ValueError("Output scale is not 1.0, cannot dequantize")
-            
-            new_state_dict[key] = dequantized.to('cpu', dtype=dtype)
+
+            yield key, dequantized.to('cpu', dtype=dtype)
         else:
-            new_state_dict[key] = value
+            yield key, value
+
+
+def hacked_state_dict(self, *args, **kwargs):
+    orig_state_dict = self.orig_state_dict(*args, **kwargs)
+    new_state_dict = {}
+    for key, value in iter_dequantized_state_dict(orig_state_dict):
+        new_state_dict[key] = value
     return new_state_dict
 
 # hacks the state dict so we can dequantize before saving
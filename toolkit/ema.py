@@ -1,7 +1,8 @@
 from __future__ import division
 from __future__ import unicode_literals
 
-from typing import Iterable, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
 import weakref
 import copy
 import contextlib
@@ -38,6 +39,14 @@ class ExponentialMovingAverage:
 
         use_num_updates: Whether to use number of updates when computing
             averages.
+
+        update_every: Only average every this many calls to `update`. The
+            decay is raised to this power so the average covers the same
+            number of steps.
+
+        offload: Keep the shadow params in pinned cpu memory, in float32.
+            The params are copied off the device and averaged on a worker
+            thread while training continues. Cannot be used with feedback.
     """
 
     def __init__(
@@ -47,21 +56,39 @@ class ExponentialMovingAverage:
             use_num_updates: bool = False,
             # feeds back the decat to the parameter
             use_feedback: bool = False,
-            param_multiplier: float = 1.0
+            param_multiplier: float = 1.0,
+            update_every: int = 1,
+            offload: bool = False
     ):
         if parameters is None:
             raise ValueError("parameters must be provided")
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
+        if update_every < 1:
+            raise ValueError('update_every must be at least 1')
+        if offload and use_feedback:
+            raise ValueError('EMA feedback needs the shadow params on the device, it cannot be used with offload')
         self.decay = decay
         self.num_updates = 0 if use_num_updates else None
         self.use_feedback = use_feedback
         self.param_multiplier = param_multiplier
+        self.update_every = update_every
+        self.offload = offload
+        self.num_calls = 0
         parameters = list(parameters)
-        self.shadow_params = [
-            p.clone().detach()
-            for p in parameters
-        ]
+        if offload:
+            self.shadow_params = [self._to_offloaded(p.detach()) for p in parameters]
+        else:
+            self.shadow_params = [
+                p.clone().detach()
+                for p in parameters
+            ]
+        # (shadow device, shadow dtype, param device, param dtype) -> param indexes, built on first update
+        self._groups: Optional[Dict[Tuple, List[int]]] = None
+        # offload only. pinned copies of the params and the average running on the worker
+        self._staging: Optional[List[torch.Tensor]] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Optional[Future] = None
         self.collected_params = None
         self._is_train_mode = True
         # By maintaining only a weakref to each parameter,
@@ -114,6 +141,9 @@ class ExponentialMovingAverage:
                 initialized will be used.
         """
         parameters = self._get_parameters(parameters)
+        self.num_calls += 1
+        if self.num_calls % self.update_every != 0:
+            return
         decay = self.decay
         if self.num_updates is not None:
             self.num_updates += 1
@@ -121,36 +151,116 @@ class ExponentialMovingAverage:
                 decay,
                 (1 + self.num_updates) / (10 + self.num_updates)
             )
-        one_minus_decay = 1.0 - decay
+        # covers the calls that were skipped
+        one_minus_decay = 1.0 - decay ** self.update_every
         with torch.no_grad():
-            for s_param, param in zip(self.shadow_params, parameters):
-                s_param_float = s_param.float()
-                if s_param.dtype != torch.float32:
-                    s_param_float = s_param_float.to(torch.float32)
-                param_float = param
-                if param.dtype != torch.float32:
-                    param_float = param_float.to(torch.float32)
-                tmp = (s_param_float - param_float)
-                # tmp will be a new tensor so we can do in-place
-                tmp.mul_(one_minus_decay)
-                s_param_float.sub_(tmp)
-                
+            if self.offload:
+                self._update_offloaded(parameters, one_minus_decay)
+                return
+            for (s_device, s_dtype, p_device, p_dtype), indexes in self._get_groups(parameters).items():
+                s_params = [self.shadow_params[i] for i in indexes]
+                params = [parameters[i].data for i in indexes]
+                s_params_float = s_params
+                if s_dtype != torch.float32:
+                    s_params_float = [s.to(torch.float32) for s in s_params]
+                params_float = params
+                if p_dtype != torch.float32:
+                    params_float = [p.to(torch.float32) for p in params]
+
                 update_param = False
+                if self.use_feedback:
+                    tmp = torch._foreach_sub(s_params_float, params_float)
+                    torch._foreach_mul_(tmp, one_minus_decay)
+
+                # s - (1 - decay) * (s - p) for the whole group
+                torch._foreach_lerp_(s_params_float, params_float, one_minus_decay)
+
                 if self.use_feedback:
                     # make feedback 10x decay
-                    param_float.add_(tmp * 10)
+                    torch._foreach_add_(params_float, tmp, alpha=10)
                     update_param = True
-                
+                    del tmp
+
                 if self.param_multiplier != 1.0:
-                    param_float.mul_(self.param_multiplier)
+                    torch._foreach_mul_(params_float, self.param_multiplier)
                     update_param = True
-                
-                if s_param.dtype !=  torch.float32:
-                    copy_stochastic(s_param, s_param_float)
-                
-                if update_param and param.dtype != torch.float32:
-                    copy_stochastic(param, param_float)
-                
+
+                if s_dtype != torch.float32:
+                    for s_param, s_param_float in zip(s_params, s_params_float):
+                        copy_stochastic(s_param, s_param_float)
+
+                if update_param and p_dtype != torch.float32:
+                    for param, param_float in zip(params, params_float):
+                        copy_stochastic(param, param_float)
+
+    def _get_groups(self, parameters: List[torch.nn.Parameter]) -> Dict[Tuple, List[int]]:
+        if self._groups is None:
+            groups = {}
+            for i, (s_param, param) in enumerate(zip(self.shadow_params, parameters)):
+                key = (s_param.device, s_param.dtype, param.device, param.dtype)
+                groups.setdefault(key, []).append(i)
+            self._groups = groups
+        return self._groups
+
+    @staticmethod
+    def _to_offloaded(tensor: torch.Tensor) -> torch.Tensor:
+        offloaded = torch.empty(
+            tensor.shape,
+            dtype=torch.float32 if tensor.is_floating_point() else tensor.dtype,
+            pin_memory=torch.cuda.is_available()
+        )
+        offloaded.copy_(tensor)
+        return offloaded
+
+    def _update_offloaded(self, parameters: List[torch.nn.Parameter], one_minus_decay: float):
+        # the staging buffers are still read by the last average
+        self.wait()
+        if self._staging is None:
+            self._staging = [
+                torch.empty(p.shape, dtype=p.dtype, pin_memory=torch.cuda.is_available())
+                for p in parameters
+            ]
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ema')
+        is_cuda = False
+        for staging, param in zip(self._staging, parameters):
+            is_cuda = is_cuda or param.is_cuda
+            staging.copy_(param.detach(), non_blocking=True)
+        copied = None
+        if is_cuda:
+            copied = torch.cuda.Event()
+            copied.record()
+        if self.param_multiplier != 1.0:
+            # queued after the copies, the average still sees the params from before
+            for (_, _, _, p_dtype), indexes in self._get_groups(parameters).items():
+                params = [parameters[i].data for i in indexes]
+                if p_dtype == torch.float32:
+                    torch._foreach_mul_(params, self.param_multiplier)
+                else:
+                    params_float = torch._foreach_mul([p.to(torch.float32) for p in params], self.param_multiplier)
+                    for param, param_float in zip(params, params_float):
+                        copy_stochastic(param, param_float)
+        self._pending = self._executor.submit(self._average_staging, copied, one_minus_decay)
+
+    def _average_staging(self, copied: Optional['torch.cuda.Event'], one_minus_decay: float):
+        if copied is not None:
+            copied.synchronize()
+        groups: Dict[torch.dtype, List[int]] = {}
+        for i, staging in enumerate(self._staging):
+            groups.setdefault(staging.dtype, []).append(i)
+        for dtype, indexes in groups.items():
+            s_params = [self.shadow_params[i] for i in indexes]
+            params_float = [self._staging[i] for i in indexes]
+            if dtype != torch.float32:
+                params_float = [p.to(torch.float32) for p in params_float]
+            torch._foreach_lerp_(s_params, params_float, one_minus_decay)
+
+    def wait(self) -> None:
+        """Blocks until an offloaded average running on the worker is done"""
+        if self._pending is not None:
+            pending = self._pending
+            self._pending = None
+            # raises anything the worker raised
+            pending.result()
 
     def copy_to(
             self,
@@ -166,6 +276,7 @@ class ExponentialMovingAverage:
                 initialized will be used.
         """
         parameters = self._get_parameters(parameters)
+        self.wait()
         for s_param, param in zip(self.shadow_params, parameters):
             param.data.copy_(s_param.data)
 
@@ -250,6 +361,8 @@ class ExponentialMovingAverage:
         Args:
             device: like `device` argument to `torch.Tensor.to`
         """
+        self.wait()
+        self._groups = None
         # .to() on the tensors handles None correctly
         self.shadow_params = [
             p.to(device=device, dtype=dtype)
@@ -271,6 +384,7 @@ class ExponentialMovingAverage:
         # Following PyTorch conventions, references to tensors are returned:
         # "returns a reference to the state and not its copy!" -
         # https://pytorch.org/tutorials/beginner/saving_loading_models.html#what-is-a-state-dict
+        self.wait()
         return {
             "decay": self.decay,
             "num_updates": self.num_updates,
@@ -287,6 +401,8 @@ class ExponentialMovingAverage:
         """
         # deepcopy, to be consistent with module API
         state_dict = copy.deepcopy(state_dict)
+        self.wait()
+        self._groups = None
         self.decay = state_dict["decay"]
         if self.decay < 0.0 or self.decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
@@ -320,9 +436,12 @@ class ExponentialMovingAverage:
             if not any(p is None for p in params):
                 # ^ parameter references are still good
                 for i, p in enumerate(params):
-                    self.shadow_params[i] = self.shadow_params[i].to(
-                        device=p.device, dtype=p.dtype
-                    )
+                    if self.offload:
+                        self.shadow_params[i] = self._to_offloaded(self.shadow_params[i])
+                    else:
+                        self.shadow_params[i] = self.shadow_params[i].to(
+                            device=p.device, dtype=p.dtype
+                        )
                     if self.collected_params is not None:
                         self.collected_params[i] = self.collected_params[i].to(
                             device=p.device, dtype=p.dtype
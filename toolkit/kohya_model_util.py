@@ -1174,13 +1174,6 @@ def is_safetensors(path):
 
 
 def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
-    # text encoderの格納形式が違うモデルに対応する ('text_model'がない)
-    TEXT_ENCODER_KEY_REPLACEMENTS = [
-        ("cond_stage_model.transformer.embeddings.", "cond_stage_model.transformer.text_model.embeddings."),
-        ("cond_stage_model.transformer.encoder.", "cond_stage_model.transformer.text_model.encoder."),
-        ("cond_stage_model.transformer.final_layer_norm.", "cond_stage_model.transformer.text_model.final_layer_norm."),
-    ]
-
     if is_safetensors(ckpt_path):
         checkpoint = None
         state_dict = load_file(ckpt_path)  # , device) # may causes error
@@ -1192,6 +1185,18 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
             state_dict = checkpoint
             checkpoint = None
 
+    convert_text_encoder_keys(state_dict)
+    return checkpoint, state_dict
+
+
+def convert_text_encoder_keys(state_dict):
+    # text encoderの格納形式が違うモデルに対応する ('text_model'がない)
+    TEXT_ENCODER_KEY_REPLACEMENTS = [
+        ("cond_stage_model.transformer.embeddings.", "cond_stage_model.transformer.text_model.embeddings."),
+        ("cond_stage_model.transformer.encoder.", "cond_stage_model.transformer.text_model.encoder."),
+        ("cond_stage_model.transformer.final_layer_norm.", "cond_stage_model.transformer.text_model.final_layer_norm."),
+    ]
+
     key_reps = []
     for rep_from, rep_to in TEXT_ENCODER_KEY_REPLACEMENTS:
         for key in state_dict.keys():
@@ -1203,7 +1208,64 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
         state_dict[new_key] = state_dict[key]
         del state_dict[key]
 
-    return checkpoint, state_dict
+    return state_dict
+
+
+def create_text_encoder_config_v2():
+    return CLIPTextConfig(
+        vocab_size=49408,
+        hidden_size=1024,
+        intermediate_size=4096,
+        num_hidden_layers=23,
+        num_attention_heads=16,
+        max_position_embeddings=77,
+        hidden_act="gelu",
+        layer_norm_eps=1e-05,
+        dropout=0.0,
+        attention_dropout=0.0,
+        initializer_range=0.02,
+        initializer_factor=1.0,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+        model_type="clip_text_model",
+        projection_dim=512,
+        torch_dtype="float32",
+        transformers_version="4.25.0.dev0",
+    )
+
+
+def create_text_encoder_config_v1():
+    # same architecture as openai/clip-vit-large-patch14 text model
+    return CLIPTextConfig(
+        vocab_size=49408,
+        hidden_size=768,
+        intermediate_size=3072,
+        num_hidden_layers=12,
+        num_attention_heads=12,
+        max_position_embeddings=77,
+        hidden_act="quick_gelu",
+        layer_norm_eps=1e-05,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+        projection_dim=768,
+    )
+
+
+def create_empty_models_from_stable_diffusion_config(v2, unet_use_linear_projection_in_v2=False):
+    """
+    Builds the text encoder and unet on the meta device. Useful for walking the module tree of a
+    checkpoint without loading its weights.
+    """
+    from accelerate import init_empty_weights
+    unet_config = create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
+    with init_empty_weights():
+        text_model = CLIPTextModel._from_config(
+            create_text_encoder_config_v2() if v2 else create_text_encoder_config_v1()
+        )
+        unet = UNet2DConditionModel(**unet_config)
+    return text_model, unet
 
 
 # TODO dtype指定の動作が怪しいので確認する text_encoderを指定形式で作れるか未確認
@@ -1230,27 +1292,7 @@ def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dt
     # convert text_model
     if v2:
         converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v2(state_dict, 77)
-        cfg = CLIPTextConfig(
-            vocab_size=49408,
-            hidden_size=1024,
-            intermediate_size=4096,
-            num_hidden_layers=23,
-            num_attention_heads=16,
-            max_position_embeddings=77,
-            hidden_act="gelu",
-            layer_norm_eps=1e-05,
-            dropout=0.0,
-            attention_dropout=0.0,
-            initializer_range=0.02,
-            initializer_factor=1.0,
-            pad_token_id=1,
-            bos_token_id=0,
-            eos_token_id=2,
-            model_type="clip_text_model",
-            projection_dim=512,
-            torch_dtype="float32",
-            transformers_version="4.25.0.dev0",
-        )
+        cfg = create_text_encoder_config_v2()
         text_model = CLIPTextModel._from_config(cfg)
         info = text_model.load_state_dict(converted_text_encoder_checkpoint)
     else:
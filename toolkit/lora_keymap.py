@@ -0,0 +1,330 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterator, Mapping, Optional, Tuple
+
+from toolkit.paths import KEYMAP_CACHE_ROOT, KEYMAPS_ROOT
+from toolkit.saving import get_lora_keymap_from_model_keymap
+
+# Key translation for saving and loading network weights. The keymap json files are several MB, so they
+# are parsed once per process and also written to a binary file in the user cache folder. Later processes
+# load that instead and only decode the keys they look up. Translated keys are cached, a network saves
+# and loads the same keys over and over.
+
+KEYMAP_BIN_MAGIC = b'AITKKM02'
+# magic, json mtime_ns, json size, number of pairs
+KEYMAP_BIN_HEADER = struct.Struct('<8sqqI')
+
+_keymap_lock = threading.Lock()
+# raw ldm -> diffusers keymaps by json file name, None if the file does not exist
+_raw_keymaps: Dict[str, Optional[Mapping[str, str]]] = {}
+_translators: Dict[Tuple, 'KeyTranslator'] = {}
+
+
+def get_keymap_bin_path(json_path: str) -> str:
+    # checkouts can have different keymaps, so the cache file is per json path
+    path_hash = hashlib.sha1(os.path.abspath(json_path).encode('utf-8')).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(json_path))[0]
+    return os.path.join(KEYMAP_CACHE_ROOT, f"{name}-{path_hash}.keymap.bin")
+
+
+def write_keymap_bin(keymap: Mapping[str, str], bin_path: str, json_stat: os.stat_result):
+    # header, the offset of every key and value in the string blob, the pair indices sorted by key and
+    # sorted by value for lookups in both directions, then all the strings back to back
+    strings = []
+    for ldm_key, diffusers_key in keymap.items():
+        strings.append(ldm_key.encode('utf-8'))
+        strings.append(diffusers_key.encode('utf-8'))
+    num_pairs = len(strings) // 2
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    # sorted is stable, equal values stay in file order so the last one can win like a dict inversion
+    by_key = sorted(range(num_pairs), key=lambda i: strings[i * 2])
+    by_value = sorted(range(num_pairs), key=lambda i: strings[i * 2 + 1])
+    header = KEYMAP_BIN_HEADER.pack(KEYMAP_BIN_MAGIC, json_stat.st_mtime_ns, json_stat.st_size, num_pairs)
+    os.makedirs(os.path.dirname(bin_path), exist_ok=True)
+    tmp_path = f"{bin_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(struct.pack(f'<{num_pairs}I', *by_key))
+        f.write(struct.pack(f'<{num_pairs}I', *by_value))
+        f.write(b''.join(strings))
+    os.replace(tmp_path, bin_path)
+
+
+class BinaryKeymap(Mapping):
+    """
+    Read only keymap backed by the bytes of a keymap.bin file. Lookups binary search the sorted index
+    and only decode the strings they compare, iterating decodes the pairs in file order as it goes.
+    """
+
+    def __init__(self, data: bytes, num_pairs: int, inverted: bool = False):
+        self.data = data
+        self.num_pairs = num_pairs
+        self.inverted = inverted
+        self.offsets_start = KEYMAP_BIN_HEADER.size
+        by_key_start = self.offsets_start + (num_pairs * 2 + 1) * 4
+        by_value_start = by_key_start + num_pairs * 4
+        self.index_start = by_value_start if inverted else by_key_start
+        self.blob_start = by_value_start + num_pairs * 4
+        # values can repeat, the inverse view counts them once when it is first asked
+        self._num_keys: Optional[int] = None if inverted else num_pairs
+
+    def inverse(self) -> 'BinaryKeymap':
+        """The value -> key view of the same data"""
+        return BinaryKeymap(self.data, self.num_pairs, inverted=not self.inverted)
+
+    def _get_bytes(self, string_idx: int) -> bytes:
+        start, end = struct.unpack_from('<2I', self.data, self.offsets_start + string_idx * 4)
+        return self.data[self.blob_start + start:self.blob_start + end]
+
+    def _get_pair_idx(self, i: int) -> int:
+        return struct.unpack_from('<I', self.data, self.index_start + i * 4)[0]
+
+    def _lookup_idx(self, key_bytes: bytes) -> Optional[int]:
+        # the pair of the last occurrence of key_bytes, like inverting into a dict would keep
+        i = bisect_right(_SortedColumn(self), key_bytes)
+        if i == 0:
+            return None
+        pair_idx = self._get_pair_idx(i - 1)
+        if self._get_bytes(pair_idx * 2 + (1 if self.inverted else 0)) != key_bytes:
+            return None
+        return pair_idx
+
+    def __getitem__(self, key: str) -> str:
+        pair_idx = self._lookup_idx(key.encode('utf-8'))
+        if pair_idx is None:
+            raise KeyError(key)
+        return self._get_bytes(pair_idx * 2 + (0 if self.inverted else 1)).decode('utf-8')
+
+    def __contains__(self, key) -> bool:
+        return isinstance(key, str) and self._lookup_idx(key.encode('utf-8')) is not None
+
+    def _iter_pair_indices(self) -> Iterator[int]:
+        if not self.inverted:
+            # the keys come from a dict, every pair is its own key
+            yield from range(self.num_pairs)
+            return
+        # equal values are next to each other in the sorted index, the last one is the one lookups return
+        sorted_values = _SortedColumn(self)
+        for i in range(self.num_pairs):
+            if i + 1 < self.num_pairs and sorted_values[i + 1] == sorted_values[i]:
+                continue
+            yield self._get_pair_idx(i)
+
+    def __iter__(self) -> Iterator[str]:
+        column = 1 if self.inverted else 0
+        for pair_idx in self._iter_pair_indices():
+            yield self._get_bytes(pair_idx * 2 + column).decode('utf-8')
+
+    def items(self):
+        for pair_idx in self._iter_pair_indices():
+            ldm_key = self._get_bytes(pair_idx * 2).decode('utf-8')
+            diffusers_key = self._get_bytes(pair_idx * 2 + 1).decode('utf-8')
+            yield (diffusers_key, ldm_key) if self.inverted else (ldm_key, diffusers_key)
+
+    def __len__(self) -> int:
+        if self._num_keys is None:
+            self._num_keys = sum(1 for _ in self._iter_pair_indices())
+        return self._num_keys
+
+
+class _SortedColumn:
+    """The looked up column of a BinaryKeymap in sorted order, decoded as bisect reads it"""
+
+    def __init__(self, keymap: BinaryKeymap):
+        self.keymap = keymap
+        self.column = 1 if keymap.inverted else 0
+
+    def __len__(self) -> int:
+        return self.keymap.num_pairs
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.keymap._get_bytes(self.keymap._get_pair_idx(i) * 2 + self.column)
+
+
+def read_keymap_bin(bin_path: str, json_stat: Optional[os.stat_result]) -> Optional[BinaryKeymap]:
+    """Returns the keymap, or None if the file is missing, corrupt or older than the json"""
+    try:
+        with open(bin_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < KEYMAP_BIN_HEADER.size:
+        return None
+    magic, mtime_ns, size, num_pairs = KEYMAP_BIN_HEADER.unpack_from(data, 0)
+    if magic != KEYMAP_BIN_MAGIC:
+        return None
+    if json_stat is not None and (mtime_ns != json_stat.st_mtime_ns or size != json_stat.st_size):
+        return None
+    keymap = BinaryKeymap(data, num_pairs)
+    if len(data) < keymap.blob_start:
+        return None
+    # the last offset is the size of the string blob
+    blob_size = struct.unpack_from('<I', data, keymap.offsets_start + num_pairs * 2 * 4)[0]
+    if len(data) != keymap.blob_start + blob_size:
+        return None
+    return keymap
+
+
+def load_ldm_diffusers_keymap(keymap_name: str) -> Optional[Mapping[str, str]]:
+    """
+    Loads the ldm_diffusers_keymap of a json file in toolkit/keymaps once per process. The binary copy
+    in the user cache is used when it is up to date with the json and written when it is not.
+    """
+    with _keymap_lock:
+        if keymap_name in _raw_keymaps:
+            return _raw_keymaps[keymap_name]
+        json_path = os.path.join(KEYMAPS_ROOT, keymap_name)
+        bin_path = get_keymap_bin_path(json_path)
+        json_stat = os.stat(json_path) if os.path.exists(json_path) else None
+        keymap = None
+        if json_stat is not None or os.path.exists(bin_path):
+            keymap = read_keymap_bin(bin_path, json_stat)
+        if keymap is None and json_stat is not None:
+            with open(json_path, 'r') as f:
+                keymap = OrderedDict(json.load(f)['ldm_diffusers_keymap'])
+            try:
+                write_keymap_bin(keymap, bin_path, json_stat)
+            except OSError:
+                # no writable cache folder, just parse the json next time
+                pass
+        _raw_keymaps[keymap_name] = keymap
+        return keymap
+
+
+class KeyTranslator:
+    """
+    Translates between the keys of a network state dict and the keys in its saved files for one
+    keymap / network type / format combination. Results are cached per key.
+    """
+
+    def __init__(
+            self,
+            keymap: Optional[Mapping[str, str]],
+            network_type: str = 'lora',
+            peft_format: bool = False,
+            is_pixart: bool = False,
+    ):
+        # saved key -> network key
+        self.keymap = keymap
+        self.network_type = network_type.lower()
+        self.peft_format = peft_format
+        self.is_pixart = is_pixart
+        # network key -> saved key
+        self.save_keymap: Mapping[str, str] = {}
+        if isinstance(keymap, BinaryKeymap):
+            self.save_keymap = keymap.inverse()
+        elif keymap is not None:
+            for ldm_key, diffusers_key in keymap.items():
+                #  invert them
+                self.save_keymap[diffusers_key] = ldm_key
+        self._save_cache: Dict[Tuple[str, bool], Optional[str]] = {}
+        self._load_cache: Dict[str, Optional[str]] = {}
+
+    def _to_save_key(self, key: str, use_keymap: bool) -> Optional[str]:
+        if use_keymap:
+            key = self.save_keymap.get(key, key)
+        if self.peft_format:
+            # lora_down = lora_A
+            # lora_up = lora_B
+            # no alpha
+            if key.endswith('.alpha'):
+                return None
+            key = key.replace('lora_down', 'lora_A')
+            key = key.replace('lora_up', 'lora_B')
+            # replace all $$ with .
+            key = key.replace('$$', '.')
+        if self.network_type == "lokr":
+            # lora_transformer_transformer_blocks_7_attn_to_v.lokr_w1 to lycoris_transformer_blocks_7_attn_to_v.lokr_w1
+            key = key.replace('lora_transformer_', 'lycoris_')
+        return key
+
+    def to_save_key(self, key: str, use_keymap: bool = True) -> Optional[str]:
+        """Key to save a network weight under, None if it is not saved. Extra state dict items skip the keymap"""
+        cache_key = (key, use_keymap)
+        if cache_key not in self._save_cache:
+            self._save_cache[cache_key] = self._to_save_key(key, use_keymap)
+        return self._save_cache[cache_key]
+
+    def _to_load_key(self, key: str) -> Optional[str]:
+        if self.keymap is not None:
+            key = self.keymap.get(key, key)
+        # replace old double __ with single _
+        if self.is_pixart:
+            key = key.replace('__', '_')
+        if self.peft_format:
+            # lora_down = lora_A
+            # lora_up = lora_B
+            # no alpha
+            if key.endswith('.alpha'):
+                return None
+            key = key.replace('lora_A', 'lora_down')
+            key = key.replace('lora_B', 'lora_up')
+            # replace all . with $$
+            key = key.replace('.', '$$')
+            key = key.replace('$$lora_down$$', '.lora_down.')
+            key = key.replace('$$lora_up$$', '.lora_up.')
+        if self.network_type == "lokr":
+            # lora_transformer_transformer_blocks_7_attn_to_v.lokr_w1 to lycoris_transformer_blocks_7_attn_to_v.lokr_w1
+            key = key.replace('lycoris_', 'lora_transformer_')
+        return key
+
+    def to_load_key(self, key: str) -> Optional[str]:
+        """Network key for a key in a saved file, None if it is not loaded"""
+        if key not in self._load_cache:
+            self._load_cache[key] = self._to_load_key(key)
+        return self._load_cache[key]
+
+
+def build_network_keymap(
+        keymap_name: str,
+        use_weight_mapping: bool,
+        network_type: str
+) -> Optional[Mapping[str, str]]:
+    keymap = load_ldm_diffusers_keymap(keymap_name)
+    if keymap is None:
+        return None
+    if use_weight_mapping:
+        # get keymap from weights
+        keymap = get_lora_keymap_from_model_keymap(keymap)
+
+    # upgrade keymaps for DoRA
+    if network_type.lower() == 'dora':
+        new_keymap = OrderedDict()
+        for ldm_key, diffusers_key in keymap.items():
+            ldm_key = ldm_key.replace('.alpha', '.magnitude')
+            diffusers_key = diffusers_key.replace('.alpha', '.magnitude')
+            new_keymap[ldm_key] = diffusers_key
+        keymap = new_keymap
+    return keymap
+
+
+def get_key_translator(
+        arch: str,
+        network_type: str = 'lora',
+        peft_format: bool = False,
+        is_pixart: bool = False,
+        use_weight_mapping: bool = False,
+) -> KeyTranslator:
+    """
+    The shared translator for an arch (the keymap tail, sd1, sdxl, ...). Built once per process, the
+    keymaps and cached keys are never modified after that so networks can share them.
+    """
+    memo_key = (arch, network_type.lower(), peft_format, is_pixart, use_weight_mapping)
+    translator = _translators.get(memo_key, None)
+    if translator is None:
+        keymap_name = f"stable_diffusion_locon_{arch}.json"
+        if use_weight_mapping:
+            keymap_name = f"stable_diffusion_{arch}.json"
+        keymap = build_network_keymap(keymap_name, use_weight_mapping, network_type)
+        translator = KeyTranslator(keymap, network_type=network_type, peft_format=peft_format, is_pixart=is_pixart)
+        with _keymap_lock:
+            translator = _translators.setdefault(memo_key, translator)
+    return translator
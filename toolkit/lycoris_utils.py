@@ -1,5 +1,6 @@
 # heavily based on https://github.com/KohakuBlueleaf/LyCORIS/blob/main/lycoris/utils.py
 
+import os
 from typing import *
 
 import numpy as np
@@ -22,18 +23,11 @@ def make_sparse(t: torch.Tensor, sparsity=0.95):
     return sparse_t
 
 
-def extract_conv(
-        weight: Union[torch.Tensor, nn.Parameter],
-        mode='fixed',
-        mode_param=0,
-        device='cpu',
-        is_cp=False,
-) -> Tuple[nn.Parameter, nn.Parameter]:
-    weight = weight.to(device)
-    out_ch, in_ch, kernel_size, _ = weight.shape
+LINEAR_LAYERS = {'Linear', 'LoRACompatibleLinear'}
+CONV_LAYERS = {'Conv2d', 'LoRACompatibleConv'}
 
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
 
+def get_lora_rank(S: torch.Tensor, mode='fixed', mode_param=0):
     if mode == 'fixed':
         lora_rank = mode_param
     elif mode == 'threshold':
@@ -50,15 +44,59 @@ def extract_conv(
         lora_rank = torch.sum(s_cum < min_cum_sum)
     else:
         raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
+    return int(lora_rank)
+
+
+def truncated_svd(matrix: torch.Tensor, rank: int, lowrank_niter: Optional[int] = None):
+    """
+    Top rank singular vectors of matrix from an exact reduced svd. With lowrank_niter set, a randomized
+    svd is used instead, which only computes a few more than rank vectors. It is faster on large
+    layers but approximate, so it is opt in.
+    """
+    if lowrank_niter is not None and rank < min(matrix.shape) // 2:
+        q = min(rank + 8, min(matrix.shape))
+        U, S, V = torch.svd_lowrank(matrix, q=q, niter=lowrank_niter)
+        return U[:, :rank], S[:rank], V[:, :rank].T
+    U, S, Vh = linalg.svd(matrix, full_matrices=False)
+    return U[:, :rank], S[:rank], Vh[:rank, :]
+
+
+def _low_rank_decompose(matrix, mode, mode_param, allow_full, lowrank_niter=None):
+    # returns U, S, Vh, lora_rank or None if the full weight should be stored
+    out_ch, in_ch = matrix.shape
+    if mode == 'fixed':
+        # the rank is known up front so there is no need for every singular value
+        lora_rank = min(out_ch, in_ch, max(1, mode_param))
+        if lora_rank >= out_ch / 2 and allow_full:
+            return None
+        U, S, Vh = truncated_svd(matrix, lora_rank, lowrank_niter)
+        return U, S, Vh, lora_rank
+    U, S, Vh = linalg.svd(matrix, full_matrices=False)
+    lora_rank = get_lora_rank(S, mode, mode_param)
     lora_rank = max(1, lora_rank)
     lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2 and not is_cp:
+    if lora_rank >= out_ch / 2 and allow_full:
+        return None
+    return U[:, :lora_rank], S[:lora_rank], Vh[:lora_rank, :], lora_rank
+
+
+def extract_conv(
+        weight: Union[torch.Tensor, nn.Parameter],
+        mode='fixed',
+        mode_param=0,
+        device='cpu',
+        is_cp=False,
+        lowrank_niter: Optional[int] = None,
+) -> Tuple[nn.Parameter, nn.Parameter]:
+    weight = weight.to(device)
+    out_ch, in_ch, kernel_size, _ = weight.shape
+
+    decomposed = _low_rank_decompose(weight.reshape(out_ch, -1), mode, mode_param, not is_cp, lowrank_niter)
+    if decomposed is None:
         return weight, 'full'
+    U, S, Vh, lora_rank = decomposed
 
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
     U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
 
     diff = (weight - (U @ Vh).reshape(out_ch, in_ch, kernel_size, kernel_size)).detach()
     extract_weight_A = Vh.reshape(lora_rank, in_ch, kernel_size, kernel_size).detach()
@@ -72,37 +110,17 @@ def extract_linear(
         mode='fixed',
         mode_param=0,
         device='cpu',
+        lowrank_niter: Optional[int] = None,
 ) -> Tuple[nn.Parameter, nn.Parameter]:
     weight = weight.to(device)
     out_ch, in_ch = weight.shape
 
-    U, S, Vh = linalg.svd(weight)
-
-    if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
-        assert mode_param >= 0
-        lora_rank = torch.sum(S > mode_param)
-    elif mode == 'ratio':
-        assert 1 >= mode_param >= 0
-        min_s = torch.max(S) * mode_param
-        lora_rank = torch.sum(S > min_s)
-    elif mode == 'quantile' or mode == 'percentile':
-        assert 1 >= mode_param >= 0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum < min_cum_sum)
-    else:
-        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2:
+    decomposed = _low_rank_decompose(weight, mode, mode_param, True, lowrank_niter)
+    if decomposed is None:
         return weight, 'full'
+    U, S, Vh, lora_rank = decomposed
 
-    U = U[:, :lora_rank]
-    S = S[:lora_rank]
     U = U @ torch.diag(S)
-    Vh = Vh[:lora_rank, :]
 
     diff = (weight - U @ Vh).detach()
     extract_weight_A = Vh.reshape(lora_rank, in_ch).detach()
@@ -111,9 +129,11 @@ def extract_linear(
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
-def extract_diff(
-        base_model,
-        db_model,
+def extract_module_lora(
+        lora_name: str,
+        layer: str,
+        root_weight: torch.Tensor,
+        base_weight: torch.Tensor,
         mode='fixed',
         linear_mode_param=0,
         conv_mode_param=0,
@@ -121,12 +141,85 @@ def extract_diff(
         use_bias=False,
         sparsity=0.98,
         small_conv=True,
+        linear_only=False,
+        lowrank_niter: Optional[int] = None,
+) -> 'OrderedDict[str, torch.Tensor]':
+    """
+    Extracts the lora weights for a single layer from the tuned (root) and base weights.
+    Returns an empty dict if the layer is skipped or did not change.
+    """
+    loras = OrderedDict()
+    if layer not in LINEAR_LAYERS and layer not in CONV_LAYERS:
+        return loras
+    if torch.allclose(root_weight, base_weight):
+        return loras
+
+    if layer in LINEAR_LAYERS:
+        weight, decompose_mode = extract_linear(
+            (root_weight - base_weight),
+            mode,
+            linear_mode_param,
+            device=extract_device,
+            lowrank_niter=lowrank_niter,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+    else:
+        is_linear = (root_weight.shape[2] == 1 and root_weight.shape[3] == 1)
+        if not is_linear and linear_only:
+            return loras
+        weight, decompose_mode = extract_conv(
+            (root_weight - base_weight),
+            mode,
+            linear_mode_param if is_linear else conv_mode_param,
+            device=extract_device,
+            lowrank_niter=lowrank_niter,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+        if small_conv and not is_linear and decompose_mode == 'low rank':
+            dim = extract_a.size(0)
+            (extract_c, extract_a, _), _ = extract_conv(
+                extract_a.transpose(0, 1),
+                'fixed', dim,
+                extract_device, True,
+                lowrank_niter=lowrank_niter,
+            )
+            extract_a = extract_a.transpose(0, 1)
+            extract_c = extract_c.transpose(0, 1)
+            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
+            diff = root_weight - torch.einsum(
+                'i j k l, j r, p i -> p r k l',
+                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
+            ).detach().cpu().contiguous()
+            del extract_c
+    if decompose_mode == 'low rank':
+        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+        if use_bias:
+            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+
+            indices = sparse_diff.indices().to(torch.int16)
+            values = sparse_diff.values().half()
+            loras[f'{lora_name}.bias_indices'] = indices
+            loras[f'{lora_name}.bias_values'] = values
+            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+        del extract_a, extract_b, diff
+    elif decompose_mode == 'full':
+        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
+    else:
+        raise NotImplementedError
+    return loras
+
+
+def get_extract_target_modules(
         linear_only=False,
         extract_unet=True,
         extract_text_encoder=True,
 ):
-    meta = OrderedDict()
-
+    # (unet target module classes, unet target names, text encoder target module classes)
     UNET_TARGET_REPLACE_MODULE = [
         "Transformer2DModel",
         "Attention",
@@ -156,6 +249,60 @@ def extract_diff(
     if not extract_text_encoder:
         TEXT_ENCODER_TARGET_REPLACE_MODULE = []
 
+    return UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE
+
+
+def get_extract_targets(
+        prefix: str,
+        root_module: torch.nn.Module,
+        target_replace_modules,
+        target_replace_names=[]
+) -> 'OrderedDict[str, Tuple[str, str]]':
+    """
+    Returns {lora_name: (weight key, layer class name)} for every layer an extraction looks at,
+    in module order. Layers inside nested target modules are only listed once.
+    """
+    targets = OrderedDict()
+    for name, module in root_module.named_modules():
+        if module.__class__.__name__ in target_replace_modules:
+            for child_name, child_module in module.named_modules():
+                layer = child_module.__class__.__name__
+                if layer not in LINEAR_LAYERS and layer not in CONV_LAYERS:
+                    continue
+                lora_name = (prefix + '.' + name + '.' + child_name).replace('.', '_')
+                if lora_name not in targets:
+                    weight_key = '.'.join([part for part in [name, child_name, 'weight'] if part != ''])
+                    targets[lora_name] = (weight_key, layer)
+        elif name in target_replace_names:
+            layer = module.__class__.__name__
+            if layer not in LINEAR_LAYERS and layer not in CONV_LAYERS:
+                continue
+            lora_name = (prefix + '.' + name).replace('.', '_')
+            if lora_name not in targets:
+                targets[lora_name] = (f"{name}.weight", layer)
+    return targets
+
+
+def extract_diff(
+        base_model,
+        db_model,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+        lowrank_niter: Optional[int] = None,
+):
+    meta = OrderedDict()
+
+    UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE = \
+        get_extract_target_modules(linear_only, extract_unet, extract_text_encoder)
+
     LORA_PREFIX_UNET = 'lora_unet'
     LORA_PREFIX_TEXT_ENCODER = 'lora_te'
 
@@ -167,158 +314,26 @@ def extract_diff(
             target_replace_names=[]
     ):
         loras = {}
-        temp = {}
-        temp_name = {}
-
-        for name, module in root_module.named_modules():
-            if module.__class__.__name__ in target_replace_modules:
-                temp[name] = {}
-                for child_name, child_module in module.named_modules():
-                    if child_module.__class__.__name__ not in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        continue
-                    temp[name][child_name] = child_module.weight
-            elif name in target_replace_names:
-                temp_name[name] = module.weight
-
-        for name, module in tqdm(list(target_module.named_modules())):
-            if name in temp:
-                weights = temp[name]
-                for child_name, child_module in module.named_modules():
-                    lora_name = prefix + '.' + name + '.' + child_name
-                    lora_name = lora_name.replace('.', '_')
-                    layer = child_module.__class__.__name__
-                    if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        root_weight = child_module.weight
-                        if torch.allclose(root_weight, weights[child_name]):
-                            continue
-
-                    if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                        weight, decompose_mode = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                    elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                        is_linear = (child_module.weight.shape[2] == 1
-                                     and child_module.weight.shape[3] == 1)
-                        if not is_linear and linear_only:
-                            continue
-                        weight, decompose_mode = extract_conv(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                        if small_conv and not is_linear and decompose_mode == 'low rank':
-                            dim = extract_a.size(0)
-                            (extract_c, extract_a, _), _ = extract_conv(
-                                extract_a.transpose(0, 1),
-                                'fixed', dim,
-                                extract_device, True
-                            )
-                            extract_a = extract_a.transpose(0, 1)
-                            extract_c = extract_c.transpose(0, 1)
-                            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                            diff = child_module.weight - torch.einsum(
-                                'i j k l, j r, p i -> p r k l',
-                                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                            ).detach().cpu().contiguous()
-                            del extract_c
-                    else:
-                        continue
-                    if decompose_mode == 'low rank':
-                        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                        if use_bias:
-                            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                            indices = sparse_diff.indices().to(torch.int16)
-                            values = sparse_diff.values().half()
-                            loras[f'{lora_name}.bias_indices'] = indices
-                            loras[f'{lora_name}.bias_values'] = values
-                            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                        del extract_a, extract_b, diff
-                    elif decompose_mode == 'full':
-                        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                    else:
-                        raise NotImplementedError
-            elif name in temp_name:
-                weights = temp_name[name]
-                lora_name = prefix + '.' + name
-                lora_name = lora_name.replace('.', '_')
-                layer = module.__class__.__name__
-
-                if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                    root_weight = module.weight
-                    if torch.allclose(root_weight, weights):
-                        continue
-
-                if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                    weight, decompose_mode = extract_linear(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                    is_linear = (
-                            root_weight.shape[2] == 1
-                            and root_weight.shape[3] == 1
-                    )
-                    if not is_linear and linear_only:
-                        continue
-                    weight, decompose_mode = extract_conv(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param if is_linear else conv_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                    if small_conv and not is_linear and decompose_mode == 'low rank':
-                        dim = extract_a.size(0)
-                        (extract_c, extract_a, _), _ = extract_conv(
-                            extract_a.transpose(0, 1),
-                            'fixed', dim,
-                            extract_device, True
-                        )
-                        extract_a = extract_a.transpose(0, 1)
-                        extract_c = extract_c.transpose(0, 1)
-                        loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                        diff = root_weight - torch.einsum(
-                            'i j k l, j r, p i -> p r k l',
-                            extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                        ).detach().cpu().contiguous()
-                        del extract_c
-                else:
-                    continue
-                if decompose_mode == 'low rank':
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    if use_bias:
-                        diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                        sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                        indices = sparse_diff.indices().to(torch.int16)
-                        values = sparse_diff.values().half()
-                        loras[f'{lora_name}.bias_indices'] = indices
-                        loras[f'{lora_name}.bias_values'] = values
-                        loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                    del extract_a, extract_b, diff
-                elif decompose_mode == 'full':
-                    loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                else:
-                    raise NotImplementedError
+        base_weights = dict(root_module.named_parameters())
+        db_weights = dict(target_module.named_parameters())
+        targets = get_extract_targets(prefix, target_module, target_replace_modules, target_replace_names)
+
+        for lora_name, (weight_key, layer) in tqdm(list(targets.items())):
+            loras.update(extract_module_lora(
+                lora_name,
+                layer,
+                db_weights[weight_key],
+                base_weights[weight_key],
+                mode=mode,
+                linear_mode_param=linear_mode_param,
+                conv_mode_param=conv_mode_param,
+                extract_device=extract_device,
+                use_bias=use_bias,
+                sparsity=sparsity,
+                small_conv=small_conv,
+                linear_only=linear_only,
+                lowrank_niter=lowrank_niter,
+            ))
         return loras
 
     text_encoder_loras = make_state_dict(
@@ -338,6 +353,168 @@ def extract_diff(
     return (text_encoder_loras | unet_loras), meta
 
 
+class _LazyCheckpointKeys:
+    """
+    Maps the diffusers keys of an ldm stable diffusion safetensors checkpoint back to the tensors
+    stored in the file without loading it. The normal conversion is run on meta tensors, and each
+    converted tensor is a view of one stored tensor, so its size, stride and offset are recorded and
+    replayed on the real tensor when it is read. Keys the conversion built some other way map to None.
+    """
+
+    def __init__(self, ckpt_path: str, v2: bool, unet_use_linear_projection_in_v2=False):
+        from safetensors import safe_open
+        from toolkit import kohya_model_util
+
+        self.ckpt_path = ckpt_path
+        # run the text encoder key rename on the key names themselves to know where each key came from
+        with safe_open(ckpt_path, framework="pt") as f:
+            renamed_keys = kohya_model_util.convert_text_encoder_keys({key: key for key in f.keys()})
+            meta_state_dict = {
+                key: torch.empty(f.get_slice(file_key).get_shape(), device='meta')
+                for key, file_key in renamed_keys.items()
+            }
+        # the conversion pops and renames keys, remember which stored tensor each meta tensor is
+        id_to_key = {id(meta_state_dict[key]): file_key for key, file_key in renamed_keys.items()}
+
+        unet_config = kohya_model_util.create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
+        text_encoder_sd = (
+            kohya_model_util.convert_ldm_clip_checkpoint_v2(meta_state_dict, 77) if v2
+            else kohya_model_util.convert_ldm_clip_checkpoint_v1(meta_state_dict)
+        )
+        unet_sd = kohya_model_util.convert_ldm_unet_checkpoint(v2, meta_state_dict, unet_config)
+
+        self.text_encoder_keys = self._map_keys(text_encoder_sd, id_to_key)
+        self.unet_keys = self._map_keys(unet_sd, id_to_key)
+
+    def _map_keys(self, converted_sd, id_to_key):
+        key_map = {}
+        for key, value in converted_sd.items():
+            if not isinstance(value, torch.Tensor):
+                continue
+            root = value._base if value._base is not None else value
+            if not value.is_meta or id(root) not in id_to_key:
+                # made by the conversion, not a view of a stored tensor
+                key_map[key] = None
+                continue
+            key_map[key] = (id_to_key[id(root)], tuple(value.size()), tuple(value.stride()), value.storage_offset())
+        return key_map
+
+    def get_tensor(self, handle, key_map, key: str) -> torch.Tensor:
+        if key_map.get(key, None) is None:
+            raise KeyError(f"{key} can not be read directly from {self.ckpt_path}")
+        file_key, size, stride, offset = key_map[key]
+        return handle.get_tensor(file_key).as_strided(size, stride, offset)
+
+
+def extract_diff_from_files(
+        base_path: str,
+        db_path: str,
+        is_v2=False,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+        lowrank_niter: Optional[int] = None,
+        num_workers: int = 1,
+):
+    """
+    Same output as extract_diff, but reads both ldm safetensors checkpoints tensor by tensor from
+    their memory mapped files instead of loading the models, and extracts layers on num_workers threads.
+    Layers missing from either checkpoint are skipped and listed in the skipped_layers meta. Raises if
+    a weight can not be read straight from the files, instead of leaving it out of the extraction.
+    """
+    from safetensors import safe_open
+    from toolkit.kohya_model_util import create_empty_models_from_stable_diffusion_config
+    from toolkit.util.threads import split_cores_thread_pool
+
+    meta = OrderedDict()
+
+    UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE = \
+        get_extract_target_modules(linear_only, extract_unet, extract_text_encoder)
+
+    LORA_PREFIX_UNET = 'lora_unet'
+    LORA_PREFIX_TEXT_ENCODER = 'lora_te'
+
+    # module tree only, no weights
+    empty_text_encoder, empty_unet = create_empty_models_from_stable_diffusion_config(is_v2)
+    base_keys = _LazyCheckpointKeys(base_path, is_v2)
+    db_keys = _LazyCheckpointKeys(db_path, is_v2)
+
+    jobs = []
+    for lora_name, (weight_key, layer) in get_extract_targets(
+            LORA_PREFIX_TEXT_ENCODER, empty_text_encoder, TEXT_ENCODER_TARGET_REPLACE_MODULE
+    ).items():
+        jobs.append((lora_name, weight_key, layer, base_keys.text_encoder_keys, db_keys.text_encoder_keys))
+    for lora_name, (weight_key, layer) in get_extract_targets(
+            LORA_PREFIX_UNET, empty_unet, UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME
+    ).items():
+        jobs.append((lora_name, weight_key, layer, base_keys.unet_keys, db_keys.unet_keys))
+    del empty_text_encoder, empty_unet
+
+    def run_job(job):
+        lora_name, weight_key, layer, base_key_map, db_key_map = job
+        with safe_open(base_path, framework="pt") as base_f, safe_open(db_path, framework="pt") as db_f:
+            # extraction always ran on float32 weights, keep it that way
+            base_weight = base_keys.get_tensor(base_f, base_key_map, weight_key).float()
+            db_weight = db_keys.get_tensor(db_f, db_key_map, weight_key).float()
+        return extract_module_lora(
+            lora_name,
+            layer,
+            db_weight,
+            base_weight,
+            mode=mode,
+            linear_mode_param=linear_mode_param,
+            conv_mode_param=conv_mode_param,
+            extract_device=extract_device,
+            use_bias=use_bias,
+            sparsity=sparsity,
+            small_conv=small_conv,
+            linear_only=linear_only,
+            lowrank_niter=lowrank_niter,
+        )
+
+    runnable_jobs = []
+    skipped_layers = []
+    unreadable_keys = []
+    for job in jobs:
+        lora_name, weight_key, _, base_key_map, db_key_map = job
+        if weight_key not in base_key_map or weight_key not in db_key_map:
+            skipped_layers.append(lora_name)
+        elif base_key_map[weight_key] is None or db_key_map[weight_key] is None:
+            unreadable_keys.append(weight_key)
+        else:
+            runnable_jobs.append(job)
+    jobs = runnable_jobs
+    if len(unreadable_keys) > 0:
+        raise ValueError(
+            f"{len(unreadable_keys)} weights can not be read directly from the checkpoint files, "
+            f"extract from the loaded models instead: {', '.join(unreadable_keys)}"
+        )
+    if len(skipped_layers) > 0:
+        print(f"Skipping {len(skipped_layers)} layers that are not in both checkpoints: {', '.join(skipped_layers)}")
+        meta['skipped_layers'] = skipped_layers
+
+    with split_cores_thread_pool(num_workers, thread_name_prefix='extract') as executor:
+        # map keeps the module order so the output matches extract_diff
+        results = list(tqdm(executor.map(run_job, jobs), total=len(jobs)))
+
+    text_encoder_loras = {}
+    unet_loras = {}
+    for job, loras in zip(jobs, results):
+        if job[0].startswith(LORA_PREFIX_TEXT_ENCODER):
+            text_encoder_loras.update(loras)
+        else:
+            unet_loras.update(loras)
+    print(len(text_encoder_loras), len(unet_loras))
+    return (text_encoder_loras | unet_loras), meta
+
+
 def get_module(
         lyco_state_dict: Dict,
         lora_name
@@ -534,3 +711,152 @@ def merge(
         UNET_TARGET_REPLACE_NAME
     )
     print(f'{merged} Modules been merged')
+
+
+def _iter_ordered_parallel(fn, items, num_workers: int):
+    # like executor.map, but only keeps a few results in flight so memory stays bounded
+    from toolkit.util.threads import split_cores_thread_pool
+    items = list(items)
+    window = max(1, num_workers * 2)
+    with split_cores_thread_pool(num_workers, thread_name_prefix='merge') as executor:
+        futures = []
+        next_idx = 0
+        while next_idx < len(items) or len(futures) > 0:
+            while next_idx < len(items) and len(futures) < window:
+                futures.append(executor.submit(fn, items[next_idx]))
+                next_idx += 1
+            yield futures.pop(0).result()
+
+
+def merge_into_safetensors(
+        base_path: str,
+        loras: List[Tuple[str, float]],
+        output_path: str,
+        targets: Dict[str, Tuple[str, tuple, tuple, int]],
+        dtype: Optional[torch.dtype] = None,
+        device='cpu',
+        num_workers: int = 1,
+        max_shard_size: Union[int, str] = "5GB",
+        metadata: Optional[Dict[str, str]] = None,
+) -> int:
+    """
+    Merges LoRA / LyCORIS files, each with its own scale, into the safetensors checkpoint at base_path
+    and writes the result to output_path. targets maps each lora module name to the view of the stored
+    base tensor it changes, as (file key, size, stride, storage offset). Base tensors are read one at a
+    time from the memory mapped file and written to size limited shards as they are merged.
+    Returns the number of modules merged.
+    """
+    from safetensors import safe_open
+    from toolkit.saving import save_sharded_safetensors
+
+    # lora files are small, load them fully and index their keys by module
+    lora_state_dicts = []
+    for lora_path, lora_scale in loras:
+        lyco_state_dict = OrderedDict()
+        keys_by_name = {}
+        with safe_open(lora_path, framework="pt") as f:
+            for key in f.keys():
+                lyco_state_dict[key] = f.get_tensor(key)
+                keys_by_name.setdefault(key.split('.')[0], []).append(key)
+        lora_state_dicts.append((lyco_state_dict, keys_by_name, lora_scale))
+
+    # stored key -> the views of it the loras change. One stored tensor can hold several
+    # modules, like the fused qkv of the v2 text encoder
+    updates_by_file_key = {}
+    for lora_name, (file_key, size, stride, offset) in targets.items():
+        if not any(lora_name in keys_by_name for _, keys_by_name, _ in lora_state_dicts):
+            continue
+        updates_by_file_key.setdefault(file_key, []).append((lora_name, size, stride, offset))
+
+    def merge_tensor(file_key):
+        # returns the key, the merged tensor and how many modules were merged into it
+        with safe_open(base_path, framework="pt") as f:
+            tensor = f.get_tensor(file_key)
+        out_dtype = dtype if dtype is not None and tensor.is_floating_point() else tensor.dtype
+        if file_key not in updates_by_file_key:
+            return file_key, tensor.to(out_dtype), 0
+        weight = tensor.to(device=device, dtype=torch.float32, copy=True)
+        for lora_name, size, stride, offset in updates_by_file_key[file_key]:
+            view = weight.as_strided(size, stride, offset)
+            for lyco_state_dict, keys_by_name, lora_scale in lora_state_dicts:
+                if lora_name not in keys_by_name:
+                    continue
+                module_state_dict = {
+                    key: lyco_state_dict[key].to(device, dtype=torch.float32) for key in keys_by_name[lora_name]
+                }
+                view.copy_(rebuild_weight(*get_module(module_state_dict, lora_name), view, lora_scale))
+        return file_key, weight.to('cpu', dtype=out_dtype).contiguous(), len(updates_by_file_key[file_key])
+
+    with safe_open(base_path, framework="pt") as f:
+        file_keys = list(f.keys())
+
+    # counted here on the main thread as the results come in
+    merged_counts = []
+
+    def iter_merged():
+        for file_key, tensor, num_merged in _iter_ordered_parallel(merge_tensor, file_keys, num_workers):
+            merged_counts.append(num_merged)
+            yield file_key, tensor
+
+    # only the previous save of this exact name is replaced, other files in the folder are left alone
+    save_sharded_safetensors(
+        tqdm(iter_merged(), total=len(file_keys), desc='Merging'),
+        os.path.dirname(os.path.abspath(output_path)),
+        weights_name=os.path.basename(output_path),
+        max_shard_size=max_shard_size,
+        metadata=metadata,
+    )
+    return sum(merged_counts)
+
+
+def merge_from_files(
+        base_path: str,
+        loras: List[Tuple[str, float]],
+        output_path: str,
+        is_v2=False,
+        dtype: Optional[torch.dtype] = None,
+        device='cpu',
+        num_workers: int = 1,
+        max_shard_size: Union[int, str] = "5GB",
+        metadata: Optional[Dict[str, str]] = None,
+):
+    """
+    Merges one or more LoRA / LyCORIS files, each with its own scale, into an ldm stable diffusion
+    safetensors checkpoint without loading it. Base tensors are read one at a time from the memory
+    mapped file, only the ones a LoRA touches are rebuilt, and the result is written to size limited
+    shards as it goes. The output keeps the key layout of the base checkpoint.
+    """
+    from toolkit.kohya_model_util import create_empty_models_from_stable_diffusion_config
+
+    UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE = \
+        get_extract_target_modules()
+    LORA_PREFIX_UNET = 'lora_unet'
+    LORA_PREFIX_TEXT_ENCODER = 'lora_te'
+
+    empty_text_encoder, empty_unet = create_empty_models_from_stable_diffusion_config(is_v2)
+    base_keys = _LazyCheckpointKeys(base_path, is_v2)
+    targets = OrderedDict()
+    for lora_name, (weight_key, _) in get_extract_targets(
+            LORA_PREFIX_TEXT_ENCODER, empty_text_encoder, TEXT_ENCODER_TARGET_REPLACE_MODULE
+    ).items():
+        if weight_key in base_keys.text_encoder_keys:
+            targets[lora_name] = base_keys.text_encoder_keys[weight_key]
+    for lora_name, (weight_key, _) in get_extract_targets(
+            LORA_PREFIX_UNET, empty_unet, UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME
+    ).items():
+        if weight_key in base_keys.unet_keys:
+            targets[lora_name] = base_keys.unet_keys[weight_key]
+    del empty_text_encoder, empty_unet
+
+    merged = merge_into_safetensors(
+        base_path,
+        loras,
+        output_path,
+        targets,
+        dtype=dtype,
+        device=device,
+        num_workers=num_workers,
+        max_shard_size=max_shard_size,
+        metadata=metadata,
+    )
+    print(f'{merged} Modules been merged')
@@ -1,5 +1,11 @@
+from typing import Optional
+
 import torch
 from .manager_modules import LinearLayerMemoryManager, ConvLayerMemoryManager
+from .planner import GB, LayerResidency, ResidencyPlan, get_module_nbytes, plan_residency
+from .prefetch import CudaTransferBackend, PrefetchScheduler
+from toolkit.module_index import ModuleIndex, NameFilter
+from toolkit.print import print_acc
 
 LINEAR_MODULES = [
     "Linear",
@@ -41,6 +47,17 @@ class MemoryManager:
         self.module: torch.nn.Module = module
         self.process_device: torch.device = process_device
         self.unmanaged_modules: list[torch.nn.Module] = []
+        self.plan: Optional[ResidencyPlan] = None
+        # copies the weights of the next layers ahead of time, None copies each layer when it is called
+        self.prefetcher: Optional[PrefetchScheduler] = None
+
+    def set_timer(self, timer):
+        """Reports the time layers wait for their prefetched weights to timer"""
+        if self.prefetcher is not None:
+            self.prefetcher.timer = timer
+            timer.add_after_print_hook(
+                lambda _: print_acc(f" - {self.module.__class__.__name__} {self.prefetcher.get_stats()}")
+            )
 
     def memory_managed_to(self, *args, **kwargs):
         # first move all the unmanaged modules
@@ -60,33 +77,58 @@ class MemoryManager:
         return self.module
 
     @classmethod
-    def attach(cls, module: torch.nn.Module, device: torch.device):
+    def attach(
+        cls,
+        module: torch.nn.Module,
+        device: torch.device,
+        budget_gb: Optional[float] = None,
+        prefetch_depth: Optional[int] = None,
+    ):
+        """
+        Bounces the linear and conv weights of module from cpu to device on every call. With a budget,
+        the layers that fit in it stay on the device like any other module and only the rest are bounced.
+        prefetch_depth is how many layers ahead bounced weights are copied, cuda only.
+        """
         if hasattr(module, "_memory_manager"):
             # already attached
             return
 
         module._memory_manager = cls(module, device)
+        device = torch.device(device)
+        if prefetch_depth is not None and prefetch_depth > 0 and device.type == "cuda":
+            module._memory_manager.prefetcher = PrefetchScheduler(
+                CudaTransferBackend(device), depth=prefetch_depth
+            )
 
         # override the to method to handle memory management
         module._mm_to = module.to
         module.to = module._memory_manager.memory_managed_to
 
-        # attach to all modules
-        for name, sub_module in module.named_modules():
-            for child_name, child_module in sub_module.named_modules():
-                if child_module.__class__.__name__ in LINEAR_MODULES:
-                    # linear
-                    LinearLayerMemoryManager.attach(
-                        child_module, module._memory_manager
-                    )
-                elif child_module.__class__.__name__ in CONV_MODULES:
-                    # conv
-                    ConvLayerMemoryManager.attach(child_module, module._memory_manager)
-                elif child_module.__class__.__name__ in UNMANAGED_MODULES or any(
-                    inc in child_module.__class__.__name__
-                    for inc in UNMANAGED_MODULES_INCLUDES
-                ):
-                    # unmanaged
-                    module._memory_manager.unmanaged_modules.append(child_module)
-                else:
-                    continue
+        # attach to all modules, each one is visited once
+        unmanaged_includes = NameFilter(UNMANAGED_MODULES_INCLUDES)
+        layers = []
+        for child_name, child_module in ModuleIndex(module).iter_modules():
+            class_name = child_module.__class__.__name__
+            if class_name in LINEAR_MODULES or class_name in CONV_MODULES:
+                layers.append(LayerResidency(child_name, get_module_nbytes(child_module), module=child_module))
+            elif class_name in UNMANAGED_MODULES or unmanaged_includes.matches(class_name):
+                # unmanaged
+                module._memory_manager.unmanaged_modules.append(child_module)
+
+        budget_bytes = int(budget_gb * GB) if budget_gb is not None else None
+        plan = plan_residency(layers, budget_bytes)
+        module._memory_manager.plan = plan
+        for layer in plan.layers:
+            if layer.is_resident:
+                # moves with the model like the unmanaged modules
+                module._memory_manager.unmanaged_modules.append(layer.module)
+            elif layer.module.__class__.__name__ in LINEAR_MODULES:
+                # linear
+                LinearLayerMemoryManager.attach(
+                    layer.module, module._memory_manager, layer.name
+                )
+            else:
+                # conv
+                ConvLayerMemoryManager.attach(layer.module, module._memory_manager, layer.name)
+        if budget_bytes is not None:
+            print_acc(f"Memory manager {module.__class__.__name__}: {plan.get_summary()}")
@@ -128,7 +128,7 @@ def _move_params_to_cpu_and_pin(module: nn.Module):
 
 class _BouncingLinearFn(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, x, weight_cpu, bias_cpu, device: torch.device):
+    def forward(ctx, x, weight_cpu, bias_cpu, device: torch.device, layer=None):
         # choose compute dtype to match activations
         target_dtype = (
             x.dtype
@@ -162,6 +162,17 @@ class _BouncingLinearFn(torch.autograd.Function):
             ctx.device = torch.device("cpu")
             return out.to(x.device)
 
+        if layer is not None and layer.manager.prefetcher is not None:
+            # weights were copied ahead of time by the prefetcher
+            layer.target_dtype = target_dtype
+            weight, bias = layer.manager.prefetcher.get_weights(layer)
+            out = F.linear(x, weight, bias)
+            ctx.save_for_backward(x, weight_cpu, bias_cpu)
+            ctx.device = device
+            ctx.target_dtype = target_dtype
+            ctx.layer = layer
+            return out
+
         state = _get_device_state(device)
         ts = state["transfer_stream"]
         w_bufs, b_bufs = state["w_buffers"], state["b_buffers"]
@@ -219,7 +230,33 @@ class _BouncingLinearFn(torch.autograd.Function):
                 if (bias_cpu is not None and getattr(bias_cpu, "requires_grad", False))
                 else None
             )
-            return grad_input.to(grad_out.device), grad_weight, grad_bias, None
+            return grad_input.to(grad_out.device), grad_weight, grad_bias, None, None
+
+        layer = getattr(ctx, "layer", None)
+        if layer is not None and layer.manager.prefetcher is not None:
+            prefetcher = layer.manager.prefetcher
+            # prefetched in reverse order
+            weight, _ = prefetcher.get_weights(layer, is_backward=True)
+            grad_weight = None
+            grad_bias = None
+            if (
+                getattr(weight_cpu, "requires_grad", False)
+                and weight_cpu.dtype.is_floating_point
+            ):
+                grad_weight = prefetcher.start_grad_offload(
+                    grad_out.flatten(0, -2).T @ x.flatten(0, -2)
+                )
+            if bias_cpu is not None and getattr(bias_cpu, "requires_grad", False):
+                grad_bias = prefetcher.start_grad_offload(
+                    grad_out.sum(dim=tuple(range(grad_out.ndim - 1)))
+                )
+            # computed while the grads copy to the cpu
+            grad_input = grad_out.to(dtype=target_dtype) @ weight
+            if grad_weight is not None:
+                grad_weight = prefetcher.finish_grad_offload(grad_weight)
+            if grad_bias is not None:
+                grad_bias = prefetcher.finish_grad_offload(grad_bias)
+            return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None, None
 
         state = _get_device_state(device)
         transfer_stream = state["transfer_stream"]
@@ -291,7 +328,7 @@ class _BouncingLinearFn(torch.autograd.Function):
                 grad_bias = b_grad_buffers[idx].to("cpu", non_blocking=True)
             state["transfer_weight_backward_finished_event"].record()
 
-        return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None
+        return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None, None
 
 
 class _BouncingConv2dFn(torch.autograd.Function):
@@ -306,6 +343,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
         padding: Tuple[int, int],
         dilation: Tuple[int, int],
         groups: int,
+        layer=None,
     ):
         target_dtype = (
             x.dtype
@@ -342,6 +380,16 @@ class _BouncingConv2dFn(torch.autograd.Function):
             ctx.meta = ("cpu", stride, padding, dilation, groups, target_dtype)
             return out.to(x.device)
 
+        if layer is not None and layer.manager.prefetcher is not None:
+            # weights were copied ahead of time by the prefetcher
+            layer.target_dtype = target_dtype
+            weight, bias = layer.manager.prefetcher.get_weights(layer)
+            out = F.conv2d(x, weight, bias, stride, padding, dilation, groups)
+            ctx.save_for_backward(x, weight_cpu, bias_cpu)
+            ctx.meta = (device, stride, padding, dilation, groups, target_dtype)
+            ctx.layer = layer
+            return out
+
         state = _get_device_state(device)
         ts = state["transfer_stream"]
         w_bufs, b_bufs = state["w_buffers"], state["b_buffers"]
@@ -426,6 +474,59 @@ class _BouncingConv2dFn(torch.autograd.Function):
                 None,
                 None,
                 None,
+                None,
+            )
+
+        from torch.nn.grad import conv2d_input, conv2d_weight  # type: ignore
+
+        layer = getattr(ctx, "layer", None)
+        if layer is not None and layer.manager.prefetcher is not None:
+            prefetcher = layer.manager.prefetcher
+            # prefetched in reverse order
+            weight, _ = prefetcher.get_weights(layer, is_backward=True)
+            grad_weight = None
+            grad_bias = None
+            if (
+                getattr(weight_cpu, "requires_grad", False)
+                and weight_cpu.dtype.is_floating_point
+            ):
+                grad_weight = prefetcher.start_grad_offload(
+                    conv2d_weight(
+                        x,
+                        weight_cpu.shape,
+                        grad_out,
+                        stride=stride,
+                        padding=padding,
+                        dilation=dilation,
+                        groups=groups,
+                    )
+                )
+            if bias_cpu is not None and getattr(bias_cpu, "requires_grad", False):
+                grad_bias = prefetcher.start_grad_offload(grad_out.sum(dim=(0, 2, 3)))
+            # computed while the grads copy to the cpu
+            grad_input = conv2d_input(
+                x.shape,
+                weight,
+                grad_out.to(dtype=target_dtype),
+                stride=stride,
+                padding=padding,
+                dilation=dilation,
+                groups=groups,
+            )
+            if grad_weight is not None:
+                grad_weight = prefetcher.finish_grad_offload(grad_weight)
+            if grad_bias is not None:
+                grad_bias = prefetcher.finish_grad_offload(grad_bias)
+            return (
+                grad_input.to(dtype=grad_out.dtype),
+                grad_weight,
+                grad_bias,
+                None,
+                None,
+                None,
+                None,
+                None,
+                None,
             )
 
         state = _get_device_state(device)
@@ -468,8 +569,6 @@ class _BouncingConv2dFn(torch.autograd.Function):
         torch.cuda.current_stream().wait_event(ev_tx_b)
         ev_cu_b_start.record()
 
-        from torch.nn.grad import conv2d_input, conv2d_weight  # type: ignore
-
         grad_input = conv2d_input(
             x.shape,
             w_bwd_buffers[idx],
@@ -525,6 +624,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
             None,
             None,
             None,
+            None,
         )
 
 
@@ -533,28 +633,49 @@ class BaseLayerMemoryManager:
         self,
         module: nn.Module,
         manager: "MemoryManager",
+        name: str = "",
     ):
         self.module: nn.Module = module
         self.manager: "MemoryManager" = manager
+        self.name = name
+        # compute dtype of the last call, prefetches are materialized in it
+        self.target_dtype: Optional[torch.dtype] = None
 
     @classmethod
-    def attach(cls, module: nn.Module, manager: "MemoryManager"):
+    def attach(cls, module: nn.Module, manager: "MemoryManager", name: str = ""):
         if hasattr(module, "_layer_memory_manager"):
             return
-        module._layer_memory_manager = cls(module, manager)
+        module._layer_memory_manager = cls(module, manager, name)
 
         # mark parameters as memory managed
         for param in module.parameters(recurse=False):
             param._is_memory_managed = True
 
+    def materialize(self, device: torch.device):
+        """Copies the weight and bias to device, quantized weights are dequantized there"""
+        weight_cpu = self.module.weight
+        bias_cpu = getattr(self.module, "bias", None)
+        target_dtype = self.target_dtype if self.target_dtype is not None else torch.bfloat16
+        weight = weight_cpu.to(device, non_blocking=True)
+        if _is_quantized_tensor(weight_cpu):
+            try:
+                weight = weight.dequantize()
+            except Exception:
+                weight = weight.to(dtype=torch.float32, non_blocking=True)
+            if weight.dtype != target_dtype:
+                weight = weight.to(target_dtype, non_blocking=True)
+        bias = bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+        return weight, bias
+
 
 class LinearLayerMemoryManager(BaseLayerMemoryManager):
     def __init__(
         self,
         module: nn.Module,
         manager: "MemoryManager",
+        name: str = "",
     ):
-        super().__init__(module, manager)
+        super().__init__(module, manager, name)
 
         # 1) Move params to CPU + pin memory for fast H2D
         _move_params_to_cpu_and_pin(self.module)
@@ -573,7 +694,7 @@ class LinearLayerMemoryManager(BaseLayerMemoryManager):
             device = self.manager.process_device
 
             # NOTE: do NOT move params to device here; autograd fn streams & bounces them
-            return _BouncingLinearFn.apply(x, weight_cpu, bias_cpu, device)
+            return _BouncingLinearFn.apply(x, weight_cpu, bias_cpu, device, self)
 
         self.module.forward = _mm_forward
 
@@ -583,8 +704,9 @@ class ConvLayerMemoryManager(BaseLayerMemoryManager):
         self,
         module: nn.Module,
         manager: "MemoryManager",
+        name: str = "",
     ):
-        super().__init__(module, manager)
+        super().__init__(module, manager, name)
 
         # 1) Move params to CPU + pin memory for fast H2D
         _move_params_to_cpu_and_pin(self.module)
@@ -620,7 +742,7 @@ class ConvLayerMemoryManager(BaseLayerMemoryManager):
             device = self.manager.process_device
 
             return _BouncingConv2dFn.apply(
-                x, weight_cpu, bias_cpu, device, stride, padding, dilation, groups
+                x, weight_cpu, bias_cpu, device, stride, padding, dilation, groups, self
             )
 
         self.module.forward = _mm_forward
@@ -0,0 +1,120 @@
+from typing import Callable, Dict, List, Optional
+
+import torch
+
+# Decides which layers of a memory managed model stay on the device and which are bounced from cpu on
+# every call. Only sizes and call counts are used so plans can be made and checked without a gpu.
+
+GB = 1024 ** 3
+
+
+def get_tensor_nbytes(t: Optional[torch.Tensor]) -> int:
+    if t is None:
+        return 0
+    # quantized wrappers keep the real storage in inner tensors
+    inner = [getattr(t, name, None) for name in ("_data", "_scale", "_shift")]
+    inner = [x for x in inner if isinstance(x, torch.Tensor)]
+    if len(inner) > 0:
+        return sum(get_tensor_nbytes(x) for x in inner)
+    return t.numel() * t.element_size()
+
+
+def get_module_nbytes(module: torch.nn.Module) -> int:
+    return sum(get_tensor_nbytes(p) for p in module.parameters(recurse=False))
+
+
+class LayerResidency:
+    def __init__(self, name: str, num_bytes: int, calls_per_step: int = 1, module: torch.nn.Module = None):
+        self.name = name
+        self.num_bytes = num_bytes
+        # how many times the layer runs per forward pass of the model
+        self.calls_per_step = calls_per_step
+        self.module = module
+        self.is_resident = False
+
+    def get_transfer_bytes(self, passes_per_call: int = 1) -> int:
+        if self.is_resident:
+            return 0
+        return self.num_bytes * self.calls_per_step * passes_per_call
+
+
+class ResidencyPlan:
+    """Which layers stay on the device and the transfer volume that leaves for the rest"""
+
+    def __init__(self, layers: List[LayerResidency], budget_bytes: Optional[int]):
+        self.layers = layers
+        self.budget_bytes = budget_bytes
+
+    @property
+    def resident_layers(self) -> List[LayerResidency]:
+        return [layer for layer in self.layers if layer.is_resident]
+
+    @property
+    def bounced_layers(self) -> List[LayerResidency]:
+        return [layer for layer in self.layers if not layer.is_resident]
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(layer.num_bytes for layer in self.resident_layers)
+
+    @property
+    def bounced_bytes(self) -> int:
+        return sum(layer.num_bytes for layer in self.bounced_layers)
+
+    def get_transfer_bytes_per_step(self, passes_per_call: int = 1) -> int:
+        """
+        Bytes copied to the device per model step. passes_per_call is 1 for inference, 2 when training
+        (the weight is bounced again for the backward pass) and 3 with gradient checkpointing.
+        """
+        return sum(layer.get_transfer_bytes(passes_per_call) for layer in self.layers)
+
+    def get_summary(self) -> str:
+        budget = f"{self.budget_bytes / GB:.2f}GB" if self.budget_bytes is not None else "none"
+        return (
+            f"budget {budget}, "
+            f"{len(self.resident_layers)} layers resident ({self.resident_bytes / GB:.2f}GB), "
+            f"{len(self.bounced_layers)} bounced ({self.bounced_bytes / GB:.2f}GB), "
+            f"transfer per step {self.get_transfer_bytes_per_step(1) / GB:.2f}GB inference, "
+            f"{self.get_transfer_bytes_per_step(2) / GB:.2f}GB training"
+        )
+
+
+def plan_residency(layers: List[LayerResidency], budget_bytes: Optional[int]) -> ResidencyPlan:
+    """
+    Keeps the layers that save the most transfer per byte on the device until the budget is used up.
+    Every byte of a layer is copied once per call, so layers that run most often go first and larger
+    layers go first among equals. Layers that do not fit are skipped so smaller ones can fill the rest.
+    """
+    for layer in layers:
+        layer.is_resident = False
+    if budget_bytes is None or budget_bytes <= 0:
+        return ResidencyPlan(layers, budget_bytes)
+    remaining = budget_bytes
+    ranked = sorted(layers, key=lambda layer: (layer.calls_per_step, layer.num_bytes), reverse=True)
+    for layer in ranked:
+        if layer.calls_per_step <= 0:
+            # never runs, no reason to keep it on the device
+            continue
+        if layer.num_bytes <= remaining:
+            layer.is_resident = True
+            remaining -= layer.num_bytes
+    return ResidencyPlan(layers, budget_bytes)
+
+
+def measure_call_counts(
+        modules: Dict[str, torch.nn.Module],
+        run_fn: Callable[[], None]
+) -> Dict[str, int]:
+    """Runs run_fn once and counts the forward calls of every module, eg for weights shared across blocks"""
+    counts = {name: 0 for name in modules}
+    handles = []
+    for name, module in modules.items():
+        def hook(_module, _args, _name=name):
+            counts[_name] += 1
+        handles.append(module.register_forward_pre_hook(hook))
+    try:
+        run_fn()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return counts
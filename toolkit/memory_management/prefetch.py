@@ -0,0 +1,242 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import torch
+
+from toolkit.timer import Timer
+
+if TYPE_CHECKING:
+    from .manager_modules import BaseLayerMemoryManager
+
+
+class TransferBackend:
+    """Copies the weights of a layer to the device. The cuda one copies on a side stream"""
+
+    def start(self, layer: 'BaseLayerMemoryManager'):
+        raise NotImplementedError()
+
+    def is_ready(self, handle) -> bool:
+        raise NotImplementedError()
+
+    def synchronize(self, handle):
+        """Blocks until the copy is done, only used to measure stalls"""
+        raise NotImplementedError()
+
+    def wait(self, handle) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Returns the device weights once the compute stream can use them"""
+        raise NotImplementedError()
+
+    def start_grad_offload(self, grad: torch.Tensor):
+        """Starts copying a gradient computed on the device to the cpu"""
+        return grad.to("cpu")
+
+    def finish_grad_offload(self, handle) -> torch.Tensor:
+        """Returns the cpu gradient once the copy is done"""
+        return handle
+
+
+class CudaTransferBackend(TransferBackend):
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+        # gradients go the other way, on their own stream so they do not queue behind weight copies
+        self.grad_stream = torch.cuda.Stream(device=device)
+
+    def start(self, layer: 'BaseLayerMemoryManager'):
+        event = torch.cuda.Event()
+        with torch.cuda.stream(self.stream):
+            weight, bias = layer.materialize(self.device)
+            event.record()
+        return weight, bias, event
+
+    def is_ready(self, handle) -> bool:
+        return handle[2].query()
+
+    def synchronize(self, handle):
+        handle[2].synchronize()
+
+    def wait(self, handle) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        weight, bias, event = handle
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(event)
+        # allocated on the transfer stream, keep the memory until the compute stream is done with it
+        weight.record_stream(compute_stream)
+        if bias is not None:
+            bias.record_stream(compute_stream)
+        return weight, bias
+
+    def start_grad_offload(self, grad: torch.Tensor):
+        # pinned so the copy is async. The caching host allocator reuses these buffers once the copy is done
+        cpu_grad = torch.empty(grad.shape, dtype=grad.dtype, device="cpu", pin_memory=True)
+        event = torch.cuda.Event()
+        self.grad_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.grad_stream):
+            cpu_grad.copy_(grad, non_blocking=True)
+            event.record()
+        # allocated on the compute stream, keep the memory until the copy is done with it
+        grad.record_stream(self.grad_stream)
+        return cpu_grad, event
+
+    def finish_grad_offload(self, handle) -> torch.Tensor:
+        cpu_grad, event = handle
+        # autograd accumulates cpu gradients right away, so the host waits for this copy only
+        event.synchronize()
+        return cpu_grad
+
+
+class PrefetchScheduler:
+    """
+    Records the order the managed layers run in during the first step, from the first forward call until
+    it runs again, including backward and any recomputation from gradient checkpointing. After that, every
+    call starts copying the weights of the next depth calls in that order, so transfers run ahead of compute
+    instead of one layer at a time. Nothing is copied past the end of the step, the optimizer updates the
+    cpu weights in place between steps. Calls that do not follow the recorded order still work, they just
+    copy on demand. If most calls over a step miss, the order is recorded again.
+    """
+
+    def __init__(self, backend: TransferBackend, depth: int = 2, timer: Optional[Timer] = None):
+        if depth < 1:
+            raise ValueError("Prefetch depth has to be at least 1")
+        self.backend = backend
+        self.depth = depth
+        # the time spent waiting on weights is reported to this timer as a prefetch_stall span per wait, with
+        # a prefetch_stall/<layer> child so slow layers stand out. Measuring it blocks the host, so only with a timer
+        self.timer = timer
+
+        self.is_recording = True
+        self.sequence: List['BaseLayerMemoryManager'] = []
+        # (layer id, is backward) -> indexes of its calls in the sequence
+        self.positions: Dict[Tuple[int, bool], List[int]] = {}
+        self._first_key: Optional[Tuple[int, bool]] = None
+        self.cursor = 0
+        # sequence index -> transfer handle, oldest first
+        self.in_flight: OrderedDict[int, Tuple['BaseLayerMemoryManager', object]] = OrderedDict()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        # calls and misses since the order was last checked
+        self._window_calls = 0
+        self._window_misses = 0
+
+    def reset(self):
+        self.is_recording = True
+        self.sequence = []
+        self.positions = {}
+        self._first_key = None
+        self.cursor = 0
+        self.in_flight.clear()
+        self._window_calls = 0
+        self._window_misses = 0
+
+    def _record(self, layer: 'BaseLayerMemoryManager', is_backward: bool):
+        key = (id(layer), is_backward)
+        if key == self._first_key:
+            # the first forward call runs again, one step is recorded
+            self.is_recording = False
+            self.cursor = 0
+            return
+        if self._first_key is None:
+            if is_backward:
+                # start recording at a forward pass
+                return
+            self._first_key = key
+        self.positions.setdefault(key, []).append(len(self.sequence))
+        self.sequence.append(layer)
+
+    def _find_index(self, layer: 'BaseLayerMemoryManager', is_backward: bool) -> Optional[int]:
+        indexes = self.positions.get((id(layer), is_backward), None)
+        if indexes is None:
+            return None
+        for idx in indexes:
+            if idx >= self.cursor:
+                return idx
+        # wrapped around into the next step
+        return indexes[0]
+
+    def _check_order(self, is_miss: bool):
+        self._window_calls += 1
+        if is_miss:
+            self._window_misses += 1
+        if self._window_calls < len(self.sequence):
+            return
+        # most calls missed, the recorded order does not match what the model does now
+        if self._window_misses * 2 > self._window_calls:
+            self.reset()
+        self._window_calls = 0
+        self._window_misses = 0
+
+    def _prefetch(self, idx: int):
+        length = len(self.sequence)
+        for next_idx in range(idx + 1, min(idx + self.depth, length - 1) + 1):
+            if next_idx in self.in_flight:
+                continue
+            next_layer = self.sequence[next_idx]
+            self.in_flight[next_idx] = (next_layer, self.backend.start(next_layer))
+        # drop predictions that were never used
+        while len(self.in_flight) > self.depth:
+            self.in_flight.popitem(last=False)
+
+    def _take_in_flight(self, layer: 'BaseLayerMemoryManager', idx: Optional[int]):
+        if idx is not None and idx in self.in_flight:
+            return self.in_flight.pop(idx)[1]
+        # predicted for another call of the same layer
+        for in_flight_idx, (in_flight_layer, handle) in self.in_flight.items():
+            if in_flight_layer is layer:
+                del self.in_flight[in_flight_idx]
+                return handle
+        return None
+
+    def get_weights(
+            self,
+            layer: 'BaseLayerMemoryManager',
+            is_backward: bool = False
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Device weights of layer for a forward or backward call"""
+        if self.is_recording:
+            self._record(layer, is_backward)
+
+        idx = None
+        if not self.is_recording:
+            idx = self._find_index(layer, is_backward)
+            if idx is not None and idx < self.cursor:
+                # a new step, anything still in flight was copied before the optimizer step
+                self.in_flight.clear()
+
+        handle = self._take_in_flight(layer, idx)
+        if handle is None:
+            handle = self.backend.start(layer)
+            if not self.is_recording:
+                self.num_misses += 1
+                self._check_order(is_miss=True)
+        else:
+            self.num_hits += 1
+            self._check_order(is_miss=False)
+
+        if idx is not None and not self.is_recording:
+            self.cursor = idx + 1
+            # queue the next transfers before waiting on this one
+            self._prefetch(idx)
+
+        if self.timer is not None and not self.backend.is_ready(handle):
+            layer_stall = f'prefetch_stall/{layer.name}'
+            self.timer.start('prefetch_stall')
+            self.timer.start(layer_stall)
+            self.backend.synchronize(handle)
+            self.timer.stop(layer_stall)
+            self.timer.stop('prefetch_stall')
+        return self.backend.wait(handle)
+
+    def start_grad_offload(self, grad: torch.Tensor):
+        """Starts copying a weight or bias gradient of a backward call to the cpu"""
+        return self.backend.start_grad_offload(grad)
+
+    def finish_grad_offload(self, handle) -> torch.Tensor:
+        return self.backend.finish_grad_offload(handle)
+
+    def get_stats(self) -> str:
+        total = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / total if total > 0 else 0.0
+        return (
+            f"prefetch depth {self.depth}, {len(self.sequence)} calls per step, "
+            f"{self.num_hits} hits, {self.num_misses} misses ({hit_rate * 100:.1f}% hit rate)"
+        )
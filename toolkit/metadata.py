@@ -1,8 +1,11 @@
 import json
+import os
+import shutil
+import tempfile
 from collections import OrderedDict
-from io import BytesIO
 
 import safetensors
+import safetensors.torch
 from safetensors import safe_open
 
 from info import software_meta
@@ -28,25 +31,76 @@ def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=Tru
     return save_meta
 
 
-def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
-    """Precalculate the model hashes needed by sd-webui-additional-networks to
-    save time on indexing the model later."""
-
+def get_model_hashes_from_file(file_path: str):
+    """Streams a safetensors file from disk and returns (model_hash, legacy_hash)"""
+    with open(file_path, 'rb') as f:
+        model_hash = addnet_hash_safetensors(f)
+        legacy_hash = addnet_hash_legacy(f)
+    return model_hash, legacy_hash
+
+
+def rewrite_safetensors_metadata(src_path: str, dst_path: str, metadata: dict):
+    """Copies a safetensors file with a new metadata header. Tensor data is streamed, never loaded."""
+    with open(src_path, 'rb') as src:
+        header_size = int.from_bytes(src.read(8), "little")
+        header = json.loads(src.read(header_size))
+        header.pop('__metadata__', None)
+        new_header = OrderedDict()
+        if metadata is not None and len(metadata) > 0:
+            new_header['__metadata__'] = metadata
+        new_header.update(header)
+        header_bytes = json.dumps(new_header, separators=(',', ':')).encode('utf-8')
+        # data has to start 8 byte aligned
+        header_bytes += b' ' * ((8 - len(header_bytes) % 8) % 8)
+        with open(dst_path, 'wb') as dst:
+            dst.write(len(header_bytes).to_bytes(8, "little"))
+            dst.write(header_bytes)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _get_hash_metadata(meta: OrderedDict) -> dict:
     # Because writing user metadata to the file can change the result of
     # sd_models.model_hash(), only retain the training metadata for purposes of
     # calculating the hash, as they are meant to be immutable
-    metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
+    return {k: v for k, v in meta.items() if k.startswith("ss_")}
 
-    bytes = safetensors.torch.save(state_dict, metadata)
-    b = BytesIO(bytes)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
+def add_model_hash_to_meta(state_dict, meta: OrderedDict, work_dir: str = None) -> OrderedDict:
+    """Precalculate the model hashes needed by sd-webui-additional-networks to
+    save time on indexing the model later. The model is serialized to a temp file in
+    work_dir and hashed from disk so no in memory copy of the serialized model is made."""
+    metadata = _get_hash_metadata(meta)
+
+    fd, hash_path = tempfile.mkstemp(suffix='.safetensors', dir=work_dir)
+    os.close(fd)
+    try:
+        safetensors.torch.save_file(state_dict, hash_path, metadata)
+        model_hash, legacy_hash = get_model_hashes_from_file(hash_path)
+    finally:
+        os.remove(hash_path)
     meta["sshs_model_hash"] = model_hash
     meta["sshs_legacy_hash"] = legacy_hash
     return meta
 
 
+def save_file_with_model_hash(state_dict, output_file: str, meta: OrderedDict) -> OrderedDict:
+    """Saves a safetensors file with the sd-webui-additional-networks hashes in its metadata.
+    The tensors are only serialized once. The file is written with the hash metadata, hashed
+    from disk, then copied to output_file with the full metadata header."""
+    metadata = _get_hash_metadata(meta)
+    hash_path = output_file + '.hash.tmp'
+    try:
+        safetensors.torch.save_file(state_dict, hash_path, metadata)
+        model_hash, legacy_hash = get_model_hashes_from_file(hash_path)
+        meta["sshs_model_hash"] = model_hash
+        meta["sshs_legacy_hash"] = legacy_hash
+        rewrite_safetensors_metadata(hash_path, output_file, meta)
+    finally:
+        if os.path.exists(hash_path):
+            os.remove(hash_path)
+    return meta
+
+
 def add_base_model_info_to_meta(
         meta: OrderedDict,
         base_model: str = None,
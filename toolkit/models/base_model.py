@@ -24,6 +24,7 @@ from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.saving import DEFAULT_MAX_SHARD_SIZE
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 import torch
@@ -158,6 +159,8 @@ class BaseModel:
         self.use_text_encoder_2 = model_config.use_text_encoder_2
 
         self.config_file = None
+        # max size of each weight shard when saving the full model
+        self.max_shard_size = DEFAULT_MAX_SHARD_SIZE
 
         self.is_flow_matching = False
 
@@ -468,6 +471,9 @@ class BaseModel:
 
                     if network is not None:
                         network.multiplier = gen_config.network_multiplier
+                        if getattr(network, 'adapter_pool', None) is not None:
+                            # pick the checkpoint for this image from the pool
+                            network.adapter_pool.set_batch_adapters([gen_config.adapter], gen_config.network_multiplier)
                     torch.manual_seed(gen_config.seed)
                     torch.cuda.manual_seed(gen_config.seed)
 
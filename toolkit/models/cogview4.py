@@ -24,6 +24,7 @@ from transformers import GlmModel, AutoTokenizer
 from diffusers import FlowMatchEulerDiscreteScheduler
 from typing import TYPE_CHECKING
 from toolkit.accelerator import unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
 
 if TYPE_CHECKING:
@@ -294,9 +295,10 @@ class CogView4(BaseModel):
     def save_model(self, output_path, meta, save_dtype):
         # only save the unet
         transformer: CogView4Transformer2DModel = unwrap_model(self.model)
-        transformer.save_pretrained(
+        save_pretrained_streaming(
+            transformer,
             save_directory=os.path.join(output_path, 'transformer'),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
 
         meta_path = os.path.join(output_path, 'aitk_meta.yaml')
@@ -253,36 +253,11 @@ class LokrModule(ToolkitModuleMixin, nn.Module):
         if not self.can_merge_in:
             return
 
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        scale = self.scale
-        # handle trainable scaler method locon does
-        if hasattr(self, 'scalar'):
-            scale = scale * self.scalar
-
-        lokr_weight = self.get_weight(weight)
-
-        merged_weight = (
-            weight
-            + (lokr_weight * merge_weight).to(weight.device, dtype=weight.dtype)
-        )
+        def add_delta(weight: torch.Tensor):
+            lokr_weight = self.get_weight(weight)
+            weight.add_(lokr_weight.to(weight.device, dtype=weight.dtype), alpha=merge_weight)
 
-        # set weight to org_module
-        org_sd[weight_key] = merged_weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+        self.apply_merge_delta(add_delta)
 
     def get_orig_weight(self):
         weight = self.org_module[0].weight
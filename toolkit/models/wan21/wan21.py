@@ -3,6 +3,7 @@ from functools import partial
 import torch
 import yaml
 from toolkit.accelerator import unwrap_model
+from toolkit.saving import save_pretrained_streaming
 from toolkit.basic import flush
 from toolkit.config_modules import GenerateImageConfig, ModelConfig
 from toolkit.dequantize import patch_dequantization_on_save
@@ -42,7 +43,8 @@ from diffusers.pipelines.wan.pipeline_wan import XLA_AVAILABLE
 from diffusers.callbacks import MultiPipelineCallbacks, PipelineCallback
 from typing import Any, Callable, Dict, List, Optional, Union
 from toolkit.models.wan21.wan_lora_convert import convert_to_diffusers, convert_to_original
-from toolkit.util.quantize import quantize_model
+from toolkit.util.quantize import quantize_model, load_quantized_model
+from toolkit.util.quantize_cache import get_quantize_cache
 from toolkit.models.loaders.umt5 import get_umt5_encoder
 
 # for generation only?
@@ -343,21 +345,11 @@ class Wan21(BaseModel):
     def load_wan_transformer(self, transformer_path, subfolder=None):
         self.print_and_status_update("Loading transformer")
         dtype = self.torch_dtype
-        transformer = WanTransformer3DModel.from_pretrained(
-            transformer_path,
-            subfolder=subfolder,
-            torch_dtype=dtype,
-        ).to(dtype=dtype)
 
         if self.model_config.split_model_over_gpus:
             raise ValueError(
                 "Splitting model over gpus is not supported for Wan2.1 models")
 
-        if not self.model_config.low_vram:
-            # quantize on the device
-            transformer.to(self.quantize_device, dtype=dtype)
-            flush()
-
         if self.model_config.assistant_lora_path is not None or self.model_config.inference_lora_path is not None:
             raise ValueError(
                 "Assistant LoRA is not supported for Wan2.1 models currently")
@@ -366,11 +358,33 @@ class Wan21(BaseModel):
             raise ValueError(
                 "Loading LoRA is not supported for Wan2.1 models currently")
 
+        quantize_cache = None
+        if self.model_config.quantize:
+            cache_source = os.path.join(transformer_path, subfolder) if subfolder is not None else transformer_path
+            quantize_cache = get_quantize_cache(self, cache_source, WanTransformer3DModel)
+            transformer = load_quantized_model(self, quantize_cache)
+            if transformer is not None:
+                if not self.model_config.low_vram:
+                    # where it would be after quantizing
+                    transformer.to(self.quantize_device)
+                return transformer
+
+        transformer = WanTransformer3DModel.from_pretrained(
+            transformer_path,
+            subfolder=subfolder,
+            torch_dtype=dtype,
+        ).to(dtype=dtype)
+
+        if not self.model_config.low_vram:
+            # quantize on the device
+            transformer.to(self.quantize_device, dtype=dtype)
+            flush()
+
         flush()
         
         if self.model_config.quantize:
             self.print_and_status_update("Quantizing Transformer")
-            quantize_model(self, transformer)
+            quantize_model(self, transformer, cache=quantize_cache)
             flush()
         
         if self.model_config.low_vram:
@@ -644,9 +658,10 @@ class Wan21(BaseModel):
     def save_model(self, output_path, meta, save_dtype):
         # only save the unet
         transformer: Wan21 = unwrap_model(self.model)
-        transformer.save_pretrained(
+        save_pretrained_streaming(
+            transformer,
             save_directory=os.path.join(output_path, 'transformer'),
-            safe_serialization=True,
+            max_shard_size=self.max_shard_size,
         )
 
         meta_path = os.path.join(output_path, 'aitk_meta.yaml')
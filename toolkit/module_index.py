@@ -0,0 +1,134 @@
+import fnmatch
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+# Single pass index of a module tree. Network construction and memory management used to walk
+# named_modules() of every matching module again, which visits each submodule once per ancestor.
+
+
+class NameFilter:
+    """Precompiled any(word in name for word in words)"""
+
+    def __init__(self, words: Optional[List[str]]):
+        self.words = list(words) if words is not None else []
+        if len(self.words) == 0:
+            self.regex = None
+        else:
+            # longest first so the alternation does not stop at a shorter prefix
+            words_sorted = sorted(set(self.words), key=len, reverse=True)
+            self.regex = re.compile('|'.join(re.escape(w) for w in words_sorted))
+
+    def matches(self, name: str) -> bool:
+        if self.regex is None:
+            return False
+        return self.regex.search(name) is not None
+
+
+class PatternFilter:
+    """
+    Precompiled any(fnmatch(name, pattern) for pattern in patterns). Names without wildcards are looked
+    up in a set, the rest are joined into one regex, so the cost does not grow with the number of patterns.
+    """
+
+    def __init__(self, patterns: Optional[List[str]]):
+        self.patterns = list(patterns) if patterns is not None else []
+        self.exact = set()
+        wildcards = []
+        for pattern in self.patterns:
+            if any(c in pattern for c in '*?['):
+                wildcards.append(pattern)
+            else:
+                self.exact.add(os.path.normcase(pattern))
+        self.regex = None
+        if len(wildcards) > 0:
+            self.regex = re.compile('|'.join(
+                f"(?:{fnmatch.translate(os.path.normcase(p))})" for p in dict.fromkeys(wildcards)
+            ))
+
+    def matches(self, name: str) -> bool:
+        name = os.path.normcase(name)
+        if name in self.exact:
+            return True
+        return self.regex is not None and self.regex.match(name) is not None
+
+
+class ModuleIndex:
+    """
+    Every module under root in named_modules() order with its full name and class name, built in one
+    walk. Parameter counts are computed once per module and cached.
+    """
+
+    def __init__(self, root: torch.nn.Module):
+        self.root = root
+        self.names: List[str] = []
+        self.modules: List[torch.nn.Module] = []
+        self.class_names: List[str] = []
+        # index of the parent entry, -1 for the root
+        self.parents: List[int] = []
+        # parameter counts by module id
+        self._param_counts: Dict[int, int] = {}
+
+        memo = set()
+        # explicit stack in the same pre order as named_modules, shared modules only show up once
+        stack: List[Tuple[str, torch.nn.Module, int]] = [('', root, -1)]
+        while len(stack) > 0:
+            name, module, parent = stack.pop()
+            if module is None or id(module) in memo:
+                continue
+            memo.add(id(module))
+            idx = len(self.modules)
+            self.names.append(name)
+            self.modules.append(module)
+            self.class_names.append(module.__class__.__name__)
+            self.parents.append(parent)
+            children = list(module._modules.items())
+            for child_name, child in reversed(children):
+                child_full_name = name + ('.' if name else '') + child_name
+                stack.append((child_full_name, child, idx))
+
+    def __len__(self):
+        return len(self.modules)
+
+    def get_param_count(self, module: torch.nn.Module) -> int:
+        key = id(module)
+        if key not in self._param_counts:
+            self._param_counts[key] = sum(p.numel() for p in module.parameters())
+        return self._param_counts[key]
+
+    def get_target_roots(self, target_class_names: List[str]) -> List[int]:
+        """For every entry, the index of its outermost ancestor (or itself) with a class in the list, else -1"""
+        targets = set(target_class_names)
+        roots = []
+        for idx, class_name in enumerate(self.class_names):
+            parent = self.parents[idx]
+            parent_root = roots[parent] if parent >= 0 else -1
+            if parent_root < 0 and class_name in targets:
+                roots.append(idx)
+            else:
+                roots.append(parent_root)
+        return roots
+
+    def iter_under_targets(
+            self,
+            target_class_names: List[str],
+            class_names: Optional[List[str]] = None
+    ) -> Iterator[Tuple[str, torch.nn.Module, torch.nn.Module]]:
+        """
+        Yields (full name, module, target module) for each module that is, or is inside, a module whose class
+        is in target_class_names. The target module is the outermost one. class_names limits the modules yielded.
+        """
+        roots = self.get_target_roots(target_class_names)
+        wanted = set(class_names) if class_names is not None else None
+        for idx, root_idx in enumerate(roots):
+            if root_idx < 0:
+                continue
+            if wanted is not None and self.class_names[idx] not in wanted:
+                continue
+            yield self.names[idx], self.modules[idx], self.modules[root_idx]
+
+    def iter_modules(self) -> Iterator[Tuple[str, torch.nn.Module]]:
+        for name, module in zip(self.names, self.modules):
+            yield name, module
@@ -0,0 +1,151 @@
+from typing import List, Optional, TYPE_CHECKING, Union
+
+import torch
+
+from toolkit.checkpoint_manifest import CheckpointManifest
+from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import LoRASlotConfig, NetworkConfig
+    from toolkit.network_mixins import Network
+
+# Several LoRAs trained at once on one frozen base model.
+# Every network is applied to the same model, so their forwards are chained on each layer. A batch is
+# built from one batch per LoRA and each network gets a per sample routing mask that zeroes its
+# multiplier on the samples of the other LoRAs. The base forward is shared by all of them while
+# each network only receives gradients from its own samples.
+
+
+class LoRASlot:
+    """A LoRA trained next to the main network with its own optimizer, data and save folder"""
+
+    def __init__(
+            self,
+            slot_config: 'LoRASlotConfig',
+            network_config: 'NetworkConfig',
+            network: 'Network',
+            save_root: str,
+    ):
+        self.config = slot_config
+        self.name = slot_config.name
+        self.network_config = network_config
+        self.network = network
+        self.save_root = save_root
+        self.manifest = CheckpointManifest(save_root)
+        self.params = []
+        self.optimizer = None
+        self.lr_scheduler = None
+        self.data_loader = None
+        self.data_loader_iterator = None
+        self.last_save_step = 0
+
+    def next_batch(self) -> DataLoaderBatchDTO:
+        from toolkit.data_loader import trigger_dataloader_setup_epoch
+        if self.data_loader_iterator is None:
+            self.data_loader_iterator = iter(self.data_loader)
+        try:
+            return next(self.data_loader_iterator)
+        except StopIteration:
+            # hit the end of an epoch, reset
+            self.data_loader_iterator = iter(self.data_loader)
+            trigger_dataloader_setup_epoch(self.data_loader)
+            return next(self.data_loader_iterator)
+
+    def get_trainable_params(self) -> List[torch.nn.Parameter]:
+        params = []
+        for group in self.params:
+            if isinstance(group, dict):
+                params += list(group['params'])
+            else:
+                params.append(group)
+        return params
+
+
+def _get_image_shape(batch: DataLoaderBatchDTO):
+    if batch.latents is not None:
+        return 'latents', tuple(batch.latents.shape[1:])
+    if batch.tensor is not None:
+        return 'tensor', tuple(batch.tensor.shape[1:])
+    return None
+
+
+def can_combine_batches(batches: List[DataLoaderBatchDTO], allow_reg: bool = False) -> bool:
+    """
+    Batches can only be concatenated if their images or latents and control images have the same size.
+    Reg batches after the first one are refused unless allow_reg is set
+    """
+    first = batches[0]
+    first_shape = _get_image_shape(first)
+    if first_shape is None:
+        return False
+    for batch in batches[1:]:
+        if _get_image_shape(batch) != first_shape:
+            return False
+        if (batch.control_tensor is None) != (first.control_tensor is None):
+            return False
+        if batch.control_tensor is not None and batch.control_tensor.shape[1:] != first.control_tensor.shape[1:]:
+            return False
+        if (batch.mask_tensor is None) != (first.mask_tensor is None):
+            return False
+        if batch.mask_tensor is not None and batch.mask_tensor.shape[1:] != first.mask_tensor.shape[1:]:
+            return False
+        if batch.control_tensor_list is not None or first.control_tensor_list is not None:
+            return False
+        if not allow_reg and any(batch.get_is_reg_list()):
+            return False
+    return True
+
+
+def combine_batches(batches: List[DataLoaderBatchDTO], allow_reg: bool = False) -> Optional[DataLoaderBatchDTO]:
+    """
+    Builds one batch from the file items of several batches, in order. Each sample's loss multiplier is
+    scaled so the batch mean of the combined batch is the sum of the batch means of the batches, the same
+    as running them as separate microbatches of one step. A LoRA routed to one of the batches gets the
+    gradient of that batch alone, a LoRA that sees all of them (a train and a reg batch packed together)
+    gets the sum of their gradients. Returns None if the batches cannot be concatenated.
+    """
+    if not can_combine_batches(batches, allow_reg=allow_reg):
+        return None
+    file_items = []
+    for batch in batches:
+        file_items += batch.file_items
+    try:
+        combined = DataLoaderBatchDTO(file_items=file_items)
+    except Exception:
+        return None
+    total = len(file_items)
+    loss_multiplier_list = []
+    for batch in batches:
+        scale = total / len(batch.file_items)
+        loss_multiplier_list += [x * scale for x in batch.loss_multiplier_list]
+    combined.loss_multiplier_list = loss_multiplier_list
+    return combined
+
+
+def get_routing_masks(batch_sizes: List[int]) -> List[List[float]]:
+    """One per sample mask per network for a batch made of the given batch sizes in order"""
+    total = sum(batch_sizes)
+    masks = []
+    start = 0
+    for size in batch_sizes:
+        mask = [0.0] * total
+        for i in range(start, start + size):
+            mask[i] = 1.0
+        masks.append(mask)
+        start += size
+    return masks
+
+
+def set_batch_routing(networks: List['Network'], routing: List[Optional[Union[float, List[float]]]]):
+    for network, routing_mask in zip(networks, routing):
+        network.set_routing_mask(routing_mask)
+
+
+def clear_batch_routing(networks: List['Network']):
+    for network in networks:
+        network.set_routing_mask(None)
+
+
+def route_to_network(networks: List['Network'], index: int):
+    """Applies only networks[index] to every sample"""
+    set_batch_routing(networks, [None if i == index else 0.0 for i in range(len(networks))])
@@ -1,4 +1,3 @@
-import json
 import os
 from collections import OrderedDict
 from typing import Optional, Union, List, Type, TYPE_CHECKING, Dict, Any, Literal
@@ -12,9 +11,8 @@ from tqdm import tqdm
 
 from toolkit.config_modules import NetworkConfig
 from toolkit.lorm import extract_conv, extract_linear, count_parameters
-from toolkit.metadata import add_model_hash_to_meta
-from toolkit.paths import KEYMAPS_ROOT
-from toolkit.saving import get_lora_keymap_from_model_keymap
+from toolkit.metadata import add_model_hash_to_meta, save_file_with_model_hash
+from toolkit.lora_keymap import KeyTranslator, get_key_translator
 from optimum.quanto import QBytesTensor
 
 if TYPE_CHECKING:
@@ -22,6 +20,7 @@ if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork, LoRAModule
     from toolkit.stable_diffusion_model import StableDiffusion
     from toolkit.models.DoRA import DoRAModule
+    from toolkit.adapter_pool import LoRAAdapterPool
 
 Network = Union['LycorisSpecialNetwork', 'LoRASpecialNetwork']
 Module = Union['LoConSpecialModule', 'LoRAModule', 'DoRAModule']
@@ -167,6 +166,84 @@ class ExtractableModuleMixin:
             self.scalar.data = torch.tensor(1.0).to(self.scalar.device, self.scalar.dtype)
 
 
+# sibling projections that usually read the same input. Checked at runtime before they are fused
+FUSED_PROJECTION_GROUPS = [
+    ['add_q_proj', 'add_k_proj', 'add_v_proj'],
+    ['to_q', 'to_k', 'to_v'],
+    ['q_proj', 'k_proj', 'v_proj'],
+    ['query', 'key', 'value'],
+    ['gate_proj', 'up_proj'],
+    ['w1', 'w3'],
+]
+
+
+class FusedLoRAGroup:
+    """
+    Sibling LoRA modules, such as q, k and v, whose down projections run as a single matmul when they
+    are called with the same input tensor. The first forward pass records which of them actually share
+    an input and splits the group on that. The parameters stay in the modules so the saved state dict
+    is unchanged.
+    """
+
+    def __init__(self, modules: List['Module']):
+        self.modules = modules
+        self.split_sizes = [m.lora_down.weight.shape[0] for m in modules]
+        self.is_calibrated = False
+        self.seen_inputs: Dict[int, weakref.ref] = {}
+        self.input_ref: Optional[weakref.ref] = None
+        self.outputs: Dict[int, torch.Tensor] = {}
+
+    def _calibrate(self, index: int, x: torch.Tensor):
+        if index in self.seen_inputs:
+            # a member ran twice before the others, start over
+            self.seen_inputs = {}
+        self.seen_inputs[index] = weakref.ref(x)
+        if len(self.seen_inputs) < len(self.modules):
+            return
+        # split the members into groups by the input tensor they were called with
+        by_input = OrderedDict()
+        for i, module in enumerate(self.modules):
+            x_i = self.seen_inputs[i]()
+            key = id(x_i) if x_i is not None else ('freed', i)
+            by_input.setdefault(key, []).append(module)
+        self.seen_inputs = {}
+        for members in by_input.values():
+            if len(members) > 1:
+                group = FusedLoRAGroup(members)
+                group.is_calibrated = True
+            else:
+                group = None
+            for module in members:
+                module.fused_group = group
+
+    def _run(self, x: torch.Tensor):
+        lora_input = x
+        if isinstance(lora_input, QTensor):
+            lora_input = lora_input.dequantize()
+        # one cast and one down projection for the whole group
+        lora_input = lora_input.to(self.modules[0].lora_down.weight.dtype)
+        weight = torch.cat([m.lora_down.weight for m in self.modules], dim=0)
+        down = torch.nn.functional.linear(lora_input, weight)
+        self.outputs = dict(enumerate(down.split(self.split_sizes, dim=-1)))
+        self.input_ref = weakref.ref(x)
+
+    def forward(self, module: 'Module', x: torch.Tensor) -> Optional[torch.Tensor]:
+        """Returns the lora output of module, or None if it has to run on its own this time"""
+        index = self.modules.index(module)
+        if not self.is_calibrated:
+            self._calibrate(index, x)
+            return None
+        if self.input_ref is None or self.input_ref() is not x or index not in self.outputs:
+            self._run(x)
+        lx = self.outputs.pop(index)
+        lx = module.lora_up(lx)
+        scale = module.scale
+        # handle trainable scaler method locon does
+        if hasattr(module, 'scalar'):
+            scale = scale * module.scalar
+        return lx * scale
+
+
 class ToolkitModuleMixin:
     def __init__(
             self: Module,
@@ -177,6 +254,7 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        self.fused_group: Optional[FusedLoRAGroup] = None
 
     def _call_forward(self: Module, x):
         # module dropout
@@ -274,6 +352,10 @@ class ToolkitModuleMixin:
         if network._multiplier == 0:
             skip = True
 
+        # skip if batch routing sends no samples to this network
+        if network.is_routed_out:
+            skip = True
+
         if skip:
             # network is not active, avoid doing anything
             return self.org_forward(x, *args, **kwargs)
@@ -287,11 +369,21 @@ class ToolkitModuleMixin:
 
         org_forwarded = self.org_forward(x, *args, **kwargs)
 
-        if isinstance(x, QTensor):
-            x = x.dequantize()
-        # always cast to float32
-        lora_input = x.to(self.lora_down.weight.dtype)
-        lora_output = self._call_forward(lora_input)
+        lora_output = None
+        adapter_pool = network.adapter_pool
+        if adapter_pool is not None and adapter_pool.is_active:
+            # weights of the adapter of each row come from the pool
+            if isinstance(x, QTensor):
+                x = x.dequantize()
+            lora_output = adapter_pool.forward_module(self, x)
+        elif self.fused_group is not None:
+            lora_output = self.fused_group.forward(self, x)
+        if lora_output is None:
+            if isinstance(x, QTensor):
+                x = x.dequantize()
+            # always cast to float32
+            lora_input = x.to(self.lora_down.weight.dtype)
+            lora_output = self._call_forward(lora_input)
         multiplier = self.network_ref().torch_multiplier
 
         lora_output_batch_size = lora_output.size(0)
@@ -337,8 +429,74 @@ class ToolkitModuleMixin:
     def disable_gradient_checkpointing(self: Module):
         self.is_checkpointing = False
 
+    def get_merge_target(self: Module):
+        """
+        Returns the tensor merges are written into and the quantization scale if it is quantized.
+        Returns (None, None) if the weight can not be updated in place.
+        """
+        org_weight = self.org_module[0].weight
+        if isinstance(org_weight, QTensor) or isinstance(org_weight, QBytesTensor):
+            data = getattr(org_weight, '_data', None)
+            q_scale = getattr(org_weight, '_scale', None)
+            # packed formats (qint4, qint2) do not map one to one to the weight
+            if data is None or q_scale is None or data.shape != org_weight.shape:
+                return None, None
+            return data, q_scale
+        if type(org_weight.data) is not torch.Tensor:
+            # other tensor subclasses (torchao etc) do not support in place updates
+            return None, None
+        return org_weight.data, None
+
+    @torch.no_grad()
+    def apply_merge_delta(self: Module, add_delta) -> bool:
+        """
+        Calls add_delta(weight) which adds the merge delta to weight in place, in the compute dtype.
+        Quantized weights are dequantized, updated and quantized back with the same scale.
+        """
+        target, q_scale = self.get_merge_target()
+        if target is None:
+            return False
+        network: Network = self.network_ref()
+        # quantized and half precision weights are rounded after the add, subtracting the delta again
+        # would leave that rounding in the base weights every merge, so they are always backed up
+        is_lossy = q_scale is not None or target.dtype != torch.float32
+        if (network.merge_backup or is_lossy) and getattr(self, 'merge_backup_weight', None) is None:
+            self.merge_backup_weight = target.detach().to('cpu', copy=True)
+        if q_scale is None:
+            add_delta(target)
+            return True
+        weight = target.to(q_scale.dtype) * q_scale
+        add_delta(weight)
+        new_data = weight / q_scale
+        if not target.is_floating_point():
+            info = torch.iinfo(target.dtype)
+            new_data = new_data.round().clamp(info.min, info.max)
+        else:
+            # float8 casts overflow to nan (e4m3) or inf instead of saturating
+            max_value = torch.finfo(target.dtype).max
+            new_data = new_data.clamp(-max_value, max_value)
+        target.copy_(new_data.to(target.dtype))
+        return True
+
+    def get_merge_scale(self: Module, merge_weight=1.0) -> float:
+        scale = self.scale
+        # handle trainable scaler method locon does
+        if hasattr(self, 'scalar'):
+            scale = scale * self.scalar
+        scale = merge_weight * scale
+        if isinstance(scale, torch.Tensor):
+            scale = scale.item()
+        return scale
+
     @torch.no_grad()
     def merge_out(self: Module, merge_out_weight=1.0):
+        backup = getattr(self, 'merge_backup_weight', None)
+        if backup is not None:
+            # restore the exact weights from before the merge
+            target, _ = self.get_merge_target()
+            target.copy_(backup.to(target.device))
+            self.merge_backup_weight = None
+            return
         # make sure it is positive
         merge_out_weight = abs(merge_out_weight)
         # merging out is just merging in the negative of the weight
@@ -348,57 +506,31 @@ class ToolkitModuleMixin:
     def merge_in(self: Module, merge_weight=1.0):
         if not self.can_merge_in:
             return
-        # get up/down weight
-        if self.full_rank:
-            up_weight = None
-        else:
-            up_weight = self.lora_up.weight.clone().float()
-        down_weight = self.lora_down.weight.clone().float()
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        multiplier = merge_weight
-        scale = self.scale
-        # handle trainable scaler method locon does
-        if hasattr(self, 'scalar'):
-            scale = scale * self.scalar
-
-        # merge weight
-        if self.full_rank:
-            weight = weight + multiplier * down_weight * scale
-        elif len(weight.size()) == 2:
-            # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
-        elif down_weight.size()[2:4] == (1, 1):
-            # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
-            )
-        else:
-            # conv2d 3x3
-            conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+        alpha = self.get_merge_scale(merge_weight)
+
+        def add_delta(weight: torch.Tensor):
+            down_weight = self.lora_down.weight.to(weight.device, dtype=weight.dtype)
+            if self.full_rank:
+                weight.add_(down_weight, alpha=alpha)
+                return
+            up_weight = self.lora_up.weight.to(weight.device, dtype=weight.dtype)
+            if len(weight.size()) == 2:
+                # linear
+                weight.addmm_(up_weight, down_weight, alpha=alpha)
+            elif down_weight.size()[2:4] == (1, 1):
+                # conv2d 1x1
+                up_weight = up_weight.flatten(1)
+                down_weight = down_weight.flatten(1)
+                if weight.is_contiguous():
+                    weight.view(weight.size(0), -1).addmm_(up_weight, down_weight, alpha=alpha)
+                else:
+                    weight.add_((up_weight @ down_weight).view(weight.shape), alpha=alpha)
+            else:
+                # conv2d 3x3
+                conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+                weight.add_(conved, alpha=alpha)
 
-        # set weight to org_module
-        org_sd[weight_key] = weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+        self.apply_merge_delta(add_delta)
 
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
@@ -436,6 +568,13 @@ class ToolkitNetworkMixin:
         self.train_unet = train_unet
         self.is_checkpointing = False
         self._multiplier: float = 1.0
+        # other networks applied to the same model that follow this one's is_active and multiplier
+        self.routed_networks: List[Network] = []
+        # per sample 1.0 / 0.0 mask of the samples this network applies to, None applies to all
+        self.routing_mask: Optional[Union[float, List[float]]] = None
+        self.is_routed_out = False
+        # LoRAAdapterPool serving several checkpoints through this network's layers
+        self.adapter_pool: Optional['LoRAAdapterPool'] = None
         self.is_active: bool = False
         self.is_sdxl = is_sdxl
         self.is_ssd = is_ssd
@@ -448,10 +587,11 @@ class ToolkitNetworkMixin:
         self.module_losses: List[torch.Tensor] = []
         self.lorm_train_mode: Literal['local', None] = None
         self.can_merge_in = not is_lorm
+        self.merge_backup = network_config.merge_backup if network_config is not None else False
         # will prevent optimizer from loading as it will have double states
         self.did_change_weights = False
 
-    def get_keymap(self: Network, force_weight_mapping=False):
+    def get_key_translator(self: Network, force_weight_mapping=False) -> KeyTranslator:
         use_weight_mapping = False
 
         if self.is_ssd:
@@ -472,96 +612,44 @@ class ToolkitNetworkMixin:
         if force_weight_mapping:
             use_weight_mapping = True
 
-        # load keymap
-        keymap_name = f"stable_diffusion_locon_{keymap_tail}.json"
-        if use_weight_mapping:
-            keymap_name = f"stable_diffusion_{keymap_tail}.json"
-
-        keymap_path = os.path.join(KEYMAPS_ROOT, keymap_name)
-
-        keymap = None
-        # check if file exists
-        if os.path.exists(keymap_path):
-            with open(keymap_path, 'r') as f:
-                keymap = json.load(f)['ldm_diffusers_keymap']
-
-        if use_weight_mapping and keymap is not None:
-            # get keymap from weights
-            keymap = get_lora_keymap_from_model_keymap(keymap)
-
-        # upgrade keymaps for DoRA
-        if self.network_type.lower() == 'dora':
-            if keymap is not None:
-                new_keymap = {}
-                for ldm_key, diffusers_key in keymap.items():
-                    ldm_key = ldm_key.replace('.alpha', '.magnitude')
-                    # ldm_key = ldm_key.replace('.lora_down.weight', '.lora_down')
-                    # ldm_key = ldm_key.replace('.lora_up.weight', '.lora_up')
-
-                    diffusers_key = diffusers_key.replace('.alpha', '.magnitude')
-                    # diffusers_key = diffusers_key.replace('.lora_down.weight', '.lora_down')
-                    # diffusers_key = diffusers_key.replace('.lora_up.weight', '.lora_up')
-
-                    new_keymap[ldm_key] = diffusers_key
-
-                keymap = new_keymap
+        # shared by every network with the same settings, the keymap is only loaded once per process
+        return get_key_translator(
+            keymap_tail,
+            network_type=self.network_type,
+            peft_format=self.peft_format,
+            is_pixart=getattr(self, 'is_pixart', False),
+            use_weight_mapping=use_weight_mapping,
+        )
 
-        return keymap
+    def get_keymap(self: Network, force_weight_mapping=False):
+        # shared between networks, do not modify it
+        return self.get_key_translator(force_weight_mapping).keymap
     
     def get_state_dict(self: Network, extra_state_dict=None, dtype=torch.float16):
-        keymap = self.get_keymap()
-
-        save_keymap = {}
-        if keymap is not None:
-            for ldm_key, diffusers_key in keymap.items():
-                #  invert them
-                save_keymap[diffusers_key] = ldm_key
+        translator = self.get_key_translator()
 
         state_dict = self.state_dict()
         save_dict = OrderedDict()
 
         for key in list(state_dict.keys()):
+            save_key = translator.to_save_key(key)
+            if save_key is None:
+                del state_dict[key]
+                continue
             v = state_dict[key]
             v = v.detach().clone().to("cpu").to(dtype)
-            save_key = save_keymap[key] if key in save_keymap else key
             save_dict[save_key] = v
             del state_dict[key]
 
         if extra_state_dict is not None:
             # add extra items to state dict
             for key in list(extra_state_dict.keys()):
+                save_key = translator.to_save_key(key, use_keymap=False)
+                if save_key is None:
+                    continue
                 v = extra_state_dict[key]
                 v = v.detach().clone().to("cpu").to(dtype)
-                save_dict[key] = v
-
-        if self.peft_format:
-            # lora_down = lora_A
-            # lora_up = lora_B
-            # no alpha
-
-            new_save_dict = {}
-            for key, value in save_dict.items():
-                if key.endswith('.alpha'):
-                    continue
-                new_key = key
-                new_key = new_key.replace('lora_down', 'lora_A')
-                new_key = new_key.replace('lora_up', 'lora_B')
-                # replace all $$ with .
-                new_key = new_key.replace('$$', '.')
-                new_save_dict[new_key] = value
-
-            save_dict = new_save_dict
-        
-                
-        if self.network_type.lower() == "lokr":
-            new_save_dict = {}
-            for key, value in save_dict.items():
-                # lora_transformer_transformer_blocks_7_attn_to_v.lokr_w1 to lycoris_transformer_blocks_7_attn_to_v.lokr_w1
-                new_key = key
-                new_key = new_key.replace('lora_transformer_', 'lycoris_')
-                new_save_dict[new_key] = value
-
-            save_dict = new_save_dict
+                save_dict[save_key] = v
         
         if self.base_model_ref is not None:
             save_dict = self.base_model_ref().convert_lora_weights_before_save(save_dict)
@@ -580,24 +668,23 @@ class ToolkitNetworkMixin:
 
         if metadata is None:
             metadata = OrderedDict()
-        metadata = add_model_hash_to_meta(save_dict, metadata)
         # let the model handle the saving
         
         if self.base_model_ref is not None and hasattr(self.base_model_ref(), 'save_lora'):
+            metadata = add_model_hash_to_meta(save_dict, metadata, work_dir=os.path.dirname(file) or None)
             # call the base model save lora method
             self.base_model_ref().save_lora(save_dict, file, metadata)
             return
         
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            save_file(save_dict, file, metadata)
+            # hashes are computed from the written file
+            save_file_with_model_hash(save_dict, file, metadata)
         else:
             torch.save(save_dict, file)
 
     def load_weights(self: Network, file, force_weight_mapping=False):
         # allows us to save and load to and from ldm weights
-        keymap = self.get_keymap(force_weight_mapping)
-        keymap = {} if keymap is None else keymap
+        translator = self.get_key_translator(force_weight_mapping)
 
         if isinstance(file, str):
             if self.base_model_ref is not None and hasattr(self.base_model_ref(), 'load_lora'):
@@ -618,28 +705,9 @@ class ToolkitNetworkMixin:
 
         load_sd = OrderedDict()
         for key, value in weights_sd.items():
-            load_key = keymap[key] if key in keymap else key
-            # replace old double __ with single _
-            if self.is_pixart:
-                load_key = load_key.replace('__', '_')
-
-            if self.peft_format:
-                # lora_down = lora_A
-                # lora_up = lora_B
-                # no alpha
-                if load_key.endswith('.alpha'):
-                    continue
-                load_key = load_key.replace('lora_A', 'lora_down')
-                load_key = load_key.replace('lora_B', 'lora_up')
-                # replace all . with $$
-                load_key = load_key.replace('.', '$$')
-                load_key = load_key.replace('$$lora_down$$', '.lora_down.')
-                load_key = load_key.replace('$$lora_up$$', '.lora_up.')
-            
-            if self.network_type.lower() == "lokr":
-                # lora_transformer_transformer_blocks_7_attn_to_v.lokr_w1 to lycoris_transformer_blocks_7_attn_to_v.lokr_w1
-                load_key = load_key.replace('lycoris_', 'lora_transformer_')
-
+            load_key = translator.to_load_key(key)
+            if load_key is None:
+                continue
             load_sd[load_key] = value
 
         # extract extra items from state dict
@@ -735,14 +803,45 @@ class ToolkitNetworkMixin:
             elif isinstance(multiplier, torch.Tensor):
                 tensor_multiplier = multiplier.clone().detach().to(device, dtype=dtype)
 
+            routing_mask = getattr(self, 'routing_mask', None)
+            self.is_routed_out = False
+            if routing_mask is not None:
+                if isinstance(routing_mask, list):
+                    mask = torch.tensor(routing_mask).to(device, dtype=dtype)
+                else:
+                    mask = torch.tensor((routing_mask,)).to(device, dtype=dtype)
+                if mask.size(0) > 1 and tensor_multiplier.size(0) > mask.size(0) and \
+                        tensor_multiplier.size(0) % mask.size(0) == 0:
+                    # the trainer repeats the weight list for some batch layouts
+                    mask = mask.repeat(tensor_multiplier.size(0) // mask.size(0))
+                if tensor_multiplier.size(0) != mask.size(0) and tensor_multiplier.size(0) != 1 and mask.size(0) != 1:
+                    raise ValueError(
+                        f"Routing mask has {mask.size(0)} samples but the multiplier has {tensor_multiplier.size(0)}"
+                    )
+                # slider multipliers can have extra dims, the mask is per sample
+                mask = mask.view(-1, *([1] * (tensor_multiplier.dim() - 1)))
+                tensor_multiplier = tensor_multiplier * mask
+                self.is_routed_out = not bool(torch.any(mask != 0))
+
             self.torch_multiplier = tensor_multiplier.clone().detach()
 
+    def set_routing_mask(self: Network, routing_mask: Optional[Union[float, List[float]]]):
+        # routes a batch between several networks on the same model, see toolkit/multi_lora.py
+        if isinstance(routing_mask, list) and isinstance(self._multiplier, list) and \
+                len(self._multiplier) != len(routing_mask):
+            # still the multiplier of the last batch, the trainer sets the new one next
+            self._multiplier = 1.0
+        self.routing_mask = routing_mask
+        self._update_torch_multiplier()
+
     @property
     def multiplier(self) -> Union[float, List[float], List[List[float]]]:
         return self._multiplier
 
     @multiplier.setter
     def multiplier(self, value: Union[float, List[float], List[List[float]]]):
+        for network in getattr(self, 'routed_networks', []):
+            network.multiplier = value
         # it takes time to update all the multipliers, so we only do it if the value has changed
         if self._multiplier == value:
             return
@@ -750,6 +849,16 @@ class ToolkitNetworkMixin:
         self._multiplier = value
         self._update_torch_multiplier()
 
+    @property
+    def is_active(self: Network) -> bool:
+        return self._is_active
+
+    @is_active.setter
+    def is_active(self: Network, value: bool):
+        self._is_active = value
+        for network in getattr(self, 'routed_networks', []):
+            network.is_active = value
+
     # called when the context manager is entered
     # ie: with network:
     def __enter__(self: Network):
@@ -768,6 +877,42 @@ class ToolkitNetworkMixin:
         for lora in loras:
             lora.to(device, dtype)
 
+    def setup_fused_groups(self: Network):
+        """Groups sibling projections, like q, k and v, so their down projections run as one matmul"""
+        candidates = OrderedDict()
+        for module in self.get_all_modules():
+            module.fused_group = None
+            if module.__class__.__name__ not in ['LoRAModule', 'LoConSpecialModule']:
+                continue
+            if not isinstance(getattr(module, 'lora_down', None), nn.Linear) or module.lora_down.bias is not None:
+                continue
+            if getattr(module, 'lora_mid', None) is not None:
+                continue
+            # dropout is per module, those run on their own
+            if isinstance(module.dropout, nn.Dropout) or (
+                    not isinstance(module.dropout, nn.Module) and module.dropout):
+                continue
+            if module.rank_dropout or module.module_dropout:
+                continue
+            for group_idx, names in enumerate(FUSED_PROJECTION_GROUPS):
+                name = next(
+                    (n for n in names if module.lora_name.endswith(f"_{n}") or module.lora_name.endswith(f".{n}")),
+                    None
+                )
+                if name is not None:
+                    key = (module.lora_name[:-len(name)], group_idx)
+                    candidates.setdefault(key, []).append(module)
+                    break
+        num_groups = 0
+        for modules in candidates.values():
+            if len(modules) < 2:
+                continue
+            group = FusedLoRAGroup(modules)
+            for module in modules:
+                module.fused_group = group
+            num_groups += 1
+        print(f"Fusing LoRA down projections of {num_groups} groups of sibling modules")
+
     def get_all_modules(self: Network) -> List[Module]:
         loras = []
         if hasattr(self, 'unet_loras'):
@@ -1,7 +1,9 @@
 import math
 import torch
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from optimum.quanto import QBytesTensor
+from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, BlockwiseInt8Tensor, \
+    dequantize_group, group_params_for_update, quantize_group, stochastic_grad_accummulation
 
 class Adam8bit(Optimizer):
     """
@@ -74,65 +76,96 @@ class Adam8bit(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            beta1, beta2 = group['betas']
-            eps = group['eps']
-            lr = group['lr']
-            decay = group['weight_decay']
-            decouple = group['decouple']
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-
-                grad = p.grad.data.to(torch.float32)
-                p_fp32 = p.clone().to(torch.float32)
-
-                # Apply weight decay (coupled variant)
-                if decay != 0 and not decouple:
-                    grad.add_(p_fp32.data, alpha=decay)
-
+            params = [p for p in group['params'] if p.grad is not None]
+            for p in params:
                 state = self.state[p]
-
                 # State initialization
                 if len(state) == 0:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['exp_avg'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
+                    state['exp_avg'] = BlockwiseInt8Tensor(torch.zeros_like(p, dtype=torch.float32))
                     # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = Auto8bitTensor(
-                        torch.zeros_like(p_fp32.data).detach())
-
-                exp_avg = state['exp_avg'].to(torch.float32)
-                exp_avg_sq = state['exp_avg_sq'].to(torch.float32)
-
-                state['step'] += 1
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-
-                # Adam EMA updates
-                exp_avg.mul_(beta1).add_(grad, alpha=1-beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1-beta2)
-
-                # Apply weight decay (decoupled variant)
-                if decay != 0 and decouple:
-                    p_fp32.data.mul_(1 - lr * decay)
-
-                # Bias correction
-                step_size = lr / bias_correction1
-                denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
-
-                # Take step
-                p_fp32.data.addcdiv_(exp_avg, denom, value=-step_size)
-                
-                # Update state with stochastic rounding
-                state['exp_avg'] = Auto8bitTensor(exp_avg)
-                state['exp_avg_sq'] = Auto8bitTensor(exp_avg_sq)
-                
-                # Apply stochastic rounding to parameters
-                copy_stochastic(p.data, p_fp32.data)
+                    state['exp_avg_sq'] = BlockwiseInt8Tensor(torch.zeros_like(p, dtype=torch.float32))
+                elif not isinstance(state['exp_avg'], BlockwiseInt8Tensor):
+                    # per tensor states from older checkpoints are requantized into blocks
+                    state['exp_avg'] = BlockwiseInt8Tensor(state['exp_avg'].state_dict())
+                    state['exp_avg_sq'] = BlockwiseInt8Tensor(state['exp_avg_sq'].state_dict())
+
+            # params with the same shape are updated together
+            for group_params in group_params_for_update(params, self.state):
+                self._update_group(group, group_params)
 
         return loss
+
+    def _update_group(self, group, params):
+        beta1, beta2 = group['betas']
+        eps = group['eps']
+        lr = group['lr']
+        decay = group['weight_decay']
+        decouple = group['decouple']
+        states = [self.state[p] for p in params]
+
+        grads = [p.grad.to(torch.float32) for p in params]
+        is_fp32 = params[0].dtype == torch.float32 and not isinstance(params[0], QBytesTensor)
+        if is_fp32:
+            # update in place
+            p_fp32 = [p.data for p in params]
+        else:
+            p_fp32 = [
+                (p.dequantize() if isinstance(p, QBytesTensor) else p.data).to(torch.float32) for p in params
+            ]
+
+        # Apply weight decay (coupled variant)
+        if decay != 0 and not decouple:
+            grads = torch._foreach_add(grads, p_fp32, alpha=decay)
+
+        # one dequantize for the whole group, the per param views are updated with foreach ops
+        exp_avg_stack = dequantize_group([state['exp_avg'] for state in states])
+        exp_avg_sq_stack = dequantize_group([state['exp_avg_sq'] for state in states])
+        exp_avgs = list(exp_avg_stack.unbind(0))
+        exp_avg_sqs = list(exp_avg_sq_stack.unbind(0))
+
+        # all params in a group are on the same step
+        step = states[0]['step'] + 1
+        for state in states:
+            state['step'] = step
+        bias_correction1 = 1 - beta1 ** step
+        bias_correction2 = 1 - beta2 ** step
+
+        # Adam EMA updates
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+        # Apply weight decay (decoupled variant)
+        if decay != 0 and decouple:
+            torch._foreach_mul_(p_fp32, 1 - lr * decay)
+
+        # Bias correction
+        step_size = lr / bias_correction1
+        denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_div_(denom, math.sqrt(bias_correction2))
+        torch._foreach_add_(denom, eps)
+
+        # Take step
+        torch._foreach_addcdiv_(p_fp32, exp_avgs, denom, value=-step_size)
+        del denom, grads
+
+        # Update state, one quantize for the whole group
+        for state, exp_avg, exp_avg_sq in zip(
+                states,
+                quantize_group(exp_avg_stack, torch.float32),
+                quantize_group(exp_avg_sq_stack, torch.float32)
+        ):
+            state['exp_avg'] = exp_avg
+            state['exp_avg_sq'] = exp_avg_sq
+
+        if not is_fp32:
+            # Apply stochastic rounding to parameters
+            for p, p_updated in zip(params, p_fp32):
+                copy_stochastic(p.data, p_updated)
+
     
     def state_dict(self):
         """Returns the state of the optimizer as a dict."""
@@ -154,9 +187,10 @@ class Adam8bit(Optimizer):
         # First, load the basic state
         super().load_state_dict(state_dict)
         
-        # Then convert any Auto8bitTensor states back to objects
+        # Then convert any Auto8bitTensor states back to objects. Per tensor states from
+        # older checkpoints are requantized into blocks
         for param_id, param_state in self.state.items():
             for key, value in param_state.items():
                 if isinstance(value, dict) and value.get('_type') == 'Auto8bitTensor':
-                    param_state[key] = Auto8bitTensor(value['state'])
+                    param_state[key] = BlockwiseInt8Tensor(value['state'])
 
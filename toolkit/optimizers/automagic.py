@@ -1,6 +1,7 @@
 from typing import List
 import torch
-from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import BlockwiseInt8Tensor, copy_stochastic, \
+    dequantize_group, group_params_for_update, load_8bit_tensor, quantize_group, stochastic_grad_accummulation
 from optimum.quanto import QBytesTensor
 import random
 
@@ -116,6 +117,12 @@ class Automagic(torch.optim.Optimizer):
     def _rms(tensor):
         return tensor.norm(2) / (tensor.numel() ** 0.5)
 
+    @staticmethod
+    def _rms_stack(tensor):
+        # rms of every tensor in a stack
+        flat = tensor.reshape(tensor.shape[0], -1)
+        return flat.norm(2, dim=1) / (flat.shape[1] ** 0.5)
+
     @staticmethod
     def _approx_sq_grad(exp_avg_sq_row, exp_avg_sq_col):
         r_factor = (exp_avg_sq_row / exp_avg_sq_row.mean(dim=-
@@ -163,128 +170,148 @@ class Automagic(torch.optim.Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            params = []
             for p in group["params"]:
                 if p.grad is None or not p.requires_grad:
                     continue
-
-                grad = p.grad
-                if grad.dtype != torch.float32:
-                    grad = grad.to(torch.float32)
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError(
                         "Automagic does not support sparse gradients.")
+                self._prepare_state(p)
+                params.append(p)
 
-                state = self.state[p]
-                grad_shape = grad.shape
+            # params with the same shape are updated together
+            for group_params in group_params_for_update(params, self.state):
+                self._update_group(group, group_params)
 
-                factored = len(grad_shape) >= 2
-                # State Initialization
-                if len(state) == 0:
-                    self.initialize_state(p)
+        return loss
+
+    def _prepare_state(self, p):
+        state = self.state[p]
+        factored = len(p.shape) >= 2
+        # State Initialization
+        if len(state) == 0:
+            self.initialize_state(p)
+        else:
+            # Check if exp_avg_sq_row and exp_avg_sq_col exist for factored case
+            if factored:
+                if "exp_avg_sq_row" not in state or "exp_avg_sq_col" not in state:
+                    state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1]).to(p.device, dtype=torch.float32)
+                    state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:]).to(
+                        p.device, dtype=torch.float32)
                 else:
-                    # Check if exp_avg_sq_row and exp_avg_sq_col exist for factored case
-                    if factored:
-                        if "exp_avg_sq_row" not in state or "exp_avg_sq_col" not in state:
-                            state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1]).to(grad)
-                            state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:]).to(grad)
-                        else:
-                            state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(grad)
-                            state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(grad)
-                    # Check if exp_avg_sq exists for non-factored case
-                    else:
-                        if "exp_avg_sq" not in state:
-                            state["exp_avg_sq"] = torch.zeros_like(grad)
-                        else:
-                            state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
-
-                p_data_fp32 = p
-
-                if isinstance(p_data_fp32, QBytesTensor):
-                    p_data_fp32 = p_data_fp32.dequantize()
-                if p.dtype != torch.float32:
-                    p_data_fp32 = p_data_fp32.clone().float()
-
-                # Initialize step if it doesn't exist
-                if "step" not in state:
-                    state["step"] = 0
-                state["step"] += 1
-                state["RMS"] = self._rms(p_data_fp32)
-
-                # Use fixed beta2 from group instead of decay_rate calculation
-                beta2 = group["beta2"]
-                eps = group["eps"]
-                if isinstance(eps, tuple) or isinstance(eps, list):
-                    eps = eps[0]
-                update = (grad**2) + eps
-                if factored:
-                    exp_avg_sq_row = state["exp_avg_sq_row"]
-                    exp_avg_sq_col = state["exp_avg_sq_col"]
-
-                    exp_avg_sq_row.mul_(beta2).add_(
-                        update.mean(dim=-1), alpha=(1.0 - beta2))
-                    exp_avg_sq_col.mul_(beta2).add_(
-                        update.mean(dim=-2), alpha=(1.0 - beta2))
-
-                    # Approximation of exponential moving average of square of gradient
-                    update = self._approx_sq_grad(
-                        exp_avg_sq_row, exp_avg_sq_col)
-                    update.mul_(grad)
+                    state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(p.device, dtype=torch.float32)
+                    state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(p.device, dtype=torch.float32)
+            # Check if exp_avg_sq exists for non-factored case
+            else:
+                if "exp_avg_sq" not in state:
+                    state["exp_avg_sq"] = torch.zeros(p.shape, device=p.device, dtype=torch.float32)
                 else:
-                    exp_avg_sq = state["exp_avg_sq"]
-
-                    exp_avg_sq.mul_(beta2).add_(update, alpha=(1.0 - beta2))
-                    update = exp_avg_sq.rsqrt().mul_(grad)
-
-                update.div_(
-                    (self._rms(update) / group["clip_threshold"]).clamp_(min=1.0))
-
-                # Ensure state is properly initialized
-                if 'last_polarity' not in state or 'lr_mask' not in state:
-                    self.initialize_state(p)
-                
-                # Get signs of current last update and updates
-                last_polarity = state['last_polarity']
-                current_polarity = (update > 0).to(torch.bool)
-                sign_agreement = torch.where(
-                    last_polarity == current_polarity, 1, -1)
-                state['last_polarity'] = current_polarity
-
-                lr_mask = state['lr_mask'].to(torch.float32)
-
-                # Update learning rate mask based on sign agreement
-                new_lr = torch.where(
-                    sign_agreement > 0,
-                    lr_mask + self.lr_bump,  # Increase lr
-                    lr_mask - self.lr_bump  # Decrease lr
-                )
-
-                # Clip learning rates to bounds
-                new_lr = torch.clamp(
-                    new_lr,
-                    min=self.min_lr,
-                    max=self.max_lr
-                )
-
-                # Apply the learning rate mask to the update
-                update.mul_(new_lr)
-
-                state['lr_mask'] = Auto8bitTensor(new_lr)
-                state['avg_lr'] = torch.mean(new_lr)
-
-                if group["weight_decay"] != 0:
-                    # Apply weight decay with per-parameter learning rates
-                    # Instead of using add_ with a tensor alpha (which isn't supported),
-                    # we'll use element-wise multiplication to apply the weight decay
-                    weight_decay_update = p_data_fp32 * (-group["weight_decay"]) * new_lr
-                    p_data_fp32.add_(weight_decay_update)
-
-                p_data_fp32.add_(-update)
+                    state["exp_avg_sq"] = state["exp_avg_sq"].to(p.device, dtype=torch.float32)
+        # Ensure state is properly initialized
+        if 'last_polarity' not in state or 'lr_mask' not in state:
+            self.initialize_state(p)
+        if not isinstance(state['lr_mask'], BlockwiseInt8Tensor):
+            # per tensor masks from older checkpoints are requantized into blocks
+            state['lr_mask'] = BlockwiseInt8Tensor(state['lr_mask'].state_dict())
+        # Initialize step if it doesn't exist
+        if "step" not in state:
+            state["step"] = 0
+
+    def _update_group(self, group, params):
+        # every tensor here is a stack of the group's params, [n, *shape]
+        states = [self.state[p] for p in params]
+        num = len(params)
+
+        grad = torch.stack([p.grad.to(torch.float32) for p in params])
+        is_fp32 = params[0].dtype == torch.float32 and not isinstance(params[0], QBytesTensor)
+        p_data_fp32 = torch.stack([
+            (p.dequantize() if isinstance(p, QBytesTensor) else p.data).to(torch.float32) for p in params
+        ])
+
+        for state in states:
+            state["step"] += 1
+        rms = self._rms_stack(p_data_fp32)
+        factored = p_data_fp32.dim() >= 3
+
+        # Use fixed beta2 from group instead of decay_rate calculation
+        beta2 = group["beta2"]
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grad**2) + eps
+        if factored:
+            exp_avg_sq_row = torch.stack([state["exp_avg_sq_row"] for state in states]).to(torch.float32)
+            exp_avg_sq_col = torch.stack([state["exp_avg_sq_col"] for state in states]).to(torch.float32)
+
+            exp_avg_sq_row.mul_(beta2).add_(
+                update.mean(dim=-1), alpha=(1.0 - beta2))
+            exp_avg_sq_col.mul_(beta2).add_(
+                update.mean(dim=-2), alpha=(1.0 - beta2))
+
+            # Approximation of exponential moving average of square of gradient
+            update = self._approx_sq_grad(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grad)
+        else:
+            exp_avg_sq = torch.stack([state["exp_avg_sq"] for state in states]).to(torch.float32)
+
+            exp_avg_sq.mul_(beta2).add_(update, alpha=(1.0 - beta2))
+            update = exp_avg_sq.rsqrt().mul_(grad)
+        del grad
+
+        clip = (self._rms_stack(update) / group["clip_threshold"]).clamp_(min=1.0)
+        update.div_(clip.view(num, *([1] * (update.dim() - 1))))
+
+        # Get signs of current last update and updates
+        last_polarity = torch.stack([state['last_polarity'] for state in states])
+        current_polarity = (update > 0).to(torch.bool)
+        sign_agreement = last_polarity == current_polarity
+
+        lr_mask = dequantize_group([state['lr_mask'] for state in states])
+
+        # Update learning rate mask based on sign agreement
+        new_lr = torch.where(
+            sign_agreement,
+            lr_mask + self.lr_bump,  # Increase lr
+            lr_mask - self.lr_bump  # Decrease lr
+        )
+        del lr_mask, last_polarity, sign_agreement
+
+        # Clip learning rates to bounds
+        new_lr.clamp_(min=self.min_lr, max=self.max_lr)
+
+        # Apply the learning rate mask to the update
+        update.mul_(new_lr)
+        avg_lr = new_lr.reshape(num, -1).mean(dim=1)
+
+        if group["weight_decay"] != 0:
+            # Apply weight decay with per-parameter learning rates
+            p_data_fp32.addcmul_(p_data_fp32, new_lr, value=-group["weight_decay"])
+
+        p_data_fp32.add_(-update)
+        del update
+
+        # the stacked results are handed back to the params as views
+        new_lr_masks = quantize_group(new_lr, torch.float32)
+        for i, state in enumerate(states):
+            state["RMS"] = rms[i]
+            state['last_polarity'] = current_polarity[i]
+            state['lr_mask'] = new_lr_masks[i]
+            state['avg_lr'] = avg_lr[i]
+            if factored:
+                state["exp_avg_sq_row"] = exp_avg_sq_row[i]
+                state["exp_avg_sq_col"] = exp_avg_sq_col[i]
+            else:
+                state["exp_avg_sq"] = exp_avg_sq[i]
 
-                if p.dtype != torch.float32:
-                    # apply stochastic rounding
-                    copy_stochastic(p, p_data_fp32)
+        for i, p in enumerate(params):
+            if is_fp32:
+                p.data.copy_(p_data_fp32[i])
+            else:
+                # apply stochastic rounding
+                copy_stochastic(p, p_data_fp32[i])
 
-        return loss
     
     def initialize_state(self, p):
         state = self.state[p]
@@ -292,7 +319,7 @@ class Automagic(torch.optim.Optimizer):
 
         # store the lr mask
         if 'lr_mask' not in state:
-            state['lr_mask'] = Auto8bitTensor(torch.ones(
+            state['lr_mask'] = BlockwiseInt8Tensor(torch.ones(
                 p.shape).to(p.device, dtype=torch.float32) * self.lr
             )
         state['avg_lr'] = torch.mean(
@@ -402,22 +429,24 @@ class Automagic(torch.optim.Optimizer):
             # Load the lr_mask from the saved state
             saved_lr_mask = saved_state['lr_mask']
             
-            # Reconstruct the Auto8bitTensor from its state dict
+            # Reconstruct the lr mask from its state dict, per tensor masks from older
+            # checkpoints are requantized into blocks
             try:
+                saved_shape = load_8bit_tensor(saved_lr_mask).shape if 'quantized' in saved_lr_mask else None
                 # Make sure the shapes match
-                if 'quantized' in saved_lr_mask and saved_lr_mask['quantized'].shape == current_param.shape:
-                    current_state['lr_mask'] = Auto8bitTensor(saved_lr_mask)
+                if saved_shape == current_param.shape:
+                    current_state['lr_mask'] = BlockwiseInt8Tensor(saved_lr_mask)
                 else:
                     print(f"WARNING: Shape mismatch for parameter {i}. "
-                          f"Expected {current_param.shape}, got {saved_lr_mask['quantized'].shape if 'quantized' in saved_lr_mask else 'unknown'}. "
+                          f"Expected {current_param.shape}, got {saved_shape if saved_shape is not None else 'unknown'}. "
                           f"Initializing new lr_mask.")
                     # Initialize a new lr_mask
-                    current_state['lr_mask'] = Auto8bitTensor(torch.ones(
+                    current_state['lr_mask'] = BlockwiseInt8Tensor(torch.ones(
                         current_param.shape).to(current_param.device, dtype=torch.float32) * self.lr
                     )
             except Exception as e:
                 print(f"ERROR: Failed to load lr_mask for parameter {i}: {e}")
                 # Initialize a new lr_mask
-                current_state['lr_mask'] = Auto8bitTensor(torch.ones(
+                current_state['lr_mask'] = BlockwiseInt8Tensor(torch.ones(
                     current_param.shape).to(current_param.device, dtype=torch.float32) * self.lr
                 )
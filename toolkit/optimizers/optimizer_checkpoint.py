@@ -0,0 +1,328 @@
+import json
+import os
+import shutil
+from collections import OrderedDict, defaultdict
+from typing import Dict, Union
+
+import torch
+
+from toolkit.delta_checkpoint import DeltaFileReader, DeltaSave
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor, load_8bit_tensor
+from toolkit.saving import DEFAULT_MAX_SHARD_SIZE, save_sharded_safetensors
+
+# Optimizer state saved as safetensors shards plus a json file describing every state entry.
+#   optimizer_state/
+#       optimizer_state.json                 param groups and a descriptor per state entry
+#       optimizer.safetensors                or numbered shards + optimizer.safetensors.index.json
+# On load only the param groups are restored up front. The tensors stay memory mapped and each
+# param's state is read and placed on its device the first time the optimizer touches it.
+# Optimizers with their own load_state_dict get the whole state dict in the format it was saved in.
+# With delta checkpoints the shards of a delta save are stored against optimizer_state_base, hard
+# links to the state written with the last full snapshot.
+
+OPTIMIZER_STATE_FOLDER = 'optimizer_state'
+OPTIMIZER_STATE_BASE_FOLDER = 'optimizer_state_base'
+OPTIMIZER_STATE_META_FILE = 'optimizer_state.json'
+OPTIMIZER_WEIGHTS_NAME = 'optimizer.safetensors'
+
+
+def _dtype_from_string(dtype_str: str) -> torch.dtype:
+    return getattr(torch, dtype_str.replace('torch.', ''))
+
+
+def _describe_auto8bit(auto8bit_state: dict, tensor_name: str, fmt: str, tensors: 'OrderedDict') -> dict:
+    tensors[tensor_name] = auto8bit_state['quantized']
+    desc = {
+        'type': 'auto8bit',
+        'format': fmt,
+        'name': tensor_name,
+        'orig_dtype': str(auto8bit_state['orig_dtype']),
+    }
+    scale = auto8bit_state['scale']
+    if isinstance(scale, torch.Tensor):
+        tensors[f"{tensor_name}.scale"] = scale
+        desc['scale_name'] = f"{tensor_name}.scale"
+    else:
+        desc['scale'] = float(scale)
+    # any extra fields, such as block sizes, are plain values
+    for key, value in auto8bit_state.items():
+        if key not in ['quantized', 'scale', 'orig_dtype']:
+            desc.setdefault('extra', {})[key] = value
+    return desc
+
+
+def _describe_state_value(value, tensor_name: str, tensors: 'OrderedDict') -> dict:
+    if isinstance(value, torch.Tensor):
+        tensors[tensor_name] = value
+        return {'type': 'tensor', 'name': tensor_name}
+    if isinstance(value, Auto8bitTensor):
+        # Prodigy8bit keeps the objects in its state dict
+        return _describe_auto8bit(value.state_dict(), tensor_name, 'object', tensors)
+    if isinstance(value, dict) and value.get('_type') == 'Auto8bitTensor':
+        # Adam8bit state dict format
+        return _describe_auto8bit(value['state'], tensor_name, 'wrapped', tensors)
+    if isinstance(value, dict) and 'quantized' in value and 'scale' in value and 'orig_dtype' in value:
+        # Automagic lr_mask format
+        return _describe_auto8bit(value, tensor_name, 'dict', tensors)
+    # plain python values like step counts
+    json.dumps(value)
+    return {'type': 'value', 'value': value}
+
+
+def save_optimizer_state_sharded(
+        optimizer_state_dict: dict,
+        save_root: str,
+        max_shard_size: Union[int, str] = DEFAULT_MAX_SHARD_SIZE,
+        as_delta: bool = False
+) -> str:
+    """
+    Saves an optimizer state dict as safetensors shards in save_root/optimizer_state.
+    Raises TypeError / ValueError if the state holds something that cannot be described,
+    in which case the caller should fall back to torch.save. With as_delta the shards are
+    written as deltas against save_root/optimizer_state_base if it exists.
+    """
+    tensors = OrderedDict()
+    state_desc = OrderedDict()
+    for param_id, param_state in optimizer_state_dict['state'].items():
+        param_desc = OrderedDict()
+        for key, value in param_state.items():
+            param_desc[key] = _describe_state_value(value, f"state.{param_id}.{key}", tensors)
+        state_desc[str(param_id)] = param_desc
+
+    meta = {
+        'param_groups': optimizer_state_dict['param_groups'],
+        'state': state_desc,
+    }
+    # validate before writing anything
+    meta_string = json.dumps(meta)
+
+    folder = os.path.join(save_root, OPTIMIZER_STATE_FOLDER)
+    tmp_folder = folder + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    def iter_tensors():
+        # moved to cpu one tensor at a time as the shards are written
+        for name, tensor in tensors.items():
+            yield name, tensor.detach().to('cpu').contiguous()
+
+    base_folder = os.path.join(save_root, OPTIMIZER_STATE_BASE_FOLDER)
+    if as_delta and os.path.exists(base_folder):
+        with DeltaSave(tmp_folder, base_folder):
+            save_sharded_safetensors(
+                iter_tensors(),
+                tmp_folder,
+                weights_name=OPTIMIZER_WEIGHTS_NAME,
+                max_shard_size=max_shard_size,
+                metadata={'format': 'pt'},
+            )
+    else:
+        save_sharded_safetensors(
+            iter_tensors(),
+            tmp_folder,
+            weights_name=OPTIMIZER_WEIGHTS_NAME,
+            max_shard_size=max_shard_size,
+            metadata={'format': 'pt'},
+        )
+    with open(os.path.join(tmp_folder, OPTIMIZER_STATE_META_FILE), 'w') as f:
+        f.write(meta_string)
+
+    # swap in the new state
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+    return folder
+
+
+def keep_optimizer_state_as_delta_base(save_root: str):
+    """Keeps the current optimizer state as the base later delta saves are written against"""
+    folder = os.path.join(save_root, OPTIMIZER_STATE_FOLDER)
+    base_folder = os.path.join(save_root, OPTIMIZER_STATE_BASE_FOLDER)
+    if os.path.exists(base_folder):
+        shutil.rmtree(base_folder)
+    os.makedirs(base_folder)
+    for filename in os.listdir(folder):
+        src = os.path.join(folder, filename)
+        dst = os.path.join(base_folder, filename)
+        try:
+            # the next save replaces the folder rather than writing into the files, so links are safe
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+def has_sharded_optimizer_state(save_root: str) -> bool:
+    return os.path.exists(os.path.join(save_root, OPTIMIZER_STATE_FOLDER, OPTIMIZER_STATE_META_FILE))
+
+
+class _ShardReader:
+    # keeps the shards memory mapped and reads single tensors on demand, decoding delta saves
+    def __init__(self, folder: str):
+        self.folder = folder
+        index_path = os.path.join(folder, f"{OPTIMIZER_WEIGHTS_NAME}.index.json")
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self.weight_map = json.load(f)['weight_map']
+        else:
+            self.weight_map = None
+        self.handles = {}
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        filename = OPTIMIZER_WEIGHTS_NAME if self.weight_map is None else self.weight_map[name]
+        if filename not in self.handles:
+            self.handles[filename] = DeltaFileReader(os.path.join(self.folder, filename))
+        return self.handles[filename].get_tensor(name)
+
+
+def _load_auto8bit_state(reader: _ShardReader, desc: dict, device) -> dict:
+    auto8bit_state = {
+        'quantized': reader.get_tensor(desc['name']).to(device),
+        'orig_dtype': _dtype_from_string(desc['orig_dtype']),
+    }
+    if 'scale_name' in desc:
+        auto8bit_state['scale'] = reader.get_tensor(desc['scale_name']).to(device)
+    else:
+        auto8bit_state['scale'] = desc['scale']
+    auto8bit_state.update(desc.get('extra', {}))
+    return auto8bit_state
+
+
+def _load_saved_value(reader: _ShardReader, desc: dict, device):
+    # rebuilds a state value in the format the optimizer's state_dict returned it in
+    if desc['type'] == 'value':
+        return desc['value']
+    if desc['type'] == 'tensor':
+        return reader.get_tensor(desc['name']).to(device)
+    if desc['type'] == 'auto8bit':
+        auto8bit_state = _load_auto8bit_state(reader, desc, device)
+        if desc['format'] == 'object':
+            return load_8bit_tensor(auto8bit_state)
+        if desc['format'] == 'wrapped':
+            return {'_type': 'Auto8bitTensor', 'state': auto8bit_state}
+        return auto8bit_state
+    raise ValueError(f"Unknown optimizer state type {desc['type']}")
+
+
+class LazyOptimizerState(defaultdict):
+    """
+    Drop in for optimizer.state. Saved states are only read from the memory mapped shards
+    and moved to the device the first time the param is looked up.
+    """
+
+    def __init__(self, reader: _ShardReader, pending: Dict[torch.Tensor, dict]):
+        super().__init__(dict)
+        self.reader = reader
+        self.pending = pending
+
+    def _load_value(self, param: torch.Tensor, key: str, desc: dict):
+        if desc['type'] == 'value':
+            return desc['value']
+        if desc['type'] == 'tensor':
+            value = self.reader.get_tensor(desc['name'])
+            if key == 'step':
+                # torch keeps step on the cpu unless capturable or fused
+                return value
+            # same as torch.optim.Optimizer.load_state_dict, floating point state follows the param dtype
+            if param.is_floating_point() and value.is_floating_point():
+                return value.to(device=param.device, dtype=param.dtype)
+            return value.to(param.device)
+        if desc['type'] == 'auto8bit':
+            # the live state of all the 8bit optimizers holds Auto8bitTensor objects
+            return load_8bit_tensor(_load_auto8bit_state(self.reader, desc, param.device))
+        raise ValueError(f"Unknown optimizer state type {desc['type']}")
+
+    def _materialize(self, param: torch.Tensor) -> dict:
+        param_desc = self.pending.pop(param)
+        state = {key: self._load_value(param, key, desc) for key, desc in param_desc.items()}
+        super().__setitem__(param, state)
+        return state
+
+    def materialize_all(self):
+        for param in list(self.pending.keys()):
+            self._materialize(param)
+
+    def __missing__(self, key):
+        if key in self.pending:
+            return self._materialize(key)
+        return super().__missing__(key)
+
+    def __contains__(self, key):
+        return key in self.pending or super().__contains__(key)
+
+    def __len__(self):
+        return len(self.pending) + super().__len__()
+
+    def __iter__(self):
+        self.materialize_all()
+        return super().__iter__()
+
+    def keys(self):
+        self.materialize_all()
+        return super().keys()
+
+    def values(self):
+        self.materialize_all()
+        return super().values()
+
+    def items(self):
+        # state_dict() walks items, so everything is loaded before saving
+        self.materialize_all()
+        return super().items()
+
+    def get(self, key, default=None):
+        if key in self.pending:
+            return self._materialize(key)
+        return super().get(key, default)
+
+
+def load_optimizer_state_sharded(optimizer: torch.optim.Optimizer, save_root: str):
+    """
+    Restores the param groups of an optimizer saved with save_optimizer_state_sharded and
+    installs a LazyOptimizerState so per param state is only loaded when it is first used.
+    Params are matched to the saved ids by their order in the param groups, like torch does.
+    Optimizers that override load_state_dict are loaded through it instead, all at once.
+    """
+    folder = os.path.join(save_root, OPTIMIZER_STATE_FOLDER)
+    with open(os.path.join(folder, OPTIMIZER_STATE_META_FILE), 'r') as f:
+        meta = json.load(f)
+    reader = _ShardReader(folder)
+    saved_groups = meta['param_groups']
+
+    if type(optimizer).load_state_dict is not torch.optim.Optimizer.load_state_dict:
+        # Adam8bit rebuilds its blockwise states and Automagic tolerates a changed param list in their
+        # own load_state_dict, so they get the full state dict. Nothing is loaded lazily for them
+        id_to_device = {}
+        for saved_group, group in zip(saved_groups, optimizer.param_groups):
+            for saved_id, param in zip(saved_group['params'], group['params']):
+                id_to_device[str(saved_id)] = param.device
+        state = {}
+        for saved_id, param_desc in meta['state'].items():
+            device = id_to_device.get(saved_id, 'cpu')
+            param_id = int(saved_id) if saved_id.isdigit() else saved_id
+            state[param_id] = {
+                key: _load_saved_value(reader, desc, 'cpu' if key == 'step' else device)
+                for key, desc in param_desc.items()
+            }
+        optimizer.load_state_dict({'state': state, 'param_groups': saved_groups})
+        return optimizer
+
+    if len(saved_groups) != len(optimizer.param_groups):
+        raise ValueError("Loaded optimizer state has a different number of parameter groups")
+    id_to_param = {}
+    for saved_group, group in zip(saved_groups, optimizer.param_groups):
+        if len(saved_group['params']) != len(group['params']):
+            raise ValueError("Loaded optimizer state has a different number of parameters in a group")
+        for saved_id, param in zip(saved_group['params'], group['params']):
+            id_to_param[str(saved_id)] = param
+
+    # restore the group settings without touching the state, which is rebuilt lazily below
+    torch.optim.Optimizer.load_state_dict(optimizer, {'state': {}, 'param_groups': saved_groups})
+
+    pending = {}
+    for saved_id, param_desc in meta['state'].items():
+        if saved_id in id_to_param:
+            pending[id_to_param[saved_id]] = param_desc
+
+    optimizer.state = LazyOptimizerState(reader, pending)
+    return optimizer
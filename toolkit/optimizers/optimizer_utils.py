@@ -1,6 +1,7 @@
+import math
 import torch
 from torch import Tensor
-from typing import Optional
+from typing import Dict, Hashable, List, Optional, Tuple
 from optimum.quanto import QBytesTensor
 
 
@@ -211,10 +212,155 @@ class Auto8bitTensor:
         self.scale = state_dict['scale']
         self.orig_dtype = state_dict['orig_dtype']
 
+    @property
+    def shape(self) -> torch.Size:
+        return self.quantized.shape
+
     def __str__(self):
         return f"Auto8bitTensor({self.dequantize()})"
 
 
+# elements that share one scale in BlockwiseInt8Tensor
+DEFAULT_BLOCK_SIZE = 256
+# max elements updated at once by the grouped optimizer steps, bounds the fp32 working memory
+MAX_GROUP_NUMEL = 2 ** 24
+
+
+def quantize_blockwise(data: Tensor, block_size: int = DEFAULT_BLOCK_SIZE) -> Tuple[Tensor, Tensor]:
+    """
+    Quantizes a stack of tensors [n, ...] to int8 with one absmax scale per block of block_size elements.
+    Returns int8 [n, num_blocks * block_size] (zero padded) and float32 scales [n, num_blocks].
+    Nothing leaves the device, so there is no sync.
+    """
+    flat = data.reshape(data.shape[0], -1).to(torch.float32)
+    numel = flat.shape[1]
+    num_blocks = max(1, math.ceil(numel / block_size))
+    padding = num_blocks * block_size - numel
+    if padding > 0:
+        flat = torch.nn.functional.pad(flat, (0, padding))
+    blocks = flat.view(flat.shape[0], num_blocks, block_size)
+    scale = blocks.abs().amax(dim=-1).div_(127.0)
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    quantized = blocks.div(scale.unsqueeze(-1)).round_().clamp_(-127, 127).to(torch.int8)
+    return quantized.view(flat.shape[0], -1), scale
+
+
+def dequantize_blockwise(quantized: Tensor, scale: Tensor, shape: torch.Size) -> Tensor:
+    """Inverse of quantize_blockwise, returns float32 [n, *shape]"""
+    num = quantized.shape[0]
+    blocks = quantized.view(num, scale.shape[-1], -1).to(torch.float32).mul_(scale.unsqueeze(-1))
+    numel = math.prod(shape)
+    return blocks.view(num, -1)[:, :numel].reshape(num, *shape)
+
+
+class BlockwiseInt8Tensor(Auto8bitTensor):
+    """
+    8bit state with one scale per block of elements instead of one per tensor. The scales stay a tensor,
+    so quantizing never calls .item(), and outliers only cost precision within their own block.
+    Can be built from the state dict of an Auto8bitTensor, which is requantized into blocks.
+    """
+
+    def __init__(self, data: Tensor, block_size: int = DEFAULT_BLOCK_SIZE):
+        if isinstance(data, dict):
+            self._load_from_state_dict(data)
+        else:
+            quantized, scale = quantize_blockwise(data.unsqueeze(0), block_size)
+            self.quantized = quantized[0]
+            self.scale = scale[0]
+            self.orig_dtype = data.dtype
+            self.block_size = block_size
+            self._shape = data.shape
+
+    @classmethod
+    def from_blocks(cls, quantized: Tensor, scale: Tensor, orig_dtype: torch.dtype, shape: torch.Size,
+                    block_size: int) -> 'BlockwiseInt8Tensor':
+        tensor = cls.__new__(cls)
+        tensor.quantized = quantized
+        tensor.scale = scale
+        tensor.orig_dtype = orig_dtype
+        tensor.block_size = block_size
+        tensor._shape = torch.Size(shape)
+        return tensor
+
+    @property
+    def shape(self) -> torch.Size:
+        return self._shape
+
+    def dequantize(self) -> Tensor:
+        return dequantize_blockwise(self.quantized.unsqueeze(0), self.scale.unsqueeze(0), self._shape)[0]
+
+    def state_dict(self):
+        return {
+            'quantized': self.quantized,
+            'scale': self.scale,
+            'orig_dtype': self.orig_dtype,
+            'block_size': self.block_size,
+            'shape': list(self._shape),
+        }
+
+    def _load_from_state_dict(self, state_dict):
+        if 'block_size' not in state_dict:
+            # per tensor Auto8bitTensor state from older checkpoints
+            legacy = Auto8bitTensor(state_dict)
+            self.__init__(legacy.dequantize().to(legacy.quantized.device))
+            self.orig_dtype = legacy.orig_dtype
+            return
+        self.quantized = state_dict['quantized']
+        # torch casts floating point state to the param dtype on load
+        self.scale = state_dict['scale'].to(torch.float32)
+        self.orig_dtype = state_dict['orig_dtype']
+        self.block_size = state_dict['block_size']
+        self._shape = torch.Size(state_dict['shape'])
+
+    def __str__(self):
+        return f"BlockwiseInt8Tensor({self.dequantize()})"
+
+
+def dequantize_group(tensors: List[BlockwiseInt8Tensor]) -> Tensor:
+    """Dequantizes same shape states in one op, returns float32 [n, *shape]"""
+    first = tensors[0]
+    if len(tensors) == 1:
+        return first.dequantize().unsqueeze(0)
+    quantized = torch.stack([t.quantized for t in tensors])
+    scale = torch.stack([t.scale for t in tensors])
+    return dequantize_blockwise(quantized, scale, first.shape)
+
+
+def quantize_group(data: Tensor, orig_dtype: torch.dtype,
+                   block_size: int = DEFAULT_BLOCK_SIZE) -> List[BlockwiseInt8Tensor]:
+    """Quantizes a stack [n, *shape] in one op. The results are views into shared storage"""
+    quantized, scale = quantize_blockwise(data, block_size)
+    return [
+        BlockwiseInt8Tensor.from_blocks(quantized[i], scale[i], orig_dtype, data.shape[1:], block_size)
+        for i in range(data.shape[0])
+    ]
+
+
+def load_8bit_tensor(state_dict: dict) -> Auto8bitTensor:
+    """Rebuilds an 8bit state from its state dict, picking the class it was saved from"""
+    if 'block_size' in state_dict:
+        return BlockwiseInt8Tensor(state_dict)
+    return Auto8bitTensor(state_dict)
+
+
+def group_params_for_update(params: List[Tensor], state: dict,
+                            max_group_numel: int = MAX_GROUP_NUMEL) -> List[List[Tensor]]:
+    """
+    Splits params into groups that can be updated together with multi tensor ops. Params in a group
+    share device, dtype, shape and step count, and a group holds at most max_group_numel elements.
+    """
+    groups: Dict[Hashable, List[Tensor]] = {}
+    for p in params:
+        key = (p.device, p.dtype, tuple(p.shape), state[p].get('step', 0))
+        groups.setdefault(key, []).append(p)
+    chunks = []
+    for group in groups.values():
+        chunk_size = max(1, max_group_numel // max(1, group[0].numel()))
+        for i in range(0, len(group), chunk_size):
+            chunks.append(group[i:i + chunk_size])
+    return chunks
+
+
 def stochastic_grad_accummulation(param):
     if hasattr(param, "_accum_grad"):
         grad_fp32 = param._accum_grad.clone().to(torch.float32)
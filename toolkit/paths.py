@@ -3,6 +3,12 @@ import os
 TOOLKIT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_ROOT = os.path.join(TOOLKIT_ROOT, 'config')
 KEYMAPS_ROOT = os.path.join(TOOLKIT_ROOT, "toolkit", "keymaps")
+# per user cache, next to the huggingface one by default
+USER_CACHE_ROOT = os.getenv(
+    "AI_TOOLKIT_CACHE",
+    os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "ai-toolkit")
+)
+KEYMAP_CACHE_ROOT = os.path.join(USER_CACHE_ROOT, "keymaps")
 ORIG_CONFIGS_ROOT = os.path.join(TOOLKIT_ROOT, "toolkit", "orig_configs")
 DIFFUSERS_CONFIGS_ROOT = os.path.join(TOOLKIT_ROOT, "toolkit", "diffusers_configs")
 COMFY_PATH = os.getenv("COMFY_PATH", None)
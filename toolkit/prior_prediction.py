@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+import torch
+
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+
+if TYPE_CHECKING:
+    from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+
+# Prior predictions are the no grad predictions of the model with the network and adapters disabled,
+# used by prior preservation, differential output preservation, inverted mask prior and friends. When
+# the gradient accumulation microbatches of a step are set up before any of them runs its own forward,
+# their prior requests are collected here and every group of compatible requests runs as one batched
+# forward. Results are kept for the whole step keyed by (latents, timesteps, embeds), so a request that
+# is made twice is only computed once.
+
+
+def _get_tensor_key(tensor: Optional[torch.Tensor]):
+    if tensor is None:
+        return None
+    try:
+        version = tensor._version
+    except RuntimeError:
+        version = None
+    # identity, not content, so building the key never syncs with the device
+    return tensor.data_ptr(), version, tuple(tensor.shape), tensor.dtype, str(tensor.device)
+
+
+def _as_list(value) -> list:
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _get_embeds_tensors(embeds: PromptEmbeds) -> list:
+    return [*_as_list(embeds.text_embeds), embeds.pooled_embeds, *_as_list(embeds.attention_mask)]
+
+
+def _get_shape(tensor: Optional[torch.Tensor]):
+    if tensor is None:
+        return None
+    return tuple(tensor.shape[1:]), tensor.dtype, str(tensor.device)
+
+
+class PriorPredictionRequest:
+    def __init__(
+            self,
+            noisy_latents: torch.Tensor,
+            timesteps: torch.Tensor,
+            conditional_embeds: PromptEmbeds,
+            batch: 'DataLoaderBatchDTO',
+    ):
+        self.noisy_latents = noisy_latents
+        self.timesteps = timesteps
+        self.conditional_embeds = conditional_embeds
+        self.batch = batch
+        self.key = (
+            _get_tensor_key(noisy_latents),
+            _get_tensor_key(timesteps),
+            tuple(_get_tensor_key(t) for t in _get_embeds_tensors(conditional_embeds)),
+        )
+        # requests can share a forward when everything but the batch dimension matches
+        self.group_key = (
+            _get_shape(noisy_latents),
+            _get_shape(timesteps),
+            tuple(_get_shape(t) for t in _get_embeds_tensors(conditional_embeds)),
+        )
+        if isinstance(conditional_embeds.attention_mask, (list, tuple)):
+            # concat_prompt_embeds cannot join per encoder masks, run on its own
+            self.group_key = self.key
+
+    @property
+    def batch_size(self) -> int:
+        return self.noisy_latents.shape[0]
+
+
+class PriorPredictionEngine:
+    def __init__(self):
+        # request key -> (request, prior prediction) for the current step. Holding the request keeps its
+        # tensors alive, so their memory cannot be reused by a new tensor with the same key
+        self.results = OrderedDict()
+        self.num_requests = 0
+        self.num_forwards = 0
+
+    def start_step(self):
+        self.results.clear()
+        self.num_requests = 0
+        self.num_forwards = 0
+
+    @property
+    def num_forwards_saved(self) -> int:
+        return self.num_requests - self.num_forwards
+
+    def predict(
+            self,
+            requests: List[PriorPredictionRequest],
+            predict_fn: Callable[[torch.Tensor, torch.Tensor, PromptEmbeds, 'DataLoaderBatchDTO'], torch.Tensor]
+    ) -> List[torch.Tensor]:
+        """
+        Prior prediction for every request. predict_fn(noisy_latents, timesteps, conditional_embeds, batch)
+        runs one forward, it gets the batch of the first request in a group so the requests must not depend
+        on their batch beyond the tensors passed in.
+        """
+        self.num_requests += len(requests)
+        groups = OrderedDict()
+        for request in requests:
+            if request.key in self.results:
+                continue
+            group = groups.setdefault(request.group_key, OrderedDict())
+            group.setdefault(request.key, request)
+
+        for group in groups.values():
+            group_requests = list(group.values())
+            if len(group_requests) == 1:
+                request = group_requests[0]
+                prior_pred = predict_fn(request.noisy_latents, request.timesteps, request.conditional_embeds, request.batch)
+                self.results[request.key] = (request, prior_pred.detach())
+            else:
+                prior_pred = predict_fn(
+                    torch.cat([request.noisy_latents for request in group_requests], dim=0),
+                    torch.cat([request.timesteps.flatten() for request in group_requests], dim=0),
+                    concat_prompt_embeds([request.conditional_embeds for request in group_requests]),
+                    group_requests[0].batch,
+                )
+                split_sizes = [request.batch_size for request in group_requests]
+                for request, pred in zip(group_requests, torch.split(prior_pred.detach(), split_sizes, dim=0)):
+                    self.results[request.key] = (request, pred)
+            self.num_forwards += 1
+
+        return [self.results[request.key][1] for request in requests]
@@ -5,6 +5,7 @@ from diffusers import FlowMatchEulerDiscreteScheduler
 import torch
 import numpy as np
 from toolkit.timestep_weighing.default_weighing_scheme import default_weighing_scheme
+from toolkit.samplers.timestep_index import TimestepIndex
 
 
 def calculate_shift(
@@ -54,33 +55,30 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
             self.linear_timesteps = timesteps
             self.linear_timesteps_weights = bsmntw_weighing
             self.linear_timesteps_weights2 = hbsmntw_weighing
+            self.default_weighing_scheme = torch.tensor(default_weighing_scheme, dtype=torch.float32)
             pass
 
+        # batched timestep to index lookups and per device copies of the sigmas and weights
+        self.timestep_index = TimestepIndex()
+
     def get_weights_for_timesteps(self, timesteps: torch.Tensor, v2=False, timestep_type="linear") -> torch.Tensor:
         # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item()
-                        for t in timesteps]
+        step_indices = self.timestep_index.get_indices(self.timesteps, timesteps)
 
         # Get the weights for the timesteps
         if timestep_type == "weighted":
-            weights = torch.tensor(
-                [default_weighing_scheme[i] for i in step_indices],
-                device=timesteps.device,
-                dtype=timesteps.dtype
-            )
-        if v2:
-            weights = self.linear_timesteps_weights2[step_indices].flatten()
+            name, weights = 'default_weighing_scheme', self.default_weighing_scheme
+        elif v2:
+            name, weights = 'linear_timesteps_weights2', self.linear_timesteps_weights2
         else:
-            weights = self.linear_timesteps_weights[step_indices].flatten()
+            name, weights = 'linear_timesteps_weights', self.linear_timesteps_weights
+        weights = self.timestep_index.get_table(name, weights, step_indices.device)
 
-        return weights
+        return weights[step_indices].flatten()
 
     def get_sigmas(self, timesteps: torch.Tensor, n_dim, dtype, device) -> torch.Tensor:
-        sigmas = self.sigmas.to(device=device, dtype=dtype)
-        schedule_timesteps = self.timesteps.to(device)
-        timesteps = timesteps.to(device)
-        step_indices = [(schedule_timesteps == t).nonzero().item()
-                        for t in timesteps]
+        sigmas = self.timestep_index.get_table('sigmas', self.sigmas, device, dtype)
+        step_indices = self.timestep_index.get_indices(self.timesteps, timesteps.to(device))
 
         sigma = sigmas[step_indices].flatten()
         while len(sigma.shape) < n_dim:
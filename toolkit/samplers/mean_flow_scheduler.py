@@ -2,6 +2,7 @@ from typing import Union
 from diffusers import FlowMatchEulerDiscreteScheduler
 import torch
 from toolkit.timestep_weighing.default_weighing_scheme import default_weighing_scheme
+from toolkit.samplers.timestep_index import TimestepIndex
 
 from dataclasses import dataclass
 from typing import Optional, Tuple
@@ -36,23 +37,25 @@ class MeanFlowScheduler(FlowMatchEulerDiscreteScheduler):
             timesteps = torch.linspace(1000, 1, num_timesteps, device="cpu")
 
             self.linear_timesteps = timesteps
+            self.default_weighing_scheme = torch.tensor(default_weighing_scheme, dtype=torch.float32)
             pass
 
+        self.timestep_index = TimestepIndex()
+
     def get_weights_for_timesteps(
         self, timesteps: torch.Tensor, v2=False, timestep_type="linear"
     ) -> torch.Tensor:
-        # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item() for t in timesteps]
-
         weights = 1.0
 
         # Get the weights for the timesteps
         if timestep_type == "weighted":
-            weights = torch.tensor(
-                [default_weighing_scheme[i] for i in step_indices],
-                device=timesteps.device,
-                dtype=timesteps.dtype,
-            )
+            step_indices = self.timestep_index.get_indices(self.timesteps, timesteps)
+            weights = self.timestep_index.get_table(
+                'default_weighing_scheme',
+                self.default_weighing_scheme,
+                step_indices.device,
+                timesteps.dtype
+            )[step_indices]
 
         return weights
 
@@ -0,0 +1,79 @@
+from typing import Optional
+
+import torch
+
+# Maps batches of timesteps to their index in a scheduler's timesteps without a host sync per sample.
+# The schedule is sorted once per device and searched with searchsorted. The nearest entry wins, so
+# timesteps that went through a lower precision dtype still find their step. Everything built from a
+# schedule is kept until the schedule tensor is replaced or modified in place, the trainer assigns
+# scheduler.timesteps and scheduler.sigmas directly.
+
+
+def _get_version(tensor: torch.Tensor) -> Optional[int]:
+    try:
+        return tensor._version
+    except RuntimeError:
+        # inference tensors have no version counter, they cannot be modified in place either
+        return None
+
+
+def sort_schedule(schedule: torch.Tensor, device) -> tuple:
+    """(ascending values, their index in schedule) for lookup_indices"""
+    values = schedule.detach().to(device=device, dtype=torch.float32).flatten()
+    return torch.sort(values, stable=True)
+
+
+def lookup_indices(values: torch.Tensor, order: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+    """Index of the nearest schedule entry for every timestep, on the device of the sorted schedule"""
+    timesteps = timesteps.detach().to(device=values.device, dtype=values.dtype).flatten()
+    if values.numel() == 1:
+        return torch.zeros_like(timesteps, dtype=torch.long)
+    # first entry >= t, then pick whichever neighbour is closer
+    pos = torch.searchsorted(values, timesteps).clamp_(1, values.numel() - 1)
+    closer_left = (timesteps - values[pos - 1]) <= (values[pos] - timesteps)
+    pos = pos - closer_left.long()
+    return order[pos]
+
+
+def get_timestep_indices(schedule: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+    """Uncached lookup for schedulers without a TimestepIndex"""
+    values, order = sort_schedule(schedule, timesteps.device)
+    return lookup_indices(values, order, timesteps)
+
+
+class TimestepIndex:
+    def __init__(self):
+        # key -> (source tensor, its version, value)
+        self._cache = {}
+
+    def _get_cached(self, key, source: torch.Tensor, build):
+        entry = self._cache.get(key)
+        version = _get_version(source)
+        if entry is not None and entry[0] is source and entry[1] == version:
+            return entry[2]
+        value = build()
+        self._cache[key] = (source, version, value)
+        return value
+
+    def get_indices(self, schedule: torch.Tensor, timesteps: torch.Tensor) -> torch.Tensor:
+        """Index into schedule for every timestep, on the device of timesteps"""
+        timesteps = torch.as_tensor(timesteps)
+        device = timesteps.device
+        values, order = self._get_cached(
+            ('index', str(device)),
+            schedule,
+            lambda: sort_schedule(schedule, device)
+        )
+        return lookup_indices(values, order, timesteps)
+
+    def get_table(self, name: str, source: torch.Tensor, device, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+        """source (sigmas, weights, ...) moved to device and dtype once"""
+        device = torch.device(device)
+        return self._get_cached(
+            (name, str(device), dtype),
+            source,
+            lambda: source.detach().to(device=device, dtype=dtype)
+        )
+
+    def clear(self):
+        self._cache.clear()
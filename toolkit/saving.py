@@ -1,17 +1,22 @@
 import json
 import os
+import re
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Literal, Optional, Union
+from typing import TYPE_CHECKING, Iterable, List, Literal, Optional, Tuple, Union
 
 import torch
 from safetensors.torch import load_file, save_file
 
+from toolkit.delta_checkpoint import get_active_delta_save
 from toolkit.train_tools import get_torch_dtype
 from toolkit.paths import KEYMAPS_ROOT
 
 if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
 
+# max size of a single weight shard when saving full models. Peak extra memory while saving is about one shard
+DEFAULT_MAX_SHARD_SIZE = "5GB"
+
 
 def get_slices_from_string(s: str) -> tuple:
     slice_strings = s.split(',')
@@ -152,6 +157,9 @@ def save_ldm_model_from_diffusers(
 
     # make sure parent folder exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    delta_save = get_active_delta_save()
+    if delta_save is not None:
+        converted_state_dict, meta = delta_save.encode(converted_state_dict, output_file, meta)
     save_file(converted_state_dict, output_file, metadata=meta)
 
 
@@ -328,3 +336,186 @@ def get_lora_keymap_from_model_keymap(model_keymap: 'OrderedDict') -> 'OrderedDi
         lora_keymap[f"{key}.alpha"] = f"{value}.alpha"
 
     return lora_keymap
+
+
+def parse_size_to_bytes(size: Union[int, str]) -> int:
+    # accepts ints or strings like "5GB", "500MB"
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper()
+    units = [('TB', 10 ** 12), ('GB', 10 ** 9), ('MB', 10 ** 6), ('KB', 10 ** 3), ('B', 1)]
+    for unit, multiplier in units:
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiplier)
+    return int(size)
+
+
+def iter_state_dict_for_save(
+        model: torch.nn.Module,
+        dtype: Optional[torch.dtype] = None,
+        device: Union[str, torch.device] = 'cpu'
+) -> Iterable[Tuple[str, torch.Tensor]]:
+    """
+    Yields the (key, tensor) pairs of a model state dict one at a time. Quantized models
+    patched with patch_dequantization_on_save are dequantized per tensor and everything is
+    cast and moved as it is yielded, so a full converted copy is never held in memory.
+    """
+    if hasattr(model, 'orig_state_dict'):
+        from toolkit.dequantize import iter_dequantized_state_dict
+        items = iter_dequantized_state_dict(model.orig_state_dict())
+    else:
+        items = model.state_dict().items()
+    for key, value in items:
+        value = value.detach()
+        if dtype is not None and value.is_floating_point():
+            value = value.to(device, dtype=dtype)
+        else:
+            value = value.to(device)
+        yield key, value.contiguous()
+
+
+def get_previous_save_files(save_directory: str, weights_name: str) -> List[str]:
+    """Files of an earlier save_sharded_safetensors of weights_name in save_directory"""
+    if not os.path.isdir(save_directory):
+        return []
+    base_name, ext = os.path.splitext(weights_name)
+    shard_pattern = re.compile(rf"{re.escape(base_name)}-\d{{5}}-of-\d{{5}}{re.escape(ext)}")
+    tmp_pattern = re.compile(rf"{re.escape(base_name)}-\d{{5}}{re.escape(ext)}\.tmp")
+    index_name = f"{weights_name}.index.json"
+
+    files = []
+    if os.path.exists(os.path.join(save_directory, weights_name)):
+        files.append(weights_name)
+    if os.path.exists(os.path.join(save_directory, index_name)):
+        files.append(index_name)
+        try:
+            with open(os.path.join(save_directory, index_name), 'r') as f:
+                weight_map = json.load(f).get('weight_map', {})
+        except (OSError, ValueError):
+            weight_map = {}
+        for filename in sorted(set(weight_map.values())):
+            if shard_pattern.fullmatch(filename) and os.path.exists(os.path.join(save_directory, filename)):
+                files.append(filename)
+    for filename in sorted(os.listdir(save_directory)):
+        if tmp_pattern.fullmatch(filename):
+            files.append(filename)
+    return files
+
+
+def save_sharded_safetensors(
+        state_dict_items: Iterable[Tuple[str, torch.Tensor]],
+        save_directory: str,
+        weights_name: str = 'diffusion_pytorch_model.safetensors',
+        max_shard_size: Union[int, str] = DEFAULT_MAX_SHARD_SIZE,
+        metadata: Optional[dict] = None,
+):
+    """
+    Writes tensors from an iterator into size limited safetensors shards as they come in.
+    Uses the same layout as huggingface save_pretrained, a single weights_name file if it
+    fits in one shard, otherwise numbered shards plus a weights_name.index.json weight map.
+    """
+    max_shard_bytes = parse_size_to_bytes(max_shard_size)
+    os.makedirs(save_directory, exist_ok=True)
+    base_name, ext = os.path.splitext(weights_name)
+
+    shard = OrderedDict()
+    shard_bytes = 0
+    shard_storages = set()
+    # list of (tmp_filename, keys)
+    written_shards = []
+    total_size = 0
+
+    def write_shard():
+        tmp_filename = f"{base_name}-{len(written_shards) + 1:05d}{ext}.tmp"
+        tmp_path = os.path.join(save_directory, tmp_filename)
+        shard_tensors, shard_metadata = shard, metadata
+        delta_save = get_active_delta_save()
+        if delta_save is not None:
+            # delta checkpoints are encoded here, the full shard is never written
+            shard_tensors, shard_metadata = delta_save.encode(shard, tmp_path, metadata)
+        save_file(shard_tensors, tmp_path, metadata=shard_metadata)
+        written_shards.append((tmp_filename, list(shard.keys())))
+
+    for key, tensor in state_dict_items:
+        tensor_bytes = tensor.numel() * tensor.element_size()
+        if len(shard) > 0 and shard_bytes + tensor_bytes > max_shard_bytes:
+            write_shard()
+            shard.clear()
+            shard_storages.clear()
+            shard_bytes = 0
+        if tensor.numel() > 0:
+            # safetensors refuses tensors that share memory (tied weights), give them their own copy
+            storage_ptr = tensor.untyped_storage().data_ptr()
+            if storage_ptr in shard_storages:
+                tensor = tensor.clone()
+                storage_ptr = tensor.untyped_storage().data_ptr()
+            shard_storages.add(storage_ptr)
+        shard[key] = tensor
+        shard_bytes += tensor_bytes
+        total_size += tensor_bytes
+
+    if len(shard) > 0 or len(written_shards) == 0:
+        write_shard()
+        shard.clear()
+
+    # remove the weights of a previous save with this name. Other files in the folder can share the base
+    # name, so only the shards the previous index lists are removed, and unfinished shards of a failed save
+    num_shards = len(written_shards)
+    tmp_filenames = [tmp_filename for tmp_filename, _ in written_shards]
+    for filename in get_previous_save_files(save_directory, weights_name):
+        if filename not in tmp_filenames:
+            os.remove(os.path.join(save_directory, filename))
+
+    if num_shards == 1:
+        os.replace(
+            os.path.join(save_directory, written_shards[0][0]),
+            os.path.join(save_directory, weights_name)
+        )
+        return
+
+    weight_map = OrderedDict()
+    for idx, (tmp_filename, keys) in enumerate(written_shards):
+        shard_filename = f"{base_name}-{idx + 1:05d}-of-{num_shards:05d}{ext}"
+        os.replace(
+            os.path.join(save_directory, tmp_filename),
+            os.path.join(save_directory, shard_filename)
+        )
+        for key in keys:
+            weight_map[key] = shard_filename
+
+    index = {
+        "metadata": {"total_size": total_size},
+        "weight_map": weight_map,
+    }
+    index_path = os.path.join(save_directory, f"{weights_name}.index.json")
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def save_pretrained_streaming(
+        model: torch.nn.Module,
+        save_directory: str,
+        max_shard_size: Union[int, str] = DEFAULT_MAX_SHARD_SIZE,
+        dtype: Optional[torch.dtype] = None,
+):
+    """
+    Drop in replacement for model.save_pretrained(save_directory, safe_serialization=True) that
+    streams the weights to size limited shards instead of building the full state dict first.
+    """
+    os.makedirs(save_directory, exist_ok=True)
+    weights_name = 'diffusion_pytorch_model.safetensors'
+    if hasattr(model, 'save_config'):
+        # diffusers model
+        model.save_config(save_directory)
+    elif hasattr(model, 'config') and hasattr(model.config, 'save_pretrained'):
+        # transformers model
+        model.config.save_pretrained(save_directory)
+        weights_name = 'model.safetensors'
+    save_sharded_safetensors(
+        iter_state_dict_for_save(model, dtype=dtype),
+        save_directory,
+        weights_name=weights_name,
+        max_shard_size=max_shard_size,
+        metadata={"format": "pt"},
+    )
@@ -36,7 +36,8 @@ from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, conca
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
-from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers
+from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers, \
+    save_pretrained_streaming, DEFAULT_MAX_SHARD_SIZE
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 from einops import rearrange, repeat
@@ -194,6 +195,8 @@ class StableDiffusion:
         self.use_text_encoder_2 = model_config.use_text_encoder_2
 
         self.config_file = None
+        # max size of each weight shard when saving the full model
+        self.max_shard_size = DEFAULT_MAX_SHARD_SIZE
 
         self.is_flow_matching = False
         if self.is_flux or self.is_v3 or self.is_auraflow or self.is_lumina2 or isinstance(self.noise_scheduler, CustomFlowMatchEulerDiscreteScheduler):
@@ -1411,6 +1414,9 @@ class StableDiffusion:
 
                     if network is not None:
                         network.multiplier = gen_config.network_multiplier
+                        if getattr(network, 'adapter_pool', None) is not None:
+                            # pick the checkpoint for this image from the pool
+                            network.adapter_pool.set_batch_adapters([gen_config.adapter], gen_config.network_multiplier)
                     torch.manual_seed(gen_config.seed)
                     torch.cuda.manual_seed(gen_config.seed)
                     
@@ -2770,16 +2776,18 @@ class StableDiffusion:
             if self.is_flux:
                 # only save the unet
                 transformer: FluxTransformer2DModel = unwrap_model(self.unet)
-                transformer.save_pretrained(
+                save_pretrained_streaming(
+                    transformer,
                     save_directory=os.path.join(output_file, 'transformer'),
-                    safe_serialization=True,
+                    max_shard_size=self.max_shard_size,
                 )
             elif self.is_lumina2:
                 # only save the unet
                 transformer: Lumina2Transformer2DModel = unwrap_model(self.unet)
-                transformer.save_pretrained(
+                save_pretrained_streaming(
+                    transformer,
                     save_directory=os.path.join(output_file, 'transformer'),
-                    safe_serialization=True,
+                    max_shard_size=self.max_shard_size,
                 )
                 
             else:
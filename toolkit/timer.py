@@ -1,81 +1,412 @@
+import json
+import threading
 import time
 from collections import OrderedDict, deque
 import sys
 import os
+from typing import List, Optional
 
 # check if is ui process will have IS_AI_TOOLKIT_UI in env
 is_ui = os.environ.get("IS_AI_TOOLKIT_UI", "0") == "1"
 
+# Timings of named spans of the train loop. Spans nest, a span started while another one is open is its
+# child. Wall time is taken with the monotonic perf_counter. Optionally every span also records cuda events
+# for its device time (resolved when the stats are read, so the host is not blocked), synchronizes the
+# device at its ends so the wall time covers the work it queued, and tracks the peak allocated device
+# memory while it was open. The peak counter is only reset when an outermost span starts. A nested span that
+# does not go past the peak reached before it started only knows what was allocated at its ends, which is
+# what it reports. Finished spans can be streamed to a Chrome trace (chrome://tracing, Perfetto)
+# or a JSONL file. A disabled timer does nothing but return from its calls.
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = (
+        'name', 'parent', 'step', 'thread', 'start_time', 'end_time', 'start_event', 'end_event', 'peak_memory',
+        'start_peak_memory'
+    )
+
+    def __init__(self, name: str, parent: Optional['_Span'], step: Optional[int]):
+        self.name = name
+        self.parent = parent
+        self.step = step
+        self.thread = threading.get_ident()
+        self.start_time = 0.0
+        self.end_time = 0.0
+        self.start_event = None
+        self.end_event = None
+        self.peak_memory = None
+        self.start_peak_memory = None
+
+    @property
+    def path(self) -> str:
+        if self.parent is None:
+            return self.name
+        return f"{self.parent.path}/{self.name}"
+
+    def get_device_time(self) -> Optional[float]:
+        if self.end_event is None:
+            return None
+        self.end_event.synchronize()
+        return self.start_event.elapsed_time(self.end_event) / 1000.0
+
+
+class _SpanContext:
+    __slots__ = ('timer', 'name')
+
+    def __init__(self, timer: 'Timer', name: str):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer.start(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # No exceptions, stop the timer normally
+            self.timer.stop(self.name)
+        else:
+            # There was an exception, cancel the timer
+            self.timer.cancel(self.name)
+        return False
+
+
+class SpanStats:
+    """Rolling stats of every span with the same name"""
+
+    def __init__(self, max_buffer: int, parent: Optional[str]):
+        # name of the span it was first opened in
+        self.parent = parent
+        self.times = deque(maxlen=max_buffer)
+        self.device_spans = deque(maxlen=max_buffer)
+        self.peak_memory = deque(maxlen=max_buffer)
+        # since the last reset
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, span: _Span):
+        elapsed_time = span.end_time - span.start_time
+        self.times.append(elapsed_time)
+        self.count += 1
+        self.total += elapsed_time
+        self.max = max(self.max, elapsed_time)
+        if span.end_event is not None:
+            self.device_spans.append(span)
+        if span.peak_memory is not None:
+            self.peak_memory.append(span.peak_memory)
+
+    @property
+    def avg(self) -> float:
+        return sum(self.times) / len(self.times)
+
+    @property
+    def device_avg(self) -> Optional[float]:
+        if len(self.device_spans) == 0:
+            return None
+        return sum(span.get_device_time() for span in self.device_spans) / len(self.device_spans)
+
+    @property
+    def peak_memory_max(self) -> Optional[int]:
+        if len(self.peak_memory) == 0:
+            return None
+        return max(self.peak_memory)
+
+
+class TraceWriter:
+    """
+    Streams finished spans to path. A .jsonl path gets one span per line, anything else a Chrome trace
+    as a JSON array. The trace format allows the array to be left open, so events are appended as they come
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.is_jsonl = path.endswith('.jsonl')
+        self.pid = os.getpid()
+        self.file = None
+
+    def write(self, events: List[dict]):
+        if len(events) == 0:
+            return
+        if self.file is None:
+            folder = os.path.dirname(self.path)
+            if folder != '':
+                os.makedirs(folder, exist_ok=True)
+            self.file = open(self.path, 'w')
+            if not self.is_jsonl:
+                self.file.write('[\n')
+        end = '\n' if self.is_jsonl else ',\n'
+        for event in events:
+            self.file.write(json.dumps(event) + end)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 class Timer:
-    def __init__(self, name='Timer', max_buffer=10):
+    def __init__(
+            self,
+            name='Timer',
+            max_buffer=10,
+            enabled: bool = True,
+            device_timing: bool = False,
+            sync: bool = False,
+            track_memory: bool = False,
+            trace_path: Optional[str] = None,
+            trace_buffer: int = 1000,
+    ):
         self.name = name
         self.max_buffer = max_buffer
+        self.enabled = enabled
+        # the cuda only options are dropped on machines without it
+        has_cuda = False
+        if enabled and (device_timing or sync or track_memory):
+            import torch
+            has_cuda = torch.cuda.is_available()
+        self.device_timing = device_timing and has_cuda
+        self.sync = sync and has_cuda
+        self.track_memory = track_memory and has_cuda
         self.timers = OrderedDict()
         self.active_timers = {}
-        self.current_timer = None  # Used for the context manager functionality
         self._after_print_hooks = []
+        self._local = threading.local()
+        self.step: Optional[int] = None
+        self.trace_writer = TraceWriter(trace_path) if enabled and trace_path is not None else None
+        # finished spans waiting to be written to the trace
+        self._trace_spans: List[_Span] = []
+        self.trace_buffer = trace_buffer
+        self._origin = time.perf_counter()
+
+    def _get_stack(self) -> List[_Span]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def set_step(self, step: int):
+        """Step the following spans are tagged with in the trace"""
+        self.step = step
 
     def start(self, timer_name):
+        if not self.enabled:
+            return
+        if self.sync:
+            import torch
+            torch.cuda.synchronize()
+        stack = self._get_stack()
+        parent = stack[-1] if len(stack) > 0 else None
+        span = _Span(timer_name, parent, self.step)
         if timer_name not in self.timers:
-            self.timers[timer_name] = deque(maxlen=self.max_buffer)
-        self.active_timers[timer_name] = time.time()
+            self.timers[timer_name] = SpanStats(self.max_buffer, None if parent is None else parent.name)
+        if self.track_memory:
+            import torch
+            if parent is None:
+                # resetting in nested spans would lose the peak of the spans around them
+                torch.cuda.reset_peak_memory_stats()
+            span.peak_memory = torch.cuda.memory_allocated()
+            span.start_peak_memory = torch.cuda.max_memory_allocated()
+        if self.device_timing:
+            import torch
+            span.start_event = torch.cuda.Event(enable_timing=True)
+            span.start_event.record()
+        stack.append(span)
+        self.active_timers[timer_name] = span
+        span.start_time = time.perf_counter()
 
     def cancel(self, timer_name):
         """Cancel an active timer."""
         if timer_name in self.active_timers:
-            del self.active_timers[timer_name]
+            self._pop(self.active_timers.pop(timer_name))
+
+    def _pop(self, span: _Span):
+        stack = self._get_stack()
+        for idx in range(len(stack) - 1, -1, -1):
+            if stack[idx] is span:
+                del stack[idx]
+                break
 
     def stop(self, timer_name):
+        if not self.enabled:
+            return
+        end_time = time.perf_counter()
         if timer_name not in self.active_timers:
             raise ValueError(f"Timer '{timer_name}' was not started!")
+        span = self.active_timers.pop(timer_name)
+        if self.sync:
+            import torch
+            torch.cuda.synchronize()
+            end_time = time.perf_counter()
+        span.end_time = end_time
+        if span.start_event is not None:
+            import torch
+            span.end_event = torch.cuda.Event(enable_timing=True)
+            span.end_event.record()
+        if span.peak_memory is not None:
+            import torch
+            peak_memory = torch.cuda.max_memory_allocated()
+            if peak_memory > span.start_peak_memory:
+                # went past everything before it, the peak is its own
+                span.peak_memory = peak_memory
+            else:
+                span.peak_memory = max(span.peak_memory, torch.cuda.memory_allocated())
+            if span.parent is not None and span.parent.peak_memory is not None:
+                span.parent.peak_memory = max(span.parent.peak_memory, span.peak_memory)
+        self._pop(span)
 
-        elapsed_time = time.time() - self.active_timers[timer_name]
-        self.timers[timer_name].append(elapsed_time)
-
-        # Clean up active timers
-        del self.active_timers[timer_name]
-
-        # Check if this timer's buffer exceeds max_buffer and remove the oldest if it does
-        if len(self.timers[timer_name]) > self.max_buffer:
-            self.timers[timer_name].popleft()
+        self.timers[timer_name].add(span)
+        if self.trace_writer is not None:
+            self._trace_spans.append(span)
+            if len(self._trace_spans) >= self.trace_buffer:
+                self.flush_trace()
 
     def add_after_print_hook(self, hook):
         self._after_print_hooks.append(hook)
 
+    def _get_sorted_names(self) -> List[str]:
+        # every span under the one it was first opened in, longest at top
+        children = OrderedDict()
+        for timer_name, stats in self.timers.items():
+            if len(stats.times) == 0:
+                continue
+            parent = stats.parent if stats.parent in self.timers and stats.parent != timer_name else None
+            children.setdefault(parent, []).append(timer_name)
+        names = []
+
+        def add(parent, seen):
+            for timer_name in sorted(children.get(parent, []), key=lambda x: sum(self.timers[x].times), reverse=True):
+                if timer_name in seen:
+                    continue
+                seen.add(timer_name)
+                names.append(timer_name)
+                add(timer_name, seen)
+
+        seen = set()
+        add(None, seen)
+        # spans whose parents only ever ran inside them
+        for timer_name in sorted(self.timers.keys(), key=lambda x: sum(self.timers[x].times), reverse=True):
+            if timer_name not in seen and len(self.timers[timer_name].times) > 0:
+                seen.add(timer_name)
+                names.append(timer_name)
+                add(timer_name, seen)
+        return names
+
+    def _get_depth(self, timer_name: str) -> int:
+        depth = 0
+        seen = {timer_name}
+        parent = self.timers[timer_name].parent
+        while parent is not None and parent in self.timers and parent not in seen:
+            seen.add(parent)
+            depth += 1
+            parent = self.timers[parent].parent
+        return depth
+
+    def get_stats(self) -> OrderedDict:
+        """name -> avg, max, count, total in seconds, device_avg in seconds and peak_memory in bytes when tracked"""
+        stats_dict = OrderedDict()
+        for timer_name in self._get_sorted_names():
+            stats = self.timers[timer_name]
+            stats_dict[timer_name] = {
+                'avg': stats.avg,
+                'max': stats.max,
+                'count': stats.count,
+                'total': stats.total,
+                'device_avg': stats.device_avg,
+                'peak_memory': stats.peak_memory_max,
+                'parent': stats.parent,
+            }
+        return stats_dict
+
+    def get_log_dict(self) -> OrderedDict:
+        """The stats flattened for the logger"""
+        log_dict = OrderedDict()
+        for timer_name, stats in self.get_stats().items():
+            log_dict[f"timing/{timer_name}"] = stats['avg']
+            if stats['device_avg'] is not None:
+                log_dict[f"timing_device/{timer_name}"] = stats['device_avg']
+            if stats['peak_memory'] is not None:
+                log_dict[f"memory_peak_gb/{timer_name}"] = stats['peak_memory'] / (1024 ** 3)
+        return log_dict
+
     def print(self):
+        if not self.enabled:
+            return
         if not is_ui:
             print(f"\nTimer '{self.name}':")
         timing_dict = {}
-        # sort by longest at top
-        for timer_name, timings in sorted(self.timers.items(), key=lambda x: sum(x[1]), reverse=True):
-            avg_time = sum(timings) / len(timings)
-            
+        for timer_name, stats in self.get_stats().items():
             if not is_ui:
-                print(f" - {avg_time:.4f}s avg - {timer_name}, num = {len(timings)}")
-            timing_dict[timer_name] = avg_time
+                indent = '  ' * self._get_depth(timer_name)
+                line = f" - {indent}{stats['avg']:.4f}s avg - {timer_name}, num = {stats['count']}"
+                if stats['device_avg'] is not None:
+                    line += f", device {stats['device_avg']:.4f}s avg"
+                if stats['peak_memory'] is not None:
+                    line += f", peak {stats['peak_memory'] / (1024 ** 3):.2f}GB"
+                print(line)
+            timing_dict[timer_name] = stats['avg']
 
         for hook in self._after_print_hooks:
             hook(timing_dict)
         if not is_ui:
             print('')
+        self.flush_trace()
+
+    def _get_trace_event(self, span: _Span) -> dict:
+        args = {'path': span.path}
+        if span.step is not None:
+            args['step'] = span.step
+        device_time = span.get_device_time()
+        if device_time is not None:
+            args['device_time'] = device_time
+        if span.peak_memory is not None:
+            args['peak_memory'] = span.peak_memory
+        return {
+            'name': span.name,
+            'cat': 'host' if span.parent is None else span.parent.name,
+            'ph': 'X',
+            # microseconds
+            'ts': (span.start_time - self._origin) * 1e6,
+            'dur': (span.end_time - span.start_time) * 1e6,
+            'pid': self.trace_writer.pid,
+            'tid': span.thread,
+            'args': args,
+        }
+
+    def flush_trace(self):
+        """Writes the finished spans to the trace file"""
+        if self.trace_writer is None or len(self._trace_spans) == 0:
+            return
+        events = [self._get_trace_event(span) for span in self._trace_spans]
+        self._trace_spans.clear()
+        self.trace_writer.write(events)
+
+    def close(self):
+        self.flush_trace()
+        if self.trace_writer is not None:
+            self.trace_writer.close()
 
     def reset(self):
+        self.flush_trace()
         self.timers.clear()
         self.active_timers.clear()
+        self._get_stack().clear()
 
     def __call__(self, timer_name):
         """Enable the use of the Timer class as a context manager."""
-        self.current_timer = timer_name
-        self.start(timer_name)
-        return self
-
-    def __enter__(self):
-        pass
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            # No exceptions, stop the timer normally
-            self.stop(self.current_timer)
-        else:
-            # There was an exception, cancel the timer
-            self.cancel(self.current_timer)
+        if not self.enabled:
+            return _NULL_SPAN
+        return _SpanContext(self, timer_name)
@@ -0,0 +1,177 @@
+from typing import Optional
+
+import torch
+
+# Samplers for the indices into the noise scheduler's timesteps the train loop trains on. Every strategy
+# is a probability mass over the indices. It is built once on the device as a cdf and sampled by
+# inverting the cdf with searchsorted, a whole accumulation window at a time, and the batches of the
+# window are handed out from that draw. pmf gives the probability of drawn indices, importance_weights
+# turns it into the loss weight that makes the draw count as a uniform one over the sampled range.
+
+
+class TimestepSampler:
+    def __init__(
+            self,
+            num_timesteps: int,
+            device,
+            window_size: int = 1,
+            generator: Optional[torch.Generator] = None
+    ):
+        self.num_timesteps = num_timesteps
+        self.device = torch.device(device)
+        # number of batches drawn at once
+        self.window_size = max(1, window_size)
+        self.generator = generator
+
+        probabilities = self.get_probabilities().to(torch.float64)
+        if probabilities.shape != (num_timesteps,) or probabilities.sum() <= 0:
+            raise ValueError(f"{self.__class__.__name__} has no probability mass over {num_timesteps} timesteps")
+        probabilities = probabilities / probabilities.sum()
+        cdf = torch.cumsum(probabilities, dim=0)
+        cdf[-1] = 1.0
+        self.probabilities = probabilities.to(device=self.device, dtype=torch.float32)
+        self.cdf = cdf.to(device=self.device, dtype=torch.float32)
+        # weight of every index so the expected weight under this sampler is 1
+        support = (probabilities > 0).sum()
+        weights = torch.where(probabilities > 0, 1.0 / (support * probabilities), torch.zeros_like(probabilities))
+        self.weights = weights.to(device=self.device, dtype=torch.float32)
+
+        self._buffer: Optional[torch.Tensor] = None
+        self._buffer_pos = 0
+
+    def get_probabilities(self) -> torch.Tensor:
+        """Unnormalized mass of every index, on the cpu. Override in subclass"""
+        raise NotImplementedError
+
+    def draw(self, num: int) -> torch.Tensor:
+        """num independent indices with one searchsorted"""
+        u = torch.rand((num,), device=self.device, generator=self.generator)
+        indices = torch.searchsorted(self.cdf, u, right=True)
+        return indices.clamp_(0, self.num_timesteps - 1)
+
+    def sample(self, batch_size: int) -> torch.Tensor:
+        """Indices for one batch, taken from the current window and drawing the next one when it runs out"""
+        if self._buffer is None or self._buffer_pos + batch_size > self._buffer.shape[0]:
+            self._buffer = self.draw(batch_size * self.window_size)
+            self._buffer_pos = 0
+        indices = self._buffer[self._buffer_pos:self._buffer_pos + batch_size]
+        self._buffer_pos += batch_size
+        return indices
+
+    def pmf(self, indices: torch.Tensor) -> torch.Tensor:
+        return self.probabilities[indices.to(self.device, dtype=torch.long)]
+
+    def importance_weights(self, indices: torch.Tensor) -> torch.Tensor:
+        return self.weights[indices.to(self.device, dtype=torch.long)]
+
+
+class ConstantTimestepSampler(TimestepSampler):
+    def __init__(self, index: int, num_timesteps: int, device, **kwargs):
+        self.index = index
+        super().__init__(num_timesteps, device, **kwargs)
+
+    def get_probabilities(self) -> torch.Tensor:
+        probabilities = torch.zeros(self.num_timesteps, dtype=torch.float64)
+        probabilities[self.index] = 1.0
+        return probabilities
+
+    def draw(self, num: int) -> torch.Tensor:
+        return torch.full((num,), self.index, device=self.device, dtype=torch.long)
+
+
+class UniformTimestepSampler(TimestepSampler):
+    # low and high are inclusive
+    def __init__(self, low: int, high: int, num_timesteps: int, device, **kwargs):
+        self.low = low
+        self.high = high
+        super().__init__(num_timesteps, device, **kwargs)
+
+    def get_probabilities(self) -> torch.Tensor:
+        probabilities = torch.zeros(self.num_timesteps, dtype=torch.float64)
+        probabilities[self.low:self.high + 1] = 1.0
+        return probabilities
+
+
+class CubicTimestepSampler(TimestepSampler):
+    """
+    Cubic sampling from the diffusers training code, favoring earlier timesteps for content and later ones
+    for style. See section 3.4 of https://arxiv.org/abs/2302.08453. A uniform u becomes u ** 3 (content) or
+    1 - u ** 3 (style), scaled to scale_timesteps, mapped from [0, scale_timesteps - 1] to
+    [min_index, max_index], truncated and clamped. The mass below is that mapping solved for u.
+    """
+
+    def __init__(
+            self,
+            content_or_style: str,
+            min_index: int,
+            max_index: int,
+            scale_timesteps: int,
+            num_timesteps: int,
+            device,
+            **kwargs
+    ):
+        if content_or_style not in ['content', 'style']:
+            raise ValueError(f"Unknown content_or_style {content_or_style}")
+        self.content_or_style = content_or_style
+        self.min_index = min_index
+        self.max_index = max_index
+        self.scale_timesteps = scale_timesteps
+        super().__init__(num_timesteps, device, **kwargs)
+
+    def get_probabilities(self) -> torch.Tensor:
+        probabilities = torch.zeros(self.num_timesteps, dtype=torch.float64)
+        if self.max_index <= self.min_index:
+            probabilities[self.max_index] = 1.0
+            return probabilities
+        scale = (self.max_index - self.min_index) / (self.scale_timesteps - 1)
+        k = torch.arange(self.min_index, self.max_index + 1, dtype=torch.float64)
+        # P(index <= k) = P(u ** 3 < a) for content and P(1 - u ** 3 < a) for style
+        a = ((k + 1 - self.min_index) / (scale * self.scale_timesteps)).clamp(0.0, 1.0)
+        if self.content_or_style == 'content':
+            cdf = a ** (1 / 3)
+        else:
+            cdf = 1 - (1 - a) ** (1 / 3)
+        # everything past max is clamped onto it
+        cdf[-1] = 1.0
+        probabilities[self.min_index:self.max_index + 1] = torch.diff(cdf, prepend=cdf.new_zeros(1))
+        return probabilities
+
+
+def get_timestep_sampler(
+        train_config,
+        content_or_style: str,
+        num_train_timesteps: int,
+        min_noise_steps: int,
+        max_noise_steps: int,
+        device,
+) -> TimestepSampler:
+    """The sampler the train config asks for over num_train_timesteps scheduler timesteps"""
+    kwargs = {'window_size': train_config.gradient_accumulation}
+    if train_config.timestep_type == 'next_sample':
+        # -1 for 0 idx, -1 so we can step
+        return UniformTimestepSampler(0, num_train_timesteps - 3, num_train_timesteps, device, **kwargs)
+    if train_config.timestep_type == 'one_step':
+        return ConstantTimestepSampler(0, num_train_timesteps, device, **kwargs)
+    if content_or_style in ['style', 'content']:
+        return CubicTimestepSampler(
+            content_or_style,
+            min_noise_steps,
+            max_noise_steps,
+            train_config.num_train_timesteps,
+            num_train_timesteps,
+            device,
+            **kwargs
+        )
+    if content_or_style == 'balanced':
+        if min_noise_steps == max_noise_steps:
+            return ConstantTimestepSampler(min_noise_steps, num_train_timesteps, device, **kwargs)
+        # todo, some schedulers use indices, otheres use timesteps. Not sure what to do here
+        min_idx = min_noise_steps + 1
+        max_idx = max_noise_steps - 1
+        if train_config.noise_scheduler == 'flowmatch':
+            # flowmatch uses indices, so we need to use indices
+            min_idx = min_noise_steps
+            max_idx = max_noise_steps
+        # the upper bound is exclusive, like randint
+        return UniformTimestepSampler(min_idx, max_idx - 1, num_train_timesteps, device, **kwargs)
+    raise ValueError(f"Unknown content_or_style {content_or_style}")
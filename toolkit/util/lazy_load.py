@@ -0,0 +1,162 @@
+import glob
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from tqdm import tqdm
+
+from toolkit.print import print_acc
+
+# Loads a model without ever holding all of its full precision weights. The module tree is built on the
+# meta device, then every transformer block is read from the memory mapped safetensors files, cast,
+# handed to process_block (quantize, pin, ...) and the files are closed again so their pages can be
+# released before the next block. Peak host memory is about one block plus the processed model.
+
+
+def get_safetensors_weight_map(folder: str) -> Dict[str, str]:
+    """key -> safetensors file in folder, from the index when there is one"""
+    index_files = glob.glob(os.path.join(folder, "*.safetensors.index.json"))
+    if len(index_files) > 0:
+        with open(index_files[0], "r") as f:
+            weight_map = json.load(f)["weight_map"]
+        return {key: os.path.join(folder, filename) for key, filename in weight_map.items()}
+    weight_map = {}
+    for file_path in sorted(glob.glob(os.path.join(folder, "*.safetensors"))):
+        with safe_open(file_path, framework="pt", device="cpu") as f:
+            for key in f.keys():
+                weight_map[key] = file_path
+    return weight_map
+
+
+def get_pretrained_folder(name_or_path: str, subfolder: Optional[str] = None) -> Optional[str]:
+    """
+    Local folder with the diffusers format weights of a model, downloading a hub repo if needed.
+    None if there are no safetensors weights to load lazily.
+    """
+    if os.path.isfile(name_or_path):
+        # single file checkpoints have their own key format
+        return None
+    if os.path.isdir(name_or_path):
+        folder = name_or_path
+    else:
+        from huggingface_hub import snapshot_download
+        allow_patterns = [f"{subfolder}/*"] if subfolder is not None else None
+        folder = snapshot_download(name_or_path, allow_patterns=allow_patterns)
+    if subfolder is not None:
+        folder = os.path.join(folder, subfolder)
+    if len(glob.glob(os.path.join(folder, "*.safetensors"))) == 0:
+        return None
+    return folder
+
+
+class _OpenFiles:
+    # safe_open handles, kept for one block at a time
+    def __init__(self):
+        self.handles = {}
+
+    def get_tensor(self, file_path: str, key: str) -> torch.Tensor:
+        if file_path not in self.handles:
+            self.handles[file_path] = safe_open(file_path, framework="pt", device="cpu")
+        return self.handles[file_path].get_tensor(key)
+
+    def close(self):
+        # dropping the handles unmaps the files
+        self.handles.clear()
+
+
+def _is_keep_in_fp32(key: str, keep_in_fp32_modules: List[str]) -> bool:
+    parts = key.split(".")
+    return any(module in parts for module in keep_in_fp32_modules)
+
+
+def load_model_lazily(
+        build_fn: Callable[[], torch.nn.Module],
+        weight_map: Dict[str, str],
+        dtype: torch.dtype,
+        block_names: Optional[List[str]] = None,
+        process_block: Optional[Callable[[torch.nn.Module], None]] = None,
+) -> torch.nn.Module:
+    """
+    Builds the model with build_fn on the meta device and loads its weights from weight_map one block at a
+    time. block_names are the attributes holding the block lists, every block is passed to process_block
+    as soon as it is loaded. Everything outside the blocks is loaded last and is not processed.
+    """
+    from accelerate import init_empty_weights
+
+    with init_empty_weights():
+        model = build_fn()
+    keep_in_fp32_modules = getattr(model, "_keep_in_fp32_modules", None) or []
+
+    # (prefix, module) in load order, the blocks first and the rest of the model last
+    units: List[Tuple[str, torch.nn.Module]] = []
+    for block_name in block_names or []:
+        block_list = getattr(model, block_name, None)
+        if block_list is None:
+            continue
+        for i, block in enumerate(block_list):
+            units.append((f"{block_name}.{i}.", block))
+    block_prefixes = tuple(prefix for prefix, _ in units)
+
+    keys_by_unit: Dict[str, List[str]] = {prefix: [] for prefix, _ in units}
+    rest_keys = []
+    for key in weight_map.keys():
+        prefix = next((p for p in block_prefixes if key.startswith(p)), None)
+        if prefix is None:
+            rest_keys.append(key)
+        else:
+            keys_by_unit[prefix].append(key)
+
+    open_files = _OpenFiles()
+    unexpected_keys = []
+
+    def load_unit(prefix: str, module: torch.nn.Module, keys: List[str]):
+        state_dict = {}
+        for key in keys:
+            tensor = open_files.get_tensor(weight_map[key], key)
+            if tensor.is_floating_point() and not _is_keep_in_fp32(key, keep_in_fp32_modules):
+                tensor = tensor.to(dtype)
+            state_dict[key[len(prefix):]] = tensor
+        result = module.load_state_dict(state_dict, strict=False, assign=True)
+        unexpected_keys.extend(prefix + key for key in result.unexpected_keys)
+        open_files.close()
+
+    for prefix, block in tqdm(units, desc="Loading blocks"):
+        load_unit(prefix, block, keys_by_unit[prefix])
+        if process_block is not None:
+            process_block(block)
+    load_unit("", model, rest_keys)
+
+    if len(unexpected_keys) > 0:
+        print_acc(f"Lazy load ignored {len(unexpected_keys)} unexpected keys, eg {unexpected_keys[:3]}")
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    missing += [name for name, buffer in model.named_buffers() if buffer.is_meta]
+    if len(missing) > 0:
+        raise ValueError(f"Lazy load is missing {len(missing)} weights, eg {missing[:3]}")
+    return model
+
+
+def load_pretrained_lazily(
+        model_class,
+        name_or_path: str,
+        subfolder: Optional[str],
+        dtype: torch.dtype,
+        block_names: Optional[List[str]] = None,
+        process_block: Optional[Callable[[torch.nn.Module], None]] = None,
+) -> Optional[torch.nn.Module]:
+    """
+    load_model_lazily for a diffusers model class and a pretrained folder or hub repo. Returns None when
+    the weights are not in a format that can be loaded this way, so the caller uses from_pretrained.
+    """
+    folder = get_pretrained_folder(name_or_path, subfolder)
+    if folder is None:
+        return None
+    config = model_class.load_config(folder)
+    return load_model_lazily(
+        lambda: model_class.from_config(config),
+        get_safetensors_weight_map(folder),
+        dtype,
+        block_names=block_names,
+        process_block=process_block,
+    )
@@ -1,5 +1,6 @@
-from fnmatch import fnmatch
-from typing import List, Optional, Union, TYPE_CHECKING
+import time
+from functools import partial
+from typing import List, Optional, Tuple, Union, TYPE_CHECKING
 import torch
 
 from optimum.quanto.quantize import _quantize_submodule
@@ -14,11 +15,15 @@ from tqdm import tqdm
 from safetensors.torch import load_file
 from huggingface_hub import hf_hub_download
 
+from toolkit.module_index import PatternFilter
 from toolkit.print import print_acc
+from toolkit.util.threads import split_cores_thread_pool
 import os
 
 if TYPE_CHECKING:
+    from toolkit.lora_special import LoRASpecialNetwork
     from toolkit.models.base_model import BaseModel
+    from toolkit.util.quantize_cache import QuantizedModelCache
 
 # the quantize function in quanto had a bug where it was using exclude instead of include
 
@@ -60,6 +65,29 @@ def get_qtype(qtype: Union[str, qtype]) -> qtype:
         return qtype
 
 
+def select_modules(
+    model: torch.nn.Module,
+    include: Optional[Union[str, List[str]]] = None,
+    exclude: Optional[Union[str, List[str]]] = None,
+) -> List[Tuple[str, torch.nn.Module]]:
+    """The (name, module) pairs of model that match include and do not match exclude, fnmatch style"""
+    if include is not None:
+        include = [include] if isinstance(include, str) else include
+    if exclude is not None:
+        exclude = [exclude] if isinstance(exclude, str) else exclude
+    # compiled once, exclude has one entry per lora module with an accuracy recovery adapter
+    include_filter = PatternFilter(include) if include is not None else None
+    exclude_filter = PatternFilter(exclude) if exclude is not None else None
+    selected = []
+    for name, m in model.named_modules():
+        if include_filter is not None and not include_filter.matches(name):
+            continue
+        if exclude_filter is not None and exclude_filter.matches(name):
+            continue
+        selected.append((name, m))
+    return selected
+
+
 def quantize(
     model: torch.nn.Module,
     weights: Optional[Union[str, qtype, aotype]] = None,
@@ -94,17 +122,7 @@ def quantize(
             Patterns constituting the denylist. If provided, module names must not match
             any patterns from the denylist.
     """
-    if include is not None:
-        include = [include] if isinstance(include, str) else include
-    if exclude is not None:
-        exclude = [exclude] if isinstance(exclude, str) else exclude
-    for name, m in model.named_modules():
-        if include is not None and not any(
-            fnmatch(name, pattern) for pattern in include
-        ):
-            continue
-        if exclude is not None and any(fnmatch(name, pattern) for pattern in exclude):
-            continue
+    for name, m in select_modules(model, include, exclude):
         try:
             # check if m is QLinear or QConv2d
             if m.__class__.__name__ in Q_MODULES:
@@ -126,10 +144,194 @@ def quantize(
             # raise e
 
 
+def quantize_block(
+    block: torch.nn.Module,
+    weights: Union[qtype, aotype],
+    device: Union[str, torch.device],
+    dtype: torch.dtype,
+) -> float:
+    """Quantizes and freezes one block on device and moves it back to the cpu, returns the seconds it took"""
+    start = time.perf_counter()
+    block.to(device, dtype=dtype, non_blocking=True)
+    quantize(block, weights=weights)
+    freeze(block)
+    block.to("cpu", non_blocking=True)
+    return time.perf_counter() - start
+
+
+def quantize_blocks(
+    blocks: List[torch.nn.Module],
+    weights: Union[qtype, aotype],
+    device: Union[str, torch.device],
+    dtype: torch.dtype,
+    num_workers: Optional[int] = None,
+) -> List[float]:
+    """
+    Moves every block to device, quantizes and freezes it and moves it back to the cpu. Blocks do not
+    share modules, so when the device is the cpu they are quantized on a thread pool. Returns the
+    seconds each block took and prints the slowest ones.
+    """
+    device = torch.device(device)
+    quantize_fn = partial(quantize_block, weights=weights, device=device, dtype=dtype)
+
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    start = time.perf_counter()
+    if device.type == "cpu" and num_workers > 1 and len(blocks) > 1:
+        # the quantize kernels release the gil, the workers split the intra op threads between them
+        with split_cores_thread_pool(num_workers, thread_name_prefix="quantize") as executor:
+            timings = list(tqdm(executor.map(quantize_fn, blocks), total=len(blocks)))
+    else:
+        timings = [quantize_fn(block) for block in tqdm(blocks)]
+    total = time.perf_counter() - start
+
+    if len(timings) > 0:
+        slowest = sorted(range(len(timings)), key=lambda i: timings[i], reverse=True)[:3]
+        print_acc(
+            f" - quantized {len(blocks)} blocks in {total:.2f}s, "
+            f"{sum(timings) / len(timings):.3f}s per block, slowest: "
+            + ", ".join(f"block {i} {timings[i]:.3f}s" for i in slowest)
+        )
+    return timings
+
+
+def load_accuracy_recovery_adapter(
+    base_model: "BaseModel",
+    model_to_quantize: torch.nn.Module,
+) -> "LoRASpecialNetwork":
+    """Builds the accuracy recovery adapter of the model config and applies it to model_to_quantize"""
+    from toolkit.config_modules import NetworkConfig
+    from toolkit.lora_special import LoRASpecialNetwork
+
+    # we need to load and quantize with an accuracy recovery adapter
+    # todo handle hf repos
+    load_lora_path = base_model.model_config.accuracy_recovery_adapter
+
+    if not os.path.exists(load_lora_path):
+        # not local file, grab from the hub
+
+        path_split = load_lora_path.split("/")
+        if len(path_split) > 3:
+            raise ValueError(
+                "The accuracy recovery adapter path must be a local path or for a hf repo, 'username/repo_name/filename.safetensors'."
+            )
+        repo_id = f"{path_split[0]}/{path_split[1]}"
+        print_acc(f"Grabbing lora from the hub: {load_lora_path}")
+        new_lora_path = hf_hub_download(
+            repo_id,
+            filename=path_split[-1],
+        )
+        # replace the path
+        load_lora_path = new_lora_path
+
+    # build the lora config based on the lora weights
+    lora_state_dict = load_file(load_lora_path)
+    
+    if hasattr(base_model, "convert_lora_weights_before_load"):
+        lora_state_dict = base_model.convert_lora_weights_before_load(lora_state_dict)
+    
+    network_config = {
+        "type": "lora",
+        "network_kwargs": {"only_if_contains": []},
+        "transformer_only": False,
+    }
+    first_key = list(lora_state_dict.keys())[0]
+    first_weight = lora_state_dict[first_key]
+    # if it starts with lycoris and includes lokr
+    if first_key.startswith("lycoris") and any(
+        "lokr" in key for key in lora_state_dict.keys()
+    ):
+        network_config["type"] = "lokr"
+    
+    network_kwargs = {}
+
+    # find firse loraA weight
+    if network_config["type"] == "lora":
+        linear_dim = None
+        for key, value in lora_state_dict.items():
+            if "lora_A" in key:
+                linear_dim = int(value.shape[0])
+                break
+        linear_alpha = linear_dim
+        network_config["linear"] = linear_dim
+        network_config["linear_alpha"] = linear_alpha
+
+        # we build the keys to match every key
+        only_if_contains = []
+        for key in lora_state_dict.keys():
+            contains_key = key.split(".lora_")[0]
+            if contains_key not in only_if_contains:
+                only_if_contains.append(contains_key)
+
+        network_kwargs["only_if_contains"] = only_if_contains
+    elif network_config["type"] == "lokr":
+        # find the factor
+        largest_factor = 0
+        for key, value in lora_state_dict.items():
+            if "lokr_w1" in key:
+                factor = int(value.shape[0])
+                if factor > largest_factor:
+                    largest_factor = factor
+        network_config["lokr_full_rank"] = True
+        network_config["lokr_factor"] = largest_factor
+
+        only_if_contains = []
+        for key in lora_state_dict.keys():
+            if "lokr_w1" in key:
+                contains_key = key.split(".lokr_w1")[0]
+                contains_key = contains_key.replace("lycoris_", "")
+                if contains_key not in only_if_contains:
+                    only_if_contains.append(contains_key)
+        network_kwargs["only_if_contains"] = only_if_contains
+    
+    if hasattr(base_model, 'target_lora_modules'):
+        network_kwargs['target_lin_modules'] = base_model.target_lora_modules
+
+    # todo auto grab these
+    # get dim and scale
+    network_config = NetworkConfig(**network_config)
+
+    network = LoRASpecialNetwork(
+        text_encoder=None,
+        unet=model_to_quantize,
+        lora_dim=network_config.linear,
+        multiplier=1.0,
+        alpha=network_config.linear_alpha,
+        # conv_lora_dim=self.network_config.conv,
+        # conv_alpha=self.network_config.conv_alpha,
+        train_unet=True,
+        train_text_encoder=False,
+        network_config=network_config,
+        network_type=network_config.type,
+        transformer_only=network_config.transformer_only,
+        is_transformer=base_model.is_transformer,
+        base_model=base_model,
+        **network_kwargs
+    )
+    network.apply_to(
+        None, model_to_quantize, apply_text_encoder=False, apply_unet=True
+    )
+    network.force_to(base_model.device_torch, dtype=base_model.torch_dtype)
+    network._update_torch_multiplier()
+    network.load_weights(lora_state_dict)
+    network.eval()
+    network.is_active = True
+    network.can_merge_in = False
+    base_model.accuracy_recovery_adapter = network
+    return network
+
+
 def quantize_model(
     base_model: "BaseModel",
     model_to_quantize: torch.nn.Module,
+    cache: Optional["QuantizedModelCache"] = None,
+    blocks_quantized: bool = False,
 ):
+    """
+    Quantizes the model in place. With a cache from get_quantize_cache, the quantized weights are
+    saved so load_quantized_model can skip all of this next time. blocks_quantized skips the
+    transformer blocks, for models that were quantized block by block while loading.
+    """
     from toolkit.dequantize import patch_dequantization_on_save
 
     if not hasattr(base_model, "get_transformer_block_names"):
@@ -141,124 +343,7 @@ def quantize_model(
     patch_dequantization_on_save(model_to_quantize)
 
     if base_model.model_config.accuracy_recovery_adapter is not None:
-        from toolkit.config_modules import NetworkConfig
-        from toolkit.lora_special import LoRASpecialNetwork
-
-        # we need to load and quantize with an accuracy recovery adapter
-        # todo handle hf repos
-        load_lora_path = base_model.model_config.accuracy_recovery_adapter
-
-        if not os.path.exists(load_lora_path):
-            # not local file, grab from the hub
-
-            path_split = load_lora_path.split("/")
-            if len(path_split) > 3:
-                raise ValueError(
-                    "The accuracy recovery adapter path must be a local path or for a hf repo, 'username/repo_name/filename.safetensors'."
-                )
-            repo_id = f"{path_split[0]}/{path_split[1]}"
-            print_acc(f"Grabbing lora from the hub: {load_lora_path}")
-            new_lora_path = hf_hub_download(
-                repo_id,
-                filename=path_split[-1],
-            )
-            # replace the path
-            load_lora_path = new_lora_path
-
-        # build the lora config based on the lora weights
-        lora_state_dict = load_file(load_lora_path)
-        
-        if hasattr(base_model, "convert_lora_weights_before_load"):
-            lora_state_dict = base_model.convert_lora_weights_before_load(lora_state_dict)
-        
-        network_config = {
-            "type": "lora",
-            "network_kwargs": {"only_if_contains": []},
-            "transformer_only": False,
-        }
-        first_key = list(lora_state_dict.keys())[0]
-        first_weight = lora_state_dict[first_key]
-        # if it starts with lycoris and includes lokr
-        if first_key.startswith("lycoris") and any(
-            "lokr" in key for key in lora_state_dict.keys()
-        ):
-            network_config["type"] = "lokr"
-        
-        network_kwargs = {}
-
-        # find firse loraA weight
-        if network_config["type"] == "lora":
-            linear_dim = None
-            for key, value in lora_state_dict.items():
-                if "lora_A" in key:
-                    linear_dim = int(value.shape[0])
-                    break
-            linear_alpha = linear_dim
-            network_config["linear"] = linear_dim
-            network_config["linear_alpha"] = linear_alpha
-
-            # we build the keys to match every key
-            only_if_contains = []
-            for key in lora_state_dict.keys():
-                contains_key = key.split(".lora_")[0]
-                if contains_key not in only_if_contains:
-                    only_if_contains.append(contains_key)
-
-            network_kwargs["only_if_contains"] = only_if_contains
-        elif network_config["type"] == "lokr":
-            # find the factor
-            largest_factor = 0
-            for key, value in lora_state_dict.items():
-                if "lokr_w1" in key:
-                    factor = int(value.shape[0])
-                    if factor > largest_factor:
-                        largest_factor = factor
-            network_config["lokr_full_rank"] = True
-            network_config["lokr_factor"] = largest_factor
-
-            only_if_contains = []
-            for key in lora_state_dict.keys():
-                if "lokr_w1" in key:
-                    contains_key = key.split(".lokr_w1")[0]
-                    contains_key = contains_key.replace("lycoris_", "")
-                    if contains_key not in only_if_contains:
-                        only_if_contains.append(contains_key)
-            network_kwargs["only_if_contains"] = only_if_contains
-        
-        if hasattr(base_model, 'target_lora_modules'):
-            network_kwargs['target_lin_modules'] = base_model.target_lora_modules
-
-        # todo auto grab these
-        # get dim and scale
-        network_config = NetworkConfig(**network_config)
-
-        network = LoRASpecialNetwork(
-            text_encoder=None,
-            unet=model_to_quantize,
-            lora_dim=network_config.linear,
-            multiplier=1.0,
-            alpha=network_config.linear_alpha,
-            # conv_lora_dim=self.network_config.conv,
-            # conv_alpha=self.network_config.conv_alpha,
-            train_unet=True,
-            train_text_encoder=False,
-            network_config=network_config,
-            network_type=network_config.type,
-            transformer_only=network_config.transformer_only,
-            is_transformer=base_model.is_transformer,
-            base_model=base_model,
-            **network_kwargs
-        )
-        network.apply_to(
-            None, model_to_quantize, apply_text_encoder=False, apply_unet=True
-        )
-        network.force_to(base_model.device_torch, dtype=base_model.torch_dtype)
-        network._update_torch_multiplier()
-        network.load_weights(lora_state_dict)
-        network.eval()
-        network.is_active = True
-        network.can_merge_in = False
-        base_model.accuracy_recovery_adapter = network
+        network = load_accuracy_recovery_adapter(base_model, model_to_quantize)
 
         # quantize it
         lora_exclude_modules = []
@@ -297,14 +382,17 @@ def quantize_model(
             block_list = getattr(model_to_quantize, name, None)
             if block_list is not None:
                 all_blocks += list(block_list)
-        base_model.print_and_status_update(
-            f" - quantizing {len(all_blocks)} transformer blocks"
-        )
-        for block in tqdm(all_blocks):
-            block.to(base_model.device_torch, dtype=base_model.torch_dtype, non_blocking=True)
-            quantize(block, weights=quantization_type)
-            freeze(block)
-            block.to("cpu", non_blocking=True)
+        if not blocks_quantized:
+            base_model.print_and_status_update(
+                f" - quantizing {len(all_blocks)} transformer blocks"
+            )
+            quantize_blocks(
+                all_blocks,
+                quantization_type,
+                base_model.device_torch,
+                base_model.torch_dtype,
+                num_workers=base_model.model_config.quantize_num_workers,
+            )
 
         # todo, on extras find a universal way to quantize them on device and move them back to their original
         # device without having to move the transformer blocks to the device first
@@ -312,3 +400,34 @@ def quantize_model(
         # model_to_quantize.to(base_model.device_torch, dtype=base_model.torch_dtype)
         quantize(model_to_quantize, weights=quantization_type)
         freeze(model_to_quantize)
+
+    if cache is not None:
+        base_model.print_and_status_update(" - saving quantized model to cache")
+        cache.save(model_to_quantize)
+
+
+def load_quantized_model(
+    base_model: "BaseModel",
+    cache: Optional["QuantizedModelCache"],
+) -> Optional[torch.nn.Module]:
+    """
+    Loads a model quantize_model saved to the cache, with the weights memory mapped. Returns None when
+    there is nothing cached yet, or the cache cannot be used, so the caller loads and quantizes as usual.
+    """
+    from toolkit.dequantize import patch_dequantization_on_save
+
+    if cache is None or not cache.exists():
+        return None
+    base_model.print_and_status_update(f" - loading quantized model from cache {cache.folder}")
+    try:
+        model = cache.load()
+    except Exception as e:
+        print_acc(f"Failed to load quantized model from cache, quantizing again: {e}")
+        return None
+    for param in model.parameters():
+        param.requires_grad = False
+    patch_dequantization_on_save(model)
+    if base_model.model_config.accuracy_recovery_adapter is not None:
+        # the weights under the adapter are already quantized, it only has to be applied
+        load_accuracy_recovery_adapter(base_model, model)
+    return model
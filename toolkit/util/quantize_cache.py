@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import TYPE_CHECKING, Optional, Type
+
+import torch
+
+from toolkit.paths import TOOLKIT_ROOT
+from toolkit.print import print_acc
+
+if TYPE_CHECKING:
+    from toolkit.models.base_model import BaseModel
+
+# Quantized models saved after the first quantization so later jobs can skip loading the full precision
+# weights and quantizing them again.
+#   <cache dir>/<key>/
+#       quantized.pt     config, quanto quantization map and the raw quantized state dict
+#       meta.json        what the key was built from, for humans
+# The state dict holds the quanto _data / _scale tensors and torchao tensors as they are, so it is
+# saved with torch.save and memory mapped on load straight into a module tree built on the meta device.
+
+QUANTIZE_CACHE_VERSION = 1
+DEFAULT_QUANTIZE_CACHE_DIR = os.path.join(TOOLKIT_ROOT, "cache", "quantized")
+QUANTIZE_CACHE_WEIGHTS_NAME = "quantized.pt"
+QUANTIZE_CACHE_META_NAME = "meta.json"
+
+# files that change when the weights change
+SOURCE_EXTENSIONS = ('.safetensors', '.bin', '.pt', '.pth', '.json')
+
+
+def _get_file_fingerprint(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def get_source_fingerprint(path: Optional[str]) -> Optional[dict]:
+    """Identifies a local file, folder or hub repo without hashing the weights"""
+    if path is None:
+        return None
+    if os.path.isfile(path):
+        return {'path': os.path.abspath(path), **_get_file_fingerprint(path)}
+    if os.path.isdir(path):
+        files = {}
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(SOURCE_EXTENSIONS):
+                    file_path = os.path.join(root, filename)
+                    files[os.path.relpath(file_path, path)] = _get_file_fingerprint(file_path)
+        return {'path': os.path.abspath(path), 'files': files}
+    fingerprint = {'name': path}
+    try:
+        # the snapshot folder of a downloaded repo is named after its commit
+        from huggingface_hub import try_to_load_from_cache
+        cached = try_to_load_from_cache(path, "model_index.json")
+        if isinstance(cached, str):
+            fingerprint['revision'] = os.path.basename(os.path.dirname(cached))
+    except Exception:
+        pass
+    return fingerprint
+
+
+def _get_library_versions() -> dict:
+    versions = {'torch': torch.__version__}
+    for name in ['optimum.quanto', 'torchao']:
+        try:
+            from importlib.metadata import version
+            versions[name] = version(name.replace('.', '-'))
+        except Exception:
+            versions[name] = None
+    return versions
+
+
+class QuantizedModelCache:
+    def __init__(self, cache_dir: str, key_data: dict, model_class: Type[torch.nn.Module]):
+        self.key_data = key_data
+        # built from the saved config on load
+        self.model_class = model_class
+        key_string = json.dumps(key_data, sort_keys=True, default=str)
+        self.key = hashlib.sha256(key_string.encode('utf-8')).hexdigest()[:32]
+        self.folder = os.path.join(cache_dir, self.key)
+        self.weights_path = os.path.join(self.folder, QUANTIZE_CACHE_WEIGHTS_NAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.weights_path)
+
+    def save(self, model: torch.nn.Module):
+        from optimum.quanto import quantization_map
+
+        # the quantized tensors, not the dequantized ones patch_dequantization_on_save returns
+        get_state_dict = getattr(model, 'orig_state_dict', model.state_dict)
+        config = getattr(model, 'config', None)
+        payload = {
+            'version': QUANTIZE_CACHE_VERSION,
+            'config': dict(config) if config is not None else None,
+            'quantization_map': quantization_map(model),
+            'state_dict': {key: value.detach().to('cpu') for key, value in get_state_dict().items()},
+        }
+        tmp_folder = self.folder + '.tmp'
+        if os.path.exists(tmp_folder):
+            shutil.rmtree(tmp_folder)
+        os.makedirs(tmp_folder)
+        torch.save(payload, os.path.join(tmp_folder, QUANTIZE_CACHE_WEIGHTS_NAME))
+        with open(os.path.join(tmp_folder, QUANTIZE_CACHE_META_NAME), 'w') as f:
+            json.dump({'class': model.__class__.__name__, 'key': self.key_data}, f, indent=2, default=str)
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.replace(tmp_folder, self.folder)
+        print_acc(f" - saved quantized model to cache {self.folder}")
+
+    def load(self) -> torch.nn.Module:
+        from accelerate import init_empty_weights
+        from optimum.quanto.quantize import _quantize_submodule
+        from optimum.quanto.tensor import qtypes
+
+        payload = torch.load(self.weights_path, map_location='cpu', mmap=True, weights_only=False)
+        if payload['version'] != QUANTIZE_CACHE_VERSION or payload['config'] is None:
+            raise ValueError(f"Quantize cache {self.folder} cannot be loaded by this version")
+        with init_empty_weights():
+            model = self.model_class.from_config(payload['config'])
+        # swap in the quanto modules, their weights are set by the state dict
+        modules = dict(model.named_modules())
+        for name, qconfig in payload['quantization_map'].items():
+            activations = qconfig.get('activations', 'none')
+            _quantize_submodule(
+                model,
+                name,
+                modules[name],
+                weights=qtypes[qconfig['weights']],
+                activations=None if activations == 'none' else qtypes[activations],
+            )
+        # the memory mapped tensors become the params, nothing is copied
+        model.load_state_dict(payload['state_dict'], strict=True, assign=True)
+        for name, param in model.named_parameters():
+            if param.is_meta:
+                raise ValueError(f"Quantize cache {self.folder} does not have {name}")
+        return model
+
+
+def get_quantize_cache(
+        base_model: 'BaseModel',
+        source_path: str,
+        model_class: Type[torch.nn.Module]
+) -> Optional[QuantizedModelCache]:
+    """The cache entry for quantizing the model at source_path with the model config, None if caching is off"""
+    model_config = base_model.model_config
+    if not model_config.quantize_cache:
+        return None
+    key_data = {
+        'version': QUANTIZE_CACHE_VERSION,
+        'class': model_class.__name__,
+        'source': get_source_fingerprint(source_path),
+        'qtype': model_config.qtype,
+        # the adapter decides which modules are quantized with qtype and which are excluded
+        'accuracy_recovery_adapter': get_source_fingerprint(model_config.accuracy_recovery_adapter),
+        'quantize_kwargs': model_config.quantize_kwargs,
+        'dtype': str(base_model.torch_dtype),
+        'block_names': base_model.get_transformer_block_names(),
+        'libraries': _get_library_versions(),
+    }
+    cache_dir = model_config.quantize_cache_dir or DEFAULT_QUANTIZE_CACHE_DIR
+    return QuantizedModelCache(cache_dir, key_data, model_class)
@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+
+@contextmanager
+def split_cores_thread_pool(num_workers: int, thread_name_prefix: str = ''):
+    """
+    ThreadPoolExecutor whose workers split the torch intra-op threads between them, so workers
+    running large ops at the same time do not each try to use every core. The cap is set in each
+    worker. Some torch builds share the setting across the process, so the caller's value is
+    restored when the pool is done.
+    """
+    num_workers = max(1, num_workers)
+    prev_num_threads = torch.get_num_threads()
+    threads_per_worker = max(1, prev_num_threads // num_workers)
+
+    def init_worker():
+        torch.set_num_threads(threads_per_worker)
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=num_workers,
+                thread_name_prefix=thread_name_prefix,
+                initializer=init_worker
+        ) as executor:
+            yield executor
+    finally:
+        torch.set_num_threads(prev_num_threads)
@@ -24,6 +24,26 @@ export async function GET(request: NextRequest, { params }: { params: { jobID: s
     return NextResponse.json({ files: [] });
   }
 
+  // the trainer keeps a manifest of its saves, use it instead of walking the folder when it exists
+  const manifestPath = path.join(jobFolder, 'checkpoints.json');
+  if (fs.existsSync(manifestPath)) {
+    try {
+      const manifest = JSON.parse(fs.readFileSync(manifestPath, 'utf-8'));
+      const fileObjects: { path: string; size: number }[] = [];
+      for (const artifact of manifest.artifacts || []) {
+        for (const file of artifact.files || []) {
+          if (file.path.endsWith('.safetensors')) {
+            fileObjects.push({ path: path.join(jobFolder, file.path), size: file.size });
+          }
+        }
+      }
+      fileObjects.sort((a, b) => a.path.localeCompare(b.path));
+      return NextResponse.json({ files: fileObjects });
+    } catch (e) {
+      console.error('Error reading checkpoint manifest:', e);
+    }
+  }
+
   // find all safetensors files in the job folder
   let files = fs
     .readdirSync(jobFolder)